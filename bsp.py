@@ -21,12 +21,30 @@ Architecture:
 - KasManager: Handles KAS build system operations  
 - EnvironmentManager: Manages build environment variables with expansion
 - PathResolver: Utility for path resolution and validation
+- ProcessRunner: Asyncio runner for concurrent kas, docker and bitbake processes
+- BuildLogArchive: Compressed, indexed per-build command logs
+- BuildFingerprint: Build input fingerprint for skipping up-to-date BSP builds
+- LayerStore: Layer repository worktrees shared between build directories
+- BuildDispatcher: Cache-affinity placement of BSP builds on several build hosts
 
 Typical Usage:
   $ python bsp.py list                    # List available BSPs
   $ python bsp.py build <bsp_name>        # Build a specific BSP
   $ python bsp.py shell <bsp_name>        # Enter interactive shell for BSP
   $ python bsp.py export <bsp_name>       # Export BSP configuration
+  $ python bsp.py logs <bsp_name> --errors # Show errors of the latest build log
+  $ python bsp.py layers sync --all       # Prepare shared layer worktrees
+  $ python bsp.py patches check --all     # Verify all patches apply
+  $ python bsp.py lock --all              # Pin floating refs in KAS lock files
+  $ python bsp.py offline-check --all     # Verify DL_DIR holds every needed download
+  $ python bsp.py downloads check --fix   # Remove partial and stale DL_DIR entries
+  $ python bsp.py du --all                # Show disk usage of all build paths
+  $ python bsp.py metrics serve           # Export build and cache metrics to Prometheus
+  $ python bsp.py containers build --all  # Pre-build all container images
+  $ python bsp.py sstate serve            # Share the local sstate cache over HTTP
+  $ python bsp.py dispatch --all          # Build all BSPs on the configured build hosts
+  $ python bsp.py plan --all -j 4         # Estimate a rebuild of all BSPs with 4 jobs
+  $ python bsp.py watch <bsp_name>        # Revalidate KAS includes on every edit
 
 Configuration:
   Uses YAML configuration files (default: bsp-registry.yml) to define:
@@ -35,25 +53,67 @@ Configuration:
   - Cache directories and build parameters
   - Environment variables with expansion support (e.g., $ENV{HOME})
   - Container definitions for different build environments
+  - Included registry files (includes: registry.d/*.yml), loaded per BSP through an index
 """
 
 import subprocess
 import os
 import sys
+import signal
+import time
+import asyncio
 import logging
 import argparse
-import dacite
 import tempfile
 import re
+import gzip
+import json
+import bisect
+import heapq
+import hashlib
+import shutil
+import errno
+import difflib
+import typing
+import dataclasses
+import shlex
+import contextlib
+import cProfile
+import pickle
+import select
+import struct
+import ctypes
+import concurrent.futures
+import threading
+import fcntl
+import socket
+import ipaddress
+import hmac
+import sqlite3
+import http.client
+import http.server
 
 import yaml
+from collections import deque
+from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from urllib.parse import urlparse, quote, unquote
+from typing import List, Optional, Dict, Any, Deque, TextIO, BinaryIO, Iterable, Tuple, Set
 
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
 
 # =============================================================================
-# Logging Colors
+# Optional Compression Support
+# =============================================================================
+
+try:
+    import zstandard
+    ZSTANDARD_AVAILABLE = True
+except ImportError:
+    ZSTANDARD_AVAILABLE = False
+
+# =============================================================================
+# Logging Formatters
 # =============================================================================
 
 try:
@@ -88,10 +148,47 @@ class ColoramaFormatter(logging.Formatter):
     RESET = Style.RESET_ALL if COLORAMA_AVAILABLE else '\033[0m'
     
     def format(self, record):
+        # Color a copy: the record is shared by all handlers and must stay unchanged
         color = self.COLOR_MAP.get(record.levelno, '')
-        record.levelname = f"{color}{record.levelname}{self.RESET}"
-        record.msg = f"{color}{record.msg}{self.RESET}"
-        return super().format(record)
+        colored = logging.makeLogRecord(record.__dict__)
+        colored.levelname = f"{color}{record.levelname}{self.RESET}"
+        colored.msg = f"{color}{record.getMessage()}{self.RESET}"
+        colored.args = None
+        return super().format(colored)
+
+# Fields added to every JSON log event, e.g. the BSP being built
+log_context: Dict[str, Any] = {}
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as one JSON object per line (--log-format json).
+    
+    Every event has time (UTC, ISO 8601), level, logger and message. The
+    fields of log_context and the structured fields passed with extra=
+    (bsp, phase, duration, exit_code) are added when present, so log
+    shippers do not need to parse messages.
+    """
+
+    FIELDS = ('bsp', 'phase', 'duration', 'exit_code')
+
+    def format(self, record):
+        event = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        event.update(log_context)
+        for name in self.FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                event[name] = value
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+# Logger of command completion events (phase, duration and exit code of each child process)
+process_log = logging.getLogger("bsp.process")
     
 # =============================================================================
 # Exception Hierarchy
@@ -257,6 +354,26 @@ class Registry:
     """
     bsp: Optional[List[BSP]] = field(default_factory=empty_list)
 
+@dataclass
+class BuildHost:
+    """
+    Build host that BSP builds can be dispatched to.
+    
+    Attributes:
+        name: Unique host name (also used as the Buildbot worker name)
+        ssh: SSH destination ([user@]host); None runs the host as a local subprocess
+        path: Checkout of this repository on the host
+        registry: Registry file relative to path
+        jobs: Number of BSP builds run concurrently on the host
+        python: Python interpreter used to run bsp.py on the host
+    """
+    name: str
+    ssh: Optional[str] = None
+    path: str = "."
+    registry: str = "bsp-registry.yml"
+    jobs: int = 1
+    python: str = "python3"
+
 @dataclass
 class RegistryRoot:
     """
@@ -267,11 +384,28 @@ class RegistryRoot:
         registry: Main registry data containing BSP definitions
         containers: Dictionary of container definitions keyed by name
         environment: Global environment variables for all builds (supports expansion)
+        hosts: Build hosts for distributed builds
+        includes: Registry files with further BSP definitions (glob patterns relative to this file)
     """
     specification: Specification
-    registry: Registry
+    registry: Registry = field(default_factory=Registry)
     containers: Optional[Dict[str, Docker]] = field(default_factory=empty_dict)
     environment: Optional[List[EnvironmentVariable]] = field(default_factory=empty_list)
+    hosts: Optional[List[BuildHost]] = field(default_factory=empty_list)
+    includes: Optional[List[str]] = field(default_factory=empty_list)
+
+@dataclass
+class RegistryFile:
+    """
+    Registry file included from the root registry.
+    
+    Included files only hold BSP definitions; containers, environment and
+    hosts are defined in the root registry.
+    
+    Attributes:
+        registry: Registry data containing BSP definitions
+    """
+    registry: Registry = field(default_factory=Registry)
 
 # =============================================================================
 # YAML Configuration Parser with Container Support
@@ -311,1321 +445,8544 @@ def parse_yaml_file(yaml_string: str) -> Dict[Any, Any]:
         SystemExit: If YAML parsing fails due to malformed content
     """
     try:
-        return yaml.safe_load(yaml_string)
+        return yaml.load(yaml_string, Loader=RegistryLoader)
     except yaml.YAMLError as e:
         logging.error(f"Failed to parse YAML: {e}")
         sys.exit(1)
 
-def convert_containers_list_to_dict(containers_list: List[Dict[str, Any]]) -> Dict[str, Docker]:
+class _MarkedDict(dict):
+    """Mapping loaded from YAML that remembers where it and each of its keys start."""
+    mark: Tuple[int, int] = (0, 0)
+    key_marks: Dict[Any, Tuple[int, int]] = {}
+
+class RegistryLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    """Safe YAML loader (libyaml when available) recording line and column of mappings and keys."""
+
+    def construct_marked_map(self, node):
+        data = _MarkedDict()
+        data.mark = (node.start_mark.line + 1, node.start_mark.column + 1)
+        yield data
+        data.update(self.construct_mapping(node))
+        data.key_marks = {key_node.value: (key_node.start_mark.line + 1, key_node.start_mark.column + 1)
+                          for key_node, _ in node.value if isinstance(key_node, yaml.ScalarNode)}
+
+RegistryLoader.add_constructor('tag:yaml.org,2002:map', RegistryLoader.construct_marked_map)
+
+class RegistryValidator:
     """
-    Convert containers list format to dictionary format for dacite.
-    
-    The YAML format uses a list of dictionaries where each dictionary has one key
-    (the container name). This function converts it to a dictionary keyed by container name.
-    
-    Example input:
-        [
-            {"ubuntu-20.04": {"file": "...", "image": "...", "args": [...]}},
-            {"ubuntu-22.04": {"file": "...", "image": "...", "args": [...]}}
-        ]
-    
-    Example output:
-        {
-            "ubuntu-20.04": {"file": "...", "image": "...", "args": [...]},
-            "ubuntu-22.04": {"file": "...", "image": "...", "args": [...]}
-        }
+    Single-pass validator building the registry dataclasses from parsed YAML.
     
-    Args:
-        containers_list: List of container definitions in YAML format
+    A converter is compiled once per type from the dataclass fields and
+    their type hints (dataclasses, Optional, List, Dict and scalar types)
+    and cached, so validating a registry is a single walk over the parsed
+    data that creates the dataclass instances directly. Locations are
+    passed down as (parent, key, container) chains and only turned into a
+    key path and YAML line/column when a problem is reported. All errors
+    of a file are collected; unknown keys are ignored with a warning that
+    suggests the closest known key.
+    """
+
+    _converters: Dict[Any, Any] = {}
+    _INVALID = object()
+
+    def __init__(self, filename: Path):
+        """
+        Args:
+            filename: Registry file name used in messages
+        """
+        self.filename = filename
+        self.errors: List[str] = []
+        self.warnings: List[str] = []
+
+    @staticmethod
+    def describe(location: Optional[tuple], value: Any = None) -> Tuple[str, Tuple[int, int]]:
+        """
+        Get the key path and YAML position of a location.
         
-    Returns:
-        Dictionary mapping container names to Docker configurations
-    """
-    containers_dict = {}
-    
-    for container_item in containers_list:
-        for container_name, container_config in container_item.items():
-            if isinstance(container_config, dict):
-                # Convert to Docker dataclass
-                containers_dict[container_name] = Docker(
-                    image=container_config.get('image'),
-                    file=container_config.get('file'),
-                    args=[DockerArg(name=arg['name'], value=arg['value']) 
-                          for arg in container_config.get('args', [])]
-                )
+        Args:
+            location: (parent, key, container) chain, None for the document root
+            value: Value at the location (its own position is used if known)
+            
+        Returns:
+            Tuple of key path (e.g. 'registry.bsp[2].build') and (line, column)
+        """
+        mark = getattr(value, 'mark', None)
+        keys = []
+        node = location
+        while node:
+            parent, key, container = node
+            keys.append(f"[{key}]" if isinstance(key, int) else f".{key}")
+            if mark is None:
+                if isinstance(key, int):
+                    mark = getattr(container[key], 'mark', None)
+                else:
+                    mark = getattr(container, 'key_marks', {}).get(key)
+            node = parent
+        path = "".join(reversed(keys)).lstrip('.') or "registry root"
+        return path, mark or (1, 1)
+
+    def error(self, location: Optional[tuple], value: Any, message: str) -> object:
+        """Record an error at a location and return the invalid value marker."""
+        path, (line, column) = self.describe(location, value)
+        self.errors.append(f"{self.filename}:{line}:{column}: {path}: {message}")
+        return self._INVALID
+
+    def warning(self, location: Optional[tuple], message: str) -> None:
+        """Record a warning at a location."""
+        path, (line, column) = self.describe(location)
+        self.warnings.append(f"{self.filename}:{line}:{column}: {path}: {message}")
+
+    @staticmethod
+    def type_name(value: Any) -> str:
+        """YAML flavoured name of the type of a loaded value."""
+        if value is None:
+            return "null"
+        if isinstance(value, dict):
+            return "mapping"
+        if isinstance(value, list):
+            return "list"
+        return type(value).__name__
+
+    @classmethod
+    def compile(cls, tp: Any):
+        """
+        Get the converter for a type.
+        
+        Converters are called as converter(validator, value, location) and
+        return the converted value or the invalid value marker.
+        """
+        converter = cls._converters.get(tp)
+        if converter is None:
+            converter = cls._compile(tp)
+            cls._converters[tp] = converter
+        return converter
+
+    @classmethod
+    def _compile(cls, tp: Any):
+        invalid = cls._INVALID
+        origin = typing.get_origin(tp)
+        args = typing.get_args(tp)
+
+        if dataclasses.is_dataclass(tp):
+            hints = typing.get_type_hints(tp)
+            # (name, converter, has default, optional): missing optional keys without default become None
+            specs = []
+            for f in dataclasses.fields(tp):
+                has_default = f.default is not dataclasses.MISSING or f.default_factory is not dataclasses.MISSING
+                optional = type(None) in typing.get_args(hints[f.name])
+                specs.append((f.name, cls.compile(hints[f.name]), has_default, optional))
+            known = {name for name, _, _, _ in specs}
+            names = sorted(known)
+
+            def convert_dataclass(validator, value, location):
+                if not isinstance(value, dict):
+                    return validator.error(location, value, f"expected a mapping, got {validator.type_name(value)}")
+                kwargs = {}
+                valid = True
+                for name, converter, has_default, optional in specs:
+                    if name in value:
+                        result = converter(validator, value[name], (location, name, value))
+                        if result is invalid:
+                            valid = False
+                        else:
+                            kwargs[name] = result
+                    elif optional and not has_default:
+                        kwargs[name] = None
+                    elif not has_default:
+                        validator.error(location, value, f"missing required key '{name}'")
+                        valid = False
+                if not known.issuperset(value):
+                    for key in value:
+                        if key in known:
+                            continue
+                        close = difflib.get_close_matches(str(key), names, n=1)
+                        suggestion = f", did you mean '{close[0]}'?" if close else ""
+                        validator.warning((location, key, value), f"unknown key ignored{suggestion}")
+                return tp(**kwargs) if valid else invalid
+            return cls._generate_fast_path(tp, hints, convert_dataclass)
+
+        if origin is typing.Union:
+            members = [arg for arg in args if arg is not type(None)]
+            inner = cls.compile(members[0]) if len(members) == 1 else cls.compile(Any)
+
+            def convert_optional(validator, value, location):
+                return None if value is None else inner(validator, value, location)
+            return convert_optional
+
+        if origin is list:
+            item_type = args[0] if args else Any
+            convert_item = cls.compile(item_type)
+            scalar_items = item_type in (str, int, bool)
+
+            def convert_list(validator, value, location):
+                if not isinstance(value, list):
+                    return validator.error(location, value, f"expected a list, got {validator.type_name(value)}")
+                if scalar_items and all(type(item) is item_type for item in value):
+                    return list(value)
+                items = [convert_item(validator, item, (location, number, value))
+                         for number, item in enumerate(value)]
+                return invalid if any(item is invalid for item in items) else items
+            return convert_list
+
+        if origin is dict:
+            convert_value = cls.compile(args[1] if args else Any)
+
+            def convert_dict(validator, value, location):
+                if not isinstance(value, dict):
+                    return validator.error(location, value, f"expected a mapping, got {validator.type_name(value)}")
+                result = {}
+                valid = True
+                for key, item in value.items():
+                    if not isinstance(key, str):
+                        validator.error((location, key, value), None, "key is not a string")
+                        valid = False
+                        continue
+                    result[key] = convert_value(validator, item, (location, key, value))
+                    valid = valid and result[key] is not invalid
+                return result if valid else invalid
+            return convert_dict
+
+        if tp is Any:
+            return lambda validator, value, location: value
+
+        accepted = (int, float) if tp is float else tp
+
+        def convert_scalar(validator, value, location):
+            if type(value) is tp or (isinstance(value, accepted) and not isinstance(value, bool)):
+                return value
+            return validator.error(location, None, f"expected {tp.__name__}, got {validator.type_name(value)}")
+        return convert_scalar
+
+    @classmethod
+    def _generate_fast_path(cls, tp: Any, hints: Dict[str, Any], convert_dataclass):
+        """
+        Generate a specialised converter for valid mappings of a dataclass.
+        
+        The generated function checks scalar fields inline with exact type
+        tests, converts nested fields with their compiled converters and
+        calls the constructor with positional arguments. Anything unusual
+        (unknown or missing keys, wrong scalar types) is handed to the
+        generic convert_dataclass, which reports the problems.
+        """
+        fields = dataclasses.fields(tp)
+        if any(not f.init for f in fields):
+            return convert_dataclass
+        missing = object()
+        namespace = {'known': {f.name for f in fields}, 'missing': missing, 'invalid': cls._INVALID,
+                     'generic': convert_dataclass, 'data_class': tp}
+        lines = ["def convert_fast(validator, value, location):",
+                 "    if not isinstance(value, dict) or not known.issuperset(value):",
+                 "        return generic(validator, value, location)"]
+        nested = []
+        for number, f in enumerate(fields):
+            var = f"v{number}"
+            hint = hints[f.name]
+            members = [arg for arg in typing.get_args(hint) if arg is not type(None)]
+            optional = typing.get_origin(hint) is typing.Union and type(None) in typing.get_args(hint)
+            base = members[0] if optional and len(members) == 1 else hint
+            lines.append(f"    {var} = value.get({f.name!r}, missing)")
+            if f.default_factory is not dataclasses.MISSING:
+                namespace[f"d{number}"] = f.default_factory
+                default = f"{var} = d{number}()"
+            elif f.default is not dataclasses.MISSING:
+                namespace[f"d{number}"] = f.default
+                default = f"{var} = d{number}"
+            elif optional:
+                default = f"{var} = None"
             else:
-                logging.warning(f"Invalid container configuration for {container_name}, skipping")
-    
-    return containers_dict
+                lines.append(f"    if {var} is missing: return generic(validator, value, location)")
+                default = None
+            if base in (str, int, bool):
+                if default:
+                    lines.append(f"    if {var} is missing: {default}")
+                namespace[f"t{number}"] = base
+                check = f"type({var}) is not t{number}"
+                if optional or f.default is None:
+                    check = f"{var} is not None and {check}"
+                lines.append(f"    if {check}: return generic(validator, value, location)")
+            else:
+                namespace[f"c{number}"] = cls.compile(hint)
+                nested.append((number, f.name, default))
+        # Defaults are already converted values: only keys present in the mapping go through converters
+        for number, name, default in nested:
+            convert = f"v{number} = c{number}(validator, v{number}, (location, {name!r}, value))"
+            if default:
+                lines.append(f"    if v{number} is missing: {default}")
+                lines.append(f"    else: {convert}")
+            else:
+                lines.append(f"    {convert}")
+        if nested:
+            lines.append(f"    if {' or '.join(f'v{number} is invalid' for number, _, _ in nested)}: return invalid")
+        lines.append(f"    return data_class({', '.join(f'v{number}' for number in range(len(fields)))})")
+        exec("\n".join(lines), namespace)
+        return namespace['convert_fast']
+
+    def validate(self, data_class: Any, data: Any) -> Any:
+        """
+        Convert loaded YAML data into a dataclass instance.
+        
+        Args:
+            data_class: Dataclass of the document root
+            data: Loaded YAML document
+            
+        Returns:
+            Dataclass instance, or None if errors were recorded
+        """
+        result = self.compile(data_class)(self, data, None)
+        return None if result is self._INVALID else result
 
-def get_registry_from_yaml_file(filename: Path) -> RegistryRoot:
+def get_registry_from_yaml_file(filename: Path, data_class: Any = RegistryRoot) -> RegistryRoot:
     """
-    Parse YAML file into structured RegistryRoot object using dacite.
+    Parse YAML file into structured RegistryRoot object.
     
-    This function converts the raw YAML dictionary into strongly-typed
-    dataclasses with comprehensive type checking and validation.
+    The YAML dictionary is converted into strongly-typed dataclasses with
+    type checking by RegistryValidator. Errors carry the line and column
+    of the offending key; unknown keys are reported as warnings.
     
     Args:
         filename: Path to registry YAML file
+        data_class: Dataclass of the document (RegistryFile for included files)
         
     Returns:
-        Structured registry configuration as RegistryRoot object
+        Structured registry configuration as RegistryRoot object (or data_class)
         
     Raises:
         SystemExit: If configuration is invalid, malformed, or missing required fields
     """
     yaml_string = read_yaml_file(filename)
     yaml_dict = parse_yaml_file(yaml_string)
+    validator = RegistryValidator(filename)
 
-    # Pre-process containers list to dictionary format if needed
-    if 'containers' in yaml_dict and isinstance(yaml_dict['containers'], list):
+    # The YAML format lists containers as single-key mappings; merge them into one mapping
+    containers = yaml_dict.get('containers') if isinstance(yaml_dict, dict) else None
+    if isinstance(containers, list):
         logging.debug("Converting containers list to dictionary format")
-        yaml_dict['containers'] = convert_containers_list_to_dict(yaml_dict['containers'])
-
-    try:
-        # Use dacite to convert dictionary to strongly-typed dataclass
-        # strict=False allows forward compatibility with new fields
-        cfg = dacite.Config(strict=False)
-        ast = dacite.from_dict(data_class=RegistryRoot, data=yaml_dict, config=cfg)
-        return ast
-    except dacite.UnexpectedDataError as e:
-        logging.error(f"Configuration error in {filename}: Unknown fields found - {e}")
+        merged = _MarkedDict()
+        merged.mark = getattr(containers, 'mark', yaml_dict.key_marks.get('containers', (1, 1)))
+        merged.key_marks = {}
+        for item in containers:
+            if not isinstance(item, dict):
+                validator.error((None, 'containers', yaml_dict), None,
+                                f"expected a mapping of container name to configuration, "
+                                f"got {validator.type_name(item)}")
+                continue
+            merged.update(item)
+            merged.key_marks.update(item.key_marks)
+        yaml_dict['containers'] = merged
+
+    registry = validator.validate(data_class, yaml_dict)
+    for message in validator.warnings:
+        logging.warning(message)
+    if validator.errors or registry is None:
+        for message in validator.errors:
+            logging.error(message)
+        logging.error(f"Invalid registry configuration in {filename}")
         sys.exit(1)
-    except dacite.WrongTypeError as e:
-        logging.error(f"Type error in configuration {filename}: Field type mismatch - {e}")
-        sys.exit(1)
-    except dacite.MissingValueError as e:
-        logging.error(f"Missing value in configuration {filename}: Required field missing - {e}")
-        sys.exit(1)
-
-# =============================================================================
-# Docker Operations
-# =============================================================================
+    return registry
 
-def build_docker(dockerfile_dir: str, dockerfile: str, tag: str, 
-                 build_args: Optional[List[DockerArg]] = None) -> None:
+class RegistryIndex:
     """
-    Build Docker image from Dockerfile with comprehensive validation.
+    Name to file index of the BSPs defined in included registry files.
     
-    This function handles the complete Docker build process including:
-    - Prerequisite validation (directory and file existence)
-    - Build argument processing
-    - Directory context management
-    - Error handling and logging
-    
-    Args:
-        dockerfile_dir: Directory containing Dockerfile and build context
-        dockerfile: Dockerfile name (e.g., 'Dockerfile')
-        tag: Image tag for the built image (e.g., 'my-bsp:latest')
-        build_args: List of Docker build arguments for parameterized builds
-        
-    Raises:
-        SystemExit: If Docker build fails, prerequisites are missing, or Docker is unavailable
+    The index is stored as .<registry name>.index.json next to the root
+    registry. It records every BSP name with its file and description, and
+    the modification time and size of every included file. An index is
+    reused while the set of included files and their stamps are unchanged,
+    so commands that need one BSP parse only the file defining it and
+    listing BSPs parses no included file at all. Files parsed while
+    rebuilding the index are kept in memory for the running command.
     """
-    logging.info(f"Building docker container {tag} using {dockerfile}")
-    
-    # Validate prerequisites before attempting build
-    if not os.path.isdir(dockerfile_dir):
-        logging.error(f"Docker build directory does not exist: {dockerfile_dir}")
-        sys.exit(1)
-        
-    dockerfile_path = os.path.join(dockerfile_dir, dockerfile)
-    if not os.path.isfile(dockerfile_path):
-        logging.error(f"Dockerfile not found: {dockerfile_path}")
-        sys.exit(1)
 
-    original_dir = os.getcwd()
-    try:
-        # Change to Dockerfile directory for proper build context
-        os.chdir(dockerfile_dir)
-        
-        # Build docker command with all required parameters
-        cmd = ["docker", "build", "-f", dockerfile, "-t", tag]
-        
-        # Add build arguments if provided (for parameterized Docker builds)
-        if build_args:
-            for argument in build_args:
-                cmd.extend(["--build-arg", f"{argument.name}={argument.value}"])
+    VERSION = 1
 
-        cmd.extend(["."])  # Build context is current directory
-        
-        logging.info(f"Running: {' '.join(cmd)}")
-        
-        # Execute build command with real-time output capture
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
-        logging.info("Docker build completed successfully")
+    def __init__(self, root_path: Path, patterns: List[str]):
+        """
+        Args:
+            root_path: Root registry file
+            patterns: Include patterns relative to the root registry directory
+        """
+        self.root_path = Path(root_path)
+        self.base_dir = self.root_path.parent
+        self.patterns = patterns
+        self.path = self.base_dir / f".{self.root_path.name}.index.json"
+        self.entries: Dict[str, Dict[str, str]] = {}
+        self._parsed: Dict[str, List[BSP]] = {}
+
+    def files(self) -> List[str]:
+        """
+        Included registry files, relative to the root registry directory.
         
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Docker build failed with return code {e.returncode}")
-        logging.error(f"Error output: {e.stderr}")
-        sys.exit(1)
-    except Exception as e:
-        logging.error(f"Unexpected error during Docker build: {e}")
-        sys.exit(1)
-    finally:
-        # Always return to original directory regardless of build outcome
-        os.chdir(original_dir)
-
-# =============================================================================
-# Path Resolution Utility
-# =============================================================================
-
-class PathResolver:
-    """
-    Utility class for path resolution and validation.
-    
-    Provides centralized methods for handling path operations with:
-    - Home directory expansion (~/ paths)
-    - Existence and type validation
-    - Directory creation with proper error handling
-    - Consistent path normalization
-    
-    All methods handle path strings with home directory notation and
-    provide consistent behavior across different platforms.
-    """
-    
-    @staticmethod
-    def resolve(path_string: str) -> Path:
+        Raises:
+            SystemExit: If a pattern without wildcards names a missing file
         """
-        Resolve path with ~ expansion to absolute Path object.
+        files = []
+        for pattern in self.patterns:
+            matches = sorted(self.base_dir.glob(pattern))
+            if not matches and not any(char in pattern for char in '*?['):
+                logging.error(f"Included registry file not found: {self.base_dir / pattern}")
+                sys.exit(1)
+            for match in matches:
+                name = match.relative_to(self.base_dir).as_posix()
+                if match.is_file() and match != self.root_path and name not in files:
+                    files.append(name)
+        return files
+
+    def _stamps(self, files: List[str]) -> Dict[str, List[int]]:
+        stamps = {}
+        for name in files:
+            stat = (self.base_dir / name).stat()
+            stamps[name] = [stat.st_mtime_ns, stat.st_size]
+        return stamps
+
+    def load(self) -> Dict[str, Dict[str, str]]:
+        """
+        Load the index, rebuilding it if an included file was added, removed or changed.
         
-        Args:
-            path_string: Path string that may contain ~ for home directory
-            
         Returns:
-            Resolved absolute Path object
+            Index entries ({'file': ..., 'description': ...}) keyed by BSP name
         """
-        return Path(path_string).expanduser().resolve()
-    
-    @staticmethod
-    def resolve_str(path_string: str) -> str:
+        files = self.files()
+        stamps = self._stamps(files)
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == self.VERSION and index.get('files') == stamps:
+                self.entries = index['bsps']
+                return self.entries
+        except (OSError, ValueError, KeyError):
+            pass
+        return self.rebuild(files, stamps)
+
+    def rebuild(self, files: Optional[List[str]] = None,
+                stamps: Optional[Dict[str, List[int]]] = None) -> Dict[str, Dict[str, str]]:
         """
-        Resolve path with ~ expansion to absolute string.
+        Parse all included files and write a new index.
         
-        Args:
-            path_string: Path string that may contain ~ for home directory
-            
-        Returns:
-            Resolved absolute path as string
+        Raises:
+            SystemExit: If an included file is invalid or a BSP is defined twice
         """
-        return str(PathResolver.resolve(path_string))
-    
-    @staticmethod
-    def exists(path_string: str) -> bool:
+        files = self.files() if files is None else files
+        stamps = self._stamps(files) if stamps is None else stamps
+        entries: Dict[str, Dict[str, str]] = {}
+        for name in files:
+            bsps = get_registry_from_yaml_file(self.base_dir / name, RegistryFile).registry.bsp or []
+            for bsp in bsps:
+                if bsp.name in entries:
+                    logging.error(f"BSP {bsp.name} is defined in {entries[bsp.name]['file']} and {name}")
+                    sys.exit(1)
+                entries[bsp.name] = {"file": name, "description": bsp.description}
+            self._parsed[name] = bsps
+        logging.info(f"Indexed {len(entries)} BSPs in {len(files)} included registry files")
+
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": self.VERSION, "files": stamps, "bsps": entries}, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.debug("Cannot write registry index %s: %s", self.path, e)
+        self.entries = entries
+        return entries
+
+    def read_file(self, name: str) -> List[BSP]:
         """
-        Check if path exists after resolving ~ expansion.
+        Get the BSP definitions of an included file.
         
         Args:
-            path_string: Path to check for existence
+            name: File name relative to the root registry directory
             
         Returns:
-            True if path exists, False otherwise
+            BSPs defined in the file
         """
-        return PathResolver.resolve(path_string).exists()
+        if name not in self._parsed:
+            logging.debug("Loading registry file %s", name)
+            with tracer.span("load registry file", "registry", file=name):
+                self._parsed[name] = get_registry_from_yaml_file(self.base_dir / name,
+                                                                 RegistryFile).registry.bsp or []
+        return self._parsed[name]
+
+# =============================================================================
+# Tracing
+# =============================================================================
+
+class _TraceSpan:
+    """Span being recorded by a Tracer (see Tracer.span)."""
+
+    def __init__(self, tracer: 'Tracer', name: str, category: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self) -> '_TraceSpan':
+        self.io = dict(self.tracer.io)
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        duration = time.monotonic() - self.start
+        for key, count in self.tracer.io.items():
+            if count != self.io[key]:
+                self.args[f"{key}_count"] = count - self.io[key]
+        self.tracer.complete(self.name, self.category, self.start, duration, self.args)
+        self.tracer.counter("file accesses", self.tracer.io)
+
+
+class Tracer:
+    """
+    Recorder of spans in Chrome trace-event format (Perfetto, chrome://tracing).
     
-    @staticmethod
-    def is_file(path_string: str) -> bool:
+    Tracing is off by default: span() then returns a shared no-op context
+    manager, so instrumented code pays one attribute check. Once started,
+    spans are recorded on the track of the thread running them and child
+    processes on a track of their own (named after the phase and command).
+    File opens and directory listings are counted through an audit hook;
+    every span records the accesses made while it was open.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events: List[Dict[str, Any]] = []
+        self.io = {"open": 0, "listdir": 0}
+        self._origin = 0.0
+        self._tracks: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def start(self, origin: Optional[float] = None) -> None:
         """
-        Check if path is a file after resolving ~ expansion.
+        Start recording.
         
         Args:
-            path_string: Path to check
-            
-        Returns:
-            True if path exists and is a file, False otherwise
+            origin: Time (time.monotonic()) shown as the start of the trace (default: now)
         """
-        return PathResolver.resolve(path_string).is_file()
-    
-    @staticmethod
-    def is_dir(path_string: str) -> bool:
+        self._origin = time.monotonic() if origin is None else origin
+        self.enabled = True
+        sys.addaudithook(self._audit)
+
+    def _audit(self, event: str, args: Tuple[Any, ...]) -> None:
+        """Count file and directory accesses (called by the interpreter for audited events)."""
+        if not self.enabled:
+            return
+        if event == 'open':
+            self.io['open'] += 1
+        elif event in ('os.listdir', 'os.scandir'):
+            self.io['listdir'] += 1
+
+    def span(self, name: str, category: str, **args: Any) -> Any:
         """
-        Check if path is a directory after resolving ~ expansion.
+        Record the duration of a block as a span.
         
         Args:
-            path_string: Path to check
+            name: Span name
+            category: Span category (e.g. registry, kas, environment)
+            **args: Values shown with the span
             
         Returns:
-            True if path exists and is a directory, False otherwise
+            Context manager recording the span
         """
-        return PathResolver.resolve(path_string).is_dir()
-    
-    @staticmethod
-    def ensure_directory(path_string: str) -> None:
+        if not self.enabled:
+            return _NO_SPAN
+        return _TraceSpan(self, name, category, args)
+
+    def complete(self, name: str, category: str, start: float, duration: float, args: Dict[str, Any],
+                 track: Optional[int] = None, track_name: Optional[str] = None) -> None:
         """
-        Ensure directory exists, create if necessary with parent directories.
+        Record a span whose start and duration are known.
         
-        This method creates the directory and all intermediate directories
-        if they don't exist, similar to 'mkdir -p' command.
+        Args:
+            name: Span name
+            category: Span category
+            start: Start time (time.monotonic())
+            duration: Duration in seconds
+            args: Values shown with the span
+            track: Track of the span (default: the calling thread)
+            track_name: Name of the track
+        """
+        if not self.enabled:
+            return
+        if track is None:
+            track = threading.get_native_id()
+            track_name = track_name or threading.current_thread().name
+        with self._lock:
+            if track not in self._tracks:
+                self._tracks[track] = track_name or str(track)
+            self.events.append({"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": track,
+                                "ts": round((start - self._origin) * 1e6), "dur": round(duration * 1e6),
+                                "args": args})
+
+    def counter(self, name: str, values: Dict[str, int]) -> None:
+        """Record the current values of a counter."""
+        with self._lock:
+            self.events.append({"name": name, "ph": "C", "pid": os.getpid(),
+                                "ts": round((time.monotonic() - self._origin) * 1e6), "args": dict(values)})
+
+    def write(self, path: str) -> None:
+        """
+        Write the recorded events as a Chrome trace file.
         
         Args:
-            path_string: Directory path to ensure existence of
-            
-        Raises:
-            SystemExit: If directory cannot be created due to permissions or I/O errors
+            path: Output file (JSON)
         """
-        path = PathResolver.resolve(path_string)
-        try:
-            path.mkdir(parents=True, exist_ok=True)
-        except (OSError, IOError) as e:
-            logging.error(f"Failed to create directory {path}: {e}")
-            sys.exit(1)
+        metadata = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": "bsp.py"}}]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": track, "args": {"name": name}}
+                     for track, name in self._tracks.items()]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, f)
 
-# Global path resolver instance for consistent path handling
-resolver = PathResolver()
+
+# Context manager returned by Tracer.span while tracing is off
+_NO_SPAN = contextlib.nullcontext()
+
+# Global tracer instance, started by --trace
+tracer = Tracer()
 
 # =============================================================================
-# Environment Variable Management with Expansion
+# Asynchronous Process Runner
 # =============================================================================
 
-class EnvironmentManager:
+class LineHandler:
     """
-    Manager for environment variable configuration in build environments.
-    
-    Handles environment variable setup, validation, and management for:
-    - Build cache directories (DL_DIR, SSTATE_DIR)
-    - Git configuration (GITCONFIG_FILE)
-    - Custom build variables
-    - Container-specific environment settings
-    
-    Supports environment variable expansion in the form of $ENV{VAR_NAME}
-    for referencing system environment variables in configuration.
-    
-    This class ensures consistent environment setup across different
-    build types (native, Docker, kas-container).
+    Base class for consumers of child process output.
+
+    Handlers receive decoded output one line at a time (without the trailing
+    newline) and are closed once the process and its output streams have
+    finished. Several handlers can be attached to the same stream, e.g.
+    console output, a log file and a metrics parser, and one handler can be
+    attached to both stdout and stderr.
     """
-    
-    # Regular expression pattern to match $ENV{VAR_NAME} style variables
-    ENV_VAR_PATTERN = re.compile(r'\$ENV\{([^}]+)\}')
-    
-    def __init__(self, environment_vars: Optional[List[EnvironmentVariable]] = None):
+
+    def handle(self, line: str) -> None:
+        """Process a single line of output."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release resources held by the handler."""
+        pass
+
+class ConsoleLineHandler(LineHandler):
+    """Echo output lines to a console stream (stdout by default)."""
+
+    def __init__(self, stream: Optional[TextIO] = None, prefix: str = ""):
         """
-        Initialize Environment manager with optional variables.
-        
         Args:
-            environment_vars: List of environment variables to manage
+            stream: Text stream to write to (defaults to sys.stdout at write time)
+            prefix: Optional prefix for every line (useful for concurrent children)
         """
-        self.environment_vars = environment_vars or []
-        self._env_dict = self._build_environment_dict()
-        
+        self.stream = stream
+        self.prefix = prefix
+
+    def handle(self, line: str) -> None:
+        stream = self.stream or sys.stdout
+        stream.write(f"{self.prefix}{line}\n")
+        stream.flush()
+
+class CaptureLineHandler(LineHandler):
+    """
+    Collect output lines in memory.
+
+    When max_lines is given only the last max_lines lines are kept, which is
+    enough to report the tail of a failing command without holding its
+    complete output.
+    """
+
+    def __init__(self, max_lines: Optional[int] = None):
+        self.lines: Deque[str] = deque(maxlen=max_lines)
+
+    def handle(self, line: str) -> None:
+        self.lines.append(line)
+
+    @property
+    def text(self) -> str:
+        """Captured output joined into a single string."""
+        if not self.lines:
+            return ""
+        return "\n".join(self.lines) + "\n"
+
+class LoggingLineHandler(LineHandler):
+    """Forward output lines to the logging system."""
+
+    def __init__(self, level: int = logging.DEBUG, prefix: str = ""):
+        self.level = level
+        self.prefix = prefix
+
+    def handle(self, line: str) -> None:
+        logging.log(self.level, "%s%s", self.prefix, line)
+
+class FileLineHandler(LineHandler):
+    """Append output lines to a plain text file."""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def handle(self, line: str) -> None:
+        self._file.write(line + "\n")
+
+    def close(self) -> None:
+        self._file.close()
+
+@dataclass
+class ProcessSpec:
+    """
+    Description of a child process to run.
+
+    Attributes:
+        cmd: Command and arguments
+        cwd: Working directory for the child
+        env: Environment for the child (inherits the current one if None)
+        phase: Phase name used for logging, timeouts and telemetry (e.g. 'build')
+        timeout: Maximum run time in seconds (None for no limit)
+        stdout_handlers: Line handlers for stdout (stdout is inherited if empty)
+        stderr_handlers: Line handlers for stderr (stderr is inherited if empty)
+        interactive: Keep the terminal attached (stdin/stdout/stderr inherited)
+        bsp: BSP the process works for, labelling its log event and metrics
+            (default: the BSP of bsp_context)
+        stdin_chunks: Byte chunks written to stdin (stdin is /dev/null if None)
+        stdout_sink: Binary file receiving stdout unchanged instead of stdout_handlers
+    """
+    cmd: List[str]
+    cwd: Optional[str] = None
+    env: Optional[Dict[str, str]] = None
+    phase: str = "run"
+    timeout: Optional[float] = None
+    stdout_handlers: List[LineHandler] = field(default_factory=empty_list)
+    stderr_handlers: List[LineHandler] = field(default_factory=empty_list)
+    interactive: bool = False
+    bsp: Optional[str] = None
+    stdin_chunks: Optional[Iterable[bytes]] = None
+    stdout_sink: Optional[BinaryIO] = None
+
+@dataclass
+class ProcessResult:
+    """
+    Outcome of a child process run.
+
+    Attributes:
+        cmd: Command that was executed
+        phase: Phase name from the process specification
+        returncode: Exit status (negative for termination by signal)
+        duration: Wall clock run time in seconds
+        timed_out: True if the child was stopped because its timeout expired
+        interrupted: True if the child was stopped because of Ctrl-C
+        stdout: Captured standard output, filled in by callers that capture it
+    """
+    cmd: List[str]
+    phase: str
+    returncode: int
+    duration: float
+    timed_out: bool = False
+    interrupted: bool = False
+    stdout: str = ""
+
+    @property
+    def ok(self) -> bool:
+        """True if the process exited successfully."""
+        return self.returncode == 0 and not self.timed_out and not self.interrupted
+
+class ProcessRunner:
+    """
+    Asyncio based runner for external commands (kas, kas-container, docker, bitbake).
+
+    Each child gets its own output pumps feeding the attached line handlers
+    through a bounded queue: when handlers fall behind, the pump stops reading
+    and the child blocks on its pipe instead of the runner buffering without
+    limit. Many children can run concurrently in one event loop.
+
+    Non-interactive children are started in their own session so that Ctrl-C
+    is handled by the runner: SIGINT is forwarded to the child's process group
+    (kas-container traps it and removes its container), followed by SIGTERM
+    and SIGKILL if the child does not exit within the grace periods. Timeouts
+    and task cancellation use the same shutdown sequence.
+    """
+
+    # Maximum length of a single output line kept by the stream reader
+    LINE_LIMIT = 1024 * 1024
+    # Read size for binary output passed to a sink
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, queue_size: int = 1024, interrupt_grace: float = 30.0,
+                 terminate_grace: float = 10.0):
+        """
+        Initialize process runner.
+
+        Args:
+            queue_size: Number of lines buffered per stream before applying backpressure
+            interrupt_grace: Seconds to wait after SIGINT before sending SIGTERM
+            terminate_grace: Seconds to wait after SIGTERM before sending SIGKILL
+        """
+        self.queue_size = queue_size
+        self.interrupt_grace = interrupt_grace
+        self.terminate_grace = terminate_grace
+        self._interrupt_event = None
+
+    def _get_interrupt_event(self) -> asyncio.Event:
+        """Get the interrupt event bound to the running event loop."""
+        if self._interrupt_event is None:
+            self._interrupt_event = asyncio.Event()
+        return self._interrupt_event
+
+    def interrupt(self) -> None:
+        """Request shutdown of all running children (same as pressing Ctrl-C)."""
+        event = self._get_interrupt_event()
+        if event.is_set():
+            logging.warning("Interrupt already in progress, waiting for child processes to exit")
+            return
+        logging.warning("Interrupt received, stopping child processes...")
+        event.set()
+
+    async def _pump(self, stream: asyncio.StreamReader, handlers: List[LineHandler]) -> None:
+        """Read lines from a child stream and dispatch them to handlers with backpressure."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+
+        async def consume():
+            while True:
+                line = await queue.get()
+                if line is None:
+                    return
+                for handler in handlers:
+                    try:
+                        handler.handle(line)
+                    except Exception as e:
+                        logging.debug("Output handler %s failed: %s", type(handler).__name__, e)
+
+        consumer = asyncio.ensure_future(consume())
+        try:
+            while True:
+                try:
+                    raw = await stream.readline()
+                except ValueError:
+                    # Line longer than LINE_LIMIT; the reader drops it
+                    await queue.put("[output line too long, truncated]")
+                    continue
+                if not raw:
+                    break
+                await queue.put(raw.decode('utf-8', errors='replace').rstrip('\r\n'))
+        except asyncio.CancelledError:
+            consumer.cancel()
+            raise
+        else:
+            await queue.put(None)
+            await consumer
+
+    @classmethod
+    async def _copy(cls, stream: asyncio.StreamReader, sink: BinaryIO) -> None:
+        """
+        Pass binary output of a child to a sink; the pipe applies backpressure while the sink writes.
+
+        If the sink fails, the rest of the output is discarded so the child
+        does not block on a full pipe, and the error is raised at the end.
+        """
+        error = None
+        while True:
+            chunk = await stream.read(cls.CHUNK_SIZE)
+            if not chunk:
+                break
+            if error is None:
+                try:
+                    sink.write(chunk)
+                except Exception as e:
+                    error = e
+        if error is not None:
+            raise error
+
+    @staticmethod
+    async def _feed(stream: asyncio.StreamWriter, chunks: Iterable[bytes]) -> None:
+        """Write byte chunks to the stdin of a child, waiting for it to drain the pipe."""
+        try:
+            for chunk in chunks:
+                stream.write(chunk)
+                await stream.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The child exited early, its exit status and output explain why
+        finally:
+            stream.close()
+
+    def _send_signal(self, proc: asyncio.subprocess.Process, spec: ProcessSpec, sig: int) -> None:
+        """Send a signal to the child (its whole process group when not interactive)."""
+        try:
+            if spec.interactive:
+                proc.send_signal(sig)
+            else:
+                os.killpg(proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    async def _terminate(self, proc: asyncio.subprocess.Process, spec: ProcessSpec,
+                         already_interrupted: bool = False) -> None:
+        """Stop a child with escalating signals: SIGINT, SIGTERM, then SIGKILL."""
+        sequence = [(signal.SIGINT, self.interrupt_grace),
+                    (signal.SIGTERM, self.terminate_grace),
+                    (signal.SIGKILL, None)]
+        for index, (sig, grace) in enumerate(sequence):
+            # An interactive child already received SIGINT from the terminal
+            if not (index == 0 and already_interrupted):
+                logging.debug("Sending %s to %s (pid %d)", signal.Signals(sig).name, spec.cmd[0], proc.pid)
+                self._send_signal(proc, spec, sig)
+            if grace is None:
+                await proc.wait()
+                return
+            try:
+                await asyncio.wait_for(proc.wait(), grace)
+                return
+            except asyncio.TimeoutError:
+                if proc.returncode is not None:
+                    # The child exited but descendants still hold its output pipes
+                    logging.debug("Killing leftover processes of %s (pid %d)", spec.cmd[0], proc.pid)
+                    self._send_signal(proc, spec, signal.SIGKILL)
+                    await proc.wait()
+                    return
+                logging.warning(f"{spec.cmd[0]} did not exit within {grace:g}s after "
+                                f"{signal.Signals(sig).name}")
+
+    async def run(self, spec: ProcessSpec) -> ProcessResult:
+        """
+        Run a single child process to completion.
+
+        Args:
+            spec: Process specification
+
+        Returns:
+            Process result with exit status and timing information
+
+        Raises:
+            OSError: If the command cannot be started (e.g. not installed)
+            asyncio.CancelledError: If the calling task is cancelled (the child is stopped first)
+        """
+        interactive = spec.interactive
+        pipe_stdin = spec.stdin_chunks is not None and not interactive
+        pipe_stdout = bool(spec.stdout_handlers or spec.stdout_sink) and not interactive
+        pipe_stderr = bool(spec.stderr_handlers) and not interactive
+        interrupt_event = self._get_interrupt_event()
+
+        start = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            *spec.cmd,
+            cwd=spec.cwd,
+            env=spec.env,
+            stdin=None if interactive else asyncio.subprocess.PIPE if pipe_stdin else subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE if pipe_stdout else None,
+            stderr=asyncio.subprocess.PIPE if pipe_stderr else None,
+            start_new_session=not interactive,
+            limit=self.LINE_LIMIT,
+        )
+        logging.debug("Started %s phase: %s (pid %d)", spec.phase, spec.cmd[0], proc.pid)
+        metrics.adjust('bsp_running_processes', 1, phase=spec.phase)
+
+        pumps = []
+        if pipe_stdin:
+            pumps.append(asyncio.ensure_future(self._feed(proc.stdin, spec.stdin_chunks)))
+        if pipe_stdout and spec.stdout_sink is not None:
+            pumps.append(asyncio.ensure_future(self._copy(proc.stdout, spec.stdout_sink)))
+        elif pipe_stdout:
+            pumps.append(asyncio.ensure_future(self._pump(proc.stdout, spec.stdout_handlers)))
+        if pipe_stderr:
+            pumps.append(asyncio.ensure_future(self._pump(proc.stderr, spec.stderr_handlers)))
+
+        waiter = asyncio.ensure_future(proc.wait())
+        interrupted_waiter = asyncio.ensure_future(interrupt_event.wait())
+        timed_out = False
+        interrupted = False
+        try:
+            done, _ = await asyncio.wait({waiter, interrupted_waiter}, timeout=spec.timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if waiter not in done:
+                if interrupted_waiter in done:
+                    interrupted = True
+                else:
+                    timed_out = True
+                    logging.error(f"{spec.phase} phase timed out after {spec.timeout:g}s")
+                await self._terminate(proc, spec, already_interrupted=interrupted and interactive)
+            await asyncio.gather(*pumps)
+        except asyncio.CancelledError:
+            await self._terminate(proc, spec)
+            for pump in pumps:
+                pump.cancel()
+            raise
+        finally:
+            interrupted_waiter.cancel()
+            waiter.cancel()
+            metrics.adjust('bsp_running_processes', -1, phase=spec.phase)
+            # Handlers may be shared by stdout and stderr: close each one once
+            closed = set()
+            for handler in spec.stdout_handlers + spec.stderr_handlers:
+                if id(handler) not in closed:
+                    closed.add(id(handler))
+                    handler.close()
+
+        result = ProcessResult(
+            cmd=list(spec.cmd),
+            phase=spec.phase,
+            returncode=proc.returncode,
+            duration=time.monotonic() - start,
+            timed_out=timed_out,
+            interrupted=interrupted,
+        )
+        if tracer.enabled:
+            command = os.path.basename(spec.cmd[0])
+            tracer.complete(f"{spec.phase}: {command}", "process", start, result.duration,
+                            {"cmd": shlex.join(spec.cmd), "returncode": proc.returncode, "timed_out": timed_out},
+                            track=proc.pid, track_name=f"{spec.phase} {command} (pid {proc.pid})")
+        if metrics.enabled:
+            metrics.observe_process(spec, result)
+        process_log.info("%s phase: %s exited with %s after %.1fs", spec.phase, os.path.basename(spec.cmd[0]),
+                         proc.returncode, result.duration,
+                         extra={"bsp": spec.bsp, "phase": spec.phase, "duration": round(result.duration, 3),
+                                "exit_code": proc.returncode})
+        return result
+
+    async def run_all(self, specs: List[ProcessSpec], jobs: Optional[int] = None) -> List[ProcessResult]:
+        """
+        Run several child processes concurrently.
+
+        Args:
+            specs: Process specifications
+            jobs: Maximum number of children running at the same time (None for no limit)
+
+        Returns:
+            Results in the same order as specs
+        """
+        semaphore = asyncio.Semaphore(jobs) if jobs else None
+
+        async def run_one(spec: ProcessSpec) -> ProcessResult:
+            if semaphore is None:
+                return await self.run(spec)
+            metrics.adjust('bsp_queue_depth', 1, phase=spec.phase)
+            queued = True
+            try:
+                async with semaphore:
+                    metrics.adjust('bsp_queue_depth', -1, phase=spec.phase)
+                    queued = False
+                    if self._get_interrupt_event().is_set():
+                        return ProcessResult(cmd=list(spec.cmd), phase=spec.phase, returncode=-signal.SIGINT,
+                                             duration=0.0, interrupted=True)
+                    return await self.run(spec)
+            finally:
+                if queued:
+                    metrics.adjust('bsp_queue_depth', -1, phase=spec.phase)
+
+        return list(await asyncio.gather(*(run_one(spec) for spec in specs)))
+
+    async def _main(self, coro):
+        """Event loop entry point installing the Ctrl-C handler around a coroutine."""
+        self._interrupt_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        handler_installed = False
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.interrupt)
+            handler_installed = True
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Not in the main thread or unsupported platform: default handling
+            pass
+        try:
+            return await coro
+        finally:
+            if handler_installed:
+                loop.remove_signal_handler(signal.SIGINT)
+            self._interrupt_event = None
+
+    def run_all_sync(self, specs: List[ProcessSpec], jobs: Optional[int] = None) -> List[ProcessResult]:
+        """Blocking wrapper around run_all() for synchronous callers."""
+        return self.run_coroutine_sync(self.run_all(specs, jobs))
+
+    def run_coroutine_sync(self, coro):
+        """
+        Run a coroutine using this runner to completion with Ctrl-C forwarding.
+
+        Used by callers that sequence several commands per item, e.g. git
+        operations on repository mirrors, while running items concurrently.
+        """
+        return asyncio.run(self._main(coro))
+
+    def run_sync(self, spec: ProcessSpec) -> ProcessResult:
+        """Blocking wrapper around run() for synchronous callers."""
+        return self.run_all_sync([spec])[0]
+
+# Global process runner instance shared by Docker and KAS operations
+runner = ProcessRunner()
+
+def run_captured(cmd: List[str], timeout: Optional[float] = 60, cwd: Optional[str] = None,
+                 phase: str = "query") -> ProcessResult:
+    """
+    Run a short query command through the shared runner and capture its output.
+    
+    Stderr goes to the debug log. Ctrl-C and the timeout stop the command
+    like any other child process.
+    
+    Args:
+        cmd: Command and arguments
+        timeout: Maximum run time in seconds (None for no limit)
+        cwd: Working directory for the command
+        phase: Phase name for logging and telemetry
+        
+    Returns:
+        Process result with the captured output in result.stdout
+        
+    Raises:
+        OSError: If the command cannot be started
+    """
+    output = CaptureLineHandler()
+    debug_log = LoggingLineHandler(logging.DEBUG, prefix=f"{os.path.basename(cmd[0])}: ")
+    result = runner.run_sync(ProcessSpec(cmd=cmd, cwd=cwd, phase=phase, timeout=timeout,
+                                         stdout_handlers=[output], stderr_handlers=[debug_log]))
+    result.stdout = output.text
+    return result
+
+# =============================================================================
+# Metrics
+# =============================================================================
+
+# Exported metric families: name -> (type, help)
+METRIC_FAMILIES = {
+    'bsp_command_runs_total': ('counter', 'Commands run, by command and result'),
+    'bsp_builds_total': ('counter', 'BSP builds, by BSP and result'),
+    'bsp_build_duration_seconds': ('gauge', 'Duration of the last build of a BSP'),
+    'bsp_build_last_success_timestamp_seconds': ('gauge', 'Time of the last successful build of a BSP'),
+    'bsp_phase_duration_seconds': ('gauge', 'Duration of the last run of a phase (docker, dump, build, ...)'),
+    'bsp_phase_runs_total': ('counter', 'Phase runs, by BSP, phase and result'),
+    'bsp_sstate_tasks': ('gauge', 'Setscene tasks of the last build of a BSP (BitBake sstate summary)'),
+    'bsp_sstate_hit_ratio': ('gauge', 'Share of wanted sstate objects found locally or on mirrors in the last build'),
+    'bsp_container_build_duration_seconds': ('gauge', 'Duration of the last build of a container image'),
+    'bsp_queue_depth': ('gauge', 'Commands waiting for a free slot, by phase and bsp.py process'),
+    'bsp_running_processes': ('gauge', 'Commands running, by phase and bsp.py process'),
+    'bsp_cache_size_bytes': ('gauge', 'Disk space used by a cache directory'),
+    'bsp_cache_scan_timestamp_seconds': ('gauge', 'Time the size of a cache directory was last measured'),
+    'bsp_filesystem_avail_bytes': ('gauge', 'Free space of the filesystem holding a directory'),
+    'bsp_filesystem_size_bytes': ('gauge', 'Size of the filesystem holding a directory'),
+    'bsp_metrics_update_timestamp_seconds': ('gauge', 'Time the metrics were last updated'),
+}
+
+
+class Metrics:
+    """
+    Build and cache metrics in Prometheus text format.
+    
+    Recording is off until start() is given a metrics directory. Values
+    recorded by a command are merged into a state file shared by all
+    commands on the host (counters are added, gauges replace the previous
+    value) and the result is written atomically to bsp.prom, for the
+    node_exporter textfile collector. Merges happen when the command ends
+    and, throttled, while commands it runs start and finish, so long
+    commands (dispatch, watch) keep the file current.
+    
+    Levels of a process (running and queued commands) are labelled with
+    its host and pid, so concurrent commands do not overwrite each other.
+    They are dropped when the process ends, and by later merges when the
+    process died without ending cleanly.
+    """
+
+    STATE_FILE = "bsp-metrics.json"
+    TEXT_FILE = "bsp.prom"
+    VERSION = 1
+
+    # Minimum seconds between merges while commands run
+    FLUSH_INTERVAL = 5.0
+
+    # Gauges adjusted by each process (see adjust)
+    LEVEL_FAMILIES = ('bsp_queue_depth', 'bsp_running_processes')
+
+    def __init__(self):
+        self.directory: Optional[Path] = None
+        # BSP the current command works on (label of phase metrics)
+        self.bsp: Optional[str] = None
+        self._counters: Dict[Tuple[str, str], float] = {}
+        self._gauges: Dict[Tuple[str, str], float] = {}
+        self._levels: Dict[Tuple[str, str], float] = {}
+        self._host = socket.gethostname()
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """True once a metrics directory was configured."""
+        return self.directory is not None
+
+    def start(self, directory: str) -> None:
+        """
+        Start recording.
+        
+        Args:
+            directory: Directory receiving bsp.prom and the state file
+        """
+        self.directory = resolver.resolve(directory)
+        resolver.ensure_directory(str(self.directory))
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, str]:
+        """Canonical key of a sample (labels as sorted JSON)."""
+        return name, json.dumps({key: str(value) for key, value in labels.items()}, sort_keys=True)
+
+    def inc(self, name: str, amount: float = 1.0, **labels: Any) -> None:
+        """Add to a counter."""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        """Set a gauge."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[self._key(name, labels)] = float(value)
+
+    def adjust(self, name: str, delta: float, **labels: Any) -> None:
+        """Change a gauge counting something in this process (e.g. running commands)."""
+        if not self.enabled:
+            return
+        key = self._key(name, dict(labels, host=self._host, pid=os.getpid()))
+        with self._lock:
+            self._levels[key] = self._levels.get(key, 0.0) + delta
+        self.maybe_flush()
+
+    def _is_stale_level(self, labels: str, final: bool) -> bool:
+        """Check whether a level sample belongs to a process of this host that ended."""
+        values = json.loads(labels)
+        if 'pid' not in values:
+            return True  # written before levels were labelled by process
+        if values.get('host') != self._host:
+            return False
+        pid = int(values['pid'])
+        if pid == os.getpid():
+            return final
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def get(self, name: str, **labels: Any) -> Optional[float]:
+        """Get the current value of a sample (merged state and pending values)."""
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self._gauges:
+                return self._gauges[key]
+            pending = self._counters.get(key, 0.0)
+        value = self.load_state().get(name, {}).get(key[1])
+        return None if value is None and not pending else (value or 0.0) + pending
+
+    def observe_process(self, spec: 'ProcessSpec', result: 'ProcessResult') -> None:
+        """Record the duration and outcome of a command run by the process runner."""
+        labels = {"phase": spec.phase}
+        if spec.bsp or self.bsp:
+            labels["bsp"] = spec.bsp or self.bsp
+        outcome = ('success' if result.ok else 'timeout' if result.timed_out
+                   else 'interrupted' if result.interrupted else 'failure')
+        self.set('bsp_phase_duration_seconds', result.duration, **labels)
+        self.inc('bsp_phase_runs_total', result=outcome, **labels)
+        # Image builds come from docker_build_command, which tags with -t
+        if spec.phase == 'docker' and result.ok and '-t' in spec.cmd[:-1]:
+            self.set('bsp_container_build_duration_seconds', result.duration,
+                     image=spec.cmd[spec.cmd.index('-t') + 1])
+        self.maybe_flush()
+
+    def load_state(self) -> Dict[str, Dict[str, float]]:
+        """Load the merged samples of all commands: {name: {labels JSON: value}}."""
+        if not self.enabled:
+            return {}
+        try:
+            with open(self.directory / self.STATE_FILE, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return state.get('samples') or {} if state.get('version') == self.VERSION else {}
+
+    def maybe_flush(self) -> None:
+        """Merge pending values unless that was done less than FLUSH_INTERVAL ago."""
+        if time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self, final: bool = False) -> None:
+        """
+        Merge pending values into the state file and rewrite bsp.prom.
+        
+        Args:
+            final: The process is ending; drop its levels from the state
+        """
+        if not self.enabled:
+            return
+        self._last_flush = time.monotonic()
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            gauges, self._gauges = self._gauges, {}
+            if not final:
+                gauges.update(self._levels)
+        try:
+            with open(self.directory / f".{self.STATE_FILE}.lock", 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                samples = self.load_state()
+                for (name, labels), amount in counters.items():
+                    samples.setdefault(name, {})[labels] = samples.get(name, {}).get(labels, 0.0) + amount
+                for (name, labels), value in gauges.items():
+                    samples.setdefault(name, {})[labels] = value
+                for name in self.LEVEL_FAMILIES:
+                    for labels in [labels for labels in samples.get(name, {})
+                                   if self._is_stale_level(labels, final)]:
+                        del samples[name][labels]
+                    if name in samples and not samples[name]:
+                        del samples[name]
+                samples.setdefault('bsp_metrics_update_timestamp_seconds', {})['{}'] = time.time()
+                for file_name, content in ((self.STATE_FILE, json.dumps({"version": self.VERSION,
+                                                                          "samples": samples})),
+                                           (self.TEXT_FILE, self.render(samples))):
+                    tmp_path = self.directory / f".{file_name}.tmp"
+                    tmp_path.write_text(content, encoding='utf-8')
+                    os.replace(tmp_path, self.directory / file_name)
+        except OSError as e:
+            logging.warning(f"Cannot write metrics to {self.directory}: {e}")
+
+    @staticmethod
+    def render(samples: Dict[str, Dict[str, float]]) -> str:
+        """
+        Format samples in the Prometheus text exposition format.
+        
+        Args:
+            samples: Samples as kept in the state file
+            
+        Returns:
+            Metrics text
+        """
+        def escape(value: str) -> str:
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = []
+        for name in sorted(samples):
+            kind, description = METRIC_FAMILIES.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(samples[name].items()):
+                label_text = ",".join(f'{key}="{escape(text)}"' for key, text in json.loads(labels).items())
+                lines.append(f"{name}{{{label_text}}} {float(value)!r}" if label_text else f"{name} {float(value)!r}")
+        return "\n".join(lines) + "\n"
+
+
+class SstateSummaryHandler(LineHandler):
+    """Record the BitBake sstate summary of a build as metrics of the current BSP."""
+
+    # 'Local N Mirrors N' since BitBake 1.52 (kirkstone), 'Found N' before
+    PATTERN = re.compile(r'Sstate summary: Wanted (\d+) (?:Local (\d+) Mirrors (\d+)|Found (\d+)) '
+                         r'Missed (\d+) Current (\d+)')
+
+    def __init__(self):
+        self.summary: Optional[Dict[str, int]] = None
+
+    def handle(self, line: str) -> None:
+        match = self.PATTERN.search(line)
+        if match:
+            wanted, local, mirrors, found, missed, current = match.groups()
+            self.summary = {"wanted": int(wanted), "local": int(local or found or 0),
+                            "mirrors": int(mirrors or 0), "missed": int(missed), "current": int(current)}
+
+    def close(self) -> None:
+        if not self.summary:
+            return
+        labels = {"bsp": metrics.bsp} if metrics.bsp else {}
+        for outcome, count in self.summary.items():
+            metrics.set('bsp_sstate_tasks', count, outcome=outcome, **labels)
+        wanted = self.summary['wanted']
+        ratio = (self.summary['local'] + self.summary['mirrors']) / wanted if wanted else 1.0
+        metrics.set('bsp_sstate_hit_ratio', ratio, **labels)
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP handler serving the merged metrics at /metrics."""
+
+    server_version = "bsp-metrics/1.0"
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug("metrics %s: %s", self.address_string(), format % args)
+
+    def do_GET(self) -> None:
+        if urlparse(self.path).path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = Metrics.render(metrics.load_state()).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Global metrics recorder, started when a metrics directory is configured
+metrics = Metrics()
+
+@contextlib.contextmanager
+def bsp_context(bsp_name: str):
+    """
+    Label log events and phase metrics with a BSP while working on it.
+    
+    The previous BSP (None outside of any BSP) is restored on exit, so
+    commands handling several BSPs do not tag later events with the
+    last one. Processes run in parallel for different BSPs set
+    ProcessSpec.bsp instead.
+    """
+    previous = metrics.bsp, log_context.get('bsp')
+    metrics.bsp = bsp_name
+    log_context['bsp'] = bsp_name
+    try:
+        yield
+    finally:
+        metrics.bsp = previous[0]
+        if previous[1] is None:
+            log_context.pop('bsp', None)
+        else:
+            log_context['bsp'] = previous[1]
+
+# =============================================================================
+# Build Log Archive
+# =============================================================================
+
+class FrameCodec:
+    """
+    Compression codec for independently decodable log frames.
+
+    Uses zstd when the zstandard module is installed and falls back to gzip
+    otherwise. Every frame is a complete zstd frame (or gzip member), so any
+    frame can be decompressed on its own given its offset and size.
+    """
+
+    def __init__(self, name: Optional[str] = None, level: int = 3):
+        """
+        Args:
+            name: Codec name ('zstd' or 'gzip'); defaults to the best available one
+            level: Compression level
+        """
+        if name is None:
+            name = 'zstd' if ZSTANDARD_AVAILABLE else 'gzip'
+        if name == 'zstd' and not ZSTANDARD_AVAILABLE:
+            raise ConfigurationError("zstd compressed logs require the 'zstandard' Python package")
+        if name not in ('zstd', 'gzip'):
+            raise ConfigurationError(f"Unsupported log compression: {name}")
+        self.name = name
+        self.level = level
+        self._compressor = zstandard.ZstdCompressor(level=level) if name == 'zstd' else None
+        self._decompressor = zstandard.ZstdDecompressor() if name == 'zstd' else None
+
+    @property
+    def extension(self) -> str:
+        """File extension for logs written with this codec."""
+        return '.zst' if self.name == 'zstd' else '.gz'
+
+    def compress(self, data: bytes) -> bytes:
+        if self._compressor:
+            return self._compressor.compress(data)
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        if self._decompressor:
+            return self._decompressor.decompress(data)
+        return gzip.decompress(data)
+
+class BuildLogWriter(LineHandler):
+    """
+    Line handler writing a compressed, seekable log with a side index.
+
+    Output is grouped into frames of about FRAME_SIZE uncompressed bytes
+    that are compressed independently. The side index (JSON lines, flushed
+    with every frame) records the offset, size and line range of each frame
+    together with marker records for ERROR and WARNING lines, task starts
+    and task failures. Marker records carry the line text, so listing errors
+    never touches the compressed log; showing context only decompresses the
+    frames involved.
+    """
+
+    FRAME_SIZE = 1024 * 1024
+    MAX_MARK_TEXT = 1000
+
+    # Marker classification of BitBake/KAS output lines. kas logs as
+    # '<date> <time> - <LEVEL padded to 8> - message', bsp.py as
+    # '<date> <time> - <logger> - <LEVEL> - message'.
+    MARK_PATTERNS = [
+        ('task_failed', re.compile(r'^(NOTE: recipe \S+: task \S+: Failed|ERROR: Task .* failed)')),
+        ('error', re.compile(r'^(ERROR|FATAL|CRITICAL)\b|^\S+ \S+ - (?:\S+ - )?(ERROR|CRITICAL)\s+- ')),
+        ('warning', re.compile(r'^WARNING\b|^\S+ \S+ - (?:\S+ - )?WARNING\s+- ')),
+        ('task_started', re.compile(r'^NOTE: recipe \S+: task \S+: Started')),
+    ]
+
+    def __init__(self, log_path: Path, codec: Optional[FrameCodec] = None, metadata: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            log_path: Path of the compressed log; the index is written to <log_path>.idx
+            codec: Frame codec (default: zstd if available, gzip otherwise)
+            metadata: Extra information stored in the index header (BSP, phase, command)
+        """
+        self.codec = codec or FrameCodec()
+        self.log_path = Path(log_path)
+        self.index_path = Path(str(self.log_path) + '.idx')
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        self._log = open(self.log_path, 'wb')
+        self._index = open(self.index_path, 'w', encoding='utf-8')
+        self._buffer: List[bytes] = []
+        self._buffer_size = 0
+        self._frame_first_line = 0
+        self._frame_number = 0
+        self._offset = 0
+        self._lines = 0
+        self._counts = {kind: 0 for kind, _ in self.MARK_PATTERNS}
+        self._pending_marks: List[Dict[str, Any]] = []
+        self._closed = False
+        header = {"type": "header", "format": 1, "compression": self.codec.name,
+                  "created": time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+        header.update(metadata or {})
+        self._write_index(header)
+
+    def _write_index(self, record: Dict[str, Any]) -> None:
+        self._index.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def _classify(self, line: str) -> Optional[str]:
+        for kind, pattern in self.MARK_PATTERNS:
+            if pattern.search(line):
+                return kind
+        return None
+
+    def handle(self, line: str) -> None:
+        kind = self._classify(line)
+        if kind:
+            self._counts[kind] += 1
+            self._pending_marks.append({"type": "mark", "kind": kind, "line": self._lines,
+                                        "frame": self._frame_number,
+                                        "text": line[:self.MAX_MARK_TEXT]})
+        data = (line + "\n").encode('utf-8', errors='replace')
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self._lines += 1
+        if self._buffer_size >= self.FRAME_SIZE:
+            self._flush_frame()
+
+    def _flush_frame(self) -> None:
+        """Compress buffered lines into a frame and record it in the index."""
+        if not self._buffer:
+            return
+        frame = self.codec.compress(b"".join(self._buffer))
+        self._log.write(frame)
+        self._log.flush()
+        self._write_index({"type": "frame", "offset": self._offset, "size": len(frame),
+                           "first_line": self._frame_first_line,
+                           "lines": self._lines - self._frame_first_line})
+        for mark in self._pending_marks:
+            self._write_index(mark)
+        self._index.flush()
+        self._offset += len(frame)
+        self._frame_number += 1
+        self._frame_first_line = self._lines
+        self._buffer = []
+        self._buffer_size = 0
+        self._pending_marks = []
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._flush_frame()
+        summary = {"type": "end", "lines": self._lines,
+                   "finished": time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+        summary.update(self._counts)
+        self._write_index(summary)
+        self._index.close()
+        self._log.close()
+
+@dataclass
+class BuildLogMark:
+    """
+    Indexed line of interest in an archived build log.
+
+    Attributes:
+        kind: Marker kind (error, warning, task_started, task_failed)
+        line: Zero-based line number in the log
+        frame: Index of the frame containing the line
+        text: Line text (possibly truncated)
+    """
+    kind: str
+    line: int
+    frame: int
+    text: str
+
+class BuildLogReader:
+    """
+    Reader for logs written by BuildLogWriter.
+
+    Only the side index is read on open. Frames are decompressed on demand,
+    one at a time, when log text beyond the indexed markers is needed.
+    """
+
+    def __init__(self, log_path: Path):
+        self.log_path = Path(log_path)
+        self.index_path = Path(str(self.log_path) + '.idx')
+        self.header: Dict[str, Any] = {}
+        self.summary: Dict[str, Any] = {}
+        self.frames: List[Dict[str, Any]] = []
+        self.marks: List[BuildLogMark] = []
+        self._load_index()
+        self.codec = FrameCodec(self.header.get('compression', 'zstd'))
+        self._frame_starts = [frame['first_line'] for frame in self.frames]
+
+    def _load_index(self) -> None:
+        with open(self.index_path, 'r', encoding='utf-8') as index:
+            for raw in index:
+                try:
+                    record = json.loads(raw)
+                except ValueError:
+                    # Truncated last record of a log that is still being written
+                    continue
+                record_type = record.pop('type', None)
+                if record_type == 'frame':
+                    self.frames.append(record)
+                elif record_type == 'mark':
+                    self.marks.append(BuildLogMark(**record))
+                elif record_type == 'header':
+                    self.header = record
+                elif record_type == 'end':
+                    self.summary = record
+
+    @property
+    def line_count(self) -> int:
+        """Number of lines in the log (available frames only for unfinished logs)."""
+        if 'lines' in self.summary:
+            return self.summary['lines']
+        if not self.frames:
+            return 0
+        return self.frames[-1]['first_line'] + self.frames[-1]['lines']
+
+    def read_frame(self, number: int) -> List[str]:
+        """Decompress a single frame and return its lines."""
+        frame = self.frames[number]
+        with open(self.log_path, 'rb') as log:
+            log.seek(frame['offset'])
+            data = self.codec.decompress(log.read(frame['size']))
+        return data.decode('utf-8', errors='replace').splitlines()
+
+    def get_lines(self, first: int, last: int) -> List[str]:
+        """
+        Get lines first..last (inclusive), decompressing only the frames that hold them.
+        """
+        first = max(first, 0)
+        last = min(last, self.line_count - 1)
+        if first > last or not self.frames:
+            return []
+        lines = []
+        number = bisect.bisect_right(self._frame_starts, first) - 1
+        while number < len(self.frames) and self.frames[number]['first_line'] <= last:
+            frame_lines = self.read_frame(number)
+            start = self.frames[number]['first_line']
+            lines.extend(frame_lines[max(first - start, 0):last - start + 1])
+            number += 1
+        return lines
+
+    def iter_lines(self):
+        """Iterate over all log lines, one decompressed frame at a time."""
+        for number in range(len(self.frames)):
+            yield from self.read_frame(number)
+
+class BuildLogArchive:
+    """
+    Per-build-directory archive of compressed command logs.
+
+    Logs are stored under <build_dir>/logs as <timestamp>-<phase>.log.zst
+    (or .log.gz without zstd support) with a .idx side index. Opening a new
+    log applies the retention policy: only the newest `keep` logs are kept
+    and logs older than `max_age_days` are removed.
+    """
+
+    LOG_DIR = "logs"
+
+    def __init__(self, build_dir: str, keep: int = 20, max_age_days: Optional[float] = 30,
+                 metadata: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            build_dir: BSP build directory
+            keep: Number of most recent logs to keep
+            max_age_days: Remove logs older than this many days (None to disable)
+            metadata: Information stored in the index header of every log (e.g. BSP name)
+        """
+        self.log_dir = Path(build_dir) / self.LOG_DIR
+        self.keep = keep
+        self.max_age_days = max_age_days
+        self.metadata = metadata or {}
+
+    def list_logs(self) -> List[Path]:
+        """Archived logs, oldest first."""
+        if not self.log_dir.is_dir():
+            return []
+        return sorted(path for path in self.log_dir.iterdir()
+                      if path.name.endswith(('.log.zst', '.log.gz')))
+
+    def latest(self) -> Optional[Path]:
+        """Most recent archived log, if any."""
+        logs = self.list_logs()
+        return logs[-1] if logs else None
+
+    def find(self, name: str) -> Optional[Path]:
+        """Find an archived log by file name or name prefix."""
+        for path in reversed(self.list_logs()):
+            if path.name == name or path.name.startswith(name):
+                return path
+        return None
+
+    def open_writer(self, phase: str, metadata: Optional[Dict[str, Any]] = None) -> BuildLogWriter:
+        """
+        Rotate old logs and open a writer for a new log.
+
+        Args:
+            phase: Phase name used in the log file name (build, checkout, ...)
+            metadata: Extra information stored in the index header
+        """
+        self.rotate(reserve=1)
+        codec = FrameCodec()
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = self.log_dir / f"{stamp}-{phase}.log{codec.extension}"
+        counter = 1
+        while path.exists():
+            path = self.log_dir / f"{stamp}.{counter}-{phase}.log{codec.extension}"
+            counter += 1
+        logging.info(f"Writing build log to {path}")
+        header = dict(self.metadata)
+        header.update(metadata or {})
+        header['phase'] = phase
+        return BuildLogWriter(path, codec, header)
+
+    def rotate(self, reserve: int = 0) -> List[Path]:
+        """
+        Apply the retention policy.
+
+        Args:
+            reserve: Number of slots to free for logs about to be written
+
+        Returns:
+            List of removed log files
+        """
+        logs = self.list_logs()
+        removed = []
+        if self.max_age_days is not None:
+            cutoff = time.time() - self.max_age_days * 86400
+            for path in logs:
+                if path.stat().st_mtime < cutoff:
+                    removed.append(path)
+        excess = len(logs) - len(removed) - max(self.keep - reserve, 0)
+        if excess > 0:
+            removed.extend([path for path in logs if path not in removed][:excess])
+        for path in removed:
+            logging.debug("Removing old build log %s", path)
+            for candidate in (path, Path(str(path) + '.idx')):
+                try:
+                    candidate.unlink()
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def phase_durations(self, phase: str) -> List[float]:
+        """
+        Wall clock durations of finished logs of a phase without failed tasks.
+
+        Only the header and the end record of each index are read.
+
+        Args:
+            phase: Phase name (build, checkout, ...)
+
+        Returns:
+            Durations in seconds, oldest first
+        """
+        durations = []
+        for path in self.list_logs():
+            try:
+                with open(str(path) + '.idx', 'rb') as index:
+                    header = json.loads(index.readline())
+                    index.seek(max(index.seek(0, os.SEEK_END) - 4096, 0))
+                    end = json.loads(index.read().splitlines()[-1])
+            except (OSError, ValueError, IndexError):
+                continue
+            if header.get('phase') != phase or end.get('type') != 'end' or end.get('task_failed'):
+                continue
+            try:
+                started = datetime.strptime(header['created'], '%Y-%m-%dT%H:%M:%S%z')
+                finished = datetime.strptime(end['finished'], '%Y-%m-%dT%H:%M:%S%z')
+            except (KeyError, ValueError):
+                continue
+            durations.append((finished - started).total_seconds())
+        return durations
+
+# =============================================================================
+# Build Failure Triage
+# =============================================================================
+
+@dataclass
+class TaskFailure:
+    """
+    Failed BitBake task found in build output.
+
+    Attributes:
+        recipe: Recipe file or name (e.g. 'foo_1.0.bb' or 'foo-1.0-r0')
+        task: Task name (e.g. 'do_compile')
+        exit_code: Task exit code if reported
+        logfile: Host path of the task log (log.do_<task>)
+        cause: Classified failure cause
+        excerpt: Most relevant log lines for the cause
+    """
+    recipe: str
+    task: str
+    exit_code: Optional[str] = None
+    logfile: Optional[str] = None
+    cause: str = "unknown"
+    excerpt: List[str] = field(default_factory=empty_list)
+
+@dataclass
+class FailureReport:
+    """
+    Compact description of a failed build.
+
+    Attributes:
+        phase: Failed phase (build, checkout, ...)
+        returncode: Exit code of the KAS command
+        causes: Distinct causes found, most specific first
+        failed_tasks: Failed BitBake tasks with their classification
+        errors: Last ERROR lines of the build output
+    """
+    phase: str
+    returncode: int
+    causes: List[str] = field(default_factory=empty_list)
+    failed_tasks: List[TaskFailure] = field(default_factory=empty_list)
+    errors: List[str] = field(default_factory=empty_list)
+
+class FailureCollector(LineHandler):
+    """
+    Line handler collecting failure evidence from BitBake output while it streams.
+
+    Keeps only what triage needs: failed tasks from 'Task (...) failed'
+    lines and the 'Summary: N tasks failed' listing, the log file reported
+    for each failure, diskmon messages and a bounded tail of ERROR lines.
+    """
+
+    TASK_FAILED = re.compile(r"^ERROR: Task \((?P<file>[^)]+):(?P<task>do_[\w-]+)\) failed with exit code '(?P<code>[^']*)'")
+    LOGFILE = re.compile(r"^ERROR: Logfile of failure stored in: (?P<path>\S+)")
+    RECIPE_ERROR = re.compile(r"^ERROR: (?P<recipe>\S+) (?P<task>do_[\w-]+): ")
+    SUMMARY = re.compile(r"^Summary: \d+ tasks? failed:")
+    SUMMARY_ENTRY = re.compile(r"^\s+(?:(?:mc:[^:]+:)?(?P<file>\S+)):(?P<task>do_[\w-]+)$")
+    DISKMON = re.compile(r"disk space monitor action is|No space left on device|free space of .* is running low")
+
+    def __init__(self, max_errors: int = 50):
+        self.failures: List[TaskFailure] = []
+        self.errors: Deque[str] = deque(maxlen=max_errors)
+        self.diskmon: Deque[str] = deque(maxlen=10)
+        self.messages: Dict[str, List[str]] = {}
+        self._pending_logfile: Optional[str] = None
+        self._in_summary = False
+
+    def _add_failure(self, recipe: str, task: str, exit_code: Optional[str] = None,
+                     logfile: Optional[str] = None) -> None:
+        for failure in self.failures:
+            if failure.recipe == recipe and failure.task == task:
+                failure.exit_code = failure.exit_code or exit_code
+                failure.logfile = failure.logfile or logfile
+                return
+        self.failures.append(TaskFailure(recipe=recipe, task=task, exit_code=exit_code, logfile=logfile))
+
+    def handle(self, line: str) -> None:
+        if self._in_summary:
+            match = self.SUMMARY_ENTRY.match(line)
+            if match:
+                self._add_failure(os.path.basename(match.group('file')), match.group('task'))
+                return
+            self._in_summary = False
+
+        if self.DISKMON.search(line):
+            self.diskmon.append(line)
+        if not line.startswith(("ERROR", "Summary")):
+            return
+        if self.SUMMARY.match(line):
+            self._in_summary = True
+            return
+
+        self.errors.append(line)
+        match = self.LOGFILE.match(line)
+        if match:
+            self._pending_logfile = match.group('path')
+            return
+        match = self.TASK_FAILED.match(line)
+        if match:
+            self._add_failure(os.path.basename(match.group('file')), match.group('task'),
+                              match.group('code'), self._pending_logfile)
+            self._pending_logfile = None
+            return
+        match = self.RECIPE_ERROR.match(line)
+        if match:
+            key = f"{match.group('recipe')}:{match.group('task')}"
+            self.messages.setdefault(key, []).append(line)
+
+class FailureTriage:
+    """
+    Classify build failures from collected output and task log tails.
+
+    Task logs are never read completely: only the last TAIL_BYTES of each
+    failed task's log are examined, so triage stays fast for huge compile
+    logs. Classification rules are checked in order, most specific first.
+    """
+
+    TAIL_BYTES = 64 * 1024
+    EXCERPT_LINES = 15
+
+    CAUSE_RULES = [
+        ('disk_full', re.compile(r"No space left on device|disk space monitor action is|Disk quota exceeded")),
+        ('oom_kill', re.compile(r"Killed signal terminated program|out of memory|Cannot allocate memory|"
+                                r"virtual memory exhausted|exit code '137'|\bOOM\b")),
+        ('fetch_failure', re.compile(r"Fetcher failure|FetchError|Unable to fetch URL|Network access disabled|"
+                                     r"Could not resolve host|Checksum mismatch|git ls-remote")),
+        ('patch_failure', re.compile(r"Patch .* does not apply|Hunk #\d+ FAILED|Applying patch .* failed|"
+                                     r"patch failed|QUILT_PATCHES|git am .*failed")),
+        ('compiler_error', re.compile(r"\S+:\d+(:\d+)?: (fatal )?error: |undefined reference to|"
+                                      r"collect2: error|ld: .*error|error: linker command failed")),
+    ]
+
+    # Causes implied by the failing task when the log does not say more
+    TASK_CAUSES = {
+        'do_fetch': 'fetch_failure',
+        'do_unpack': 'fetch_failure',
+        'do_patch': 'patch_failure',
+        'do_compile': 'compiler_error',
+    }
+
+    def __init__(self, build_dir: Path, use_container: bool = False):
+        """
+        Args:
+            build_dir: Host build directory
+            use_container: Whether the build ran in kas-container (paths under /build are mapped back)
+        """
+        self.build_dir = Path(build_dir)
+        self.use_container = use_container
+
+    def _host_path(self, path: str) -> Path:
+        """Map a path printed inside kas-container back to the host build directory."""
+        if self.use_container and (path == "/build" or path.startswith("/build/")):
+            return self.build_dir / path[len("/build/"):]
+        return Path(path)
+
+    @classmethod
+    def read_tail(cls, path: Path, max_bytes: Optional[int] = None) -> List[str]:
+        """Read the last lines of a file without reading all of it."""
+        max_bytes = max_bytes or cls.TAIL_BYTES
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(size - max_bytes, 0))
+            data = f.read()
+        lines = data.decode('utf-8', errors='replace').splitlines()
+        # Drop the (probably partial) first line when the file was cut
+        return lines[1:] if size > max_bytes else lines
+
+    @staticmethod
+    def recipe_name(recipe: str) -> str:
+        """Get the recipe name (PN) from a recipe file name such as 'foo_1.0.bb'."""
+        return re.sub(r'\.bb(append)?$', '', recipe).split('_')[0]
+
+    def _find_logfile(self, failure: TaskFailure) -> Optional[Path]:
+        """Locate log.<task> in tmp/work for failures without a reported log file."""
+        recipe = self.recipe_name(failure.recipe)
+        pattern = f"tmp*/work/*/{recipe}/*/temp/log.{failure.task}"
+        candidates = sorted(self.build_dir.glob(pattern), key=lambda p: p.stat().st_mtime)
+        return candidates[-1] if candidates else None
+
+    def classify(self, lines: List[str], task: Optional[str] = None) -> Tuple[str, List[str]]:
+        """
+        Classify a failure from log lines.
+
+        Args:
+            lines: Lines to examine (task log tail and related console errors)
+            task: Failed task name used as fallback hint
+
+        Returns:
+            Tuple of cause name and excerpt lines around the first match
+        """
+        for cause, pattern in self.CAUSE_RULES:
+            for index in range(len(lines) - 1, -1, -1):
+                if pattern.search(lines[index]):
+                    first = max(index - self.EXCERPT_LINES // 2, 0)
+                    return cause, lines[first:first + self.EXCERPT_LINES]
+        return self.TASK_CAUSES.get(task, 'unknown'), lines[-self.EXCERPT_LINES:]
+
+    def analyze(self, collector: FailureCollector, phase: str, returncode: int) -> FailureReport:
+        """
+        Build a failure report from collected output.
+
+        Args:
+            collector: Failure collector attached to the failed command
+            phase: Failed phase name
+            returncode: Exit code of the failed command
+
+        Returns:
+            Failure report with classified task failures
+        """
+        report = FailureReport(phase=phase, returncode=returncode, errors=list(collector.errors))
+
+        for failure in collector.failures:
+            lines = []
+            name = self.recipe_name(failure.recipe)
+            for key, messages in collector.messages.items():
+                pf, task = key.rsplit(':', 1)
+                if task == failure.task and (pf == name or pf.startswith(name + "-")):
+                    lines.extend(messages)
+            logfile = self._host_path(failure.logfile) if failure.logfile else self._find_logfile(failure)
+            if logfile and logfile.is_file():
+                failure.logfile = str(logfile)
+                try:
+                    lines.extend(self.read_tail(logfile))
+                except OSError as e:
+                    logging.debug("Cannot read task log %s: %s", logfile, e)
+            if failure.exit_code:
+                lines.append(f"exit code '{failure.exit_code}'")
+            failure.cause, failure.excerpt = self.classify(lines, failure.task)
+            report.failed_tasks.append(failure)
+
+        causes = [failure.cause for failure in report.failed_tasks]
+        if collector.diskmon:
+            causes.insert(0, 'disk_full')
+        if not causes:
+            cause, _ = self.classify(report.errors)
+            causes.append(cause)
+        report.causes = list(dict.fromkeys(causes))
+        return report
+
+    def write_report(self, report: FailureReport, path: Optional[Path] = None) -> Path:
+        """Write the report as compact JSON (default: <build_dir>/failure-report.json)."""
+        path = Path(path) if path else self.build_dir / "failure-report.json"
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(asdict(report), f, separators=(',', ':'))
+        return path
+
+    @staticmethod
+    def log_summary(report: FailureReport) -> None:
+        """Print a short console summary of the report."""
+        logging.error(f"Failure triage: {', '.join(report.causes)}")
+        for failure in report.failed_tasks:
+            logging.error(f"  {failure.recipe}:{failure.task} -> {failure.cause}"
+                          + (f" (log: {failure.logfile})" if failure.logfile else ""))
+            for line in failure.excerpt[-5:]:
+                logging.error(f"    | {line}")
+
+# =============================================================================
+# Docker Operations
+# =============================================================================
+
+# Image label carrying the container fingerprint of the build inputs
+DOCKER_FINGERPRINT_LABEL = "com.advantech.bsp-registry.fingerprint"
+
+# BuildKit builder used for image builds with cache export
+BUILDX_BUILDER = "bsp-registry"
+
+def docker_build_command(dockerfile: str, tag: str, build_args: Optional[List[DockerArg]] = None,
+                         labels: Optional[Dict[str, str]] = None,
+                         cache_dir: Optional[str] = None) -> List[str]:
+    """
+    Assemble a docker build command line.
+    
+    With a cache directory the image is built with BuildKit (docker buildx)
+    importing layers from and exporting all layers to a local cache, and is
+    loaded into the local image store afterwards.
+    
+    Args:
+        dockerfile: Dockerfile path relative to the build context
+        tag: Image tag
+        build_args: Docker build arguments
+        labels: Image labels
+        cache_dir: Local BuildKit cache directory (None for a plain docker build)
+        
+    Returns:
+        Command and arguments
+    """
+    if cache_dir:
+        cmd = ["docker", "buildx", "build", "--builder", BUILDX_BUILDER, "--load",
+               "--cache-from", f"type=local,src={cache_dir}",
+               "--cache-to", f"type=local,dest={cache_dir}.new,mode=max"]
+    else:
+        cmd = ["docker", "build"]
+    cmd.extend(["-f", dockerfile, "-t", tag])
+    for argument in build_args or []:
+        cmd.extend(["--build-arg", f"{argument.name}={argument.value}"])
+    for name, value in (labels or {}).items():
+        cmd.extend(["--label", f"{name}={value}"])
+    cmd.append(".")  # Build context is the Dockerfile directory
+    return cmd
+
+def docker_image_info(tag: str, timeout: Optional[float] = 60) -> Optional[Dict[str, Any]]:
+    """
+    Get size and labels of a local Docker image.
+    
+    Args:
+        tag: Image tag
+        timeout: Maximum run time of 'docker image inspect' in seconds
+        
+    Returns:
+        Dictionary with 'id', 'size' (bytes) and 'labels', or None if the image does not exist
+    """
+    try:
+        result = run_captured(["docker", "image", "inspect", "--format", "{{json .}}", tag], timeout)
+    except OSError as e:
+        logging.debug("Cannot inspect image %s: %s", tag, e)
+        return None
+    if not result.ok:
+        return None
+    try:
+        image = json.loads(result.stdout)
+    except ValueError:
+        return None
+    return {
+        "id": image.get("Id", ""),
+        "size": image.get("Size", 0),
+        "labels": (image.get("Config") or {}).get("Labels") or {},
+    }
+
+def docker_bridge_gateway() -> Optional[str]:
+    """
+    Get the host address on the default Docker bridge network.
+    
+    Containers on the bridge network reach the host at this address;
+    it is not routed to other machines.
+    
+    Returns:
+        Gateway IP address, or None if Docker or the bridge network is unavailable
+    """
+    try:
+        result = run_captured(["docker", "network", "inspect", "bridge", "--format",
+                               "{{range .IPAM.Config}}{{.Gateway}} {{end}}"])
+    except OSError as e:
+        logging.debug("Cannot inspect docker bridge network: %s", e)
+        return None
+    if not result.ok:
+        return None
+    gateways = [gateway for gateway in result.stdout.split() if '.' in gateway]
+    return gateways[0] if gateways else None
+
+def ensure_buildx_builder() -> bool:
+    """
+    Make sure the BuildKit builder used for cached image builds exists.
+    
+    Local cache export needs a docker-container builder; the default docker
+    driver cannot export caches.
+    
+    Returns:
+        True if the builder is available, False if docker buildx is not usable
+    """
+    try:
+        if run_captured(["docker", "buildx", "inspect", BUILDX_BUILDER]).ok:
+            return True
+        logging.info(f"Creating BuildKit builder {BUILDX_BUILDER}")
+        output = CaptureLineHandler(max_lines=20)
+        result = runner.run_sync(ProcessSpec(cmd=["docker", "buildx", "create", "--name", BUILDX_BUILDER,
+                                                  "--driver", "docker-container"],
+                                             phase="docker", timeout=120,
+                                             stdout_handlers=[output], stderr_handlers=[output]))
+    except OSError as e:
+        logging.warning(f"docker buildx not available: {e}")
+        return False
+    if not result.ok:
+        logging.warning(f"Cannot create BuildKit builder: {output.text.strip()}")
+        return False
+    return True
+
+def rotate_build_cache(cache_dir: str) -> None:
+    """
+    Replace a local BuildKit cache with the one exported by the last build.
+    
+    BuildKit never prunes a local cache it exports into, so every build
+    exports into <cache_dir>.new, which then replaces the previous cache.
+    """
+    new_dir = Path(f"{cache_dir}.new")
+    if not new_dir.is_dir():
+        return
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(new_dir, cache_dir)
+
+def build_docker(dockerfile_dir: str, dockerfile: str, tag: str, 
+                 build_args: Optional[List[DockerArg]] = None,
+                 timeout: Optional[float] = None,
+                 labels: Optional[Dict[str, str]] = None) -> None:
+    """
+    Build Docker image from Dockerfile with comprehensive validation.
+    
+    This function handles the complete Docker build process including:
+    - Prerequisite validation (directory and file existence)
+    - Build argument processing
+    - Streaming of build output to the debug log
+    - Error handling and logging
+    
+    Args:
+        dockerfile_dir: Directory containing Dockerfile and build context
+        dockerfile: Dockerfile name (e.g., 'Dockerfile')
+        tag: Image tag for the built image (e.g., 'my-bsp:latest')
+        build_args: List of Docker build arguments for parameterized builds
+        timeout: Maximum build time in seconds (None for no limit)
+        labels: Image labels (e.g. the container fingerprint)
+        
+    Raises:
+        SystemExit: If Docker build fails, prerequisites are missing, or Docker is unavailable
+    """
+    logging.info(f"Building docker container {tag} using {dockerfile}")
+    
+    # Validate prerequisites before attempting build
+    if not os.path.isdir(dockerfile_dir):
+        logging.error(f"Docker build directory does not exist: {dockerfile_dir}")
+        sys.exit(1)
+        
+    dockerfile_path = os.path.join(dockerfile_dir, dockerfile)
+    if not os.path.isfile(dockerfile_path):
+        logging.error(f"Dockerfile not found: {dockerfile_path}")
+        sys.exit(1)
+
+    # Build docker command with all required parameters
+    cmd = docker_build_command(dockerfile, tag, build_args, labels)
+    
+    logging.info(f"Running: {' '.join(cmd)}")
+
+    # Stream output to the debug log and keep the tail for error reporting
+    tail = CaptureLineHandler(max_lines=50)
+    debug_log = LoggingLineHandler(logging.DEBUG, prefix="docker: ")
+    spec = ProcessSpec(
+        cmd=cmd,
+        cwd=dockerfile_dir,
+        phase="docker",
+        timeout=timeout,
+        stdout_handlers=[debug_log, tail],
+        stderr_handlers=[debug_log, tail],
+    )
+
+    try:
+        result = runner.run_sync(spec)
+    except OSError as e:
+        logging.error(f"Unexpected error during Docker build: {e}")
+        sys.exit(1)
+
+    if result.interrupted:
+        logging.error("Docker build interrupted by user")
+        sys.exit(1)
+    if result.timed_out:
+        logging.error(f"Docker build timed out after {timeout:g}s")
+        sys.exit(1)
+    if result.returncode != 0:
+        logging.error(f"Docker build failed with return code {result.returncode}")
+        logging.error(f"Error output: {tail.text}")
+        sys.exit(1)
+
+    logging.info(f"Docker build completed successfully in {result.duration:.1f}s")
+
+# =============================================================================
+# Container Image Bundles
+# =============================================================================
+
+class _HashingWriter:
+    """Binary file wrapper computing the SHA-256 of everything written through it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.digest.update(data)
+        self.size += len(data)
+        return self.raw.write(data)
+
+    def flush(self) -> None:
+        self.raw.flush()
+
+class ImageBundleStore:
+    """
+    Directory of compressed container image tarballs for offline workers.
+    
+    Images are exported with 'docker save' and compressed on the fly
+    (zstd when the zstandard module is installed, gzip otherwise) into
+    files named after the image ID, so an unchanged image is never
+    exported twice. A manifest maps image tags to image ID, container
+    fingerprint, bundle file, size and SHA-256. Loading verifies the
+    SHA-256 of a bundle, then streams it through the decompressor into
+    'docker load' without temporary copies. Images already present with
+    the same ID are skipped.
+    """
+
+    MANIFEST = "manifest.json"
+    CHUNK_SIZE = 1 << 20
+
+    # Errors of a single image export or import, reported per image
+    ERRORS = (OSError, EOFError, ValueError, ScriptError) + ((zstandard.ZstdError,) if ZSTANDARD_AVAILABLE else ())
+
+    def __init__(self, root: str, timeout: Optional[float] = None):
+        """
+        Args:
+            root: Bundle directory
+            timeout: Maximum run time of a single 'docker save' or 'docker load' in seconds
+        """
+        self.root = Path(root)
+        self.timeout = timeout
+
+    @property
+    def manifest_path(self) -> Path:
+        """Location of the bundle manifest."""
+        return self.root / self.MANIFEST
+
+    def load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        """Manifest entries keyed by image tag (empty if there is no manifest)."""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('images', {})
+        except (OSError, ValueError):
+            return {}
+
+    def _write_manifest(self, images: Dict[str, Dict[str, Any]]) -> None:
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"created": time.strftime('%Y-%m-%dT%H:%M:%S%z'), "images": images}, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _check(self, command: str, result: ProcessResult, output: str) -> None:
+        """Raise ScriptError describing a failed docker save or load."""
+        if result.interrupted:
+            raise ScriptError(f"{command} interrupted by user")
+        if result.timed_out:
+            raise ScriptError(f"{command} timed out after {self.timeout:g}s")
+        if result.returncode != 0:
+            raise ScriptError(f"{command} failed: {output.strip()}")
+
+    async def _export(self, tag: str, path: Path) -> Tuple[int, str]:
+        """Stream 'docker save' output through the compressor into path."""
+        tmp_path = path.with_name(path.name + ".tmp")
+        errors = CaptureLineHandler(max_lines=20)
+        try:
+            with open(tmp_path, 'wb') as raw:
+                writer = _HashingWriter(raw)
+                if path.suffix == '.zst':
+                    compressor = zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(writer, closefd=False)
+                else:
+                    compressor = gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=6, mtime=0)
+                result = await runner.run(ProcessSpec(cmd=["docker", "save", tag], phase="docker",
+                                                      timeout=self.timeout, stderr_handlers=[errors],
+                                                      stdout_sink=compressor))
+                compressor.close()
+            self._check(f"docker save {tag}", result, errors.text)
+            os.replace(tmp_path, path)
+            return writer.size, writer.digest.hexdigest()
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def save(self, images: Dict[str, Docker], jobs: Optional[int] = None) -> None:
+        """
+        Export images into the bundle directory and update the manifest.
+        
+        Args:
+            images: Docker configurations keyed by image tag
+            jobs: Number of images exported in parallel
+            
+        Raises:
+            SystemExit: If an image export fails
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        manifest = self.load_manifest()
+        extension = ".tar.zst" if ZSTANDARD_AVAILABLE else ".tar.gz"
+        known_files = {entry['file']: entry for entry in manifest.values()}
+        # Query images up front: docker_image_info runs its own event loop
+        infos = {tag: docker_image_info(tag) for tag in images}
+
+        async def save_one(tag: str):
+            info = infos[tag]
+            if not info:
+                return tag, None, "image not found locally (run 'containers build' first)"
+            fingerprint = info['labels'].get(DOCKER_FINGERPRINT_LABEL)
+            if fingerprint != container_fingerprint(images[tag]):
+                logging.warning(f"{tag}: image was not built from the current container definition")
+            name = info['id'].split(':')[-1]
+            existing = [p for p in self.root.glob(f"{name}.tar.*") if not p.name.endswith('.tmp')]
+            start = time.monotonic()
+            if existing and existing[0].name in known_files:
+                path = existing[0]
+                size = known_files[path.name]['size']
+                sha256 = known_files[path.name]['sha256']
+                logging.info(f"{tag}: bundle {path.name} is up to date")
+            else:
+                path = self.root / f"{name}{extension}"
+                size, sha256 = await self._export(tag, path)
+                logging.info(f"{tag}: saved {info['size'] / 2**20:.0f} MiB image as "
+                             f"{size / 2**20:.0f} MiB in {time.monotonic() - start:.1f}s")
+            return tag, {"id": info['id'], "fingerprint": fingerprint, "file": path.name,
+                         "size": size, "sha256": sha256}, None
+
+        failed = False
+        for tag, entry, error in runner.run_coroutine_sync(self._run_all(save_one, list(images), jobs)):
+            if entry:
+                manifest[tag] = entry
+            else:
+                logging.error(f"{tag}: {error}")
+                failed = True
+        self._write_manifest(manifest)
+
+        # Drop bundles of image versions no longer referenced by the manifest; .tmp files
+        # belong to exports still running in another process
+        referenced = {entry['file'] for entry in manifest.values()}
+        for path in self.root.glob("*.tar.*"):
+            if path.suffix in ('.zst', '.gz') and path.name not in referenced:
+                logging.debug("Removing stale bundle %s", path.name)
+                path.unlink()
+        if failed:
+            sys.exit(1)
+
+    @staticmethod
+    async def _run_all(func, tags: List[str], jobs: Optional[int]) -> List[Tuple[str, Any, Optional[str]]]:
+        """Run a per-image coroutine for several images, turning errors into results for reporting."""
+        semaphore = asyncio.Semaphore(jobs or len(tags) or 1)
+
+        async def one(tag: str):
+            async with semaphore:
+                try:
+                    return await func(tag)
+                except ImageBundleStore.ERRORS as e:
+                    return tag, None, str(e)
+
+        return await asyncio.gather(*(one(tag) for tag in tags))
+
+    async def _import(self, path: Path) -> str:
+        """Stream a bundle through the decompressor into 'docker load'."""
+        output = CaptureLineHandler(max_lines=50)
+        with open(path, 'rb') as reader:
+            if path.suffix == '.zst':
+                if not ZSTANDARD_AVAILABLE:
+                    raise ScriptError("zstd compressed bundles require the 'zstandard' Python package")
+                source = zstandard.ZstdDecompressor().stream_reader(reader)
+            else:
+                source = gzip.GzipFile(fileobj=reader, mode='rb')
+            result = await runner.run(ProcessSpec(cmd=["docker", "load"], phase="docker", timeout=self.timeout,
+                                                  stdin_chunks=iter(lambda: source.read(self.CHUNK_SIZE), b''),
+                                                  stdout_handlers=[output], stderr_handlers=[output]))
+        self._check("docker load", result, output.text)
+        return output.text.strip()
+
+    def load(self, tags: Optional[List[str]] = None, jobs: Optional[int] = None) -> None:
+        """
+        Load images from the bundle directory that are missing locally.
+        
+        Args:
+            tags: Image tags to load (default: every image in the manifest)
+            jobs: Number of images loaded in parallel
+            
+        Raises:
+            SystemExit: If there is no manifest or an image cannot be loaded
+        """
+        manifest = self.load_manifest()
+        if not manifest:
+            logging.error(f"No image bundle manifest found in {self.root}")
+            sys.exit(1)
+        selected = tags if tags else list(manifest)
+        # Query images up front: docker_image_info runs its own event loop
+        infos = {tag: docker_image_info(tag) for tag in selected if tag in manifest}
+
+        async def load_one(tag: str):
+            entry = manifest.get(tag)
+            if not entry:
+                return tag, None, "not in the bundle manifest"
+            info = infos[tag]
+            if info and info['id'] == entry['id']:
+                logging.info(f"{tag}: already present")
+                return tag, entry, None
+            start = time.monotonic()
+            # Verify first: docker load tags the image as soon as it is imported
+            sha256 = await asyncio.get_running_loop().run_in_executor(None, file_sha256, self.root / entry['file'])
+            if sha256 != entry['sha256']:
+                return tag, None, f"checksum mismatch for {entry['file']}, bundle is corrupt"
+            output = await self._import(self.root / entry['file'])
+            logging.debug("%s: %s", tag, output)
+            logging.info(f"{tag}: loaded {entry['size'] / 2**20:.0f} MiB bundle in "
+                         f"{time.monotonic() - start:.1f}s")
+            return tag, entry, None
+
+        failed = False
+        for tag, entry, error in runner.run_coroutine_sync(self._run_all(load_one, selected, jobs)):
+            if not entry:
+                logging.error(f"{tag}: {error}")
+                failed = True
+        if failed:
+            sys.exit(1)
+
+# =============================================================================
+# Path Resolution Utility
+# =============================================================================
+
+class PathResolver:
+    """
+    Utility class for path resolution and validation.
+    
+    Provides centralized methods for handling path operations with:
+    - Home directory expansion (~/ paths)
+    - Existence and type validation
+    - Directory creation with proper error handling
+    - Consistent path normalization
+    
+    All methods handle path strings with home directory notation and
+    provide consistent behavior across different platforms.
+    """
+    
+    @staticmethod
+    def resolve(path_string: str) -> Path:
+        """
+        Resolve path with ~ expansion to absolute Path object.
+        
+        Args:
+            path_string: Path string that may contain ~ for home directory
+            
+        Returns:
+            Resolved absolute Path object
+        """
+        return Path(path_string).expanduser().resolve()
+    
+    @staticmethod
+    def resolve_str(path_string: str) -> str:
+        """
+        Resolve path with ~ expansion to absolute string.
+        
+        Args:
+            path_string: Path string that may contain ~ for home directory
+            
+        Returns:
+            Resolved absolute path as string
+        """
+        return str(PathResolver.resolve(path_string))
+    
+    @staticmethod
+    def exists(path_string: str) -> bool:
+        """
+        Check if path exists after resolving ~ expansion.
+        
+        Args:
+            path_string: Path to check for existence
+            
+        Returns:
+            True if path exists, False otherwise
+        """
+        return PathResolver.resolve(path_string).exists()
+    
+    @staticmethod
+    def is_file(path_string: str) -> bool:
+        """
+        Check if path is a file after resolving ~ expansion.
+        
+        Args:
+            path_string: Path to check
+            
+        Returns:
+            True if path exists and is a file, False otherwise
+        """
+        return PathResolver.resolve(path_string).is_file()
+    
+    @staticmethod
+    def is_dir(path_string: str) -> bool:
+        """
+        Check if path is a directory after resolving ~ expansion.
+        
+        Args:
+            path_string: Path to check
+            
+        Returns:
+            True if path exists and is a directory, False otherwise
+        """
+        return PathResolver.resolve(path_string).is_dir()
+    
+    @staticmethod
+    def ensure_directory(path_string: str) -> None:
+        """
+        Ensure directory exists, create if necessary with parent directories.
+        
+        This method creates the directory and all intermediate directories
+        if they don't exist, similar to 'mkdir -p' command.
+        
+        Args:
+            path_string: Directory path to ensure existence of
+            
+        Raises:
+            SystemExit: If directory cannot be created due to permissions or I/O errors
+        """
+        path = PathResolver.resolve(path_string)
+        try:
+            path.mkdir(parents=True, exist_ok=True)
+        except (OSError, IOError) as e:
+            logging.error(f"Failed to create directory {path}: {e}")
+            sys.exit(1)
+
+# Global path resolver instance for consistent path handling
+resolver = PathResolver()
+
+# =============================================================================
+# Environment Variable Management with Expansion
+# =============================================================================
+
+class EnvironmentManager:
+    """
+    Manager for environment variable configuration in build environments.
+    
+    Handles environment variable setup, validation, and management for:
+    - Build cache directories (DL_DIR, SSTATE_DIR)
+    - Git configuration (GITCONFIG_FILE)
+    - Custom build variables
+    - Container-specific environment settings
+    
+    Supports environment variable expansion in the form of $ENV{VAR_NAME}
+    for referencing system environment variables in configuration.
+    
+    This class ensures consistent environment setup across different
+    build types (native, Docker, kas-container).
+    """
+    
+    # Regular expression pattern to match $ENV{VAR_NAME} style variables
+    ENV_VAR_PATTERN = re.compile(r'\$ENV\{([^}]+)\}')
+    
+    def __init__(self, environment_vars: Optional[List[EnvironmentVariable]] = None):
+        """
+        Initialize Environment manager with optional variables.
+        
+        Args:
+            environment_vars: List of environment variables to manage
+        """
+        self.environment_vars = environment_vars or []
+        self._env_dict = self._build_environment_dict()
+        
     def _expand_environment_variables(self, value: str) -> str:
         """
-        Expand $ENV{VAR_NAME} patterns in string values.
+        Expand $ENV{VAR_NAME} patterns in string values.
+        
+        This method replaces all occurrences of $ENV{VAR_NAME} with the
+        actual value of the environment variable VAR_NAME from the system.
+        
+        Examples:
+          "$ENV{HOME}/.gitconfig" -> "/home/username/.gitconfig"
+          "$ENV{HOME}/data/cache" -> "/home/username/data/cache"
+        
+        Args:
+            value: String value that may contain $ENV{VAR} patterns
+            
+        Returns:
+            String with all $ENV{VAR} patterns expanded to their actual values
+            
+        Raises:
+            ConfigurationError: If a referenced environment variable is not set
+        """
+        def replace_env_var(match):
+            var_name = match.group(1)
+            if var_name in os.environ:
+                return os.environ[var_name]
+            else:
+                logging.warning(f"Environment variable '{var_name}' is not set, "
+                               f"using empty string for expansion in: {value}")
+                return ""
+        
+        # Replace all $ENV{VAR} patterns with actual environment variable values
+        expanded_value = self.ENV_VAR_PATTERN.sub(replace_env_var, value)
+        
+        # Also expand any standard environment variables (for backward compatibility)
+        expanded_value = os.path.expandvars(expanded_value)
+        
+        return expanded_value
+        
+    def _build_environment_dict(self) -> Dict[str, str]:
+        """
+        Build a dictionary from the environment variable list with expansion.
+        
+        This method processes each environment variable value and expands
+        any $ENV{VAR} patterns to their actual system environment values.
+        
+        Returns:
+            Dictionary of environment variables with expanded values
+        """
+        env_dict = {}
+        with tracer.span("expand environment", "environment", variables=len(self.environment_vars)):
+            for env_var in self.environment_vars:
+                # Expand environment variables in the value
+                expanded_value = self._expand_environment_variables(env_var.value)
+                env_dict[env_var.name] = expanded_value
+                logging.debug("Environment variable %s expanded: '%s' -> '%s'",
+                              env_var.name, env_var.value, expanded_value)
+        return env_dict
+    
+    def get_environment_dict(self) -> Dict[str, str]:
+        """
+        Get environment variables as a dictionary with expanded values.
+        
+        Returns:
+            Copy of the environment variables dictionary with all expansions applied
+        """
+        return self._env_dict.copy()
+    
+    def get_value(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """
+        Get the value of an environment variable by key.
+        
+        Args:
+            key: Environment variable name to lookup
+            default: Default value to return if key not found
+            
+        Returns:
+            Environment variable value (expanded) or default if not found
+        """
+        return self._env_dict.get(key, default)
+    
+    def validate_environment(self) -> bool:
+        """
+        Validate that all environment variable paths exist after expansion.
+        
+        This method checks common path variables (DL_DIR, SSTATE_DIR, GITCONFIG_FILE)
+        to ensure they point to valid locations after environment variable expansion.
+        Warnings are issued for missing paths but execution continues as paths 
+        might be created during build.
+        
+        Returns:
+            True if validation completes (warnings may still be issued)
+        """
+        # Check common path variables that should exist
+        path_variables = ['DL_DIR', 'SSTATE_DIR', 'GITCONFIG_FILE']
+        
+        for var_name in path_variables:
+            if var_name in self._env_dict:
+                path_value = self._env_dict[var_name]
+                if not resolver.exists(path_value):
+                    logging.warning(f"Environment variable {var_name} path does not exist: {path_value}")
+                    # Don't exit here - paths might be created during build process
+        
+        logging.info(f"Environment configuration validated with {len(self._env_dict)} variables")
+        return True
+        
+    def setup_environment(self, base_env: Dict[str, str]) -> Dict[str, str]:
+        """
+        Set up environment variables for build processes.
+        
+        Merges the configured environment variables with a base environment,
+        with configured variables taking precedence over existing ones.
+        All environment variable values are expanded before being set.
+        
+        Args:
+            base_env: Base environment dictionary (typically os.environ.copy())
+            
+        Returns:
+            Updated environment with all configured variables applied and expanded
+        """
+        env = base_env.copy()
+        
+        # Add all configured environment variables (overwrite existing)
+        with tracer.span("expand environment", "environment", variables=len(self.environment_vars)):
+            for env_var in self.environment_vars:
+                expanded_value = self._expand_environment_variables(env_var.value)
+                env[env_var.name] = expanded_value
+                logging.debug("Set %s=%s", env_var.name, expanded_value)
+            
+        return env
+
+# =============================================================================
+# KAS Build System Manager
+# =============================================================================
+
+class KasManager:
+    """
+    Manager for KAS (KAS is Yet Another Build System for Yocto) operations.
+    
+    This class handles KAS configuration validation, build execution,
+    and environment management with comprehensive error handling.
+    It supports both native KAS installations and containerized builds
+    using kas-container.
+    """
+    
+    def __init__(self, kas_files: List[str], build_dir: str = "build", use_container: bool = False,
+                 download_dir: str = None, sstate_dir: str = None,
+                 container_engine: str = None, container_image: str = None,
+                 search_paths: List[str] = None, env_manager: EnvironmentManager = None,
+                 timeouts: Optional[Dict[str, float]] = None,
+                 log_archive: Optional[BuildLogArchive] = None):
+        """
+        Initialize KAS manager with configuration.
+        
+        Args:
+            kas_files: List of KAS configuration files (YAML) for the build
+            build_dir: Build output directory for Yocto artifacts
+            use_container: Use kas-container instead of native kas installation
+            download_dir: Downloads cache directory for Yocto sources
+            sstate_dir: Shared state cache directory for build acceleration
+            container_engine: Container runtime (docker, podman)
+            container_image: Custom container image for kas-container
+            search_paths: Additional paths to search for configuration files
+            env_manager: Environment configuration manager
+            timeouts: Per-phase timeouts in seconds keyed by KAS command (build, checkout, dump, shell)
+            log_archive: Archive receiving a compressed copy of displayed command output
+            
+        Raises:
+            SystemExit: If initialization fails due to invalid parameters
+        """
+        if not isinstance(kas_files, list) or not kas_files:
+            logging.error("kas_files must be a non-empty list of file paths")
+            sys.exit(1)
+
+        self.kas_files = kas_files
+        self.build_dir = Path(build_dir).resolve()
+        self.use_container = use_container
+        self.container_engine = container_engine
+        self.container_image = container_image
+        self.search_paths = search_paths or []
+        self.download_dir = download_dir
+        self.sstate_dir = sstate_dir
+        self.env_manager = env_manager or EnvironmentManager()
+        self.timeouts = timeouts or {}
+        self.log_archive = log_archive
+        # Host directories mounted at the same path into kas-container (e.g. shared layers)
+        self.container_volumes: List[str] = []
+        # Additional container runtime options for kas-container (e.g. --add-host)
+        self.container_runtime_args: List[str] = []
+        # Directory with reference repositories for KAS clones (KAS_REPO_REF_DIR)
+        self.repo_ref_dir: Optional[str] = None
+        # KAS setup steps skipped by build, checkout, dump and shell (kas --skip)
+        self.skip_steps: List[str] = []
+        # BSP the configuration belongs to (labels process logs and metrics)
+        self.bsp_name: Optional[str] = None
+
+        # Add common search paths for configuration files
+        self.search_paths.extend([
+            str(Path.cwd()),              # Current working directory
+            str(self.build_dir),          # Build directory
+            str(Path(__file__).parent),   # Script directory
+            "/repo",                      # Common container path
+            "/repo/examples",             # Examples in container
+        ])
+
+        self.original_cwd = Path.cwd()
+        self._yaml_cache = {}  # Cache for parsed YAML files to avoid re-parsing
+
+        # Ensure build directory exists before starting any operations
+        resolver.ensure_directory(str(self.build_dir))
+
+    def _get_kas_command(self) -> List[str]:
+        """Get the appropriate KAS command (native or container)."""
+        if self.use_container:
+            cmd = ["kas-container"]
+            runtime_args = [f"-v {volume}:{volume}" for volume in self.container_volumes]
+            runtime_args += self.container_runtime_args
+            if runtime_args:
+                cmd += ["--runtime-args", " ".join(runtime_args)]
+            return cmd
+        else:
+            return ["kas"]
+
+    def _get_environment_with_container_vars(self) -> dict:
+        """
+        Prepare environment variables for KAS execution.
+        
+        Sets up cache directories and container-specific environment
+        variables required for KAS operation.
+        
+        Returns:
+            Environment dictionary with KAS-specific variables configured
+        """
+        env = os.environ.copy()
+
+        # Set cache directories if provided (override environment manager if specified)
+        if self.download_dir:
+            env['DL_DIR'] = self.download_dir
+        elif not env.get('DL_DIR'):  # Only set from env_manager if not already set
+            dl_dir = self.env_manager.get_value('DL_DIR')
+            if dl_dir:
+                env['DL_DIR'] = dl_dir
+                
+        if self.sstate_dir:
+            env["SSTATE_DIR"] = self.sstate_dir
+        elif not env.get('SSTATE_DIR'):  # Only set from env_manager if not already set
+            sstate_dir = self.env_manager.get_value('SSTATE_DIR')
+            if sstate_dir:
+                env['SSTATE_DIR'] = sstate_dir
+
+        # Set container-specific environment variables
+        if self.use_container:
+            if self.container_engine:
+                env['KAS_CONTAINER_ENGINE'] = self.container_engine
+            if self.container_image:
+                env['KAS_CONTAINER_IMAGE'] = self.container_image
+
+        if self.repo_ref_dir:
+            env['KAS_REPO_REF_DIR'] = self.repo_ref_dir
+
+        # Apply environment manager configuration (overrides any previous settings)
+        env = self.env_manager.setup_environment(env)
+
+        return env
+
+    def _resolve_kas_file(self, kas_file: str) -> str:
+        """
+        Resolve KAS file path to absolute path.
+        
+        Searches in multiple locations in order:
+        - Absolute path
+        - Relative to current directory
+        - Relative to build directory
+        - Script directory
+        - Custom search paths
+        
+        Args:
+            kas_file: KAS file path to resolve
+            
+        Returns:
+            Absolute path to KAS file
+            
+        Raises:
+            SystemExit: If file cannot be found in any search location
+        """
+        resolved = self._find_kas_file(kas_file)
+        if resolved:
+            return resolved
+
+        # File not found in any location
+        logging.error(f"KAS file not found: {kas_file}")
+        logging.error(f"Searched in: {', '.join(self.search_paths)}")
+        sys.exit(1)
+
+    def _find_kas_file(self, kas_file: str) -> Optional[str]:
+        """Find a KAS file in the locations searched by _resolve_kas_file."""
+        path = Path(kas_file)
+
+        # Check absolute path
+        if path.is_absolute() and path.exists():
+            return str(path.resolve())
+
+        # Check relative to current working directory
+        if path.exists():
+            return str(path.resolve())
+
+        # Check relative to build directory
+        build_dir_path = self.build_dir / path
+        if build_dir_path.exists():
+            return str(build_dir_path.resolve())
+
+        # Check relative to script directory
+        script_dir_path = Path(__file__).parent / path
+        if script_dir_path.exists():
+            return str(script_dir_path.resolve())
+
+        # Check additional search paths
+        for search_path in self.search_paths:
+            search_path_obj = Path(search_path)
+            candidate_path = search_path_obj / path
+            if candidate_path.exists():
+                return str(candidate_path.resolve())
+
+        return None
+
+    def _find_file_in_search_paths(self, filename: str) -> Optional[str]:
+        """Find a file in the configured search paths."""
+        # Check absolute path
+        if Path(filename).is_absolute() and Path(filename).exists():
+            return str(Path(filename).resolve())
+
+        # Check relative to current directory
+        if Path(filename).exists():
+            return str(Path(filename).resolve())
+
+        # Check all search paths
+        for search_path in self.search_paths:
+            candidate = Path(search_path) / filename
+            if candidate.exists():
+                return str(candidate.resolve())
+
+        return None
+
+    def _get_skip_args(self) -> List[str]:
+        """Get the kas --skip arguments for the configured skipped steps."""
+        args = []
+        for step in self.skip_steps:
+            args.extend(["--skip", step])
+        return args
+
+    def _get_kas_files_string(self) -> str:
+        """Convert list of KAS files to colon-delimited string with resolved paths."""
+        resolved_files = [self._resolve_kas_file(f) for f in self.kas_files]
+        return ":".join(resolved_files)
+
+    def _parse_yaml_file(self, file_path: str) -> Dict[str, Any]:
+        """
+        Parse YAML file with caching.
+        
+        Args:
+            file_path: Path to YAML file
+            
+        Returns:
+            Parsed YAML content as dictionary
+            
+        Raises:
+            SystemExit: If file cannot be parsed due to YAML syntax errors
+        """
+        resolved_path = self._resolve_kas_file(file_path)
+        if resolved_path in self._yaml_cache:
+            return self._yaml_cache[resolved_path]
+
+        try:
+            with open(resolved_path, 'r', encoding='utf-8') as f:
+                content = yaml.safe_load(f) or {}
+                self._yaml_cache[resolved_path] = content
+                return content
+        except (yaml.YAMLError, IOError) as e:
+            logging.error(f"Failed to parse YAML file {file_path}: {e}")
+            sys.exit(1)
+
+    def _find_includes_in_yaml(self, yaml_content: Dict[str, Any]) -> List[str]:
+        """
+        Extract include files from YAML content.
+        
+        KAS configuration files can include other files through:
+        - Top-level 'includes' key
+        - 'header' -> 'includes' nested key (less common)
+        
+        Args:
+            yaml_content: Parsed YAML content
+            
+        Returns:
+            List of include file paths found in the configuration
+        """
+        includes = []
+
+        # Check top-level includes (most common)
+        if 'includes' in yaml_content:
+            include_list = yaml_content['includes']
+            if isinstance(include_list, list):
+                includes.extend(include_list)
+
+        # Check header includes (less common, older format)
+        if 'header' in yaml_content and 'includes' in yaml_content['header']:
+            header_includes = yaml_content['header']['includes']
+            if isinstance(header_includes, list):
+                includes.extend(header_includes)
+
+        return includes
+
+    def _resolve_include_path(self, include_file: str, parent_file: str) -> str:
+        """
+        Resolve include file path relative to its parent file.
+        
+        Args:
+            include_file: Include file path (may be relative)
+            parent_file: Parent file path for relative resolution
+            
+        Returns:
+            Absolute path to include file
+            
+        Raises:
+            SystemExit: If include file cannot be found in any search location
+        """
+        found_path = self._find_include_path(include_file, parent_file)
+        if found_path:
+            return found_path
+
+        # Include file not found
+        logging.error(f"Include file not found: {include_file} (referenced from {parent_file})")
+        sys.exit(1)
+
+    def _find_include_path(self, include_file: str, parent_file: str) -> Optional[str]:
+        """Find an include file the way _resolve_include_path does, returning None if missing."""
+        # Absolute paths are used as-is
+        if include_file.startswith('/'):
+            return include_file if Path(include_file).exists() else None
+
+        # First try relative to parent file directory
+        parent_dir = Path(parent_file).parent
+        relative_path = parent_dir / include_file
+        if relative_path.exists():
+            return str(relative_path.resolve())
+
+        # Search in all configured paths
+        return self._find_file_in_search_paths(include_file)
+
+    def _get_all_included_files(self, main_files: List[str]) -> List[str]:
+        """
+        Recursively find all included files from main KAS files.
+        
+        Performs depth-first search to build complete dependency tree
+        and ensure proper inclusion order.
+        
+        Args:
+            main_files: List of main KAS configuration files
+            
+        Returns:
+            Flat list of all files in dependency order (includes first)
+            
+        Raises:
+            SystemExit: If any included file is missing or circular dependency detected
+        """
+        all_files = []
+        processed_files = set()
+
+        def process_file(file_path: str):
+            """Recursive function to process files and their includes."""
+            if file_path in processed_files:
+                return
+
+            resolved_path = self._resolve_kas_file(file_path)
+            if resolved_path in processed_files:
+                return
+
+            processed_files.add(resolved_path)
+
+            # Verify file exists
+            if not Path(resolved_path).exists():
+                logging.error(f"File not found: {file_path} (resolved to: {resolved_path})")
+                sys.exit(1)
+
+            # Parse file and find includes
+            yaml_content = self._parse_yaml_file(file_path)
+            includes = self._find_includes_in_yaml(yaml_content)
+            
+            # Process includes first (depth-first for proper dependency resolution)
+            for include in includes:
+                include_path = self._resolve_include_path(include, file_path)
+                process_file(include_path)
+
+            # Add current file after its includes
+            all_files.append(file_path)
+
+        # Process all main files
+        with tracer.span("resolve includes", "kas", files=list(main_files)):
+            for main_file in main_files:
+                process_file(main_file)
+
+        return all_files
+
+    def get_config_repo_root(self) -> Path:
+        """
+        Get the root of the repository holding the KAS configuration (the kas 'this' repo).
+        
+        Returns:
+            Repository root of the first KAS file
+        """
+        return find_repo_root(Path(self._resolve_kas_file(self.kas_files[0])))
+
+    def get_targets(self) -> List[str]:
+        """
+        Get the bitbake targets of the build.
+        
+        Returns:
+            Targets of the last file in the include closure that sets them
+        """
+        targets: List[str] = []
+        for file_path in self._get_all_included_files(self.kas_files):
+            target = self._parse_yaml_file(file_path).get('target')
+            if target:
+                targets = [target] if isinstance(target, str) else list(target)
+        return targets
+
+    @staticmethod
+    def get_lock_file(kas_file: str) -> Path:
+        """Get the lock file KAS applies after a configuration file (<name>.lock.<ext>)."""
+        path = Path(kas_file)
+        return path.with_name(f"{path.stem}.lock{path.suffix}")
+
+    def get_resolved_repos(self, use_locks: bool = True) -> Dict[str, Dict[str, Any]]:
+        """
+        Merge the repos sections of all files in the include closure.
+        
+        Later files override earlier ones like in KAS; patch entries are
+        merged by patch id and defaults.repos values (e.g. branch) are applied
+        to repositories that do not set them. Commits pinned by the lock
+        files of the closure are applied last, as KAS does.
+        
+        Args:
+            use_locks: Apply the commits of lock files
+            
+        Returns:
+            Dictionary of repository configurations keyed by repo id
+        """
+        repos: Dict[str, Dict[str, Any]] = {}
+        defaults: Dict[str, Any] = {}
+        locked: Dict[str, str] = {}
+        for file_path in self._get_all_included_files(self.kas_files):
+            content = self._parse_yaml_file(file_path)
+            lock_file = self.get_lock_file(self._resolve_kas_file(file_path))
+            if use_locks and lock_file.is_file():
+                lock_repos = (self._parse_yaml_file(str(lock_file)).get('overrides') or {}).get('repos') or {}
+                for repo_name, lock in lock_repos.items():
+                    if isinstance(lock, dict) and lock.get('commit'):
+                        locked[repo_name] = lock['commit']
+            defaults.update((content.get('defaults') or {}).get('repos') or {})
+            for repo_name, repo in (content.get('repos') or {}).items():
+                merged = repos.setdefault(repo_name, {})
+                if not isinstance(repo, dict):
+                    continue
+                for key, value in repo.items():
+                    if key == 'patches' and isinstance(value, dict):
+                        merged.setdefault('patches', {}).update(value)
+                    else:
+                        merged[key] = value
+        for repo_name, repo in repos.items():
+            if repo.get('url'):
+                for key in ('branch', 'tag'):
+                    if key in defaults and key not in repo:
+                        repo[key] = defaults[key]
+            if repo_name in locked:
+                repo['commit'] = locked[repo_name]
+        return repos
+
+    def can_add_generated_config(self) -> bool:
+        """
+        Check whether generated KAS files can be added to the build.
+        
+        KAS requires all configuration files of a build to come from the same
+        repository, so generated files in the build directory can only be
+        used when the build directory is inside the configuration repository.
+        
+        Returns:
+            True if generated configuration files can be used
+        """
+        if find_repo_root(self.build_dir) != self.get_config_repo_root():
+            logging.warning(f"Build directory {self.build_dir} is outside the configuration repository, "
+                            f"generated KAS files cannot be used")
+            return False
+        return True
+
+    def add_generated_config(self, file_name: str, config: Dict[str, Any], description: str) -> Path:
+        """
+        Write a generated KAS file into the build directory and add it to the build.
+        
+        Args:
+            file_name: File name in the build directory
+            config: KAS configuration (the header is added)
+            description: Purpose of the file, written as a comment
+            
+        Returns:
+            Path of the generated file
+        """
+        path = self.build_dir / file_name
+        content = {"header": {"version": 14}}
+        content.update(config)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"# Generated by bsp.py: {description}\n")
+            yaml.safe_dump(content, f, default_flow_style=False, sort_keys=True)
+        if str(path) not in self.kas_files:
+            self.kas_files.append(str(path))
+        return path
+
+    def validate_kas_files(self, check_includes: bool = True) -> bool:
+        """
+        Validate that all KAS configuration files exist and are accessible.
+        
+        Args:
+            check_includes: Whether to recursively validate include files
+            
+        Returns:
+            True if validation succeeds
+            
+        Raises:
+            SystemExit: If any file is missing or inaccessible
+        """
+        try:
+            # Check main files
+            for kas_file in self.kas_files:
+                self._resolve_kas_file(kas_file)  # Will exit if file not found
+
+            # Recursively check include files if requested
+            if check_includes:
+                self._get_all_included_files(self.kas_files)
+                logging.info("All KAS files validated successfully")
+
+            return True
+
+        except SystemExit:
+            # Re-raise system exit exceptions
+            raise
+        except Exception as e:
+            logging.error(f"KAS file validation failed: {e}")
+            sys.exit(1)
+
+    def check_kas_available(self) -> bool:
+        """
+        Check if KAS or kas-container is installed and available.
+        
+        Returns:
+            True if KAS is available, False otherwise
+        """
+        kas_cmd = self._get_kas_command()
+        env = self._get_environment_with_container_vars()
+        
+        try:
+            if self.use_container:
+                # For container version, check if help command works
+                test_cmd = kas_cmd + ["--help"]
+                result = subprocess.run(
+                    test_cmd,
+                    check=False,
+                    capture_output=True,
+                    text=True,
+                    timeout=30,
+                    env=env
+                )
+                return result.returncode == 0 or len(result.stdout) > 0 or len(result.stderr) > 0
+            else:
+                # For native version, check version command
+                test_cmd = kas_cmd + ["--version"]
+                subprocess.run(test_cmd, check=True, capture_output=True, timeout=30, env=env)
+                return True
+        except (subprocess.CalledProcessError, FileNotFoundError, subprocess.TimeoutExpired) as e:
+            logging.error(f"KAS command not available: {e}")
+            return False
+
+    def _run_kas_command(self, args: List[str], show_output: bool = True,
+                         interactive: bool = False) -> ProcessResult:
+        """
+        Execute KAS command with proper environment and error handling.
+        
+        The command runs through the shared process runner: output is streamed
+        line by line to the console (or captured), the phase timeout configured
+        for the KAS command is applied, and Ctrl-C is forwarded to the KAS
+        process so that kas-container can remove its container.
+        
+        Args:
+            args: Command arguments to pass to KAS
+            show_output: Whether to show live output or capture it
+            interactive: Keep the terminal attached to the command (interactive shells)
+            
+        Returns:
+            Process result; captured stdout is available as result.stdout
+            when show_output is False
+            
+        Raises:
+            SystemExit: If command fails, times out or is interrupted by user
+        """
+        cmd = self._get_kas_command() + args
+        env = self._get_environment_with_container_vars()
+        phase = args[0] if args else "kas"
+
+        logging.info(f"Running: {' '.join(cmd)}")
+        logging.info(f"Build directory: {self.build_dir}")
+        logging.info(f"Using container: {self.use_container}")
+
+        # Log important environment variables for debugging
+        important_vars = ['DL_DIR', 'SSTATE_DIR', 'GITCONFIG_FILE']
+        for var in important_vars:
+            if var in env:
+                logging.info(f"Using {var}: {env[var]}")
+
+        stdout_capture = CaptureLineHandler()
+        stderr_capture = CaptureLineHandler(max_lines=200)
+        if show_output:
+            # Show live output to console for build progress
+            stdout_handlers = [ConsoleLineHandler()]
+            stderr_handlers = [ConsoleLineHandler(sys.stderr)]
+        else:
+            # Capture output for programmatic use (export, validation)
+            stdout_handlers = [stdout_capture]
+            stderr_handlers = [stderr_capture]
+
+        # Keep a compressed, indexed copy of displayed output
+        log_writer = None
+        if self.log_archive and show_output and not interactive:
+            try:
+                log_writer = self.log_archive.open_writer(phase, {"command": cmd})
+            except (OSError, ConfigurationError) as e:
+                logging.warning(f"Build log archiving disabled: {e}")
+        if log_writer:
+            stdout_handlers.append(log_writer)
+            stderr_handlers.append(log_writer)
+
+        # Collect failure evidence for triage of failed builds
+        collector = None
+        if phase == "build" and not interactive:
+            collector = FailureCollector()
+            stdout_handlers.append(collector)
+            stderr_handlers.append(collector)
+            if metrics.enabled:
+                stdout_handlers.append(SstateSummaryHandler())
+
+        spec = ProcessSpec(
+            cmd=cmd,
+            cwd=str(self.build_dir),
+            env=env,
+            phase=phase,
+            timeout=self.timeouts.get(phase),
+            stdout_handlers=stdout_handlers,
+            stderr_handlers=stderr_handlers,
+            interactive=interactive,
+            bsp=self.bsp_name,
+        )
+        result = runner.run_sync(spec)
+        if log_writer:
+            logging.info(f"Build log saved to {log_writer.log_path}")
+
+        if result.interrupted:
+            logging.error("Command interrupted by user")
+            sys.exit(1)
+        if result.timed_out:
+            logging.error(f"KAS {phase} exceeded its timeout of {spec.timeout:g}s")
+            sys.exit(1)
+        if result.returncode != 0:
+            logging.error(f"KAS command failed with return code {result.returncode}")
+            if not show_output and stderr_capture.lines:
+                logging.error(f"Error output: {stderr_capture.text}")
+            if collector:
+                self._triage_failure(collector, phase, result.returncode)
+            sys.exit(1)
+
+        logging.debug("KAS %s finished in %.1fs", phase, result.duration)
+        result.stdout = stdout_capture.text
+        return result
+
+    def _triage_failure(self, collector: FailureCollector, phase: str, returncode: int) -> Optional[FailureReport]:
+        """
+        Classify a failed command and write failure-report.json to the build directory.
+        
+        Triage problems are logged and never mask the original failure.
+        
+        Args:
+            collector: Failure collector attached to the failed command
+            phase: Failed phase name
+            returncode: Exit code of the failed command
+            
+        Returns:
+            Failure report, or None if triage itself failed
+        """
+        try:
+            triage = FailureTriage(self.build_dir, use_container=self.use_container)
+            report = triage.analyze(collector, phase, returncode)
+            report_path = triage.write_report(report)
+        except Exception as e:
+            logging.warning(f"Failure triage failed: {e}")
+            return None
+        triage.log_summary(report)
+        logging.error(f"Failure report written to {report_path}")
+        return report
+
+    def build_project(self, target: str = None, task: str = None, show_output: bool = True) -> None:
+        """
+        Build the Yocto project using KAS.
+        
+        This is the main build method that orchestrates the complete
+        Yocto build process through KAS.
+        
+        Args:
+            target: Specific build target (recipe or image)
+            task: Specific build task (compile, configure, etc.)
+            show_output: Whether to show build output in real-time
+            
+        Raises:
+            SystemExit: If build fails or prerequisites are not met
+        """
+        # Validate environment configuration first
+        if not self.env_manager.validate_environment():
+            logging.error("Environment configuration validation failed")
+            sys.exit(1)
+
+        # Validate configuration files
+        if not self.validate_kas_files(check_includes=True):
+            logging.error("Cannot build due to missing files")
+            sys.exit(1)
+
+        # Check KAS availability
+        if not self.check_kas_available():
+            logging.error("KAS is not available. Please install KAS (e.g., 'pip install kas' or use your package manager)")
+            sys.exit(1)
+
+        # Build KAS command arguments
+        kas_files_str = self._get_kas_files_string()
+        args = ["build"] + self._get_skip_args() + [kas_files_str]
+
+        if target:
+            args.extend(["--target", target])
+        if task:
+            args.extend(["--task", task])
+
+        try:
+            self._run_kas_command(args, show_output)
+            logging.info("Build completed successfully!")
+        except SystemExit:
+            raise
+        except Exception as e:
+            logging.error(f"Build failed: {e}")
+            sys.exit(1)
+
+    def checkout_project(self, show_output: bool = True) -> None:
+        """
+        Checkout/validate the Yocto project repositories using KAS.
+        
+        This method validates that the KAS configuration is correct and
+        repositories can be cloned without performing a full build. This is
+        useful for quick validation of build configurations.
+        
+        Args:
+            show_output: Whether to show checkout output in real-time
+            
+        Raises:
+            SystemExit: If checkout/validation fails or prerequisites are not met
+        """
+        # Validate environment configuration first
+        if not self.env_manager.validate_environment():
+            logging.error("Environment configuration validation failed")
+            sys.exit(1)
+
+        # Validate configuration files
+        if not self.validate_kas_files(check_includes=True):
+            logging.error("Cannot checkout due to missing files")
+            sys.exit(1)
+
+        # Check KAS availability
+        if not self.check_kas_available():
+            logging.error("KAS is not available. Please install KAS (e.g., 'pip install kas' or use your package manager)")
+            sys.exit(1)
+
+        # Build KAS command arguments
+        kas_files_str = self._get_kas_files_string()
+        args = ["checkout"] + self._get_skip_args() + [kas_files_str]
+
+        try:
+            self._run_kas_command(args, show_output)
+            logging.info("Checkout/validation completed successfully!")
+        except SystemExit:
+            raise
+        except Exception as e:
+            logging.error(f"Checkout/validation failed: {e}")
+            sys.exit(1)
+
+    def shell_session(self, command: str = None, show_output: bool = True) -> None:
+        """
+        Start KAS shell session or execute command in build environment.
+        
+        This method launches an interactive shell session within the
+        build environment, allowing users to run commands manually.
+        
+        Args:
+            command: Optional command to execute in shell (if not provided, starts interactive shell)
+            show_output: Whether to show command output
+            
+        Raises:
+            SystemExit: If shell session fails to start
+        """
+        if not self.validate_kas_files(check_includes=True):
+            sys.exit(1)
+
+        if not self.check_kas_available():
+            logging.error("KAS is not available")
+            sys.exit(1)
+
+        kas_files_str = self._get_kas_files_string()
+        args = ["shell"] + self._get_skip_args() + [kas_files_str]
+
+        if command:
+            args.extend(["--command", command])
+            logging.info(f"Executing command in KAS shell: {command}")
+        else:
+            logging.info("Starting interactive KAS shell session...")
+            logging.info("Type 'exit' to leave the shell when done.")
+
+        try:
+            self._run_kas_command(args, show_output, interactive=not command)
+        except SystemExit:
+            raise
+        except Exception as e:
+            logging.error(f"Shell session failed: {e}")
+            sys.exit(1)
+
+    def get_shell_spec(self, command: str, stdout_handlers: List[LineHandler],
+                       stderr_handlers: List[LineHandler]) -> ProcessSpec:
+        """
+        Build the process specification of a non-interactive KAS shell command.
+        
+        Unlike shell_session, the command is not run, so commands of several
+        BSPs can be run concurrently through the process runner.
+        
+        Args:
+            command: Command run in the build environment
+            stdout_handlers: Consumers of the command output
+            stderr_handlers: Consumers of the command error output
+            
+        Returns:
+            Process specification
+        """
+        args = ["shell"] + self._get_skip_args() + [self._get_kas_files_string(), "--command", command]
+        return ProcessSpec(
+            cmd=self._get_kas_command() + args,
+            cwd=str(self.build_dir),
+            env=self._get_environment_with_container_vars(),
+            phase="shell",
+            timeout=self.timeouts.get("shell"),
+            stdout_handlers=stdout_handlers,
+            stderr_handlers=stderr_handlers,
+            bsp=self.bsp_name,
+        )
+
+    def run_bitbake_command(self, recipe: str, bitbake_args: List[str] = None, show_output: bool = True) -> None:
+        """
+        Run BitBake command through KAS shell.
+        
+        Args:
+            recipe: BitBake recipe to build
+            bitbake_args: Additional BitBake arguments
+            show_output: Whether to show command output
+            
+        Raises:
+            SystemExit: If BitBake command fails
+        """
+        if not self.validate_kas_files(check_includes=True):
+            sys.exit(1)
+
+        if not self.check_kas_available():
+            logging.error("KAS is not available")
+            sys.exit(1)
+
+        # Build BitBake command
+        bitbake_cmd = ["bitbake", recipe]
+        if bitbake_args:
+            bitbake_cmd.extend(bitbake_args)
+
+        # Execute through KAS shell
+        kas_files_str = self._get_kas_files_string()
+        args = ["shell"] + self._get_skip_args() + [kas_files_str, "--command", " ".join(bitbake_cmd)]
+
+        logging.info(f"Running BitBake: {' '.join(bitbake_cmd)}")
+
+        try:
+            self._run_kas_command(args, show_output)
+            logging.info("BitBake command completed successfully!")
+        except SystemExit:
+            raise
+        except Exception as e:
+            logging.error(f"BitBake command failed: {e}")
+            sys.exit(1)
+
+    def dump_config(self, show_output: bool = True) -> Optional[str]:
+        """
+        Dump expanded KAS configuration for verification.
+        
+        This method shows the fully resolved KAS configuration after
+        processing all includes and variable expansions.
+        
+        Args:
+            show_output: Whether to show output or return it
+            
+        Returns:
+            Configuration string if show_output=False, None otherwise
+            
+        Raises:
+            SystemExit: If config dump fails
+        """
+        if not self.validate_kas_files(check_includes=True):
+            sys.exit(1)
+
+        if not self.check_kas_available():
+            logging.error("KAS is not available")
+            sys.exit(1)
+
+        kas_files_str = self._get_kas_files_string()
+        args = ["dump"] + self._get_skip_args() + [kas_files_str]
+
+        try:
+            if show_output:
+                self._run_kas_command(args, show_output=True)
+                return None
+            else:
+                result = self._run_kas_command(args, show_output=False)
+                return result.stdout
+        except SystemExit:
+            raise
+        except Exception as e:
+            logging.error(f"Config dump failed: {e}")
+            sys.exit(1)
+
+    def export_kas_config(self, output_file: Optional[str] = None) -> str:
+        """
+        Export the complete KAS configuration as YAML.
+        
+        This method uses KAS to dump the fully resolved configuration
+        and saves it to a file or returns it as a string.
+        
+        Args:
+            output_file: Optional path to save the configuration
+            
+        Returns:
+            The KAS configuration as YAML string
+            
+        Raises:
+            SystemExit: If export fails
+        """
+        logging.info("Exporting KAS configuration...")
+        
+        if not self.validate_kas_files(check_includes=True):
+            logging.error("Cannot export due to missing files")
+            sys.exit(1)
+
+        if not self.check_kas_available():
+            logging.error("KAS is not available")
+            sys.exit(1)
+
+        try:
+            # Get the complete configuration dump
+            config_yaml = self.dump_config(show_output=False)
+            
+            if not config_yaml:
+                logging.error("Failed to get KAS configuration")
+                sys.exit(1)
+                
+            # Save to file if specified
+            if output_file:
+                output_path = Path(output_file)
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                
+                with open(output_path, 'w', encoding='utf-8') as f:
+                    f.write(config_yaml)
+                
+                logging.info(f"KAS configuration exported to: {output_path}")
+            else:
+                logging.info("KAS configuration exported successfully")
+                
+            return config_yaml
+            
+        except SystemExit:
+            raise
+        except Exception as e:
+            logging.error(f"Failed to export KAS configuration: {e}")
+            sys.exit(1)
+
+# =============================================================================
+# Build Fingerprinting
+# =============================================================================
+
+def file_sha256(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Compute the SHA-256 digest of a file without loading it into memory.
+    
+    Args:
+        path: File to hash
+        chunk_size: Read size in bytes
+        
+    Returns:
+        Hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def container_fingerprint(docker: Docker, context_dir: str = ".") -> str:
+    """
+    Compute a fingerprint of the inputs of a container image build.
+    
+    Covers the image tag, build arguments, Dockerfile contents and the
+    local files copied into the image (COPY/ADD sources), so the
+    fingerprint changes whenever a rebuild could produce a different image.
+    
+    Args:
+        docker: Docker configuration of the container
+        context_dir: Docker build context directory
+        
+    Returns:
+        Hex digest identifying the container build inputs
+    """
+    digest = hashlib.sha256()
+    digest.update(f"image={docker.image}\n".encode())
+    for arg in docker.args or []:
+        digest.update(f"arg:{arg.name}={arg.value}\n".encode())
+
+    if docker.file:
+        dockerfile = Path(context_dir) / docker.file
+        if dockerfile.is_file():
+            content = dockerfile.read_bytes()
+            digest.update(content)
+            for match in re.finditer(rb'^\s*(?:COPY|ADD)\s+(?:--\S+\s+)*(.+)$', content, re.MULTILINE):
+                sources = match.group(1).decode('utf-8', errors='replace').split()[:-1]
+                for source in sources:
+                    if "://" in source:
+                        continue
+                    for path in sorted(Path(context_dir).glob(source)):
+                        files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+                        for item in files:
+                            digest.update(f"file:{item.relative_to(context_dir)}\n".encode())
+                            digest.update(file_sha256(item).encode())
+        else:
+            digest.update(f"missing:{docker.file}\n".encode())
+    return digest.hexdigest()
+
+def find_repo_root(path: Path) -> Path:
+    """
+    Find the root of the git repository containing a path (the kas 'this' repo).
+    
+    Args:
+        path: File or directory inside the repository
+        
+    Returns:
+        Repository root, or the directory of path if it is not in a git repository
+    """
+    start = path if path.is_dir() else path.parent
+    for candidate in [start] + list(start.parents):
+        if (candidate / ".git").exists():
+            return candidate
+    return start
+
+def patch_digests(repo: Dict[str, Any], repo_root: Path, build_dir: Path) -> Dict[str, Any]:
+    """
+    Hash the patches of a resolved KAS repository.
+    
+    Args:
+        repo: Repository configuration from KasManager.get_resolved_repos
+        repo_root: Root of the configuration repository (patches of the 'this' repo)
+        build_dir: Build directory holding the other repositories
+        
+    Returns:
+        Digest per patch id; a dictionary of file digests for patch directories
+    """
+    digests: Dict[str, Any] = {}
+    for patch_id, patch in sorted((repo.get('patches') or {}).items()):
+        if not isinstance(patch, dict) or not patch.get('path'):
+            continue
+        patch_path = repo_root / patch['path'] if patch.get('repo') in (None, 'this') \
+            else build_dir / patch['path']
+        if patch_path.is_file():
+            digests[patch_id] = file_sha256(patch_path)
+        elif patch_path.is_dir():
+            digests[patch_id] = {str(p.relative_to(patch_path)): file_sha256(p)
+                                 for p in sorted(patch_path.rglob('*')) if p.is_file()}
+        else:
+            digests[patch_id] = f"missing:{patch['path']}"
+    return digests
+
+def build_deploy_dir(build_dir: Path) -> Path:
+    """
+    Locate the BitBake deploy directory of a BSP build.
+    
+    kas runs in the BSP build path and uses its default build directory
+    (<build path>/build), so BitBake writes to <build path>/build/tmp.
+    
+    Args:
+        build_dir: BSP build path (KAS_WORK_DIR)
+        
+    Returns:
+        Path of the deploy directory
+    """
+    return Path(build_dir) / "build" / "tmp" / "deploy"
+
+class BuildFingerprint:
+    """
+    Fingerprint of everything that determines the outputs of a BSP build.
+    
+    The fingerprint covers:
+    - Contents of every KAS file in the include closure and of their lock
+      files (targets, local.conf fragments and pinned repository commits)
+    - Contents of the patches referenced from repos.*.patches
+    - The container image fingerprint
+    - Build-relevant environment variables (cache locations excluded)
+    
+    It is stored next to the deploy artifacts after a successful build. A
+    later build with an identical fingerprint and existing deploy directory
+    can be skipped. Repositories that follow a branch without a pinned
+    commit make the fingerprint unstable: their content may change without
+    any local change, so such builds are never skipped.
+    """
+
+    FILE_NAME = "bsp-fingerprint.json"
+    VERSION = 1
+
+    # Variables that only relocate caches and do not change build outputs
+    CACHE_VARIABLES = {'DL_DIR', 'SSTATE_DIR', 'GITCONFIG_FILE'}
+
+    def __init__(self, kas_mgr: KasManager, container_config: Optional[Docker] = None,
+                 bsp_name: Optional[str] = None):
+        """
+        Args:
+            kas_mgr: KAS manager configured for the BSP
+            container_config: Container used for the build (None for native builds)
+            bsp_name: BSP name recorded with the fingerprint
+        """
+        self.kas_mgr = kas_mgr
+        self.container_config = container_config
+        self.bsp_name = bsp_name
+        self.components: Dict[str, Any] = {}
+        self.unpinned: List[str] = []
+        self.digest: Optional[str] = None
+
+    @property
+    def path(self) -> Path:
+        """Location of the stored fingerprint (build deploy directory)."""
+        return build_deploy_dir(self.kas_mgr.build_dir) / self.FILE_NAME
+
+    def compute(self) -> str:
+        """
+        Compute the fingerprint of the current build inputs.
+        
+        Returns:
+            Hex digest of the fingerprint components
+        """
+        kas_mgr = self.kas_mgr
+        files = [kas_mgr._resolve_kas_file(f) for f in kas_mgr._get_all_included_files(kas_mgr.kas_files)]
+        repo_root = kas_mgr.get_config_repo_root()
+
+        kas_files = {}
+        for file_path in files:
+            for path in (Path(file_path), kas_mgr.get_lock_file(file_path)):
+                if path.is_file():
+                    name = str(path.relative_to(repo_root)) if repo_root in path.parents else str(path)
+                    kas_files[name] = file_sha256(path)
+        repos = kas_mgr.get_resolved_repos()
+
+        patches = {}
+        self.unpinned = []
+        for repo_name, repo in sorted(repos.items()):
+            if repo.get('url') and not (repo.get('commit') or repo.get('tag')):
+                self.unpinned.append(repo_name)
+            for patch_id, digest in patch_digests(repo, repo_root, kas_mgr.build_dir).items():
+                patches[f"{repo_name}/{patch_id}"] = digest
+
+        environment = {name: value for name, value in kas_mgr.env_manager.get_environment_dict().items()
+                       if name not in self.CACHE_VARIABLES}
+
+        self.components = {
+            "version": self.VERSION,
+            "kas_files": kas_files,
+            "patches": patches,
+            "container": container_fingerprint(self.container_config) if self.container_config else None,
+            "environment": environment,
+            "use_container": kas_mgr.use_container,
+        }
+        self.digest = hashlib.sha256(json.dumps(self.components, sort_keys=True).encode()).hexdigest()
+        return self.digest
+
+    def load_stored(self) -> Optional[Dict[str, Any]]:
+        """Load the fingerprint stored by the last successful build, if any."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_up_to_date(self) -> bool:
+        """
+        Check whether the last successful build used identical inputs.
+        
+        Returns:
+            True if the stored fingerprint matches and deploy artifacts exist
+        """
+        if self.digest is None:
+            self.compute()
+        if self.unpinned:
+            logging.info(f"Fingerprint not reusable, unpinned repositories: {', '.join(self.unpinned)}")
+            return False
+        stored = self.load_stored()
+        if not stored or stored.get('fingerprint') != self.digest:
+            return False
+        images_dir = self.path.parent / "images"
+        return images_dir.is_dir() and any(images_dir.iterdir())
+
+    def save(self) -> Path:
+        """Store the fingerprint next to the deploy artifacts."""
+        if self.digest is None:
+            self.compute()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        record = {
+            "fingerprint": self.digest,
+            "bsp": self.bsp_name,
+            "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "components": self.components,
+        }
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        return self.path
+
+class CheckoutState:
+    """
+    State of the repositories KAS checked out into a build directory.
+    
+    Records, per repository, the requested URL and refs, the hashes of its
+    patches and the commit checked out (with patches applied) after the last
+    successful checkout. When the resolved configuration requests the same
+    state and every repository is still at its recorded commit, the KAS
+    checkout and patch steps can be skipped. Repositories following a branch
+    without a pinned commit or tag always need a checkout, since only the
+    remote knows where the branch points.
+    """
+
+    FILE_NAME = "bsp-checkout-state.json"
+    VERSION = 1
+
+    # KAS setup steps that are redundant when the checkout state matches
+    SKIP_STEPS = ["repos_checkout", "repos_apply_patches"]
+
+    def __init__(self, kas_mgr: KasManager):
+        """
+        Args:
+            kas_mgr: KAS manager configured for the BSP (including generated files)
+        """
+        self.kas_mgr = kas_mgr
+        self._desired: Optional[Dict[str, Dict[str, Any]]] = None
+
+    @property
+    def path(self) -> Path:
+        """Location of the state file (build directory)."""
+        return self.kas_mgr.build_dir / self.FILE_NAME
+
+    def desired(self) -> Dict[str, Dict[str, Any]]:
+        """Get the repository state requested by the resolved configuration."""
+        if self._desired is None:
+            repo_root = self.kas_mgr.get_config_repo_root()
+            self._desired = {}
+            for name, repo in sorted(self.kas_mgr.get_resolved_repos().items()):
+                # Repositories without URL are used in place and never checked out
+                if not repo.get('url'):
+                    continue
+                self._desired[name] = {
+                    "path": str(repo.get('path') or name),
+                    "url": repo['url'],
+                    "commit": repo.get('commit'),
+                    "tag": repo.get('tag'),
+                    "branch": repo.get('branch'),
+                    "patches": patch_digests(repo, repo_root, self.kas_mgr.build_dir),
+                }
+        return self._desired
+
+    def _head(self, repo_path: str) -> Optional[str]:
+        """Get the commit checked out in a repository of the build directory."""
+        try:
+            result = run_captured(["git", "-C", str(self.kas_mgr.build_dir / repo_path), "rev-parse", "HEAD"],
+                                  timeout=30)
+        except OSError:
+            return None
+        return result.stdout.strip() if result.ok else None
+
+    def heads(self) -> Dict[str, Optional[str]]:
+        """Get the commits checked out in the repositories of the build directory, by repository name."""
+        return {name: self._head(wanted['path']) for name, wanted in self.desired().items()}
+
+    def load_stored(self) -> Dict[str, Dict[str, Any]]:
+        """Load the repository states recorded by the last successful checkout."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(record, dict) or record.get('version') != self.VERSION:
+            return {}
+        return record.get('repos') or {}
+
+    def changed_repos(self) -> List[str]:
+        """
+        Find repositories whose checkout differs from the configuration.
+        
+        Returns:
+            Names of repositories that need a KAS checkout, empty if none does
+        """
+        stored = self.load_stored()
+        changed = []
+        for name, wanted in self.desired().items():
+            recorded = stored.get(name)
+            if not (wanted['commit'] or wanted['tag']):
+                changed.append(name)
+            elif not recorded or {key: recorded.get(key) for key in wanted} != wanted:
+                changed.append(name)
+            elif self._head(wanted['path']) != recorded.get('head'):
+                changed.append(name)
+        return changed
+
+    def invalidate(self) -> None:
+        """Forget the recorded state before KAS changes the checkout."""
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def save(self) -> Path:
+        """Record the current checkout after a successful KAS checkout or build."""
+        repos = {}
+        for name, wanted in self.desired().items():
+            repos[name] = dict(wanted, head=self._head(wanted['path']))
+        record = {
+            "version": self.VERSION,
+            "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "repos": repos,
+        }
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        return self.path
+
+# =============================================================================
+# Content-Addressed Artifact Store
+# =============================================================================
+
+@dataclass
+class ArtifactEntry:
+    """
+    Deploy artifact recorded in a BSP manifest.
+    
+    Attributes:
+        name: Path relative to the deploy directory (e.g. 'images/rsb3720/Image')
+        sha256: Content digest (object name in the store)
+        size: File size in bytes
+        mode: File permission bits
+        mtime_ns: Modification time of the deploy file after collection
+    """
+    name: str
+    sha256: str
+    size: int
+    mode: int = 0o644
+    mtime_ns: Optional[int] = None
+
+@dataclass
+class CollectStats:
+    """
+    Summary of an artifact collection run.
+    
+    Attributes:
+        files: Number of collected files
+        total_bytes: Size of all collected files
+        new_objects: Objects added to the store
+        new_bytes: Bytes added to the store
+        linked: Deploy files replaced by links to existing objects
+    """
+    files: int = 0
+    total_bytes: int = 0
+    new_objects: int = 0
+    new_bytes: int = 0
+    linked: int = 0
+
+class ArtifactStore:
+    """
+    Content-addressed store for BSP deploy artifacts.
+    
+    Files from tmp/deploy/{images,sdk} are hashed in parallel and stored
+    once under objects/<sha[:2]>/<sha>. Deploy files are then linked to the
+    stored object: a hardlink when the store is on the same filesystem,
+    a reflink (copy-on-write clone) otherwise, so byte-identical files of
+    board variants share their storage. A manifest per BSP collection
+    records name, digest, size and the BSP fingerprint; garbage collection
+    keeps the newest manifests per BSP and removes objects no longer
+    referenced by any manifest.
+    
+    Stored objects share their inode with deploy files; they must not be
+    modified in place (BitBake replaces deploy files rather than rewriting them).
+    New objects are therefore made read-only, which also applies to the
+    deploy files linked to them.
+    """
+
+    COLLECT_DIRS = ("images", "sdk")
+    FICLONE = 0x40049409  # Linux ioctl for reflinks (btrfs, xfs)
+
+    def __init__(self, root: str):
+        """
+        Args:
+            root: Store root directory
+        """
+        self.root = Path(root)
+        self.objects_dir = self.root / "objects"
+        self.manifests_dir = self.root / "manifests"
+
+    def object_path(self, sha256: str) -> Path:
+        """Location of an object in the store."""
+        return self.objects_dir / sha256[:2] / sha256
+
+    @staticmethod
+    def _iter_files(deploy_dir: Path, subdirs) -> List[Path]:
+        """List regular files (not symlinks) below the collected deploy subdirectories."""
+        files = []
+        for subdir in subdirs:
+            top = deploy_dir / subdir
+            if not top.is_dir():
+                continue
+            for dirpath, dirnames, filenames in os.walk(top):
+                for filename in filenames:
+                    path = Path(dirpath) / filename
+                    if not path.is_symlink() and path.is_file():
+                        files.append(path)
+        return sorted(files)
+
+    def _previous_digests(self, bsp_name: str) -> Dict[str, str]:
+        """
+        Digests from the last manifest, to avoid rehashing unchanged files.
+        
+        Hardlinked files are keyed by name, inode of the stored object and
+        the size and modification time recorded for the deploy file; the
+        object shares the inode, so a file rewritten in place no longer
+        matches the recorded values and is hashed again. Copies (store on
+        another filesystem without reflinks) never share the inode, so they
+        are keyed by name, size and modification time only.
+        """
+        manifest = self.latest_manifest(bsp_name)
+        if not manifest:
+            return {}
+        known = {}
+        for entry in manifest.get('files', []):
+            if entry.get('mtime_ns') is None:
+                continue
+            obj = self.object_path(entry['sha256'])
+            try:
+                st = obj.stat()
+            except OSError:
+                continue
+            known[f"{entry['name']}:{entry['size']}:{st.st_ino}:{entry['mtime_ns']}"] = entry['sha256']
+            known[f"{entry['name']}:{entry['size']}:mtime:{entry['mtime_ns']}"] = entry['sha256']
+        return known
+
+    @classmethod
+    def _clone(cls, src: Path, dst: Path) -> None:
+        """Create dst as a reflink of src, falling back to a plain copy."""
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), cls.FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    def _link(self, src: Path, dst: Path) -> None:
+        """Link dst to src through a temporary name so dst is replaced atomically."""
+        # Unique per process and thread: concurrent collections may link the same object
+        tmp = dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}.bsp-tmp")
+        if tmp.exists():
+            tmp.unlink()
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+            self._clone(src, tmp)
+        os.replace(tmp, dst)
+
+    def collect(self, bsp_name: str, deploy_dir: Path, fingerprint: Optional[str] = None,
+                jobs: Optional[int] = None) -> CollectStats:
+        """
+        Store the deploy artifacts of a BSP and write its manifest.
+        
+        Args:
+            bsp_name: BSP name
+            deploy_dir: BSP deploy directory (<build path>/build/tmp/deploy)
+            fingerprint: BSP build fingerprint recorded in the manifest
+            jobs: Number of parallel hashing workers
+            
+        Returns:
+            Collection statistics
+        """
+        deploy_dir = Path(deploy_dir)
+        files = self._iter_files(deploy_dir, self.COLLECT_DIRS)
+        known = self._previous_digests(bsp_name)
+
+        def digest(path: Path):
+            st = path.stat()
+            name = path.relative_to(deploy_dir)
+            sha = known.get(f"{name}:{st.st_size}:{st.st_ino}:{st.st_mtime_ns}")
+            # An unchanged copy of a stored object from an earlier collection needs no new copy
+            copied = known.get(f"{name}:{st.st_size}:mtime:{st.st_mtime_ns}") if not sha else None
+            return path, st, sha or copied or file_sha256(path), copied is not None
+
+        stats = CollectStats()
+        entries = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+            for path, st, sha, copied in pool.map(digest, files):
+                entry = ArtifactEntry(name=str(path.relative_to(deploy_dir)), sha256=sha,
+                                      size=st.st_size, mode=st.st_mode & 0o7777, mtime_ns=st.st_mtime_ns)
+                entries.append(entry)
+                stats.files += 1
+                stats.total_bytes += st.st_size
+                obj = self.object_path(sha)
+                try:
+                    obj_st = obj.stat()
+                except FileNotFoundError:
+                    obj.parent.mkdir(parents=True, exist_ok=True)
+                    self._link(path, obj)
+                    os.chmod(obj, st.st_mode & 0o7555)
+                    stats.new_objects += 1
+                    stats.new_bytes += st.st_size
+                    continue
+                if (obj_st.st_dev, obj_st.st_ino) != (st.st_dev, st.st_ino) and not copied:
+                    self._link(obj, path)
+                    # A copy gets the modification time of the object
+                    entry.mtime_ns = path.stat().st_mtime_ns
+                    stats.linked += 1
+
+        symlinks = []
+        for subdir in self.COLLECT_DIRS:
+            top = deploy_dir / subdir
+            if top.is_dir():
+                for path in sorted(top.rglob('*')):
+                    if path.is_symlink():
+                        symlinks.append({"name": str(path.relative_to(deploy_dir)),
+                                         "target": os.readlink(path)})
+
+        manifest = {
+            "bsp": bsp_name,
+            "fingerprint": fingerprint,
+            "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "deploy_dir": str(deploy_dir.resolve()),
+            "files": [asdict(entry) for entry in entries],
+            "symlinks": symlinks,
+        }
+        manifest_dir = self.manifests_dir / bsp_name
+        manifest_dir.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        label = fingerprint[:12] if fingerprint else "none"
+        manifest_path = manifest_dir / f"{stamp}-{label}.json"
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, manifest_path)
+        logging.info(f"Artifact manifest written to {manifest_path}")
+        return stats
+
+    def list_manifests(self, bsp_name: str) -> List[Path]:
+        """Manifests of a BSP, oldest first."""
+        manifest_dir = self.manifests_dir / bsp_name
+        if not manifest_dir.is_dir():
+            return []
+        return sorted(manifest_dir.glob("*.json"))
+
+    def latest_manifest(self, bsp_name: str) -> Optional[Dict[str, Any]]:
+        """Most recent manifest of a BSP, if any."""
+        manifests = self.list_manifests(bsp_name)
+        if not manifests:
+            return None
+        with open(manifests[-1], 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def gc(self, keep: int = 3) -> Tuple[int, int]:
+        """
+        Remove old manifests and unreferenced objects.
+        
+        Args:
+            keep: Number of most recent manifests to keep per BSP
+            
+        Returns:
+            Tuple of removed object count and freed bytes
+        """
+        referenced = set()
+        if self.manifests_dir.is_dir():
+            for bsp_dir in self.manifests_dir.iterdir():
+                if not bsp_dir.is_dir():
+                    continue
+                manifests = sorted(bsp_dir.glob("*.json"))
+                for old in manifests[:-keep] if keep > 0 else manifests:
+                    logging.debug("Removing manifest %s", old)
+                    old.unlink()
+                for manifest_path in manifests[-keep:] if keep > 0 else []:
+                    with open(manifest_path, 'r', encoding='utf-8') as f:
+                        referenced.update(entry['sha256'] for entry in json.load(f).get('files', []))
+
+        removed = 0
+        freed = 0
+        if self.objects_dir.is_dir():
+            for obj in self.objects_dir.glob("*/*"):
+                if obj.name in referenced:
+                    continue
+                st = obj.stat()
+                obj.unlink()
+                removed += 1
+                # Space is only freed when no deploy directory links the object anymore
+                if st.st_nlink <= 1:
+                    freed += st.st_size
+        return removed, freed
+
+# =============================================================================
+# Shared Layer Store
+# =============================================================================
+
+@dataclass
+class LayerSource:
+    """
+    Layer repository checkout that can be shared between build directories.
+    
+    Attributes:
+        repo: Repository id in the KAS configuration
+        url: Remote repository URL
+        commit: Pinned commit
+        patches: Patch files applied on top of the commit, in KAS order
+    """
+    repo: str
+    url: str
+    commit: str
+    patches: List[Tuple[str, Path]] = field(default_factory=empty_list)
+
+    @property
+    def patch_digest(self) -> Optional[str]:
+        """Digest of the patch series (None for an unpatched checkout)."""
+        if not self.patches:
+            return None
+        digest = hashlib.sha256()
+        for patch_id, path in self.patches:
+            digest.update(f"{patch_id}:{path.name}\n".encode())
+            digest.update(file_sha256(path).encode())
+        return digest.hexdigest()
+
+@dataclass
+class PatchSeries:
+    """
+    Patches KAS applies to a repository of a BSP.
+    
+    Attributes:
+        repo: Repository id in the KAS configuration
+        url: Remote repository URL
+        commit: Pinned commit (None if the repository follows a branch or tag)
+        branch: Branch followed by the repository
+        tag: Tag the repository is checked out at
+        patches: Patch files in KAS order
+    """
+    repo: str
+    url: str
+    commit: Optional[str] = None
+    branch: Optional[str] = None
+    tag: Optional[str] = None
+    patches: List[Tuple[str, Path]] = field(default_factory=empty_list)
+
+@dataclass
+class PatchCheck:
+    """
+    Result of checking whether a patch applies.
+    
+    Attributes:
+        repo: Repository id in the KAS configuration
+        patch_id: Patch entry id in the KAS configuration
+        path: Patch file
+        base_commit: Commit the series is applied to
+        status: 'ok', 'failed', 'missing' (patch file not found) or
+            'skipped' (an earlier patch of the series failed)
+        cached: True if the result was taken from the patch check cache
+        error: Output of git apply for failed patches
+    """
+    repo: str
+    patch_id: str
+    path: Path
+    base_commit: str
+    status: str
+    cached: bool = False
+    error: str = ""
+
+class LayerStore:
+    """
+    Shared store of layer repository checkouts.
+    
+    BSPs of a registry mostly use the same layers at the same commits, yet
+    KAS clones and checks out every repository again in each build
+    directory. The layer store keeps one bare mirror per repository, named
+    like KAS reference repositories so the mirrors directory doubles as
+    KAS_REPO_REF_DIR, and one git worktree per commit and patch series
+    below trees/<repository>/<commit>[-<patches>]. Build directories use the
+    worktrees through a generated KAS override file that turns the
+    repositories into local ones (url: null), so KAS neither fetches,
+    checks out nor patches them.
+    
+    Only repositories pinned to a commit whose patches come from the
+    configuration repository are shared. Worktrees are shared by every BSP
+    using them and must not be modified from a build.
+    
+    The store is shared by concurrent bsp.py processes (parallel builds,
+    dispatch, CI workers), so changes to a mirror and its worktrees are
+    made while holding a file lock on the mirror.
+    """
+
+    OVERRIDE_FILE = "shared-layers.yml"
+    PATCH_CACHE_FILE = "patch-checks.json"
+    KAS_AUTHOR = "kas <kas@example.com>"
+
+    def __init__(self, root: str):
+        """
+        Args:
+            root: Store root directory
+        """
+        self.root = Path(root)
+        self.mirrors_dir = self.root / "mirrors"
+        self.trees_dir = self.root / "trees"
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._fetched = set()
+
+    @staticmethod
+    def qualified_name(url: str) -> str:
+        """Repository name derived from its URL the same way KAS names reference repositories."""
+        parsed = urlparse(url)
+        name = f"{parsed.netloc}{parsed.path}"
+        for char in "@:/*":
+            name = name.replace(char, ".")
+        return name
+
+    def mirror_path(self, url: str) -> Path:
+        """Location of the bare mirror of a layer repository."""
+        return self.mirrors_dir / self.qualified_name(url)
+
+    def tree_path(self, source: LayerSource) -> Path:
+        """Location of the worktree for a layer commit and patch series."""
+        name = source.commit[:12]
+        patch_digest = source.patch_digest
+        if patch_digest:
+            name += f"-{patch_digest[:12]}"
+        return self.trees_dir / self.qualified_name(source.url) / name
+
+    def is_materialized(self, source: LayerSource) -> bool:
+        """Check whether the worktree of a layer source is complete."""
+        tree = self.tree_path(source)
+        return tree.with_name(tree.name + ".json").is_file() and tree.is_dir()
+
+    @staticmethod
+    def _resolve_patches(repo_root: Path, repo: Dict[str, Any]) -> Optional[List[Tuple[str, Path]]]:
+        """
+        Expand the patch entries of a repository into patch files in KAS order.
+        
+        Patch entries are sorted by id and directories are expanded through
+        their series file like KAS does. Patch files that do not exist are
+        included as given so callers can report them.
+        
+        Args:
+            repo_root: Root of the configuration repository
+            repo: Resolved repository configuration
+            
+        Returns:
+            List of patch ids and files, or None if a patch comes from
+            another repository than the configuration repository
+        """
+        patches = []
+        for patch_id, patch in sorted((repo.get('patches') or {}).items()):
+            if not isinstance(patch, dict) or not patch.get('path'):
+                continue
+            if patch.get('repo') not in (None, 'this'):
+                return None
+            path = repo_root / patch['path']
+            if path.is_dir() and (path / 'series').is_file():
+                with open(path / 'series', 'r', encoding='utf-8') as f:
+                    for line in f:
+                        entry = line.split(' #')[0].strip()
+                        if entry and not line.startswith('#'):
+                            patches.append((patch_id, path / entry))
+            else:
+                patches.append((patch_id, path))
+        return patches
+
+    @classmethod
+    def sources_for(cls, kas_mgr: KasManager) -> Tuple[List[LayerSource], List[str]]:
+        """
+        Determine the repositories of a KAS configuration that can be shared.
+        
+        Args:
+            kas_mgr: KAS manager configured for the BSP
+            
+        Returns:
+            Tuple of shareable layer sources and names of repositories
+            that are not shareable (not pinned, local or patched from
+            another repository)
+            
+        Raises:
+            SystemExit: If a patch file does not exist
+        """
+        repo_root = kas_mgr.get_config_repo_root()
+        sources = []
+        skipped = []
+        for repo_name, repo in sorted(kas_mgr.get_resolved_repos().items()):
+            if not repo or not repo.get('url'):
+                continue  # the configuration repository itself or a local repository
+            if not repo.get('commit') or repo.get('type', 'git') != 'git':
+                skipped.append(repo_name)
+                continue
+            patches = cls._resolve_patches(repo_root, repo)
+            if patches is None:
+                skipped.append(repo_name)
+                continue
+            for patch_id, path in patches:
+                if not path.is_file():
+                    logging.error(f"Patch {patch_id} of repository {repo_name} not found: {path}")
+                    sys.exit(1)
+            sources.append(LayerSource(repo=repo_name, url=repo['url'], commit=repo['commit'],
+                                       patches=patches))
+        return sources, skipped
+
+    @classmethod
+    def patch_series_for(cls, kas_mgr: KasManager) -> Tuple[List[PatchSeries], List[str]]:
+        """
+        Collect the patch series of the repositories of a KAS configuration.
+        
+        Args:
+            kas_mgr: KAS manager configured for the BSP
+            
+        Returns:
+            Tuple of patch series and names of patched repositories that
+            cannot be checked (patches from another repository or not git)
+        """
+        repo_root = kas_mgr.get_config_repo_root()
+        series = []
+        skipped = []
+        for repo_name, repo in sorted(kas_mgr.get_resolved_repos().items()):
+            if not repo or not repo.get('url') or not repo.get('patches'):
+                continue
+            patches = cls._resolve_patches(repo_root, repo)
+            if patches is None or repo.get('type', 'git') != 'git':
+                skipped.append(repo_name)
+                continue
+            if patches:
+                series.append(PatchSeries(repo=repo_name, url=repo['url'], commit=repo.get('commit'),
+                                          branch=repo.get('branch'), tag=repo.get('tag'),
+                                          patches=patches))
+        return series, skipped
+
+    async def _git(self, args: List[str], cwd: Optional[Path] = None, check: bool = True,
+                   env: Optional[Dict[str, str]] = None) -> ProcessResult:
+        """Run a git command through the shared process runner, capturing its output."""
+        output = CaptureLineHandler(max_lines=50)
+        spec = ProcessSpec(cmd=["git"] + args, cwd=str(cwd) if cwd else None, env=env, phase="layers",
+                           stdout_handlers=[output], stderr_handlers=[output])
+        result = await runner.run(spec)
+        result.stdout = output.text
+        if check and not result.ok:
+            raise ScriptError(f"git {' '.join(args)} failed (exit code {result.returncode}):\n"
+                              f"{output.text.rstrip()}")
+        return result
+
+    @contextlib.asynccontextmanager
+    async def _repository_lock(self, url: str):
+        """
+        Serialize changes to the mirror of a repository and its worktrees.
+        
+        Coroutines of this process wait on an asyncio lock, other processes
+        on an exclusive flock of mirrors/<name>.lock. The flock is polled so
+        waiting does not block the event loop.
+        """
+        name = self.qualified_name(url)
+        async with self._locks.setdefault(name, asyncio.Lock()):
+            self.mirrors_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.mirrors_dir / f"{name}.lock", 'w') as lock:
+                while True:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        await asyncio.sleep(0.2)
+                yield
+
+    async def _has_commit(self, mirror: Path, commit: str) -> bool:
+        """Check whether a mirror contains a commit."""
+        result = await self._git(["--git-dir", str(mirror), "cat-file", "-e", f"{commit}^{{commit}}"],
+                                 check=False)
+        return result.ok
+
+    async def _ensure_mirror(self, url: str, commit: Optional[str] = None) -> Path:
+        """
+        Create or update the bare mirror of a repository.
+        
+        With a commit the mirror is only fetched when it does not contain
+        the commit yet; without one it is fetched once per run so branches
+        and tags are current. Callers hold the repository lock.
+        """
+        mirror = self.mirror_path(url)
+        if not mirror.is_dir():
+            logging.info(f"Cloning {url}")
+            self.mirrors_dir.mkdir(parents=True, exist_ok=True)
+            tmp = mirror.with_name(mirror.name + ".tmp")
+            if tmp.exists():
+                shutil.rmtree(tmp)
+            await self._git(["clone", "--quiet", "--bare", url, str(tmp)])
+            os.replace(tmp, mirror)
+            self._fetched.add(url)
+        if commit and await self._has_commit(mirror, commit):
+            return mirror
+        if url not in self._fetched:
+            logging.info(f"Fetching {url}")
+            await self._git(["--git-dir", str(mirror), "fetch", "--quiet", "--prune", url,
+                             "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"])
+            self._fetched.add(url)
+        if commit and not await self._has_commit(mirror, commit):
+            # Commits not reachable from any branch or tag can still be fetched directly
+            await self._git(["--git-dir", str(mirror), "fetch", "--quiet", url, commit], check=False)
+            if not await self._has_commit(mirror, commit):
+                raise ScriptError(f"Commit {commit} not found in {url}")
+        return mirror
+
+    async def _apply_patches(self, source: LayerSource, tree: Path) -> None:
+        """Apply and commit the patch series like KAS does for a patched repository."""
+        for patch_id, path in source.patches:
+            await self._git(["apply", "--whitespace=nowarn", str(path)], cwd=tree)
+            await self._git(["add", "-A"], cwd=tree)
+            await self._git(["-c", "user.name=kas", "-c", "user.email=kas@example.com",
+                             "commit", "--quiet", "--no-verify", "--author", self.KAS_AUTHOR,
+                             "-m", f"kas: {patch_id}\n\npatch {path} applied by kas"], cwd=tree)
+
+    async def materialize(self, source: LayerSource) -> Tuple[Path, bool]:
+        """
+        Make the worktree of a layer source available.
+        
+        Args:
+            source: Layer source
+            
+        Returns:
+            Tuple of worktree path and whether it was created by this call
+            
+        Raises:
+            ScriptError: If a git operation fails
+        """
+        async with self._repository_lock(source.url):
+            tree = self.tree_path(source)
+            if self.is_materialized(source):
+                return tree, False
+            mirror = await self._ensure_mirror(source.url, source.commit)
+            if tree.exists():
+                # Left over from an interrupted run
+                logging.debug("Removing incomplete worktree %s", tree)
+                shutil.rmtree(tree)
+                await self._git(["--git-dir", str(mirror), "worktree", "prune"])
+            tree.parent.mkdir(parents=True, exist_ok=True)
+            await self._git(["--git-dir", str(mirror), "worktree", "add", "--quiet", "--detach",
+                             str(tree), source.commit])
+            await self._apply_patches(source, tree)
+            marker = {
+                "url": source.url,
+                "commit": source.commit,
+                "patches": [str(path) for _, path in source.patches],
+                "patch_digest": source.patch_digest,
+                "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            }
+            marker_path = tree.with_name(tree.name + ".json")
+            with open(marker_path, 'w', encoding='utf-8') as f:
+                json.dump(marker, f, indent=1)
+            logging.info(f"Layer {source.repo} ready at {tree}")
+            return tree, True
+
+    def materialize_all(self, sources: List[LayerSource], jobs: Optional[int] = None) -> int:
+        """
+        Materialize layer sources concurrently.
+        
+        Sources sharing a repository are serialized on its mirror; identical
+        sources are materialized once.
+        
+        Args:
+            sources: Layer sources
+            jobs: Maximum number of repositories processed at the same time
+            
+        Returns:
+            Number of newly created worktrees
+            
+        Raises:
+            SystemExit: If a layer cannot be materialized
+        """
+        unique: Dict[str, LayerSource] = {}
+        for source in sources:
+            unique.setdefault(str(self.tree_path(source)), source)
+
+        async def main():
+            semaphore = asyncio.Semaphore(jobs or 8)
+
+            async def one(source: LayerSource):
+                async with semaphore:
+                    return await self.materialize(source)
+
+            return await asyncio.gather(*(one(source) for source in unique.values()),
+                                        return_exceptions=True)
+
+        self._locks = {}
+        results = runner.run_coroutine_sync(main())
+        created = 0
+        failed = False
+        for source, result in zip(unique.values(), results):
+            if isinstance(result, BaseException):
+                logging.error(f"Failed to prepare layer {source.repo} ({source.url}): {result}")
+                failed = True
+            else:
+                created += int(result[1])
+        if failed:
+            sys.exit(1)
+        return created
+
+    def override_config(self, sources: List[LayerSource]) -> Dict[str, Any]:
+        """
+        KAS configuration redirecting repositories to shared worktrees.
+        
+        Args:
+            sources: Materialized layer sources
+            
+        Returns:
+            KAS configuration turning the repositories into local ones
+        """
+        repos = {source.repo: {"url": None, "path": str(self.tree_path(source))} for source in sources}
+        return {"repos": repos}
+
+    async def _resolve_ref(self, mirror: Path, url: str, commit: Optional[str] = None,
+                           tag: Optional[str] = None, branch: Optional[str] = None) -> str:
+        """Resolve the commit a repository is checked out at, following KAS ref precedence."""
+        if commit:
+            ref = commit
+        elif tag:
+            ref = f"refs/tags/{tag}"
+        elif branch:
+            ref = f"refs/heads/{branch}"
+        else:
+            ref = "HEAD"
+        result = await self._git(["--git-dir", str(mirror), "rev-parse", "--verify", "--quiet",
+                                  f"{ref}^{{commit}}"], check=False)
+        if not result.ok:
+            raise ScriptError(f"Cannot resolve {ref} in {url}")
+        return result.stdout.split()[-1]
+
+    def resolve_refs(self, refs: List[Tuple[str, Optional[str], Optional[str]]],
+                     jobs: Optional[int] = None) -> Dict[Tuple[str, Optional[str], Optional[str]], str]:
+        """
+        Resolve floating refs of repositories to commits through the mirrors.
+        
+        Every mirror is fetched at most once, and all repositories are
+        processed concurrently.
+        
+        Args:
+            refs: Tuples of repository URL, tag and branch (both None for the default branch)
+            jobs: Maximum number of repositories processed at the same time
+            
+        Returns:
+            Commit for each ref tuple
+            
+        Raises:
+            SystemExit: If a repository cannot be fetched or a ref cannot be resolved
+        """
+        unique = list(dict.fromkeys(refs))
+
+        async def main():
+            semaphore = asyncio.Semaphore(jobs or os.cpu_count() or 4)
+
+            async def one(url: str, tag: Optional[str], branch: Optional[str]):
+                async with semaphore:
+                    async with self._repository_lock(url):
+                        mirror = await self._ensure_mirror(url)
+                    return await self._resolve_ref(mirror, url, tag=tag, branch=branch)
+
+            return await asyncio.gather(*(one(*ref) for ref in unique), return_exceptions=True)
+
+        self._locks = {}
+        results = dict(zip(unique, runner.run_coroutine_sync(main())))
+        failed = False
+        for (url, tag, branch), result in results.items():
+            if isinstance(result, BaseException):
+                logging.error(f"Cannot resolve {tag or branch or 'HEAD'} of {url}: {result}")
+                failed = True
+        if failed:
+            sys.exit(1)
+        return results
+
+    async def _check_series(self, series: PatchSeries, cache: Dict[str, Dict[str, str]]) -> List[PatchCheck]:
+        """
+        Check a patch series against its base commit without a worktree.
+        
+        Patches are applied cumulatively to a temporary index read from the
+        base commit, so later patches are checked on top of earlier ones like
+        KAS applies them. A result is cached by the patch content, the base
+        commit and the patches before it; patches with cached results are
+        only applied to the index when a later patch needs to be checked.
+        """
+        async with self._repository_lock(series.url):
+            mirror = await self._ensure_mirror(series.url, series.commit)
+        base = await self._resolve_ref(mirror, series.url, series.commit, series.tag, series.branch)
+
+        results = []
+        prefix = hashlib.sha256(base.encode())
+        pending: List[Path] = []  # Patches known to apply that are not in the index yet
+        failed = False
+        with tempfile.TemporaryDirectory(prefix="bsp-patch-check-") as tmp_dir:
+            env = dict(os.environ, GIT_INDEX_FILE=str(Path(tmp_dir) / "index"))
+            index_ready = False
+            for patch_id, path in series.patches:
+                check = PatchCheck(repo=series.repo, patch_id=patch_id, path=path, base_commit=base,
+                                   status="skipped")
+                results.append(check)
+                if failed:
+                    continue
+                if not path.is_file():
+                    check.status = "missing"
+                    failed = True
+                    continue
+                patch_sha = file_sha256(path)
+                key = hashlib.sha256(f"{prefix.hexdigest()}:{patch_sha}".encode()).hexdigest()
+                prefix.update(patch_sha.encode())
+                cached = cache.get(key)
+                if cached:
+                    check.status = cached['status']
+                    check.error = cached.get('error', "")
+                    check.cached = True
+                else:
+                    if not index_ready:
+                        await self._git(["--git-dir", str(mirror), "read-tree", base], env=env)
+                        index_ready = True
+                    for pending_path in pending:
+                        await self._git(["--git-dir", str(mirror), "apply", "--cached",
+                                         "--whitespace=nowarn", str(pending_path)], env=env)
+                    pending = []
+                    result = await self._git(["--git-dir", str(mirror), "apply", "--cached",
+                                              "--whitespace=nowarn", str(path)], env=env, check=False)
+                    check.status = "ok" if result.ok else "failed"
+                    check.error = result.stdout.strip()
+                    cache[key] = {"status": check.status, "error": check.error}
+                    if result.ok:
+                        continue
+                if check.status == "ok":
+                    pending.append(path)
+                else:
+                    failed = True
+        return results
+
+    def check_patches(self, series_list: List[PatchSeries], jobs: Optional[int] = None) -> List[List[PatchCheck]]:
+        """
+        Check that patch series apply to their repositories.
+        
+        Identical series (same repository, ref and patches) are checked once.
+        Results are cached in the layer store by patch content and base
+        commit, so unchanged patch stacks are verified without running git.
+        
+        Args:
+            series_list: Patch series to check
+            jobs: Maximum number of series checked at the same time
+            
+        Returns:
+            Patch check results for each series, in the order of series_list
+            
+        Raises:
+            SystemExit: If a repository cannot be fetched or a ref cannot be resolved
+        """
+        cache_path = self.root / self.PATCH_CACHE_FILE
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+        def series_key(series: PatchSeries) -> str:
+            patches = ",".join(f"{patch_id}={path}" for patch_id, path in series.patches)
+            return f"{series.url}@{series.commit or series.tag or series.branch}:{patches}"
+
+        unique: Dict[str, PatchSeries] = {}
+        for series in series_list:
+            unique.setdefault(series_key(series), series)
+
+        async def main():
+            semaphore = asyncio.Semaphore(jobs or os.cpu_count() or 4)
+
+            async def one(series: PatchSeries):
+                async with semaphore:
+                    return await self._check_series(series, cache)
+
+            return await asyncio.gather(*(one(series) for series in unique.values()),
+                                        return_exceptions=True)
+
+        self._locks = {}
+        results = dict(zip(unique.keys(), runner.run_coroutine_sync(main())))
+        failed = False
+        for key, result in results.items():
+            if isinstance(result, BaseException):
+                logging.error(f"Cannot check patches of {unique[key].repo} ({unique[key].url}): {result}")
+                failed = True
+        if failed:
+            sys.exit(1)
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+        return [results[series_key(series)] for series in series_list]
+
+# =============================================================================
+# Shared State Mirror
+# =============================================================================
+
+def is_loopback_address(host: str) -> bool:
+    """Check whether a listen address only accepts connections from this host."""
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+class SstateRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP handler serving an SSTATE_DIR to BitBake sstate mirror fetches.
+    
+    GET and HEAD support single byte ranges and send file contents with
+    sendfile(). PUT stores new sstate objects atomically when the server
+    allows uploads; existing objects are never replaced. With an upload
+    token, PUT requests must send it as 'Authorization: Bearer <token>'.
+    """
+
+    server_version = "bsp-sstate/1.0"
+    protocol_version = "HTTP/1.1"  # Keep-alive for the many small sstate requests of a build
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug("sstate %s: %s", self.address_string(), format % args)
+
+    def _resolve(self) -> Optional[Path]:
+        """Map the request path to a file below the served directory."""
+        relative = unquote(urlparse(self.path).path).lstrip('/')
+        root = self.server.root
+        target = Path(os.path.normpath(root / relative))
+        if target != root and root not in target.parents:
+            return None
+        return target
+
+    def do_HEAD(self) -> None:
+        self._send_file(head=True)
+
+    def do_GET(self) -> None:
+        self._send_file(head=False)
+
+    def _send_file(self, head: bool) -> None:
+        target = self._resolve()
+        if target is None or not target.is_file():
+            self.send_error(404)
+            return
+        with open(target, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            start, end = 0, size - 1
+            status = 200
+            match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', '').strip())
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    start = max(0, size - int(match.group(2)))
+                if start >= size or start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f"bytes */{size}")
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+            length = end - start + 1
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+            if status == 206:
+                self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if not head and length > 0:
+                self.wfile.flush()
+                self.connection.sendfile(f, start, length)
+
+    def do_PUT(self) -> None:
+        if not self.server.allow_upload:
+            self.send_error(405, "Uploads are disabled")
+            return
+        token = self.server.upload_token
+        if token and not hmac.compare_digest(self.headers.get('Authorization', '').encode(),
+                                             f"Bearer {token}".encode()):
+            self.send_error(401, "Upload token missing or wrong")
+            return
+        target = self._resolve()
+        if target is None or not target.name.startswith('sstate:'):
+            self.send_error(403, "Only sstate objects can be uploaded")
+            return
+        try:
+            remaining = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+
+        exists = target.exists()
+        tmp = target.with_name(f".{target.name}.{threading.get_ident()}.tmp")
+        out = None
+        if not exists:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            out = open(tmp, 'wb')
+        try:
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 1 << 20))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if out:
+                    out.write(chunk)
+        finally:
+            if out:
+                out.close()
+        if remaining > 0:
+            if out:
+                tmp.unlink()
+            self.send_error(400, "Incomplete upload")
+            return
+        if out:
+            os.replace(tmp, target)
+        self.send_response(204 if exists else 201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+class SstateServer(http.server.ThreadingHTTPServer):
+    """
+    Threaded HTTP server exposing an SSTATE_DIR as a BitBake sstate mirror.
+    
+    Other workers use it through SSTATE_MIRRORS = "file://.* <url>/PATH;downloadfilename=PATH".
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root: str, host: str = "127.0.0.1", port: int = 8000, allow_upload: bool = False,
+                 upload_token: Optional[str] = None):
+        """
+        Args:
+            root: Directory to serve (SSTATE_DIR)
+            host: Address to listen on
+            port: Port to listen on (0 for any free port)
+            allow_upload: Accept PUT uploads of new sstate objects
+            upload_token: Shared secret required for uploads (None: no check)
+        """
+        self.root = Path(root).resolve()
+        self.allow_upload = allow_upload
+        self.upload_token = upload_token
+        super().__init__((host, port), SstateRequestHandler)
+
+    @property
+    def url(self) -> str:
+        """Base URL of the server."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+def sstate_mirrors_config(url: str) -> Dict[str, Any]:
+    """
+    KAS configuration adding an HTTP sstate mirror to a build.
+    
+    Args:
+        url: Base URL of the sstate mirror
+        
+    Returns:
+        KAS configuration with a local_conf_header entry for SSTATE_MIRRORS
+    """
+    mirror = f"file://.* {url.rstrip('/')}/PATH;downloadfilename=PATH"
+    return {"local_conf_header": {"bsp-sstate-mirror": f'SSTATE_MIRRORS += "{mirror}"\n'}}
+
+class SstatePusher:
+    """
+    Upload new local sstate objects to an sstate mirror server.
+    
+    Objects already pushed to a mirror are recorded in a state file in
+    SSTATE_DIR, so repeated pushes only look at objects created since. The
+    server is asked with HEAD before uploading, so objects it received from
+    another worker are not sent again.
+    """
+
+    def __init__(self, sstate_dir: str, url: str, token: Optional[str] = None):
+        """
+        Args:
+            sstate_dir: Local SSTATE_DIR
+            url: Base URL of the mirror server
+            token: Upload token of the server (SSTATE_UPLOAD_TOKEN)
+        """
+        self.sstate_dir = Path(sstate_dir)
+        self.url = url.rstrip('/')
+        self.token = token
+        parsed = urlparse(self.url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.base_path = parsed.path
+        digest = hashlib.sha256(self.url.encode()).hexdigest()[:12]
+        self.state_path = self.sstate_dir / f".bsp-pushed-{digest}"
+        self._local = threading.local()
+
+    def _pushed(self) -> set:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return {line.rstrip('\n') for line in f}
+        except OSError:
+            return set()
+
+    def pending(self) -> List[str]:
+        """Relative paths of sstate objects not pushed to the mirror yet."""
+        pushed = self._pushed()
+        pending = []
+        for dirpath, dirnames, filenames in os.walk(self.sstate_dir):
+            for filename in filenames:
+                if filename.startswith('sstate:') and not filename.endswith('.tmp'):
+                    relative = os.path.relpath(os.path.join(dirpath, filename), self.sstate_dir)
+                    if relative not in pushed:
+                        pending.append(relative)
+        return sorted(pending)
+
+    def _connection(self) -> http.client.HTTPConnection:
+        """Per-thread keep-alive connection to the mirror."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=300)
+            self._local.conn = conn
+        return conn
+
+    def _request(self, method: str, relative: str, body=None, length: int = 0) -> int:
+        path = f"{self.base_path}/{quote(relative)}"
+        headers = {"Content-Length": str(length)} if method == "PUT" else {}
+        if method == "PUT" and self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        for attempt in range(2):
+            conn = self._connection()
+            if body is not None:
+                body.seek(0)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                return response.status
+            except (OSError, http.client.HTTPException):
+                # The server may have closed the idle keep-alive connection: retry once
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+        return 0
+
+    def _push_one(self, relative: str) -> Tuple[str, int]:
+        """Upload a single object unless the mirror has it; returns the uploaded byte count."""
+        if self._request("HEAD", relative) == 200:
+            return relative, 0
+        path = self.sstate_dir / relative
+        size = path.stat().st_size
+        with open(path, 'rb') as f:
+            status = self._request("PUT", relative, body=f, length=size)
+        if status not in (200, 201, 204):
+            raise ScriptError(f"upload of {relative} failed with HTTP status {status}")
+        return relative, size if status == 201 else 0
+
+    def push(self, jobs: Optional[int] = None) -> Tuple[int, int, int]:
+        """
+        Upload all pending objects.
+        
+        Args:
+            jobs: Number of parallel uploads
+            
+        Returns:
+            Tuple of checked objects, uploaded objects and uploaded bytes
+            
+        Raises:
+            ScriptError: If the mirror rejects an upload
+            OSError: If the mirror cannot be reached
+        """
+        pending = self.pending()
+        uploaded = 0
+        uploaded_bytes = 0
+        with open(self.state_path, 'a', encoding='utf-8') as state, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=jobs or 8) as pool:
+            for relative, size in pool.map(self._push_one, pending):
+                state.write(relative + "\n")
+                if size:
+                    uploaded += 1
+                    uploaded_bytes += size
+        return len(pending), uploaded, uploaded_bytes
+
+# =============================================================================
+# Hash Equivalence Server
+# =============================================================================
+
+class HashEquivalenceServer:
+    """
+    Supervisor for a host-wide bitbake-hashserv instance.
+    
+    The server keeps its SQLite database below the cache root so hash
+    equivalence information survives across builds and build directories.
+    It runs detached from the bsp.py process and is described by a state
+    file (pid, address, port, database); every build checks that the
+    recorded server is alive and reuses it, or starts a new one. Starting
+    is serialized with a file lock so concurrent builds on the same host
+    end up sharing a single server.
+    
+    The server accepts unauthenticated writes of unihash mappings, which
+    feed sstate reuse, so it only listens on the Docker bridge gateway
+    (reachable from build containers and the host, not from the network)
+    or, without Docker, on the loopback interface.
+    """
+
+    STATE_FILE = "server.json"
+    START_TIMEOUT = 30.0
+
+    def __init__(self, root: str):
+        """
+        Args:
+            root: Directory for the database, log and state files
+        """
+        self.root = Path(root)
+        self.db_path = self.root / "hashserv.db"
+        self.log_path = self.root / "hashserv.log"
+        self.state_path = self.root / self.STATE_FILE
+
+    @staticmethod
+    def find_executable(search_dirs: List[str]) -> Optional[str]:
+        """
+        Find bitbake-hashserv in PATH or in the bitbake checkout of a build directory.
+        
+        Args:
+            search_dirs: Build directories to search
+            
+        Returns:
+            Path of the bitbake-hashserv script, or None if not found
+        """
+        executable = shutil.which("bitbake-hashserv")
+        if executable:
+            return executable
+        for directory in search_dirs:
+            for pattern in ("bitbake/bin/bitbake-hashserv", "*/bitbake/bin/bitbake-hashserv",
+                            "*/*/bitbake/bin/bitbake-hashserv"):
+                matches = sorted(Path(directory).glob(pattern))
+                if matches:
+                    return str(matches[0])
+        return None
+
+    def _read_state(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _is_alive(state: Dict[str, Any]) -> bool:
+        """Check that the recorded process exists and accepts connections."""
+        try:
+            os.kill(state['pid'], 0)
+        except (OSError, KeyError):
+            return False
+        try:
+            with socket.create_connection((state.get('host', "127.0.0.1"), state['port']), timeout=2):
+                return True
+        except OSError:
+            return False
+
+    def status(self) -> Optional[Dict[str, Any]]:
+        """State of the running server, or None if no server is running."""
+        state = self._read_state()
+        if state and self._is_alive(state):
+            return state
+        return None
+
+    def ensure_running(self, executable: str) -> Dict[str, Any]:
+        """
+        Reuse the running server or start a new one.
         
-        This method replaces all occurrences of $ENV{VAR_NAME} with the
-        actual value of the environment variable VAR_NAME from the system.
+        Args:
+            executable: Path of the bitbake-hashserv script
+            
+        Returns:
+            Server state with pid and port
+            
+        Raises:
+            ScriptError: If the server does not start
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / "server.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._read_state()
+            if state and 'host' not in state:
+                # Servers started by earlier versions listen on all interfaces
+                logging.warning("Restarting hash equivalence server that listens on all interfaces")
+                self.stop()
+                state = None
+            if state and self._is_alive(state):
+                return state
+            if state:
+                logging.warning("Hash equivalence server is not running anymore, restarting it")
+
+            # Pick a free port on an address that build containers, but not other hosts, can reach
+            host = docker_bridge_gateway() or "127.0.0.1"
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+                probe.bind((host, 0))
+                port = probe.getsockname()[1]
+            cmd = [executable, "--bind", f"{host}:{port}", "--database", str(self.db_path), "--log", "INFO"]
+            logging.info(f"Starting hash equivalence server: {' '.join(cmd)}")
+            with open(self.log_path, 'ab') as log:
+                proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+            state = {"pid": proc.pid, "host": host, "port": port, "database": str(self.db_path),
+                     "executable": executable,
+                     "started": time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+            deadline = time.monotonic() + self.START_TIMEOUT
+            while not self._is_alive(state):
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    if proc.poll() is None:
+                        proc.kill()
+                    raise ScriptError(f"bitbake-hashserv did not start, see {self.log_path}")
+                time.sleep(0.2)
+            tmp_path = self.state_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, indent=1)
+            os.replace(tmp_path, self.state_path)
+            return state
+
+    def stop(self) -> bool:
+        """
+        Stop the running server.
         
-        Examples:
-          "$ENV{HOME}/.gitconfig" -> "/home/username/.gitconfig"
-          "$ENV{HOME}/data/cache" -> "/home/username/data/cache"
+        Returns:
+            True if a server was stopped
+        """
+        state = self.status()
+        if self.state_path.exists():
+            self.state_path.unlink()
+        if not state:
+            return False
+        try:
+            os.killpg(state['pid'], signal.SIGTERM)
+        except OSError as e:
+            logging.debug("Cannot stop hash equivalence server: %s", e)
+            return False
+        return True
+
+    def hash_counts(self) -> Tuple[int, int]:
+        """
+        Count task hashes in the database.
+        
+        Returns:
+            Tuple of known task hashes and task hashes mapped to an
+            equivalent unihash of another task hash (unihash hits)
+        """
+        if not self.db_path.exists():
+            return 0, 0
+        try:
+            db = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=10)
+            try:
+                tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+                # unihashes_v2 in current bitbake, tasks_v2 in older releases
+                table = "unihashes_v2" if "unihashes_v2" in tables else "tasks_v2" if "tasks_v2" in tables else None
+                if not table:
+                    return 0, 0
+                total, hits = db.execute(f"SELECT COUNT(*), SUM(unihash != taskhash) FROM {table}").fetchone()
+                return total or 0, hits or 0
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logging.debug("Cannot read hash equivalence database: %s", e)
+            return 0, 0
+
+# =============================================================================
+# Downloads Directory
+# =============================================================================
+
+class _PlainUnpickler(pickle.Unpickler):
+    """Unpickler restricted to plain values, for checksums BitBake pickles into .done markers."""
+
+    def find_class(self, module: str, name: str):
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed")
+
+class DownloadsIndex:
+    """
+    Persistent index of the entries of a BitBake download directory (DL_DIR).
+    
+    The index records, per directory, its modification time and the type,
+    size, inode and modification time of its entries, plus the SHA-256 of
+    files once it was needed. A refresh lists again only directories whose
+    modification time changed, which happens whenever an entry is added,
+    removed or renamed, so a download directory shared by many builds is
+    not walked completely on every lookup. Digests are kept while size and
+    modification time of a file stay the same. VCS clones (e.g.
+    git2/<repository>) are indexed as single entries.
+    """
+
+    VERSION = 2
+
+    def __init__(self, root: Path, index_path: Path):
+        """
+        Args:
+            root: Download directory
+            index_path: File holding the index between runs
+        """
+        self.root = root
+        self.index_path = index_path
+        self.dirs: Dict[str, Dict[str, Any]] = {}
+        # Directories listed by the last refresh
+        self.scanned = 0
+
+    def load(self) -> None:
+        """Load the index saved by an earlier run, if it describes the same directory."""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self.VERSION and data.get('root') == str(self.root):
+            self.dirs = data.get('dirs') or {}
+
+    def save(self) -> None:
+        """Store the index for later runs."""
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": self.VERSION, "root": str(self.root), "dirs": self.dirs}, f)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _is_clone(path: Path) -> bool:
+        """Check whether a directory is a VCS clone (bare git repository or working copy)."""
+        if (path / "HEAD").is_file() and (path / "objects").is_dir():
+            return True
+        return any((path / vcs).exists() for vcs in ('.git', '.hg', '.svn'))
+
+    def _scan(self, path: Path, previous: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """List the entries of a directory, keeping digests of unchanged files."""
+        entries = {}
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    record = {"dir": is_dir, "size": 0 if is_dir else st.st_size, "mtime_ns": st.st_mtime_ns,
+                              "ino": st.st_ino}
+                    if is_dir and self._is_clone(Path(entry.path)):
+                        record["clone"] = True
+                    old = previous.get(entry.name)
+                    if old and old.get('sha256') and (old['size'], old['mtime_ns']) == (record['size'],
+                                                                                         record['mtime_ns']):
+                        record["sha256"] = old['sha256']
+                    entries[entry.name] = record
+        except OSError as e:
+            logging.warning(f"Cannot list {path}: {e}")
+        return entries
+
+    def refresh(self) -> None:
+        """Bring the index up to date, listing only directories that changed."""
+        dirs: Dict[str, Dict[str, Any]] = {}
+        pending = [""]
+        self.scanned = 0
+        while pending:
+            rel = pending.pop()
+            path = self.root / rel
+            try:
+                mtime = path.stat().st_mtime_ns
+            except OSError:
+                continue
+            cached = self.dirs.get(rel)
+            if cached and cached['mtime_ns'] == mtime:
+                entries = cached['entries']
+            else:
+                entries = self._scan(path, cached['entries'] if cached else {})
+                self.scanned += 1
+            dirs[rel] = {"mtime_ns": mtime, "entries": entries}
+            for name, entry in entries.items():
+                if entry['dir'] and not entry.get('clone'):
+                    pending.append(f"{rel}/{name}" if rel else name)
+        self.dirs = dirs
+
+    def exists(self, rel_path: str) -> bool:
+        """
+        Check whether a path below the download directory exists.
         
         Args:
-            value: String value that may contain $ENV{VAR} patterns
+            rel_path: Path relative to the download directory
             
         Returns:
-            String with all $ENV{VAR} patterns expanded to their actual values
+            True if the index has the entry (paths inside clones are checked on disk)
+        """
+        parent, name = os.path.split(rel_path)
+        if parent not in self.dirs:
+            return (self.root / rel_path).exists()
+        return name in self.dirs[parent]['entries']
+
+    def _entry(self, rel_path: str) -> Dict[str, Any]:
+        """Get the index entry of a path (which must be indexed)."""
+        parent, name = os.path.split(rel_path)
+        return self.dirs[parent]['entries'][name]
+
+    def files(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Get the indexed files (not directories or clones) with their entries."""
+        return [(f"{rel}/{name}" if rel else name, entry)
+                for rel, listing in self.dirs.items()
+                for name, entry in listing['entries'].items() if not entry['dir']]
+
+    def clones(self) -> List[str]:
+        """Get the paths of the indexed VCS clones."""
+        return [f"{rel}/{name}" if rel else name
+                for rel, listing in self.dirs.items()
+                for name, entry in listing['entries'].items() if entry.get('clone')]
+
+    def size_of(self, rel_path: str) -> int:
+        """Get the size of an indexed file, or the total size of the files of a clone."""
+        parent, name = os.path.split(rel_path)
+        entry = self.dirs.get(parent, {}).get('entries', {}).get(name)
+        if not entry:
+            return 0
+        if not entry.get('clone'):
+            return entry['size']
+        total = 0
+        for dir_path, _, names in os.walk(self.root / rel_path):
+            for file_name in names:
+                try:
+                    total += os.lstat(os.path.join(dir_path, file_name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    @staticmethod
+    def _hash(path: Path) -> Optional[str]:
+        """Hash a file in a worker process, None if it disappeared."""
+        try:
+            return file_sha256(path)
+        except OSError:
+            return None
+
+    def hash_files(self, rel_paths: List[str], jobs: Optional[int] = None) -> int:
+        """
+        Compute the SHA-256 of files not hashed yet or changed since they were hashed.
+        
+        Files are hashed in a process pool and the digests are stored in
+        the index entries.
+        
+        Args:
+            rel_paths: Indexed files relative to the download directory
+            jobs: Number of worker processes (default: CPU count)
             
-        Raises:
-            ConfigurationError: If a referenced environment variable is not set
+        Returns:
+            Number of files hashed
         """
-        def replace_env_var(match):
-            var_name = match.group(1)
-            if var_name in os.environ:
-                return os.environ[var_name]
+        todo = []
+        for rel_path in rel_paths:
+            entry = self._entry(rel_path)
+            try:
+                st = os.stat(self.root / rel_path)
+            except OSError:
+                continue
+            if entry.get('sha256') and (entry['size'], entry['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+                continue
+            entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns, ino=st.st_ino, sha256=None)
+            todo.append(rel_path)
+        if not todo:
+            return 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+            digests = pool.map(self._hash, [self.root / rel_path for rel_path in todo], chunksize=4)
+            for rel_path, digest in zip(todo, digests):
+                self._entry(rel_path)['sha256'] = digest
+        return len(todo)
+
+    def done_checksums(self, rel_path: str) -> Dict[str, str]:
+        """
+        Read the checksums BitBake recorded in the .done marker of a download.
+        
+        The marker is the pickled result of the fetcher's checksum
+        verification, keyed by checksum id ('md5', 'sha256', ...); only
+        plain values are unpickled.
+        
+        Args:
+            rel_path: Download path relative to the download directory
+            
+        Returns:
+            Checksums by id, empty if the marker records none
+        """
+        try:
+            with open(self.root / f"{rel_path}.done", 'rb') as f:
+                checksums = _PlainUnpickler(f).load()
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            return {}
+        return checksums if isinstance(checksums, dict) else {}
+
+    def is_lock_held(self, rel_path: str) -> bool:
+        """Check whether a BitBake lock file is held by a running fetch."""
+        try:
+            with open(self.root / rel_path, 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return True
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                return False
+        except OSError:
+            return False
+
+    def find_problems(self, verify: bool = False, jobs: Optional[int] = None) -> List[Tuple[str, str, str]]:
+        """
+        Find download directory entries that are incomplete, stale or corrupt.
+        
+        Args:
+            verify: Hash downloads and compare them with the checksums in their .done markers
+            jobs: Number of hashing processes
+            
+        Returns:
+            Tuples of kind ('partial', 'orphaned', 'stale-lock', 'corrupt'),
+            path relative to the download directory and description
+        """
+        problems = []
+        held = set()
+        for rel_path, _ in self.files():
+            if rel_path.endswith('.lock'):
+                if self.is_lock_held(rel_path):
+                    held.add(rel_path[:-len('.lock')])
+                else:
+                    problems.append(('stale-lock', rel_path, "lock file not held by any fetch"))
+
+        downloads = []
+        for rel_path, entry in self.files():
+            if rel_path.endswith('.lock'):
+                continue
+            if rel_path.endswith('.done'):
+                if not self.exists(rel_path[:-len('.done')]):
+                    problems.append(('orphaned', rel_path, "done marker without download"))
+            elif rel_path not in held and not self.exists(f"{rel_path}.done"):
+                problems.append(('partial', rel_path, f"no .done marker ({entry['size'] / 2**20:.1f} MiB)"))
+            elif entry['size'] == 0:
+                problems.append(('corrupt', rel_path, "empty download"))
             else:
-                logging.warning(f"Environment variable '{var_name}' is not set, "
-                               f"using empty string for expansion in: {value}")
-                return ""
+                downloads.append(rel_path)
+        for rel_path in self.clones():
+            if rel_path not in held and not self.exists(f"{rel_path}.done"):
+                problems.append(('partial', rel_path, "clone without .done marker"))
+
+        if verify:
+            expected = {}
+            for rel_path in downloads:
+                checksums = self.done_checksums(rel_path)
+                # Recipes name the checksum sha256sum, the fetcher records it as sha256
+                sha256 = checksums.get('sha256') or checksums.get('sha256sum')
+                if sha256:
+                    expected[rel_path] = sha256
+            self.hash_files(list(expected), jobs)
+            for rel_path, sha256 in sorted(expected.items()):
+                actual = self._entry(rel_path).get('sha256')
+                if actual and actual != sha256:
+                    problems.append(('corrupt', rel_path, f"sha256 {actual[:12]} does not match "
+                                                          f"{sha256[:12]} recorded in .done"))
+        return sorted(problems, key=lambda problem: problem[1])
+
+    def find_duplicates(self, jobs: Optional[int] = None) -> List[List[str]]:
+        """
+        Find downloads with identical contents stored as separate files.
         
-        # Replace all $ENV{VAR} patterns with actual environment variable values
-        expanded_value = self.ENV_VAR_PATTERN.sub(replace_env_var, value)
+        Only files whose size occurs more than once are hashed. Files that
+        are already hardlinks of each other count as one copy.
         
-        # Also expand any standard environment variables (for backward compatibility)
-        expanded_value = os.path.expandvars(expanded_value)
+        Args:
+            jobs: Number of hashing processes
+            
+        Returns:
+            Groups of paths with identical contents, one file per inode, largest first
+        """
+        by_size: Dict[int, List[str]] = {}
+        for rel_path, entry in self.files():
+            if entry['size'] and not rel_path.endswith(('.done', '.lock')):
+                by_size.setdefault(entry['size'], []).append(rel_path)
+        candidates = [rel_path for paths in by_size.values() if len(paths) > 1 for rel_path in paths]
+        self.hash_files(candidates, jobs)
+
+        groups: Dict[str, Dict[Any, str]] = {}
+        for rel_path in candidates:
+            entry = self._entry(rel_path)
+            if entry.get('sha256'):
+                inode = entry.get('ino') or rel_path
+                groups.setdefault(entry['sha256'], {}).setdefault(inode, rel_path)
+        duplicates = [sorted(paths.values()) for paths in groups.values() if len(paths) > 1]
+        return sorted(duplicates, key=lambda paths: -self._entry(paths[0])['size'])
+
+    def link_duplicates(self, paths: List[str]) -> int:
+        """
+        Replace identical downloads by hardlinks to the first one.
         
-        return expanded_value
+        Args:
+            paths: Paths with identical contents (from find_duplicates)
+            
+        Returns:
+            Bytes freed
+        """
+        source = self.root / paths[0]
+        freed = 0
+        for rel_path in paths[1:]:
+            target = self.root / rel_path
+            tmp = target.with_name(f".{target.name}.bsp-tmp")
+            try:
+                if tmp.exists():
+                    tmp.unlink()
+                os.link(source, tmp)
+                os.replace(tmp, target)
+            except OSError as e:
+                logging.warning(f"Cannot link {rel_path} to {paths[0]}: {e}")
+                continue
+            freed += self._entry(rel_path)['size']
+            self._entry(rel_path)['ino'] = source.stat().st_ino
+        return freed
+
+    def source_status(self, source: Dict[str, Any]) -> str:
+        """
+        Check whether a download needed by a recipe can be used without network access.
         
-    def _build_environment_dict(self) -> Dict[str, str]:
+        Args:
+            source: Entry of a source list (localpath, donestamp and mirrors
+                relative to the download directory)
+                
+        Returns:
+            'ok' (downloaded and complete), 'mirror' (only a mirror tarball
+            exists), 'partial' (downloaded without .done marker) or 'missing'
         """
-        Build a dictionary from the environment variable list with expansion.
+        if self.exists(source['localpath']) and self.exists(source['donestamp']):
+            return 'ok'
+        if any(self.exists(mirror) for mirror in source.get('mirrors') or []):
+            return 'mirror'
+        if self.exists(source['localpath']):
+            return 'partial'
+        return 'missing'
+
+# Source list of a BSP kept in its build directory, reused while the build fingerprint is unchanged
+SOURCE_LIST_FILE = "bsp-sources.json"
+
+# Script run in the kas shell of a BSP after 'bitbake -g': prints the downloads
+# of every recipe in pn-buildlist, as fetch2 computes them, relative to DL_DIR
+SOURCE_LIST_SCRIPT = r'''
+import json, os, shutil, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(shutil.which('bitbake'))), '..', 'lib'))
+import bb.fetch2
+import bb.tinfoil
+
+with open('pn-buildlist') as f:
+    recipes = sorted({line.strip() for line in f if line.strip()})
+with bb.tinfoil.Tinfoil() as tinfoil:
+    tinfoil.prepare(config_only=False, quiet=2)
+    for pn in recipes:
+        try:
+            d = tinfoil.parse_recipe(pn)
+            dl_dir = d.getVar('DL_DIR')
+            fetcher = bb.fetch2.Fetch((d.getVar('SRC_URI') or '').split(), d)
+            for url in fetcher.urls:
+                ud = fetcher.ud[url]
+                if ud.type == 'file' or not ud.localpath or not ud.localpath.startswith(dl_dir + '/'):
+                    continue
+                print('BSP-SOURCE ' + json.dumps({
+                    'recipe': pn,
+                    'url': url,
+                    'localpath': os.path.relpath(ud.localpath, dl_dir),
+                    'donestamp': os.path.relpath(ud.donestamp, dl_dir),
+                    'mirrors': list(getattr(ud, 'mirrortarballs', None) or []),
+                }), flush=True)
+        except Exception as e:
+            print('BSP-SOURCE-ERROR ' + json.dumps({'recipe': pn, 'error': str(e)}), flush=True)
+'''
+
+# =============================================================================
+# Disk Usage
+# =============================================================================
+
+# Usage categories of a build path, in report order
+DISK_USAGE_CATEGORIES = ('layers', 'work', 'deploy', 'sstate-control', 'cache', 'other')
+
+
+def disk_usage_category(rel_path: str) -> str:
+    """
+    Classify a directory of a build path for the disk usage report.
+    
+    KAS checks layers out into the build path and runs BitBake in its
+    build/ subdirectory, so <build path>/build/tmp/work is work, any other
+    top-level directory is a layer, and so on.
+    
+    Args:
+        rel_path: Directory relative to the build path ("" for the build path itself)
         
-        This method processes each environment variable value and expands
-        any $ENV{VAR} patterns to their actual system environment values.
+    Returns:
+        One of DISK_USAGE_CATEGORIES
+    """
+    parts = rel_path.split('/') if rel_path else []
+    in_build = bool(parts) and parts[0] == 'build'
+    if in_build:
+        parts = parts[1:]
+    if not parts:
+        return 'other'
+    if parts[0].startswith('tmp'):
+        if len(parts) < 2:
+            return 'other'
+        if parts[1] in ('work', 'work-shared'):
+            return 'work'
+        if parts[1] in ('deploy', 'sstate-control'):
+            return parts[1]
+        if parts[1] in ('cache', 'stamps'):
+            return 'cache'
+        return 'other'
+    if parts[0] == 'cache':
+        return 'cache'
+    if not in_build and parts[0] not in ('sstate-cache', 'downloads'):
+        return 'layers'
+    return 'other'
+
+
+class DiskUsageSnapshot:
+    """
+    Disk usage of build paths, kept between runs.
+    
+    For every directory below a build path the snapshot records its
+    modification time, the space allocated to its files and its
+    subdirectories. Directories are listed by a pool of threads; a later
+    scan lists again only directories whose modification time changed
+    (entries added, removed or renamed) and reuses the recorded usage of
+    the others. Files with several hardlinks are recorded by inode so
+    that each is counted once.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path):
+        """
+        Args:
+            path: File holding the snapshot between runs
+        """
+        self.path = path
+        self.trees: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # Directories listed by the last scan
+        self.scanned = 0
+
+    def load(self) -> None:
+        """Load the snapshot saved by an earlier run."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self.VERSION:
+            self.trees = data.get('trees') or {}
+
+    def save(self) -> None:
+        """Store the snapshot for later runs."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": self.VERSION, "trees": self.trees}, f)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _list(path: Path) -> Dict[str, Any]:
+        """List a directory: space of its files, hardlinked files and subdirectories."""
+        st = os.lstat(path)
+        record = {"mtime_ns": st.st_mtime_ns, "size": st.st_blocks * 512, "links": [], "subdirs": []}
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            record['subdirs'].append(entry.name)
+                            continue
+                        est = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if est.st_nlink > 1:
+                        record['links'].append([est.st_dev, est.st_ino, est.st_blocks * 512])
+                    else:
+                        record['size'] += est.st_blocks * 512
+        except OSError as e:
+            logging.warning(f"Cannot list {path}: {e}")
+        return record
+
+    def scan(self, root: Path, jobs: Optional[int] = None, refresh: bool = False) -> Dict[str, Dict[str, Any]]:
+        """
+        Bring the usage of a build path up to date.
         
+        Args:
+            root: Build path
+            jobs: Number of threads listing directories
+            refresh: List every directory again (files changed in place
+                do not change the modification time of their directory)
+                
         Returns:
-            Dictionary of environment variables with expanded values
+            Directory records by path relative to the build path
         """
-        env_dict = {}
-        for env_var in self.environment_vars:
-            # Expand environment variables in the value
-            expanded_value = self._expand_environment_variables(env_var.value)
-            env_dict[env_var.name] = expanded_value
-            logging.debug(f"Environment variable {env_var.name} expanded: "
-                         f"'{env_var.value}' -> '{expanded_value}'")
-        return env_dict
+        previous = {} if refresh else self.trees.get(str(root), {})
+
+        def visit(rel: str) -> Tuple[str, Optional[Dict[str, Any]], bool]:
+            path = root / rel if rel else root
+            try:
+                mtime = os.lstat(path).st_mtime_ns
+            except OSError:
+                return rel, None, False
+            cached = previous.get(rel)
+            if cached and cached['mtime_ns'] == mtime:
+                return rel, cached, False
+            try:
+                return rel, self._list(path), True
+            except OSError:
+                return rel, None, False
+
+        dirs: Dict[str, Dict[str, Any]] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or 16) as pool:
+            pending = {pool.submit(visit, "")}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    rel, record, listed = future.result()
+                    if record is None:
+                        continue
+                    dirs[rel] = record
+                    self.scanned += listed
+                    for name in record['subdirs']:
+                        pending.add(pool.submit(visit, f"{rel}/{name}" if rel else name))
+        if dirs:
+            self.trees[str(root)] = dirs
+        else:
+            self.trees.pop(str(root), None)
+        return dirs
+
+    @staticmethod
+    def summarize(dirs: Dict[str, Dict[str, Any]], seen: Set[Tuple[int, int]]) -> Dict[str, int]:
+        """
+        Add up the usage of a build path by category.
+        
+        Args:
+            dirs: Directory records from scan
+            seen: Inodes of hardlinked files already counted; updated
+            
+        Returns:
+            Bytes by category of DISK_USAGE_CATEGORIES
+        """
+        usage = dict.fromkeys(DISK_USAGE_CATEGORIES, 0)
+        for rel in sorted(dirs):
+            record = dirs[rel]
+            category = disk_usage_category(rel)
+            usage[category] += record['size']
+            for dev, ino, size in record['links']:
+                if (dev, ino) not in seen:
+                    seen.add((dev, ino))
+                    usage[category] += size
+        return usage
+
+# =============================================================================
+# Build Cleaning
+# =============================================================================
+
+# Prefix of directories renamed aside for removal in the background
+TRASH_PREFIX = ".bsp-trash-"
+
+# Script run detached from bsp.py: removes the directories given as arguments,
+# unlinking the files of each directory in a thread pool
+TRASH_REMOVAL_SCRIPT = r'''
+import concurrent.futures, os, sys
+
+def unlink_all(dir_path, names):
+    for name in names:
+        try:
+            os.unlink(os.path.join(dir_path, name))
+        except OSError:
+            pass
+
+for top in sys.argv[1:]:
+    dirs = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+        for dir_path, dir_names, file_names in os.walk(top):
+            dirs.append(dir_path)
+            links = [name for name in dir_names if os.path.islink(os.path.join(dir_path, name))]
+            if file_names or links:
+                pool.submit(unlink_all, dir_path, file_names + links)
+    for dir_path in reversed(dirs):
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            pass
+'''
+
+# Script run in the kas shell of a BSP: prints the recipes (with their
+# native/nativesdk variants) defined or appended in the layer directories given
+CHANGED_RECIPES_SCRIPT = r'''
+import os, shutil, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(shutil.which('bitbake'))), '..', 'lib'))
+import bb.cache
+import bb.tinfoil
+
+layers = tuple(os.path.realpath(path) + '/' for path in sys.argv[1:])
+with bb.tinfoil.Tinfoil() as tinfoil:
+    tinfoil.prepare(config_only=False, quiet=2)
+    collection = tinfoil.cooker.collections['']
+    recipes = set()
+    for fn, pn in tinfoil.cooker.recipecaches[''].pkg_fn.items():
+        real_fn = bb.cache.virtualfn2realfn(fn)[0]
+        files = [real_fn] + list(collection.get_file_appends(real_fn))
+        if any(os.path.realpath(path).startswith(layers) for path in files):
+            recipes.add(pn)
+    for pn in sorted(recipes):
+        print('BSP-RECIPE ' + pn, flush=True)
+'''
+
+
+def remove_in_background(paths: List[Path]) -> List[Path]:
+    """
+    Remove directories without waiting for the removal.
+    
+    Each directory is renamed aside within its parent directory, which is
+    atomic, so the original path can be reused at once. The renamed
+    directories, and those left over by earlier removals that were
+    interrupted, are deleted by a detached process.
+    
+    Args:
+        paths: Directories to remove (missing ones are ignored)
+        
+    Returns:
+        Directories renamed aside
+        
+    Raises:
+        OSError: If a directory cannot be renamed
+    """
+    renamed = []
+    parents = set()
+    for path in paths:
+        if not path.exists():
+            continue
+        trash = path.with_name(f"{TRASH_PREFIX}{path.name}.{time.strftime('%Y%m%d%H%M%S')}.{os.getpid()}")
+        os.rename(path, trash)
+        renamed.append(trash)
+        parents.add(path.parent)
+    leftovers = [entry for parent in parents for entry in parent.glob(f"{TRASH_PREFIX}*")
+                 if entry not in renamed and entry.is_dir()]
+    if renamed or leftovers:
+        subprocess.Popen([sys.executable, "-c", TRASH_REMOVAL_SCRIPT] + [str(path) for path in renamed + leftovers],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+    return renamed
+
+# =============================================================================
+# Distributed Builds
+# =============================================================================
+
+# Yocto release codenames recognised in BSP names
+YOCTO_RELEASES = ('dunfell', 'kirkstone', 'langdale', 'mickledore', 'nanbield',
+                  'scarthgap', 'styhead', 'walnascar', 'whinlatter')
+
+def bsp_release(bsp: BSP) -> str:
+    """
+    Get the Yocto release a BSP is built from.
+    
+    BSPs of the same release share most of their downloads and sstate
+    objects. Uses os.version when configured, otherwise the release
+    codename in the BSP name, otherwise the container name.
+    
+    Args:
+        bsp: BSP configuration object
+        
+    Returns:
+        Release name
+    """
+    if bsp.os and bsp.os.version:
+        return bsp.os.version
+    for token in bsp.name.split('-'):
+        if token in YOCTO_RELEASES:
+            return token
+    return bsp.build.environment.container or "unknown"
+
+@dataclass
+class HostAssignment:
+    """
+    Placement of a BSP build on a build host.
+    
+    Attributes:
+        bsp: BSP name
+        host: Build host name
+        score: Cache affinity score of the host for the BSP
+        reasons: Score components (e.g. 'built', 'release:3', 'image')
+    """
+    bsp: str
+    host: str
+    score: int
+    reasons: List[str] = field(default_factory=empty_list)
+
+class BuildDispatcher:
+    """
+    Dispatch BSP builds to build hosts, placing each build on the host with the warmest caches.
+    
+    Hosts are reached with ssh (BatchMode, so a missing key fails instead of
+    prompting) and run bsp.py from their own checkout of this repository.
+    Hosts without an ssh destination run bsp.py as a local subprocess in
+    their path, which stands in for a remote host in tests and on a single
+    machine.
+    
+    Placement scores each reachable host for each BSP:
+    - BUILT_SCORE if the host holds a previous build of the BSP
+    - RELEASE_SCORE for each BSP of the same release built on or already
+      placed on the host (shared downloads and sstate)
+    - IMAGE_SCORE if the host has the BSP container image with a matching fingerprint
+    - minus LOAD_PENALTY per build already placed, relative to the host jobs
+    - minus LOW_DISK_PENALTY if the host has less than MIN_FREE_BYTES free
+    """
+
+    BUILT_SCORE = 100
+    RELEASE_SCORE = 10
+    IMAGE_SCORE = 20
+    LOAD_PENALTY = 50
+    LOW_DISK_PENALTY = 100
+    MIN_FREE_BYTES = 50 * 2**30
+
+    def __init__(self, hosts: List[BuildHost], timeouts: Optional[Dict[str, float]] = None):
+        """
+        Args:
+            hosts: Configured build hosts
+            timeouts: Per-phase timeouts in seconds ('probe' and 'build' are used)
+        """
+        self.hosts = {host.name: host for host in hosts}
+        self.timeouts = timeouts or {}
+
+    @staticmethod
+    def host_command(host: BuildHost, args: List[str]) -> Tuple[List[str], Optional[str]]:
+        """
+        Build the command running bsp.py with arguments on a host.
+        
+        Args:
+            host: Build host
+            args: bsp.py command line arguments
+            
+        Returns:
+            Tuple of command and local working directory
+        """
+        command = [host.python, "bsp.py", "--no-color", "--registry", host.registry] + args
+        if host.ssh:
+            remote = f"cd {shlex.quote(host.path)} && {shlex.join(command)}"
+            return ["ssh", "-o", "BatchMode=yes", host.ssh, remote], None
+        return command, host.path
+
+    def _query(self, host_names: List[str], args: List[str], phase: str) -> Dict[str, Dict[str, Any]]:
+        """Run a bsp.py command printing JSON on several hosts and collect the parsed output."""
+        specs = []
+        captures = []
+        for name in host_names:
+            cmd, cwd = self.host_command(self.hosts[name], args)
+            capture = CaptureLineHandler()
+            debug_log = LoggingLineHandler(logging.DEBUG, prefix=f"{name}: ")
+            specs.append(ProcessSpec(cmd=cmd, cwd=cwd, phase=phase, timeout=self.timeouts.get(phase, 120),
+                                     stdout_handlers=[capture], stderr_handlers=[debug_log]))
+            captures.append(capture)
+        results = runner.run_all_sync(specs)
+
+        replies = {}
+        for name, capture, result in zip(host_names, captures, results):
+            if not result.ok:
+                logging.warning(f"Host {name} is unavailable ({phase} returned {result.returncode})")
+                continue
+            try:
+                replies[name] = json.loads(capture.text)
+            except ValueError:
+                logging.warning(f"Host {name} returned invalid {phase} output")
+        return replies
+
+    def probe(self, bsp_names: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Query cache state of all hosts concurrently.
+        
+        Args:
+            bsp_names: BSPs whose build state is queried
+            
+        Returns:
+            Probe result per reachable host (see BspManager.probe_host)
+        """
+        return self._query(list(self.hosts), ["hosts", "probe", "--json"] + bsp_names, "probe")
+
+    def assign(self, bsps: List[BSP], probes: Dict[str, Dict[str, Any]],
+               image_fingerprints: Dict[str, Optional[str]]) -> List[HostAssignment]:
+        """
+        Place BSP builds on hosts greedily by cache affinity.
+        
+        Args:
+            bsps: BSPs to place
+            probes: Probe results of the reachable hosts
+            image_fingerprints: Expected container fingerprint per BSP name
+            
+        Returns:
+            Assignments in the order of bsps
+            
+        Raises:
+            SystemExit: If no host is reachable
+        """
+        if not probes:
+            logging.error("No build host is reachable")
+            sys.exit(1)
+
+        release_counts = {name: {} for name in probes}
+        for name, probe in probes.items():
+            for info in probe.get('bsps', {}).values():
+                if info.get('built'):
+                    release = info.get('release')
+                    release_counts[name][release] = release_counts[name].get(release, 0) + 1
+        placed = {name: 0 for name in probes}
+
+        # Place BSPs with a previous build first, so load balancing does not push them off their host
+        def built_anywhere(bsp: BSP) -> bool:
+            return any(probe.get('bsps', {}).get(bsp.name, {}).get('built') for probe in probes.values())
+
+        assignments = {}
+        for bsp in sorted(bsps, key=lambda b: not built_anywhere(b)):
+            release = bsp_release(bsp)
+            best = None
+            for name, probe in probes.items():
+                info = probe.get('bsps', {}).get(bsp.name, {})
+                score = 0
+                reasons = []
+                if info.get('built'):
+                    score += self.BUILT_SCORE
+                    reasons.append("built")
+                same_release = release_counts[name].get(release, 0) - (1 if info.get('built') else 0)
+                if same_release > 0:
+                    score += self.RELEASE_SCORE * same_release
+                    reasons.append(f"release:{same_release}")
+                fingerprint = image_fingerprints.get(bsp.name)
+                if fingerprint and fingerprint in probe.get('images', {}).values():
+                    score += self.IMAGE_SCORE
+                    reasons.append("image")
+                if probe.get('free_bytes', self.MIN_FREE_BYTES) < self.MIN_FREE_BYTES:
+                    score -= self.LOW_DISK_PENALTY
+                    reasons.append("low-disk")
+                score -= self.LOAD_PENALTY * placed[name] // max(self.hosts[name].jobs, 1)
+                if best is None or score > best.score:
+                    best = HostAssignment(bsp.name, name, score, reasons)
+            assignments[bsp.name] = best
+            placed[best.host] += 1
+            if not probes[best.host].get('bsps', {}).get(bsp.name, {}).get('built'):
+                counts = release_counts[best.host]
+                counts[release] = counts.get(release, 0) + 1
+        return [assignments[bsp.name] for bsp in bsps]
+
+    def dispatch(self, assignments: List[HostAssignment], force: bool = False) -> Dict[str, ProcessResult]:
+        """
+        Run the assigned builds, at most host.jobs at a time on each host.
+        
+        Args:
+            assignments: Build placements
+            force: Pass --force to the builds
+            
+        Returns:
+            Process result per BSP name
+        """
+        by_host: Dict[str, List[Tuple[HostAssignment, ProcessSpec, CaptureLineHandler]]] = {}
+        for assignment in assignments:
+            args = ["build", assignment.bsp] + (["--force"] if force else [])
+            cmd, cwd = self.host_command(self.hosts[assignment.host], args)
+            tail = CaptureLineHandler(max_lines=50)
+            debug_log = LoggingLineHandler(logging.DEBUG, prefix=f"{assignment.host}/{assignment.bsp}: ")
+            spec = ProcessSpec(cmd=cmd, cwd=cwd, phase="build", timeout=self.timeouts.get('build'),
+                               stdout_handlers=[debug_log, tail], stderr_handlers=[debug_log, tail],
+                               bsp=assignment.bsp)
+            by_host.setdefault(assignment.host, []).append((assignment, spec, tail))
+            logging.info(f"Dispatching {assignment.bsp} to {assignment.host} (score {assignment.score})")
+
+        async def main():
+            groups = list(by_host.items())
+            outcomes = await asyncio.gather(*(
+                runner.run_all([spec for _, spec, _ in items], self.hosts[name].jobs) for name, items in groups))
+            return [(item, result) for (_, items), results in zip(groups, outcomes)
+                    for item, result in zip(items, results)]
+
+        results = {}
+        for (assignment, _, tail), result in runner.run_coroutine_sync(main()):
+            results[assignment.bsp] = result
+            if result.ok:
+                logging.info(f"{assignment.bsp}: built on {assignment.host} in {result.duration:.0f}s")
+            else:
+                logging.error(f"{assignment.bsp}: build on {assignment.host} failed "
+                              f"with return code {result.returncode}")
+                logging.error(f"Error output: {tail.text}")
+        return results
+
+    def fetch_artifacts(self, host: BuildHost, deploy_dir: str, target: Path) -> bool:
+        """
+        Copy the deploy images of a build from a host with rsync.
+        
+        Args:
+            host: Build host
+            deploy_dir: Deploy directory on the host (from its probe result)
+            target: Local target directory
+            
+        Returns:
+            True if the copy succeeded
+        """
+        source = f"{deploy_dir}/images/"
+        if host.ssh:
+            source = f"{host.ssh}:{source}"
+        target.mkdir(parents=True, exist_ok=True)
+        cmd = ["rsync", "-a", "--delete", "-e", "ssh -o BatchMode=yes", source, f"{target}/"]
+        tail = CaptureLineHandler(max_lines=20)
+        try:
+            result = runner.run_sync(ProcessSpec(cmd=cmd, phase="fetch", stdout_handlers=[tail],
+                                                 stderr_handlers=[tail]))
+        except OSError as e:
+            logging.error(f"Cannot run rsync: {e}")
+            return False
+        if not result.ok:
+            logging.error(f"Fetching artifacts from {host.name} failed: {tail.text}")
+        return result.ok
+
+# =============================================================================
+# Build Planning
+# =============================================================================
+
+def format_duration(seconds: float) -> str:
+    """Format a duration as e.g. '2h 05m', '12m' or '40s'."""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+@dataclass
+class PlanNode:
+    """
+    Step of a build plan.
+    
+    Attributes:
+        id: Unique node id ('<kind>:<name>')
+        kind: Step kind ('image', 'mirror', 'checkout' or 'build')
+        duration: Estimated duration in seconds
+        source: Origin of the estimate ('history', 'release', 'default' or 'up to date')
+        deps: Ids of the nodes that must finish first
+        bsps: BSPs that need this step
+    """
+    id: str
+    kind: str
+    duration: float
+    source: str
+    deps: List[str] = field(default_factory=empty_list)
+    bsps: List[str] = field(default_factory=empty_list)
+
+class BuildPlan:
+    """
+    Execution DAG of a set of BSP builds with duration estimates.
     
-    def get_environment_dict(self) -> Dict[str, str]:
+    Steps shared by several BSPs (container images, layer mirrors) appear
+    once. The critical path is the longest chain of dependent steps, i.e.
+    the build time with unlimited jobs. For a limited number of jobs the
+    plan is simulated with list scheduling, starting ready steps with the
+    longest remaining chain first; the critical path then also follows
+    steps that had to wait for a free job.
+    """
+
+    # Estimates used when no build log of a step exists
+    DEFAULT_DURATIONS = {
+        'image': 15 * 60,
+        'mirror': 5 * 60,
+        'mirror_update': 15,
+        'checkout': 5 * 60,
+        'checkout_shared': 30,
+        'build': 4 * 3600,
+    }
+
+    def __init__(self):
+        self.nodes: Dict[str, PlanNode] = {}
+
+    def add(self, node: PlanNode) -> PlanNode:
+        """Add a node, or record the BSPs of node on an existing node with the same id."""
+        existing = self.nodes.get(node.id)
+        if existing:
+            existing.bsps.extend(bsp for bsp in node.bsps if bsp not in existing.bsps)
+            return existing
+        self.nodes[node.id] = node
+        return node
+
+    def topological_order(self) -> List[str]:
+        """Node ids with every node after its dependencies."""
+        order = []
+        state: Dict[str, int] = {}
+        for root in self.nodes:
+            stack = [(root, False)]
+            while stack:
+                node_id, expanded = stack.pop()
+                if expanded:
+                    state[node_id] = 2
+                    order.append(node_id)
+                    continue
+                if state.get(node_id):
+                    continue
+                state[node_id] = 1
+                stack.append((node_id, True))
+                stack.extend((dep, False) for dep in self.nodes[node_id].deps if not state.get(dep))
+        return order
+
+    def _remaining(self, order: List[str]) -> Dict[str, float]:
+        """Longest chain from the start of each node to the end of the plan."""
+        dependents: Dict[str, List[str]] = {node_id: [] for node_id in self.nodes}
+        for node in self.nodes.values():
+            for dep in node.deps:
+                dependents[dep].append(node.id)
+        remaining: Dict[str, float] = {}
+        for node_id in reversed(order):
+            tail = max((remaining[d] for d in dependents[node_id]), default=0.0)
+            remaining[node_id] = self.nodes[node_id].duration + tail
+        return remaining
+
+    def critical_path(self) -> Tuple[float, List[str]]:
         """
-        Get environment variables as a dictionary with expanded values.
+        Longest chain of dependent steps (unlimited jobs).
         
         Returns:
-            Copy of the environment variables dictionary with all expansions applied
+            Tuple of path duration and node ids from first to last
         """
-        return self._env_dict.copy()
-    
-    def get_value(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        finish: Dict[str, float] = {}
+        previous: Dict[str, Optional[str]] = {}
+        for node_id in self.topological_order():
+            node = self.nodes[node_id]
+            blocker = max(node.deps, key=lambda dep: finish[dep], default=None)
+            previous[node_id] = blocker
+            finish[node_id] = (finish[blocker] if blocker else 0.0) + node.duration
+        if not finish:
+            return 0.0, []
+        node_id = max(finish, key=finish.get)
+        length = finish[node_id]
+        path = []
+        while node_id:
+            path.append(node_id)
+            node_id = previous[node_id]
+        return length, list(reversed(path))
+
+    def schedule(self, jobs: int) -> Tuple[float, List[str], Dict[str, Tuple[float, float]]]:
         """
-        Get the value of an environment variable by key.
+        Simulate the plan with a limited number of parallel jobs.
         
         Args:
-            key: Environment variable name to lookup
-            default: Default value to return if key not found
+            jobs: Number of steps run at the same time
             
         Returns:
-            Environment variable value (expanded) or default if not found
+            Tuple of total duration, critical path and (start, finish) per node id
         """
-        return self._env_dict.get(key, default)
+        order = self.topological_order()
+        remaining = self._remaining(order)
+        waiting = {node_id: len(self.nodes[node_id].deps) for node_id in self.nodes}
+        dependents: Dict[str, List[str]] = {node_id: [] for node_id in self.nodes}
+        for node in self.nodes.values():
+            for dep in node.deps:
+                dependents[dep].append(node.id)
+
+        ready: List[Tuple[float, int, str]] = []
+        rank = {node_id: number for number, node_id in enumerate(order)}
+        for node_id, count in waiting.items():
+            if count == 0:
+                heapq.heappush(ready, (-remaining[node_id], rank[node_id], node_id))
+        running: List[Tuple[float, int, str]] = []
+        times: Dict[str, Tuple[float, float]] = {}
+        previous: Dict[str, Optional[str]] = {}
+        now = 0.0
+        freed_by: Optional[str] = None
+        while ready or running:
+            while ready and len(running) < max(jobs, 1):
+                _, _, node_id = heapq.heappop(ready)
+                deps = self.nodes[node_id].deps
+                blocker = max(deps, key=lambda dep: times[dep][1], default=None)
+                # A step that became ready before now waited for the job freed by freed_by
+                if freed_by and (blocker is None or times[blocker][1] < now):
+                    blocker = freed_by
+                previous[node_id] = blocker
+                finish = now + self.nodes[node_id].duration
+                times[node_id] = (now, finish)
+                heapq.heappush(running, (finish, rank[node_id], node_id))
+            now, _, freed_by = heapq.heappop(running)
+            for dependent in dependents[freed_by]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    heapq.heappush(ready, (-remaining[dependent], rank[dependent], dependent))
+
+        if not times:
+            return 0.0, [], times
+        node_id = max(times, key=lambda n: (times[n][1], rank[n]))
+        total = times[node_id][1]
+        path = []
+        while node_id:
+            path.append(node_id)
+            node_id = previous[node_id]
+        return total, list(reversed(path)), times
+
+    def to_dict(self, jobs: int) -> Dict[str, Any]:
+        """Plan with schedule and critical paths as a JSON serializable dictionary."""
+        length, path = self.critical_path()
+        total, scheduled_path, times = self.schedule(jobs)
+        nodes = []
+        for node_id in self.topological_order():
+            record = asdict(self.nodes[node_id])
+            record['start'], record['finish'] = times[node_id]
+            nodes.append(record)
+        return {
+            "jobs": jobs,
+            "nodes": nodes,
+            "critical_path": {"duration": length, "nodes": path},
+            "schedule": {"duration": total, "critical_path": scheduled_path},
+        }
+
+    def to_dot(self, jobs: int) -> str:
+        """Plan as a Graphviz digraph with the critical path for the job count highlighted."""
+        _, path, _ = self.schedule(jobs)
+        critical = set(path)
+        critical_edges = set(zip(path, path[1:]))
+        lines = ["digraph plan {", "  rankdir=LR;", "  node [shape=box, fontname=\"sans\"];"]
+        for node_id in self.topological_order():
+            node = self.nodes[node_id]
+            label = f"{node_id}\\n{format_duration(node.duration)} ({node.source})"
+            style = ", color=red, penwidth=2" if node_id in critical else ""
+            lines.append(f"  \"{node_id}\" [label=\"{label}\"{style}];")
+            for dep in node.deps:
+                edge_style = " [color=red, penwidth=2]" if (dep, node_id) in critical_edges else ""
+                lines.append(f"  \"{dep}\" -> \"{node_id}\"{edge_style};")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+# =============================================================================
+# Configuration Watch
+# =============================================================================
+
+class InotifyWatcher:
+    """
+    Watch files for changes through Linux inotify, bound with ctypes.
     
-    def validate_environment(self) -> bool:
+    The parent directories of the files are watched rather than the files
+    themselves, so files replaced by editors (written to a temporary file
+    and renamed) and files created later are still noticed.
+    """
+
+    # New files are reported once written (IN_CLOSE_WRITE), not while still empty (IN_CREATE)
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_DELETE = 0x200
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+    def __init__(self):
         """
-        Validate that all environment variable paths exist after expansion.
+        Create the inotify instance.
         
-        This method checks common path variables (DL_DIR, SSTATE_DIR, GITCONFIG_FILE)
-        to ensure they point to valid locations after environment variable expansion.
-        Warnings are issued for missing paths but execution continues as paths 
-        might be created during build.
+        Raises:
+            OSError: If inotify is not available on this system
+        """
+        try:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            inotify_init1 = self._libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, f"inotify is not available: {e}")
+        self.fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify is not available: {os.strerror(error)}")
+        self._directories: Dict[int, str] = {}
+        self._watched: Set[str] = set()
+
+    def watch(self, files: Set[str]) -> None:
+        """Start watching the directories of the given files."""
+        for directory in {os.path.dirname(path) for path in files}:
+            if directory in self._watched or not os.path.isdir(directory):
+                continue
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                logging.warning(f"Cannot watch {directory}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self._directories[wd] = directory
+            self._watched.add(directory)
+
+    def wait(self, timeout: Optional[float]) -> Set[str]:
+        """
+        Wait for changes.
         
+        Args:
+            timeout: Seconds to wait, None to wait forever
+            
         Returns:
-            True if validation completes (warnings may still be issued)
+            Paths of changed files, empty on timeout
         """
-        # Check common path variables that should exist
-        path_variables = ['DL_DIR', 'SSTATE_DIR', 'GITCONFIG_FILE']
-        
-        for var_name in path_variables:
-            if var_name in self._env_dict:
-                path_value = self._env_dict[var_name]
-                if not resolver.exists(path_value):
-                    logging.warning(f"Environment variable {var_name} path does not exist: {path_value}")
-                    # Don't exit here - paths might be created during build process
-        
-        logging.info(f"Environment configuration validated with {len(self._env_dict)} variables")
-        return True
-        
-    def setup_environment(self, base_env: Dict[str, str]) -> Dict[str, str]:
+        changed: Set[str] = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, _mask, _cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self._directories.get(wd)
+            if directory and name:
+                changed.add(os.path.join(directory, os.fsdecode(name)))
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Watch files by polling their modification time, used where inotify is unavailable."""
+
+    INTERVAL = 1.0
+
+    def __init__(self):
+        self._stamps: Dict[str, Optional[Tuple[int, int]]] = {}
+
+    @staticmethod
+    def _stamp(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def watch(self, files: Set[str]) -> None:
+        """Start watching the given files, which need not exist yet."""
+        for path in files:
+            if path not in self._stamps:
+                self._stamps[path] = self._stamp(path)
+
+    def wait(self, timeout: Optional[float]) -> Set[str]:
+        """Wait for changes; see InotifyWatcher.wait."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path, stamp in self._stamps.items():
+                current = self._stamp(path)
+                if current != stamp:
+                    self._stamps[path] = current
+                    changed.add(path)
+            if changed:
+                return changed
+            delay = self.INTERVAL
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return changed
+            time.sleep(delay)
+
+    def close(self) -> None:
+        pass
+
+@dataclass
+class KasFileNode:
+    """
+    Parsed KAS file of an include graph.
+    
+    Attributes:
+        includes: Include entries as written in the file
+        error: Why the file is invalid, None if it is valid
+    """
+    includes: List[Any]
+    error: Optional[str] = None
+
+class IncludeGraph:
+    """
+    Include closures of the KAS files of a set of BSPs, updated incrementally.
+    
+    Every file is parsed once and parsed again only after it changed.
+    Revalidating a BSP walks its closure through the cached nodes, which
+    only costs path lookups. Includes from other repositories (given as
+    repo/file mappings) cannot be checked before a checkout and are skipped.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[str, KasFileNode] = {}
+        self.kas_managers: Dict[str, KasManager] = {}
+        # Files each BSP depends on, including expected paths of missing includes
+        self.closures: Dict[str, Set[str]] = {}
+
+    def add_bsp(self, bsp_name: str, kas_mgr: KasManager) -> List[str]:
+        """Add a BSP to the graph and validate it; see validate."""
+        self.kas_managers[bsp_name] = kas_mgr
+        return self.validate(bsp_name)
+
+    def watched_files(self) -> Set[str]:
+        """Get the files any BSP of the graph depends on."""
+        return set().union(*self.closures.values())
+
+    def _parse(self, path: str, kas_mgr: KasManager) -> KasFileNode:
+        """Parse a KAS file into a graph node."""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = yaml.load(f, Loader=RegistryLoader) or {}
+        except yaml.YAMLError as e:
+            mark = getattr(e, 'problem_mark', None)
+            where = f" at line {mark.line + 1}, column {mark.column + 1}" if mark else ""
+            return KasFileNode([], f"invalid YAML{where}: {getattr(e, 'problem', None) or e}")
+        except OSError as e:
+            return KasFileNode([], e.strerror)
+
+        if not isinstance(content, dict):
+            return KasFileNode([], "not a mapping")
+        header = content.get('header')
+        if not isinstance(header, dict) or 'version' not in header:
+            return KasFileNode([], "missing header.version")
+        return KasFileNode(kas_mgr._find_includes_in_yaml(content))
+
+    def update(self, changed: Set[str]) -> List[str]:
         """
-        Set up environment variables for build processes.
-        
-        Merges the configured environment variables with a base environment,
-        with configured variables taking precedence over existing ones.
-        All environment variable values are expanded before being set.
+        Drop changed files from the graph.
         
         Args:
-            base_env: Base environment dictionary (typically os.environ.copy())
+            changed: Paths of changed files
             
         Returns:
-            Updated environment with all configured variables applied and expanded
+            Names of the BSPs depending on any changed file
         """
-        env = base_env.copy()
+        for path in changed:
+            self.nodes.pop(path, None)
+        return [name for name, files in self.closures.items() if files & changed]
+
+    def validate(self, bsp_name: str) -> List[str]:
+        """
+        Walk the include closure of a BSP, parsing files not in the graph yet.
         
-        # Add all configured environment variables (overwrite existing)
-        for env_var in self.environment_vars:
-            expanded_value = self._expand_environment_variables(env_var.value)
-            env[env_var.name] = expanded_value
-            logging.debug(f"Set {env_var.name}={expanded_value}")
+        Args:
+            bsp_name: Name of a BSP added to the graph
             
-        return env
+        Returns:
+            Problems found (unparsable files, missing includes), empty if valid
+        """
+        kas_mgr = self.kas_managers[bsp_name]
+        visited: Set[str] = set()
+        files: Set[str] = set()
+        errors: List[str] = []
+
+        def visit(path: str) -> None:
+            if path in visited:
+                return
+            visited.add(path)
+            files.add(path)
+            node = self.nodes.get(path)
+            if node is None:
+                node = self.nodes[path] = self._parse(path, kas_mgr)
+            if node.error:
+                errors.append(f"{path}: {node.error}")
+            for include in node.includes:
+                if isinstance(include, dict):
+                    continue
+                if not isinstance(include, str):
+                    errors.append(f"{path}: invalid include entry {include!r}")
+                    continue
+                found = kas_mgr._find_include_path(include, path)
+                if found:
+                    visit(found)
+                else:
+                    errors.append(f"{path}: include {include} not found")
+                    files.add(os.path.normpath(os.path.join(os.path.dirname(path), include)))
+
+        for kas_file in kas_mgr.kas_files:
+            found = kas_mgr._find_kas_file(kas_file)
+            if found:
+                visit(found)
+            else:
+                errors.append(f"KAS file not found: {kas_file}")
+                files.add(str(Path(kas_file).resolve()))
+
+        self.closures[bsp_name] = files
+        return errors
 
 # =============================================================================
-# KAS Build System Manager
+# Main BSP Management Class with Container Support
 # =============================================================================
 
-class KasManager:
+class BspManager:
     """
-    Manager for KAS (KAS is Yet Another Build System for Yocto) operations.
+    Main BSP management class for BSP registry management.
     
-    This class handles KAS configuration validation, build execution,
-    and environment management with comprehensive error handling.
-    It supports both native KAS installations and containerized builds
-    using kas-container.
+    This class coordinates the overall BSP management flow including
+    configuration loading, BSP discovery, build execution, shell access,
+    and configuration export operations with container support.
     """
     
-    def __init__(self, kas_files: List[str], build_dir: str = "build", use_container: bool = False,
-                 download_dir: str = None, sstate_dir: str = None,
-                 container_engine: str = None, container_image: str = None,
-                 search_paths: List[str] = None, env_manager: EnvironmentManager = None):
+    def __init__(self, config_path: str = "bsp-registry.yml"):
         """
-        Initialize KAS manager with configuration.
+        Initialize BSP manager.
         
         Args:
-            kas_files: List of KAS configuration files (YAML) for the build
-            build_dir: Build output directory for Yocto artifacts
-            use_container: Use kas-container instead of native kas installation
-            download_dir: Downloads cache directory for Yocto sources
-            sstate_dir: Shared state cache directory for build acceleration
-            container_engine: Container runtime (docker, podman)
-            container_image: Custom container image for kas-container
-            search_paths: Additional paths to search for configuration files
-            env_manager: Environment configuration manager
-            
+            config_path: Path to BSP registry configuration file
+        """
+        self.config_path = Path(config_path)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.model = None  # Will hold parsed registry configuration
+        self.env_manager = None  # Environment configuration manager
+        self.containers = {}  # Dictionary of container configurations
+        self.timeouts = {}  # Per-phase timeouts in seconds (docker, checkout, build, ...)
+        self.registry_index = None  # Index of BSPs in included registry files
+        self._loaded_files = set()  # Included registry files merged into the model
+
+    def load_configuration(self) -> None:
+        """
+        Load and parse BSP configuration from YAML file.
+        
         Raises:
-            SystemExit: If initialization fails due to invalid parameters
+            SystemExit: If configuration file is missing or invalid
         """
-        if not isinstance(kas_files, list) or not kas_files:
-            logging.error("kas_files must be a non-empty list of file paths")
-            sys.exit(1)
+        try:
+            if not self.config_path.exists():
+                logging.error(f"Config file not found: {self.config_path}")
+                sys.exit(1)
 
-        self.kas_files = kas_files
-        self.build_dir = Path(build_dir).resolve()
-        self.use_container = use_container
-        self.container_engine = container_engine
-        self.container_image = container_image
-        self.search_paths = search_paths or []
-        self.download_dir = download_dir
-        self.sstate_dir = sstate_dir
-        self.env_manager = env_manager or EnvironmentManager()
+            # Parse YAML configuration into structured model
+            with tracer.span("load registry", "registry", file=str(self.config_path)):
+                self.model = get_registry_from_yaml_file(self.config_path)
+            if self.model.registry.bsp is None:
+                self.model.registry.bsp = []
+            logging.info(f"Configuration loaded successfully from {self.config_path}")
 
-        # Add common search paths for configuration files
-        self.search_paths.extend([
-            str(Path.cwd()),              # Current working directory
-            str(self.build_dir),          # Build directory
-            str(Path(__file__).parent),   # Script directory
-            "/repo",                      # Common container path
-            "/repo/examples",             # Examples in container
-        ])
+            # Included registry files are only indexed; their BSPs are loaded on demand
+            if self.model.includes:
+                self.registry_index = RegistryIndex(self.config_path, self.model.includes)
+                with tracer.span("load registry index", "registry", files=len(self.model.includes)):
+                    entries = self.registry_index.load()
+                for bsp in self.model.registry.bsp:
+                    if bsp.name in entries:
+                        logging.error(f"BSP {bsp.name} is defined in {self.config_path} "
+                                      f"and {entries[bsp.name]['file']}")
+                        sys.exit(1)
+                logging.info(f"Registry index lists {len(entries)} BSPs in included files")
 
-        self.original_cwd = Path.cwd()
-        self._yaml_cache = {}  # Cache for parsed YAML files to avoid re-parsing
+            # Store containers from model
+            if self.model.containers:
+                self.containers = self.model.containers
+                logging.info(f"Loaded {len(self.containers)} container definitions")
 
-        # Ensure build directory exists before starting any operations
-        resolver.ensure_directory(str(self.build_dir))
+            # Initialize Environment manager if configuration exists
+            if self.model.environment:
+                self.env_manager = EnvironmentManager(self.model.environment)
+                logging.info(f"Environment configuration initialized with {len(self.model.environment)} variables")
 
-    def _get_kas_command(self) -> List[str]:
-        """Get the appropriate KAS command (native or container)."""
-        if self.use_container:
-            return ["kas-container"]
-        else:
-            return ["kas"]
+        except SystemExit:
+            raise
+        except Exception as e:
+            logging.error(f"Failed to load configuration: {e}")
+            sys.exit(1)
 
-    def _get_environment_with_container_vars(self) -> dict:
-        """
-        Prepare environment variables for KAS execution.
+    def initialize(self) -> None:
+        """Initialize BSP manager components and validate configuration."""
+        logging.info("Initializing BSP manager...")
+        self.load_configuration()
         
-        Sets up cache directories and container-specific environment
-        variables required for KAS operation.
+        # Validate environment configuration if present
+        if self.env_manager:
+            if not self.env_manager.validate_environment():
+                logging.error("Environment configuration validation failed")
+                sys.exit(1)
+                
+        logging.info("BSP manager initialized successfully")
+
+    def list_bsp(self) -> None:
+        """
+        List all available BSPs in the registry.
         
-        Returns:
-            Environment dictionary with KAS-specific variables configured
+        Raises:
+            SystemExit: If no BSPs are found in registry
         """
-        env = os.environ.copy()
-
-        # Set cache directories if provided (override environment manager if specified)
-        if self.download_dir:
-            env['DL_DIR'] = self.download_dir
-        elif not env.get('DL_DIR'):  # Only set from env_manager if not already set
-            dl_dir = self.env_manager.get_value('DL_DIR')
-            if dl_dir:
-                env['DL_DIR'] = dl_dir
-                
-        if self.sstate_dir:
-            env["SSTATE_DIR"] = self.sstate_dir
-        elif not env.get('SSTATE_DIR'):  # Only set from env_manager if not already set
-            sstate_dir = self.env_manager.get_value('SSTATE_DIR')
-            if sstate_dir:
-                env['SSTATE_DIR'] = sstate_dir
+        entries = self.registry_index.entries if self.registry_index else {}
+        if not self.model or not (self.model.registry.bsp or entries):
+            logging.error("No BSPs found in registry")
+            sys.exit(1)
 
-        # Set container-specific environment variables
-        if self.use_container:
-            if self.container_engine:
-                env['KAS_CONTAINER_ENGINE'] = self.container_engine
-            if self.container_image:
-                env['KAS_CONTAINER_IMAGE'] = self.container_image
+        logging.info("Available BSPs:")
+        for bsp in self.model.registry.bsp:
+            if bsp.name not in entries:
+                print(f"- {bsp.name}: {bsp.description}")
+        for name, entry in entries.items():
+            print(f"- {name}: {entry['description']}")
 
-        # Apply environment manager configuration (overrides any previous settings)
-        env = self.env_manager.setup_environment(env)
+    def list_containers(self) -> None:
+        """
+        List all available containers in the registry.
+        
+        Raises:
+            SystemExit: If no containers are found in registry
+        """
+        if not self.containers:
+            logging.info("No container definitions found in registry")
+            return
 
-        return env
+        logging.info("Available Containers:")
+        for container_name, container_config in self.containers.items():
+            print(f"- {container_name}:")
+            print(f"    Image: {container_config.image}")
+            print(f"    File: {container_config.file}")
+            if container_config.args:
+                print(f"    Args: {', '.join([f'{arg.name}={arg.value}' for arg in container_config.args])}")
 
-    def _resolve_kas_file(self, kas_file: str) -> str:
+    def get_bsp_by_name(self, bsp_name: str) -> BSP:
         """
-        Resolve KAS file path to absolute path.
-        
-        Searches in multiple locations in order:
-        - Absolute path
-        - Relative to current directory
-        - Relative to build directory
-        - Script directory
-        - Custom search paths
+        Retrieve BSP configuration by name.
         
         Args:
-            kas_file: KAS file path to resolve
+            bsp_name: Name of the BSP to retrieve
             
         Returns:
-            Absolute path to KAS file
+            BSP configuration object
             
         Raises:
-            SystemExit: If file cannot be found in any search location
+            SystemExit: If BSP with given name is not found
         """
-        path = Path(kas_file)
-
-        # Check absolute path
-        if path.is_absolute() and path.exists():
-            return str(path.resolve())
-
-        # Check relative to current working directory
-        if path.exists():
-            return str(path.resolve())
-
-        # Check relative to build directory
-        build_dir_path = self.build_dir / path
-        if build_dir_path.exists():
-            return str(build_dir_path.resolve())
-
-        # Check relative to script directory
-        script_dir_path = Path(__file__).parent / path
-        if script_dir_path.exists():
-            return str(script_dir_path.resolve())
-
-        # Check additional search paths
-        for search_path in self.search_paths:
-            search_path_obj = Path(search_path)
-            candidate_path = search_path_obj / path
-            if candidate_path.exists():
-                return str(candidate_path.resolve())
-
-        # File not found in any location
-        logging.error(f"KAS file not found: {kas_file}")
-        logging.error(f"Searched in: {', '.join(self.search_paths)}")
+        entry = self.registry_index.entries.get(bsp_name) if self.registry_index else None
+        if entry:
+            self._load_registry_file(entry['file'])
+        for bsp in self.model.registry.bsp:
+            if bsp.name == bsp_name:
+                return bsp
+        
+        # BSP not found - show error with available options
+        logging.error(f"BSP not found: {bsp_name}")
+        logging.info("Available BSPs:")
+        for name in self.get_all_bsp_names():
+            logging.info(f"  - {name}")
         sys.exit(1)
 
-    def _find_file_in_search_paths(self, filename: str) -> Optional[str]:
-        """Find a file in the configured search paths."""
-        # Check absolute path
-        if Path(filename).is_absolute() and Path(filename).exists():
-            return str(Path(filename).resolve())
-
-        # Check relative to current directory
-        if Path(filename).exists():
-            return str(Path(filename).resolve())
-
-        # Check all search paths
-        for search_path in self.search_paths:
-            candidate = Path(search_path) / filename
-            if candidate.exists():
-                return str(candidate.resolve())
-
-        return None
-
-    def _get_kas_files_string(self) -> str:
-        """Convert list of KAS files to colon-delimited string with resolved paths."""
-        resolved_files = [self._resolve_kas_file(f) for f in self.kas_files]
-        return ":".join(resolved_files)
+    def _load_registry_file(self, name: str) -> None:
+        """Merge the BSPs of an included registry file into the model."""
+        if name in self._loaded_files:
+            return
+        self._loaded_files.add(name)
+        self.model.registry.bsp.extend(self.registry_index.read_file(name))
+
+    def get_all_bsp_names(self) -> List[str]:
+        """Names of all BSPs in the registry (included files are not parsed)."""
+        names = [bsp.name for bsp in self.model.registry.bsp]
+        if self.registry_index:
+            loaded = set(names)
+            names.extend(name for name in self.registry_index.entries if name not in loaded)
+        return names
+
+    def get_all_bsps(self) -> List[BSP]:
+        """
+        Get all BSPs in the registry, loading every included registry file.
+        
+        Returns:
+            BSP configuration objects
+        """
+        if self.registry_index:
+            for name in self.registry_index.files():
+                self._load_registry_file(name)
+        return self.model.registry.bsp
 
-    def _parse_yaml_file(self, file_path: str) -> Dict[str, Any]:
+    def get_bsp_names(self, bsp_names: List[str], select_all: bool = False) -> List[str]:
         """
-        Parse YAML file with caching.
+        Resolve BSP names given on the command line.
         
         Args:
-            file_path: Path to YAML file
+            bsp_names: Explicitly requested BSP names
+            select_all: Select every BSP in the registry
             
         Returns:
-            Parsed YAML content as dictionary
+            List of BSP names
             
         Raises:
-            SystemExit: If file cannot be parsed due to YAML syntax errors
+            SystemExit: If neither names nor select_all are given
         """
-        resolved_path = self._resolve_kas_file(file_path)
-        if resolved_path in self._yaml_cache:
-            return self._yaml_cache[resolved_path]
-
-        try:
-            with open(resolved_path, 'r', encoding='utf-8') as f:
-                content = yaml.safe_load(f) or {}
-                self._yaml_cache[resolved_path] = content
-                return content
-        except (yaml.YAMLError, IOError) as e:
-            logging.error(f"Failed to parse YAML file {file_path}: {e}")
+        if select_all:
+            return self.get_all_bsp_names()
+        if not bsp_names:
+            logging.error("No BSP specified (give BSP names or --all)")
             sys.exit(1)
+        return list(bsp_names)
 
-    def _find_includes_in_yaml(self, yaml_content: Dict[str, Any]) -> List[str]:
+    def ensure_container_image(self, container_config: Docker) -> None:
         """
-        Extract include files from YAML content.
+        Build the image of a container unless it was built from identical inputs.
         
-        KAS configuration files can include other files through:
-        - Top-level 'includes' key
-        - 'header' -> 'includes' nested key (less common)
+        Images carry the container fingerprint as a label, so images
+        pre-built with 'containers build' are reused instead of rebuilt.
         
         Args:
-            yaml_content: Parsed YAML content
+            container_config: Docker configuration of the container
             
+        Raises:
+            SystemExit: If the Docker build fails
+        """
+        fingerprint = container_fingerprint(container_config)
+        info = docker_image_info(container_config.image)
+        if info and info['labels'].get(DOCKER_FINGERPRINT_LABEL) == fingerprint:
+            logging.info(f"Docker image {container_config.image} is up to date")
+            return
+        build_docker(
+            ".",
+            container_config.file,
+            container_config.image,
+            container_config.args,
+            timeout=self.timeouts.get('docker'),
+            labels={DOCKER_FINGERPRINT_LABEL: fingerprint}
+        )
+
+    def get_container_images(self, container_names: List[str], select_all: bool = False) -> Dict[str, Docker]:
+        """
+        Resolve the container images to build.
+        
+        Args:
+            container_names: Names of registry containers
+            select_all: Select every image referenced by the registry, including
+                Docker configurations given directly in BSPs
+                
         Returns:
-            List of include file paths found in the configuration
+            Docker configurations keyed by image tag
+            
+        Raises:
+            SystemExit: If a container is unknown or none is specified
         """
-        includes = []
+        images: Dict[str, Docker] = {}
+        if select_all:
+            for container_config in self.containers.values():
+                if container_config.image:
+                    images.setdefault(container_config.image, container_config)
+            for bsp in self.get_all_bsps():
+                docker = bsp.build.environment.docker if bsp.build.environment else None
+                if docker and docker.image and not bsp.build.environment.container:
+                    images.setdefault(docker.image, docker)
+            return images
+        if not container_names:
+            logging.error("No container specified (give container names or --all)")
+            sys.exit(1)
+        for name in container_names:
+            if name not in self.containers:
+                logging.error(f"Container '{name}' not found in registry containers")
+                logging.info("Available containers:")
+                for available in self.containers.keys():
+                    logging.info(f"  - {available}")
+                sys.exit(1)
+            container_config = self.containers[name]
+            if container_config.image:
+                images.setdefault(container_config.image, container_config)
+        return images
 
-        # Check top-level includes (most common)
-        if 'includes' in yaml_content:
-            include_list = yaml_content['includes']
-            if isinstance(include_list, list):
-                includes.extend(include_list)
+    def build_containers(self, container_names: List[str], select_all: bool = False,
+                         jobs: Optional[int] = None, force: bool = False) -> None:
+        """
+        Build container images concurrently with a shared BuildKit layer cache.
+        
+        Each image is built with docker buildx, importing and exporting its
+        layers through a local cache directory below the cache root, so new
+        build workers sharing the cache reuse layers instead of running the
+        package installation again. Images are labelled with their container
+        fingerprint; images whose label matches are not rebuilt unless force
+        is set.
+        
+        Args:
+            container_names: Names of registry containers to build
+            select_all: Build every image referenced by the registry
+            jobs: Maximum number of concurrent image builds (default: all)
+            force: Rebuild images that are up to date
+            
+        Raises:
+            SystemExit: If a container is unknown or an image build fails
+        """
+        images = self.get_container_images(container_names, select_all)
+        use_buildkit = ensure_buildx_builder()
+        cache_root = self.get_cache_root() / "docker"
+        if not use_buildkit:
+            logging.warning("Building without BuildKit layer cache export")
+
+        builds = []
+        for tag, docker in images.items():
+            if not docker.file:
+                logging.info(f"{tag}: no Dockerfile, nothing to build")
+                continue
+            if not os.path.isfile(docker.file):
+                logging.error(f"Dockerfile not found for {tag}: {docker.file}")
+                sys.exit(1)
+            fingerprint = container_fingerprint(docker)
+            info = docker_image_info(tag)
+            if not force and info and info['labels'].get(DOCKER_FINGERPRINT_LABEL) == fingerprint:
+                logging.info(f"{tag}: up to date ({info['size'] / 2**20:.0f} MiB)")
+                continue
+            cache_dir = None
+            if use_buildkit:
+                cache_dir = str(cache_root / re.sub(r'[^A-Za-z0-9_.-]', '_', tag))
+                resolver.ensure_directory(str(cache_root))
+            cmd = docker_build_command(docker.file, tag, docker.args,
+                                       {DOCKER_FINGERPRINT_LABEL: fingerprint}, cache_dir)
+            logging.info(f"Running: {' '.join(cmd)}")
+            tail = CaptureLineHandler(max_lines=50)
+            debug_log = LoggingLineHandler(logging.DEBUG, prefix=f"{tag}: ")
+            spec = ProcessSpec(cmd=cmd, cwd=".", phase="docker", timeout=self.timeouts.get('docker'),
+                               stdout_handlers=[debug_log, tail], stderr_handlers=[debug_log, tail])
+            builds.append((tag, cache_dir, tail, spec))
+        if not builds:
+            return
 
-        # Check header includes (less common, older format)
-        if 'header' in yaml_content and 'includes' in yaml_content['header']:
-            header_includes = yaml_content['header']['includes']
-            if isinstance(header_includes, list):
-                includes.extend(header_includes)
+        try:
+            results = runner.run_all_sync([spec for _, _, _, spec in builds], jobs)
+        except OSError as e:
+            logging.error(f"Unexpected error during Docker build: {e}")
+            sys.exit(1)
 
-        return includes
+        failed = False
+        for (tag, cache_dir, tail, _), result in zip(builds, results):
+            if result.ok:
+                if cache_dir:
+                    rotate_build_cache(cache_dir)
+                info = docker_image_info(tag)
+                size = f"{info['size'] / 2**20:.0f} MiB" if info else "size unknown"
+                logging.info(f"{tag}: built in {result.duration:.1f}s, {size}")
+                continue
+            failed = True
+            if result.interrupted:
+                logging.error(f"{tag}: build interrupted by user")
+            elif result.timed_out:
+                logging.error(f"{tag}: build timed out after {result.duration:.0f}s")
+            else:
+                logging.error(f"{tag}: build failed with return code {result.returncode}")
+                logging.error(f"Error output: {tail.text}")
+        if failed:
+            sys.exit(1)
 
-    def _resolve_include_path(self, include_file: str, parent_file: str) -> str:
+    def get_image_bundles(self, directory: Optional[str] = None) -> ImageBundleStore:
+        """Get the image bundle directory (default: images below the cache root)."""
+        return ImageBundleStore(directory or str(self.get_cache_root() / "images"), self.timeouts.get('docker'))
+
+    def save_containers(self, container_names: List[str], select_all: bool = False,
+                        directory: Optional[str] = None, jobs: Optional[int] = None) -> None:
         """
-        Resolve include file path relative to its parent file.
+        Export container images into compressed bundles for offline workers.
         
         Args:
-            include_file: Include file path (may be relative)
-            parent_file: Parent file path for relative resolution
-            
-        Returns:
-            Absolute path to include file
+            container_names: Names of registry containers to save
+            select_all: Save every image referenced by the registry
+            directory: Bundle directory
+            jobs: Number of images exported in parallel
             
         Raises:
-            SystemExit: If include file cannot be found in any search location
+            SystemExit: If a container is unknown or an export fails
         """
-        # Absolute paths are used as-is
-        if include_file.startswith('/'):
-            return include_file
-
-        # First try relative to parent file directory
-        parent_dir = Path(parent_file).parent
-        relative_path = parent_dir / include_file
-        if relative_path.exists():
-            return str(relative_path.resolve())
+        images = self.get_container_images(container_names, select_all)
+        bundles = self.get_image_bundles(directory)
+        logging.info(f"Saving {len(images)} images to {bundles.root}")
+        bundles.save(images, jobs)
 
-        # Search in all configured paths
-        found_path = self._find_file_in_search_paths(include_file)
-        if found_path:
-            return found_path
-
-        # Include file not found
-        logging.error(f"Include file not found: {include_file} (referenced from {parent_file})")
-        sys.exit(1)
+    def load_containers(self, container_names: List[str], directory: Optional[str] = None,
+                        jobs: Optional[int] = None) -> None:
+        """
+        Load container images missing locally from compressed bundles.
+        
+        Args:
+            container_names: Names of registry containers to load (default: all bundled images)
+            directory: Bundle directory
+            jobs: Number of images loaded in parallel
+            
+        Raises:
+            SystemExit: If a container is unknown or an image cannot be loaded
+        """
+        tags = list(self.get_container_images(container_names)) if container_names else None
+        bundles = self.get_image_bundles(directory)
+        logging.info(f"Loading images from {bundles.root}")
+        bundles.load(tags, jobs)
 
-    def _get_all_included_files(self, main_files: List[str]) -> List[str]:
+    def get_container_config_for_bsp(self, bsp: BSP) -> Docker:
         """
-        Recursively find all included files from main KAS files.
+        Get the Docker configuration for a BSP, resolving container references.
         
-        Performs depth-first search to build complete dependency tree
-        and ensure proper inclusion order.
+        This method supports both direct Docker configuration and container references.
+        Priority: container reference > direct Docker configuration.
         
         Args:
-            main_files: List of main KAS configuration files
+            bsp: BSP configuration object
             
         Returns:
-            Flat list of all files in dependency order (includes first)
+            Docker configuration for the BSP
             
         Raises:
-            SystemExit: If any included file is missing or circular dependency detected
+            SystemExit: If container reference cannot be resolved or configuration is missing
         """
-        all_files = []
-        processed_files = set()
-
-        def process_file(file_path: str):
-            """Recursive function to process files and their includes."""
-            if file_path in processed_files:
-                return
-
-            resolved_path = self._resolve_kas_file(file_path)
-            if resolved_path in processed_files:
-                return
-
-            processed_files.add(resolved_path)
-
-            # Verify file exists
-            if not Path(resolved_path).exists():
-                logging.error(f"File not found: {file_path} (resolved to: {resolved_path})")
+        build_env = bsp.build.environment
+        
+        # First check for container reference
+        if build_env.container:
+            container_name = build_env.container
+            if container_name in self.containers:
+                logging.info(f"Using container reference: {container_name}")
+                return self.containers[container_name]
+            else:
+                logging.error(f"Container '{container_name}' not found in registry containers")
+                logging.info("Available containers:")
+                for name in self.containers.keys():
+                    logging.info(f"  - {name}")
                 sys.exit(1)
+        
+        # Fall back to direct Docker configuration
+        elif build_env.docker:
+            logging.info("Using direct Docker configuration")
+            return build_env.docker
+        
+        # No container configuration found
+        else:
+            logging.error(f"No container configuration found for BSP {bsp.name}")
+            logging.info("Either specify 'container' to reference a registry container or provide 'docker' configuration")
+            sys.exit(1)
 
-            # Parse file and find includes
-            yaml_content = self._parse_yaml_file(file_path)
-            includes = self._find_includes_in_yaml(yaml_content)
+    def prepare_build_directory(self, build_path: str) -> None:
+        """
+        Prepare build directory, creating it if necessary.
+        
+        Args:
+            build_path: Path to build directory
             
-            # Process includes first (depth-first for proper dependency resolution)
-            for include in includes:
-                include_path = self._resolve_include_path(include, file_path)
-                process_file(include_path)
-
-            # Add current file after its includes
-            all_files.append(file_path)
+        Raises:
+            SystemExit: If directory cannot be created
+        """
+        logging.info(f"Preparing build directory: {build_path}")
+        resolver.ensure_directory(build_path)
 
-        # Process all main files
-        for main_file in main_files:
-            process_file(main_file)
+    def get_cache_root(self) -> Path:
+        """
+        Get the root directory for caches managed by the BSP registry manager.
+        
+        Uses BSP_CACHE_DIR from the registry environment if set, otherwise
+        the parent directory of DL_DIR, otherwise ~/data/cache.
+        
+        Returns:
+            Cache root directory
+        """
+        if self.env_manager:
+            cache_dir = self.env_manager.get_value('BSP_CACHE_DIR')
+            if cache_dir:
+                return resolver.resolve(cache_dir)
+            downloads = self.env_manager.get_value('DL_DIR')
+            if downloads:
+                return resolver.resolve(downloads).parent
+        return resolver.resolve("~/data/cache")
 
-        return all_files
+    def get_artifact_store(self) -> ArtifactStore:
+        """Get the content-addressed artifact store below the cache root."""
+        return ArtifactStore(str(self.get_cache_root() / "artifacts"))
 
-    def validate_kas_files(self, check_includes: bool = True) -> bool:
+    def collect_artifacts(self, bsp_names: List[str], jobs: Optional[int] = None) -> None:
         """
-        Validate that all KAS configuration files exist and are accessible.
+        Store deploy artifacts of BSPs in the artifact store.
         
         Args:
-            check_includes: Whether to recursively validate include files
-            
-        Returns:
-            True if validation succeeds
+            bsp_names: Names of the BSPs to collect
+            jobs: Number of parallel hashing workers
             
         Raises:
-            SystemExit: If any file is missing or inaccessible
+            SystemExit: If a BSP is unknown
         """
-        try:
-            # Check main files
-            for kas_file in self.kas_files:
-                self._resolve_kas_file(kas_file)  # Will exit if file not found
-
-            # Recursively check include files if requested
-            if check_includes:
-                self._get_all_included_files(self.kas_files)
-                logging.info("All KAS files validated successfully")
-
-            return True
-
-        except SystemExit:
-            # Re-raise system exit exceptions
-            raise
-        except Exception as e:
-            logging.error(f"KAS file validation failed: {e}")
-            sys.exit(1)
-
-    def check_kas_available(self) -> bool:
+        store = self.get_artifact_store()
+        logging.info(f"Artifact store: {store.root}")
+        total = CollectStats()
+        for bsp_name in bsp_names:
+            bsp = self.get_bsp_by_name(bsp_name)
+            deploy_dir = build_deploy_dir(Path(bsp.build.path))
+            if not deploy_dir.is_dir():
+                logging.warning(f"No deploy directory for {bsp.name}: {deploy_dir}")
+                continue
+            fingerprint = None
+            try:
+                with open(deploy_dir / BuildFingerprint.FILE_NAME, 'r', encoding='utf-8') as f:
+                    fingerprint = json.load(f).get('fingerprint')
+            except (OSError, ValueError):
+                logging.debug("No build fingerprint for %s", bsp.name)
+            try:
+                stats = store.collect(bsp.name, deploy_dir, fingerprint, jobs)
+            except OSError as e:
+                logging.error(f"Failed to collect artifacts of {bsp.name}: {e}")
+                sys.exit(1)
+            logging.info(f"{bsp.name}: {stats.files} files ({stats.total_bytes / 2**20:.1f} MiB), "
+                         f"{stats.new_objects} new objects ({stats.new_bytes / 2**20:.1f} MiB), "
+                         f"{stats.linked} deduplicated")
+            for name in ('files', 'total_bytes', 'new_objects', 'new_bytes', 'linked'):
+                setattr(total, name, getattr(total, name) + getattr(stats, name))
+        if len(bsp_names) > 1:
+            logging.info(f"Total: {total.files} files ({total.total_bytes / 2**20:.1f} MiB), "
+                         f"{total.new_bytes / 2**20:.1f} MiB stored")
+
+    def gc_artifacts(self, keep: int = 3) -> None:
         """
-        Check if KAS or kas-container is installed and available.
+        Remove old manifests and unreferenced objects from the artifact store.
         
-        Returns:
-            True if KAS is available, False otherwise
+        Args:
+            keep: Number of most recent manifests to keep per BSP
         """
-        kas_cmd = self._get_kas_command()
-        env = self._get_environment_with_container_vars()
-        
-        try:
-            if self.use_container:
-                # For container version, check if help command works
-                test_cmd = kas_cmd + ["--help"]
-                result = subprocess.run(
-                    test_cmd,
-                    check=False,
-                    capture_output=True,
-                    text=True,
-                    timeout=30,
-                    env=env
-                )
-                return result.returncode == 0 or len(result.stdout) > 0 or len(result.stderr) > 0
-            else:
-                # For native version, check version command
-                test_cmd = kas_cmd + ["--version"]
-                subprocess.run(test_cmd, check=True, capture_output=True, timeout=30, env=env)
-                return True
-        except (subprocess.CalledProcessError, FileNotFoundError, subprocess.TimeoutExpired) as e:
-            logging.error(f"KAS command not available: {e}")
-            return False
+        store = self.get_artifact_store()
+        removed, freed = store.gc(keep)
+        logging.info(f"Removed {removed} unreferenced objects, freed {freed / 2**20:.1f} MiB")
 
-    def _run_kas_command(self, args: List[str], show_output: bool = True) -> subprocess.CompletedProcess:
+    def get_layer_store(self) -> LayerStore:
+        """Get the shared layer store below the cache root."""
+        return LayerStore(str(self.get_cache_root() / "layers"))
+
+    def use_shared_layers(self, kas_mgr: KasManager, jobs: Optional[int] = None) -> None:
         """
-        Execute KAS command with proper environment and error handling.
+        Serve the pinned layer repositories of a build from the shared layer store.
+        
+        Materializes the shared worktrees, writes the KAS override file into
+        the build directory and adds it to the KAS files. The store is mounted
+        at the same path into kas-container and its mirrors are used as KAS
+        reference repositories for the remaining repositories.
         
         Args:
-            args: Command arguments to pass to KAS
-            show_output: Whether to show live output or capture it
-            
-        Returns:
-            Completed process information
+            kas_mgr: KAS manager configured for the BSP
+            jobs: Maximum number of repositories prepared at the same time
             
         Raises:
-            SystemExit: If command fails or is interrupted by user
+            SystemExit: If a shared layer cannot be prepared
         """
-        cmd = self._get_kas_command() + args
-        env = self._get_environment_with_container_vars()
-
-        logging.info(f"Running: {' '.join(cmd)}")
-        logging.info(f"Build directory: {self.build_dir}")
-        logging.info(f"Using container: {self.use_container}")
-
-        # Log important environment variables for debugging
-        important_vars = ['DL_DIR', 'SSTATE_DIR', 'GITCONFIG_FILE']
-        for var in important_vars:
-            if var in env:
-                logging.info(f"Using {var}: {env[var]}")
-
-        try:
-            if show_output:
-                # Show live output to console for build progress
-                result = subprocess.run(
-                    cmd,
-                    check=True,
-                    cwd=self.build_dir,
-                    env=env
-                )
-            else:
-                # Capture output for programmatic use (export, validation)
-                result = subprocess.run(
-                    cmd,
-                    check=True,
-                    cwd=self.build_dir,
-                    capture_output=True,
-                    text=True,
-                    env=env
-                )
-            return result
+        if not kas_mgr.can_add_generated_config():
+            logging.warning("Not using shared layers")
+            return
+        store = self.get_layer_store()
+        sources, skipped = store.sources_for(kas_mgr)
+        if skipped:
+            logging.info(f"Not shared (not pinned to a commit or patched from another repository): "
+                         f"{', '.join(skipped)}")
+        if not sources:
+            return
+        created = store.materialize_all(sources, jobs)
+        kas_mgr.add_generated_config(store.OVERRIDE_FILE, store.override_config(sources),
+                                     "repositories served from the shared layer store")
+        kas_mgr.container_volumes.append(str(store.root))
+        kas_mgr.repo_ref_dir = str(store.mirrors_dir)
+        logging.info(f"Using {len(sources)} shared layers from {store.root} ({created} newly created)")
+
+    def sync_layers(self, bsp_names: List[str], jobs: Optional[int] = None) -> None:
+        """
+        Prepare the shared layer worktrees of BSPs.
+        
+        Args:
+            bsp_names: Names of the BSPs whose layers are prepared
+            jobs: Maximum number of repositories prepared at the same time
             
-        except subprocess.CalledProcessError as e:
-            logging.error(f"KAS command failed with return code {e.returncode}")
-            if not show_output and e.stderr:
-                logging.error(f"Error output: {e.stderr}")
-            sys.exit(1)
-        except KeyboardInterrupt:
-            logging.error("Command interrupted by user")
-            sys.exit(1)
-
-    def build_project(self, target: str = None, task: str = None, show_output: bool = True) -> None:
+        Raises:
+            SystemExit: If a BSP is unknown or a layer cannot be prepared
         """
-        Build the Yocto project using KAS.
+        store = self.get_layer_store()
+        logging.info(f"Layer store: {store.root}")
+        sources = []
+        for bsp_name in bsp_names:
+            bsp = self.get_bsp_by_name(bsp_name)
+            kas_mgr = self._get_kas_manager_for_bsp(bsp, use_container=False)
+            bsp_sources, skipped = store.sources_for(kas_mgr)
+            logging.info(f"{bsp.name}: {len(bsp_sources)} shared, {len(skipped)} not shared")
+            sources.extend(bsp_sources)
+        unique = {store.tree_path(source) for source in sources}
+        created = store.materialize_all(sources, jobs)
+        logging.info(f"{len(sources)} repository checkouts served by {len(unique)} shared worktrees "
+                     f"({created} newly created)")
+
+    def lock_bsps(self, bsp_names: List[str], check: bool = False, jobs: Optional[int] = None) -> None:
+        """
+        Pin the floating refs of BSPs in KAS lock files.
         
-        This is the main build method that orchestrates the complete
-        Yocto build process through KAS.
+        Repositories following a branch or tag without a commit are resolved
+        through the mirrors of the shared layer store, and their commits are
+        written to the lock file next to the first KAS file of each BSP
+        (<name>.lock.<ext>), which KAS applies automatically. BSPs sharing a
+        top-level KAS file share its lock file.
         
         Args:
-            target: Specific build target (recipe or image)
-            task: Specific build task (compile, configure, etc.)
-            show_output: Whether to show build output in real-time
+            bsp_names: Names of the BSPs to lock
+            check: Only report lock files that are missing or differ, without writing them
+            jobs: Maximum number of repositories resolved at the same time
             
         Raises:
-            SystemExit: If build fails or prerequisites are not met
+            SystemExit: If a ref cannot be resolved, BSPs sharing a lock file
+                need different commits, or check finds a difference
         """
-        # Validate environment configuration first
-        if not self.env_manager.validate_environment():
-            logging.error("Environment configuration validation failed")
+        store = self.get_layer_store()
+        wanted: List[Tuple[Path, str, str, Optional[str], Optional[str]]] = []
+        owners: Dict[Path, List[str]] = {}
+        for bsp_name in bsp_names:
+            bsp = self.get_bsp_by_name(bsp_name)
+            kas_mgr = self._get_kas_manager_for_bsp(bsp, use_container=False)
+            lock_file = kas_mgr.get_lock_file(kas_mgr._resolve_kas_file(kas_mgr.kas_files[0]))
+            owners.setdefault(lock_file, []).append(bsp.name)
+            for repo_name, repo in sorted(kas_mgr.get_resolved_repos(use_locks=False).items()):
+                if not repo.get('url') or repo.get('commit') or repo.get('type', 'git') != 'git':
+                    continue
+                wanted.append((lock_file, repo_name, repo['url'], repo.get('tag'), repo.get('branch')))
+
+        start = time.monotonic()
+        commits = store.resolve_refs([(url, tag, branch) for _, _, url, tag, branch in wanted], jobs)
+        logging.info(f"Resolved {len(commits)} refs in {time.monotonic() - start:.1f}s")
+
+        locks: Dict[Path, Dict[str, str]] = {lock_file: {} for lock_file in owners}
+        conflicts = False
+        for lock_file, repo_name, url, tag, branch in wanted:
+            commit = commits[(url, tag, branch)]
+            previous = locks[lock_file].setdefault(repo_name, commit)
+            if previous != commit:
+                logging.error(f"{lock_file}: BSPs {', '.join(owners[lock_file])} need different commits "
+                              f"of {repo_name} ({previous[:12]}, {commit[:12]})")
+                conflicts = True
+        if conflicts:
             sys.exit(1)
 
-        # Validate configuration files
-        if not self.validate_kas_files(check_includes=True):
-            logging.error("Cannot build due to missing files")
-            sys.exit(1)
-
-        # Check KAS availability
-        if not self.check_kas_available():
-            logging.error("KAS is not available. Please install KAS (e.g., 'pip install kas' or use your package manager)")
-            sys.exit(1)
-
-        # Build KAS command arguments
-        kas_files_str = self._get_kas_files_string()
-        args = ["build", kas_files_str]
-
-        if target:
-            args.extend(["--target", target])
-        if task:
-            args.extend(["--task", task])
-
-        try:
-            self._run_kas_command(args, show_output)
-            logging.info("Build completed successfully!")
-        except SystemExit:
-            raise
-        except Exception as e:
-            logging.error(f"Build failed: {e}")
+        drift = 0
+        for lock_file, repos in sorted(locks.items()):
+            try:
+                with open(lock_file, 'r', encoding='utf-8') as f:
+                    current = ((yaml.safe_load(f) or {}).get('overrides') or {}).get('repos') or {}
+            except FileNotFoundError:
+                current = None
+            except (OSError, yaml.YAMLError) as e:
+                logging.error(f"Cannot read {lock_file}: {e}")
+                sys.exit(1)
+            current_commits = {name: lock.get('commit') for name, lock in (current or {}).items()
+                               if isinstance(lock, dict)}
+            if current_commits == repos and (current is not None or not repos):
+                logging.info(f"{lock_file}: up to date ({len(repos)} repositories)")
+                continue
+
+            if check:
+                drift += 1
+                if current is None:
+                    logging.error(f"{lock_file}: missing, {len(repos)} repositories are not locked")
+                    continue
+                for repo_name in sorted(set(repos) | set(current_commits)):
+                    locked, resolved = current_commits.get(repo_name), repos.get(repo_name)
+                    if locked == resolved:
+                        continue
+                    if not resolved:
+                        logging.error(f"{lock_file}: {repo_name} is locked but no longer floating")
+                    elif not locked:
+                        logging.error(f"{lock_file}: {repo_name} is not locked (now {resolved[:12]})")
+                    else:
+                        logging.error(f"{lock_file}: {repo_name} locked at {locked[:12]}, "
+                                      f"now {resolved[:12]}")
+                continue
+
+            content = {
+                "header": {"version": 14},
+                "overrides": {"repos": {name: {"commit": commit} for name, commit in repos.items()}},
+            }
+            tmp_path = lock_file.with_name(lock_file.name + ".tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(f"# Generated by bsp.py lock for {', '.join(owners[lock_file])}\n")
+                yaml.safe_dump(content, f, default_flow_style=False, sort_keys=True)
+            os.replace(tmp_path, lock_file)
+            logging.info(f"{lock_file}: locked {len(repos)} repositories")
+
+        if drift:
+            logging.error(f"{drift} lock files are out of date, run 'bsp.py lock' to update them")
             sys.exit(1)
 
-    def checkout_project(self, show_output: bool = True) -> None:
+    def check_patches(self, bsp_names: List[str], jobs: Optional[int] = None) -> None:
         """
-        Checkout/validate the Yocto project repositories using KAS.
-        
-        This method validates that the KAS configuration is correct and
-        repositories can be cloned without performing a full build. This is
-        useful for quick validation of build configurations.
+        Verify that the patches of BSPs apply to their repositories.
         
         Args:
-            show_output: Whether to show checkout output in real-time
+            bsp_names: Names of the BSPs whose patches are checked
+            jobs: Maximum number of patch series checked at the same time
             
         Raises:
-            SystemExit: If checkout/validation fails or prerequisites are not met
+            SystemExit: If a patch does not apply or cannot be checked
         """
-        # Validate environment configuration first
-        if not self.env_manager.validate_environment():
-            logging.error("Environment configuration validation failed")
-            sys.exit(1)
+        store = self.get_layer_store()
+        series_list = []
+        owners = []
+        for bsp_name in bsp_names:
+            bsp = self.get_bsp_by_name(bsp_name)
+            kas_mgr = self._get_kas_manager_for_bsp(bsp, use_container=False)
+            bsp_series, skipped = store.patch_series_for(kas_mgr)
+            for repo_name in skipped:
+                logging.warning(f"{bsp.name}: patches of {repo_name} come from another repository, not checked")
+            series_list.extend(bsp_series)
+            owners.extend([bsp.name] * len(bsp_series))
+        if not series_list:
+            logging.info("No patches to check")
+            return
 
-        # Validate configuration files
-        if not self.validate_kas_files(check_includes=True):
-            logging.error("Cannot checkout due to missing files")
+        start = time.monotonic()
+        results = store.check_patches(series_list, jobs)
+
+        problems: Dict[Tuple[str, str], List[Any]] = {}
+        checked = set()
+        cached = 0
+        for owner, checks in zip(owners, results):
+            for check in checks:
+                key = (str(check.path), check.base_commit)
+                if key not in checked:
+                    checked.add(key)
+                    cached += int(check.cached)
+                if check.status in ('failed', 'missing'):
+                    problems.setdefault(key, [check, []])[1].append(owner)
+
+        for check, bsps in problems.values():
+            reason = "not found" if check.status == 'missing' else "does not apply"
+            logging.error(f"Patch {check.path} ({check.repo}/{check.patch_id}) {reason} "
+                          f"at {check.base_commit[:12]}, used by {', '.join(sorted(set(bsps)))}")
+            for line in check.error.splitlines()[:10]:
+                logging.error(f"  {line}")
+        logging.info(f"Checked {len(checked)} patches ({cached} cached) in {time.monotonic() - start:.1f}s: "
+                     f"{len(problems)} failed")
+        if problems:
             sys.exit(1)
 
-        # Check KAS availability
-        if not self.check_kas_available():
-            logging.error("KAS is not available. Please install KAS (e.g., 'pip install kas' or use your package manager)")
+    def get_downloads_index(self) -> DownloadsIndex:
+        """
+        Get the index of the download directory, refreshed and saved.
+        
+        Raises:
+            SystemExit: If DL_DIR is not configured or does not exist
+        """
+        dl_dir = self.env_manager.get_value('DL_DIR') if self.env_manager else None
+        if not dl_dir:
+            logging.error("DL_DIR is not configured in the registry environment")
             sys.exit(1)
-
-        # Build KAS command arguments
-        kas_files_str = self._get_kas_files_string()
-        args = ["checkout", kas_files_str]
-
-        try:
-            self._run_kas_command(args, show_output)
-            logging.info("Checkout/validation completed successfully!")
-        except SystemExit:
-            raise
-        except Exception as e:
-            logging.error(f"Checkout/validation failed: {e}")
+        root = resolver.resolve(dl_dir)
+        if not root.is_dir():
+            logging.error(f"Download directory {root} does not exist")
             sys.exit(1)
-
-    def shell_session(self, command: str = None, show_output: bool = True) -> None:
+        index = DownloadsIndex(root, self.get_cache_root() / "downloads-index.json")
+        index.load()
+        start = time.monotonic()
+        index.refresh()
+        index.save()
+        logging.info(f"Indexed {root} in {time.monotonic() - start:.2f}s "
+                     f"({index.scanned} of {len(index.dirs)} directories listed)")
+        return index
+
+    def list_sources(self, bsp_names: List[str], jobs: Optional[int] = None,
+                     refresh: bool = False) -> Dict[str, List[Dict[str, Any]]]:
         """
-        Start KAS shell session or execute command in build environment.
+        Enumerate the downloads needed to build BSPs.
         
-        This method launches an interactive shell session within the
-        build environment, allowing users to run commands manually.
+        The recipes needed for the targets of a BSP come from 'bitbake -g',
+        and their downloads from the BitBake fetcher, run in the KAS shell
+        of the BSP. The list is kept in the build directory and reused as
+        long as the build fingerprint does not change. BSPs without a
+        current list are processed concurrently.
         
         Args:
-            command: Optional command to execute in shell (if not provided, starts interactive shell)
-            show_output: Whether to show command output
+            bsp_names: Names of the BSPs
+            jobs: Maximum number of BSPs processed at the same time
+            refresh: Enumerate again even if a current list exists
+            
+        Returns:
+            Source list entries (recipe, url, localpath, donestamp, mirrors) per BSP
             
         Raises:
-            SystemExit: If shell session fails to start
+            SystemExit: If the sources of a BSP cannot be listed
         """
-        if not self.validate_kas_files(check_includes=True):
-            sys.exit(1)
-
-        if not self.check_kas_available():
-            logging.error("KAS is not available")
-            sys.exit(1)
-
-        kas_files_str = self._get_kas_files_string()
-        args = ["shell", kas_files_str]
-
-        if command:
-            args.extend(["--command", command])
-            logging.info(f"Executing command in KAS shell: {command}")
-        else:
-            logging.info("Starting interactive KAS shell session...")
-            logging.info("Type 'exit' to leave the shell when done.")
-
-        try:
-            self._run_kas_command(args, show_output)
-        except SystemExit:
-            raise
-        except Exception as e:
-            logging.error(f"Shell session failed: {e}")
+        sources: Dict[str, List[Dict[str, Any]]] = {}
+        pending = []
+        for bsp_name in bsp_names:
+            bsp = self.get_bsp_by_name(bsp_name)
+            container_config = self.get_container_config_for_bsp(bsp)
+            kas_mgr = self._get_kas_manager_for_bsp(bsp)
+            fingerprint = BuildFingerprint(kas_mgr, container_config, bsp.name)
+            fingerprint.compute()
+            # KAS builds core-image-minimal when no target is configured
+            targets = kas_mgr.get_targets() or ['core-image-minimal']
+            list_path = kas_mgr.build_dir / SOURCE_LIST_FILE
+            try:
+                with open(list_path, 'r', encoding='utf-8') as f:
+                    stored = json.load(f)
+            except (OSError, ValueError):
+                stored = {}
+            if not refresh and stored.get('fingerprint') == fingerprint.digest and stored.get('targets') == targets:
+                sources[bsp.name] = stored.get('sources') or []
+                continue
+            pending.append((bsp, container_config, kas_mgr, fingerprint.digest, targets, list_path))
+
+        if not pending:
+            return sources
+
+        specs = []
+        outputs = []
+        for bsp, container_config, kas_mgr, _, targets, _ in pending:
+            if container_config.file and container_config.image:
+                self.ensure_container_image(container_config)
+            self.use_hashserv(kas_mgr)
+            self.skip_current_checkout(CheckoutState(kas_mgr))
+            # kas shell runs in <build dir>/build (KAS_BUILD_DIR below KAS_WORK_DIR)
+            (kas_mgr.build_dir / "bsp-list-sources.py").write_text(SOURCE_LIST_SCRIPT, encoding='utf-8')
+            output = CaptureLineHandler()
+            tail = CaptureLineHandler(max_lines=20)
+            command = f"bitbake -g {' '.join(targets)} && python3 ../bsp-list-sources.py"
+            specs.append(kas_mgr.get_shell_spec(command, [output, tail], [tail]))
+            outputs.append((output, tail))
+
+        logging.info(f"Listing the sources of {len(specs)} BSPs")
+        results = runner.run_all_sync(specs, jobs)
+        failed = False
+        for (bsp, _, _, digest, targets, list_path), (output, tail), result in zip(pending, outputs, results):
+            if not result.ok:
+                logging.error(f"{bsp.name}: listing sources failed (exit code {result.returncode}):\n"
+                              f"{tail.text.rstrip()}")
+                failed = True
+                continue
+            entries = []
+            for line in output.lines:
+                if line.startswith('BSP-SOURCE '):
+                    entries.append(json.loads(line[len('BSP-SOURCE '):]))
+                elif line.startswith('BSP-SOURCE-ERROR '):
+                    error = json.loads(line[len('BSP-SOURCE-ERROR '):])
+                    logging.warning(f"{bsp.name}: cannot list sources of {error['recipe']}: {error['error']}")
+            record = {
+                "fingerprint": digest,
+                "targets": targets,
+                "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                "sources": entries,
+            }
+            with open(list_path, 'w', encoding='utf-8') as f:
+                json.dump(record, f, indent=1)
+            sources[bsp.name] = entries
+            logging.info(f"{bsp.name}: {len(entries)} sources in {result.duration:.0f}s")
+        if failed:
             sys.exit(1)
+        return sources
 
-    def run_bitbake_command(self, recipe: str, bitbake_args: List[str] = None, show_output: bool = True) -> None:
+    def offline_check(self, bsp_names: List[str], jobs: Optional[int] = None, refresh: bool = False) -> None:
         """
-        Run BitBake command through KAS shell.
+        Verify that BSPs can be built without network access (BB_NO_NETWORK).
+        
+        Every download needed by the targets of the BSPs must be in DL_DIR
+        with its .done marker, or be available as a mirror tarball
+        (BB_GENERATE_MIRROR_TARBALLS).
         
         Args:
-            recipe: BitBake recipe to build
-            bitbake_args: Additional BitBake arguments
-            show_output: Whether to show command output
+            bsp_names: Names of the BSPs to check
+            jobs: Maximum number of BSPs whose sources are listed at the same time
+            refresh: List the sources again even if a current list exists
             
         Raises:
-            SystemExit: If BitBake command fails
+            SystemExit: If a download is missing or incomplete
         """
-        if not self.validate_kas_files(check_includes=True):
+        index = self.get_downloads_index()
+        sources = self.list_sources(bsp_names, jobs, refresh)
+
+        problems: Dict[str, List[Any]] = {}
+        for bsp_name in bsp_names:
+            counts = {'ok': 0, 'mirror': 0, 'partial': 0, 'missing': 0}
+            for source in sources[bsp_name]:
+                status = index.source_status(source)
+                counts[status] += 1
+                if status in ('partial', 'missing'):
+                    problems.setdefault(source['localpath'], [status, source, []])[2].append(bsp_name)
+            logging.info(f"{bsp_name}: {counts['ok'] + counts['mirror']} of {sum(counts.values())} downloads "
+                         f"available ({counts['mirror']} as mirror tarballs), {counts['partial']} incomplete, "
+                         f"{counts['missing']} missing")
+
+        for localpath, (status, source, bsps) in sorted(problems.items()):
+            reason = "incomplete (no .done marker)" if status == 'partial' else "missing"
+            logging.error(f"{localpath} {reason}: {source['url']} ({source['recipe']}), "
+                          f"needed by {', '.join(sorted(set(bsps)))}")
+        if problems:
+            logging.error(f"{len(problems)} downloads are not available offline")
             sys.exit(1)
+        logging.info("All downloads are available offline")
 
-        if not self.check_kas_available():
-            logging.error("KAS is not available")
+    def check_downloads(self, verify: bool = False, fix: bool = False, jobs: Optional[int] = None) -> None:
+        """
+        Report incomplete, stale and corrupt entries of the download directory.
+        
+        Args:
+            verify: Compare downloads with the checksums recorded in their .done markers
+            fix: Remove the reported entries (with the .done marker of corrupt downloads)
+            jobs: Number of hashing processes
+            
+        Raises:
+            SystemExit: If problems were found and not removed
+        """
+        index = self.get_downloads_index()
+        start = time.monotonic()
+        problems = index.find_problems(verify=verify, jobs=jobs)
+        index.save()
+        for kind, rel_path, description in problems:
+            logging.warning(f"{kind}: {rel_path}: {description}")
+        counts: Dict[str, int] = {}
+        for kind, _, _ in problems:
+            counts[kind] = counts.get(kind, 0) + 1
+        summary = ", ".join(f"{count} {kind}" for kind, count in sorted(counts.items())) or "no problems"
+        logging.info(f"Checked {len(index.files())} files and {len(index.clones())} clones "
+                     f"in {time.monotonic() - start:.1f}s: {summary}")
+        if not problems:
+            return
+        if not fix:
+            logging.error("Use --fix to remove the reported entries")
             sys.exit(1)
 
-        # Build BitBake command
-        bitbake_cmd = ["bitbake", recipe]
-        if bitbake_args:
-            bitbake_cmd.extend(bitbake_args)
-
-        # Execute through KAS shell
-        kas_files_str = self._get_kas_files_string()
-        args = ["shell", kas_files_str, "--command", " ".join(bitbake_cmd)]
-
-        logging.info(f"Running BitBake: {' '.join(bitbake_cmd)}")
-
-        try:
-            self._run_kas_command(args, show_output)
-            logging.info("BitBake command completed successfully!")
-        except SystemExit:
-            raise
-        except Exception as e:
-            logging.error(f"BitBake command failed: {e}")
+        for kind, rel_path, _ in problems:
+            path = index.root / rel_path
+            try:
+                if path.is_dir() and not path.is_symlink():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+                if kind == 'corrupt':
+                    (index.root / f"{rel_path}.done").unlink(missing_ok=True)
+            except OSError as e:
+                logging.error(f"Cannot remove {rel_path}: {e}")
+        index.refresh()
+        index.save()
+        logging.info(f"Removed {len(problems)} entries")
+
+    def dedup_downloads(self, link: bool = False, jobs: Optional[int] = None) -> None:
+        """
+        Find downloads stored several times under different names.
+        
+        Args:
+            link: Replace the copies by hardlinks to one file
+            jobs: Number of hashing processes
+        """
+        index = self.get_downloads_index()
+        start = time.monotonic()
+        duplicates = index.find_duplicates(jobs)
+        wasted = 0
+        for paths in duplicates:
+            size = index.size_of(paths[0])
+            wasted += size * (len(paths) - 1)
+            print(f"{size / 2**20:10.1f} MiB x{len(paths)}  {'  '.join(paths)}")
+        logging.info(f"{len(duplicates)} duplicated downloads, {wasted / 2**20:.1f} MiB in extra copies "
+                     f"(found in {time.monotonic() - start:.1f}s)")
+        if link and duplicates:
+            freed = sum(index.link_duplicates(paths) for paths in duplicates)
+            logging.info(f"Freed {freed / 2**20:.1f} MiB by hardlinking duplicates")
+        index.save()
+
+    def downloads_usage(self, bsp_names: List[str], jobs: Optional[int] = None) -> None:
+        """
+        Attribute the download directory to BSPs.
+        
+        Downloads are attributed through the source lists of the BSPs (see
+        list_sources). Each BSP is shown with the size of all its downloads
+        and of those no other selected BSP uses.
+        
+        Args:
+            bsp_names: Names of the BSPs
+            jobs: Maximum number of BSPs whose sources are listed at the same time
+        """
+        index = self.get_downloads_index()
+        sources = self.list_sources(bsp_names, jobs)
+
+        users: Dict[str, Set[str]] = {}
+        for bsp_name in bsp_names:
+            for source in sources[bsp_name]:
+                for rel_path in [source['localpath'], source['donestamp']] + list(source.get('mirrors') or []):
+                    if index.exists(rel_path):
+                        users.setdefault(rel_path, set()).add(bsp_name)
+        sizes = {rel_path: index.size_of(rel_path) for rel_path in users}
+
+        print(f"{'BSP':<50} {'total':>12} {'exclusive':>12}")
+        for bsp_name in sorted(bsp_names):
+            total = sum(size for rel_path, size in sizes.items() if bsp_name in users[rel_path])
+            exclusive = sum(size for rel_path, size in sizes.items() if users[rel_path] == {bsp_name})
+            print(f"{bsp_name:<50} {total / 2**30:>8.2f} GiB {exclusive / 2**30:>8.2f} GiB")
+
+        unused = [rel_path for rel_path, _ in index.files() if rel_path not in users]
+        unused += [rel_path for rel_path in index.clones() if rel_path not in users]
+        unused_size = sum(index.size_of(rel_path) for rel_path in unused)
+        print(f"{'(not used by these BSPs)':<50} {unused_size / 2**30:>8.2f} GiB")
+        index.save()
+
+    def disk_usage(self, bsp_names: List[str], jobs: Optional[int] = None, refresh: bool = False,
+                   unused: bool = False, idle_days: int = 30) -> None:
+        """
+        Show the disk usage of BSP build paths by category and suggest cleanups.
+        
+        Build paths are walked in parallel and the result is kept in
+        <cache root>/disk-usage.json, so later runs only list directories
+        that changed. Hardlinked files are counted once per BSP and once in
+        the total.
+        
+        Args:
+            bsp_names: Names of the BSPs
+            jobs: Number of threads listing directories
+            refresh: List every directory again
+            unused: Also report directories next to the build paths that no
+                BSP of the registry uses
+            idle_days: Suggest cleaning build paths unchanged for this many days
+        """
+        snapshot = DiskUsageSnapshot(self.get_cache_root() / "disk-usage.json")
+        snapshot.load()
+        start = time.monotonic()
+
+        paths: Dict[Path, str] = {}
+        for bsp_name in bsp_names:
+            paths.setdefault(Path(self.get_bsp_by_name(bsp_name).build.path).resolve(), bsp_name)
+        if unused:
+            used = {Path(self.get_bsp_by_name(name).build.path).resolve() for name in self.get_all_bsp_names()}
+            for parent in sorted({path.parent for path in paths}):
+                try:
+                    candidates = [entry for entry in parent.iterdir() if entry.is_dir() and not entry.is_symlink()
+                                  and not entry.name.startswith(TRASH_PREFIX)]
+                except OSError:
+                    continue
+                for candidate in sorted(candidates):
+                    if candidate not in used:
+                        paths[candidate] = f"({candidate.name}: unused)"
+
+        rows = []
+        all_seen: Set[Tuple[int, int]] = set()
+        totals = dict.fromkeys(DISK_USAGE_CATEGORIES, 0)
+        for path, label in paths.items():
+            if not path.is_dir():
+                logging.debug("No build directory for %s: %s", label, path)
+                continue
+            dirs = snapshot.scan(path, jobs, refresh)
+            usage = DiskUsageSnapshot.summarize(dirs, set())
+            for category, size in DiskUsageSnapshot.summarize(dirs, all_seen).items():
+                totals[category] += size
+            last_change = max((record['mtime_ns'] for record in dirs.values()), default=0) / 1e9
+            rows.append((label, path, usage, last_change))
+        snapshot.save()
+        logging.info(f"Scanned {len(rows)} build paths in {time.monotonic() - start:.1f}s "
+                     f"({snapshot.scanned} directories listed)")
+
+        print(f"{'BSP':<50} " + " ".join(f"{category:>14}" for category in DISK_USAGE_CATEGORIES)
+              + f" {'total':>10}")
+        for label, _, usage, _ in sorted(rows, key=lambda row: -sum(row[2].values())):
+            print(f"{label:<50} " + " ".join(f"{usage[category] / 2**30:>10.2f} GiB"
+                                            for category in DISK_USAGE_CATEGORIES)
+                  + f" {sum(usage.values()) / 2**30:>6.2f} GiB")
+        print(f"{'(total, hardlinks counted once)':<50} "
+              + " ".join(f"{totals[category] / 2**30:>10.2f} GiB" for category in DISK_USAGE_CATEGORIES)
+              + f" {sum(totals.values()) / 2**30:>6.2f} GiB")
+
+        suggestions = []
+        now = time.time()
+        for label, path, usage, last_change in rows:
+            if label.startswith('('):
+                suggestions.append((sum(usage.values()), f"{path}: not used by any BSP in the registry"))
+            elif now - last_change > idle_days * 86400:
+                tmp_size = usage['work'] + usage['deploy'] + usage['sstate-control']
+                suggestions.append((tmp_size, f"{path}: unchanged for {(now - last_change) / 86400:.0f} days, "
+                                              f"its tmp/ can be removed (restored from sstate)"))
+            elif usage['work'] > 2 * (usage['deploy'] + usage['layers'] + usage['cache']) and usage['work'] > 2**30:
+                suggestions.append((usage['work'], f"{path}: tmp/work dominates the build path "
+                                                   f"(consider INHERIT += \"rm_work\")"))
+        if suggestions:
+            print("\nCleanup candidates:")
+            for size, text in sorted(suggestions, reverse=True):
+                print(f"{size / 2**30:>8.2f} GiB  {text}")
+
+    def get_sstate_dir(self) -> Path:
+        """
+        Get the local shared state directory.
+        
+        Raises:
+            SystemExit: If SSTATE_DIR is not configured
+        """
+        sstate = self.env_manager.get_value('SSTATE_DIR') if self.env_manager else None
+        if not sstate:
+            logging.error("SSTATE_DIR is not configured in the registry environment")
             sys.exit(1)
+        return resolver.resolve(sstate)
 
-    def dump_config(self, show_output: bool = True) -> Optional[str]:
+    def use_sstate_mirror(self, kas_mgr: KasManager) -> None:
         """
-        Dump expanded KAS configuration for verification.
+        Add the sstate mirror configured with SSTATE_MIRROR_URL to a build.
         
-        This method shows the fully resolved KAS configuration after
-        processing all includes and variable expansions.
+        Args:
+            kas_mgr: KAS manager configured for the BSP
+        """
+        url = self.env_manager.get_value('SSTATE_MIRROR_URL') if self.env_manager else None
+        if not url or not kas_mgr.can_add_generated_config():
+            return
+        kas_mgr.add_generated_config("sstate-mirror.yml", sstate_mirrors_config(url), "shared sstate mirror")
+        logging.info(f"Using sstate mirror {url}")
+
+    def get_sstate_upload_token(self) -> Optional[str]:
+        """Shared secret for sstate uploads (SSTATE_UPLOAD_TOKEN from the process or registry environment)."""
+        return os.environ.get('SSTATE_UPLOAD_TOKEN') or \
+            (self.env_manager.get_value('SSTATE_UPLOAD_TOKEN') if self.env_manager else None) or None
+
+    def serve_sstate(self, host: str = "127.0.0.1", port: int = 8000, allow_upload: bool = False,
+                     directory: Optional[str] = None) -> None:
+        """
+        Serve the local SSTATE_DIR over HTTP until interrupted.
+        
+        Uploaded objects are unpacked into the builds of every worker
+        using the mirror, so uploads on an address reachable from other
+        hosts require SSTATE_UPLOAD_TOKEN.
         
         Args:
-            show_output: Whether to show output or return it
-            
-        Returns:
-            Configuration string if show_output=False, None otherwise
+            host: Address to listen on
+            port: Port to listen on
+            allow_upload: Accept uploads of new sstate objects from other workers
+            directory: Directory to serve instead of SSTATE_DIR
             
         Raises:
-            SystemExit: If config dump fails
+            SystemExit: If the server cannot be started or uploads would be unauthenticated
         """
-        if not self.validate_kas_files(check_includes=True):
+        root = Path(directory) if directory else self.get_sstate_dir()
+        token = self.get_sstate_upload_token()
+        if allow_upload and not token and not is_loopback_address(host):
+            logging.error(f"Refusing unauthenticated uploads on {host}: set SSTATE_UPLOAD_TOKEN "
+                          f"or listen on 127.0.0.1")
             sys.exit(1)
-
-        if not self.check_kas_available():
-            logging.error("KAS is not available")
+        resolver.ensure_directory(str(root))
+        try:
+            server = SstateServer(str(root), host, port, allow_upload, token if allow_upload else None)
+        except OSError as e:
+            logging.error(f"Cannot start sstate server on {host}:{port}: {e}")
             sys.exit(1)
+        logging.info(f"Serving {root} at {server.url}{' (uploads enabled)' if allow_upload else ''}")
+        logging.info(f"Builds use it with SSTATE_MIRROR_URL=http://<this host>:{server.server_address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Stopping sstate server")
+        finally:
+            server.server_close()
 
-        kas_files_str = self._get_kas_files_string()
-        args = ["dump", kas_files_str]
-
+    def record_filesystem_metrics(self, role: str, path: Path) -> None:
+        """
+        Record the free space of the filesystem holding a directory.
+        
+        Args:
+            role: Label of the directory (DL_DIR, SSTATE_DIR or build)
+            path: Directory
+        """
+        if not metrics.enabled:
+            return
         try:
-            if show_output:
-                self._run_kas_command(args, show_output=True)
-                return None
-            else:
-                result = self._run_kas_command(args, show_output=False)
-                return result.stdout
-        except SystemExit:
-            raise
-        except Exception as e:
-            logging.error(f"Config dump failed: {e}")
-            sys.exit(1)
+            usage = shutil.disk_usage(path)
+        except OSError as e:
+            logging.debug("Cannot get the filesystem usage of %s: %s", path, e)
+            return
+        metrics.set('bsp_filesystem_avail_bytes', usage.free, dir=role, path=str(path))
+        metrics.set('bsp_filesystem_size_bytes', usage.total, dir=role, path=str(path))
 
-    def export_kas_config(self, output_file: Optional[str] = None) -> str:
+    def record_cache_metrics(self, max_age: Optional[float] = None) -> None:
         """
-        Export the complete KAS configuration as YAML.
+        Record free space and size of DL_DIR and SSTATE_DIR.
         
-        This method uses KAS to dump the fully resolved configuration
-        and saves it to a file or returns it as a string.
+        Free space is cheap and always recorded. Sizes come from the
+        incremental disk usage snapshot (see 'du'), which still visits
+        every directory, so they are only measured when max_age is given
+        and the last measurement is older.
         
         Args:
-            output_file: Optional path to save the configuration
-            
-        Returns:
-            The KAS configuration as YAML string
+            max_age: Seconds a measured cache size stays current (None: do not measure sizes)
+        """
+        if not metrics.enabled or not self.env_manager:
+            return
+        snapshot = None
+        for role in ('DL_DIR', 'SSTATE_DIR'):
+            value = self.env_manager.get_value(role)
+            if not value or not resolver.exists(value):
+                continue
+            path = resolver.resolve(value)
+            self.record_filesystem_metrics(role, path)
+            if max_age is None:
+                continue
+            scanned = metrics.get('bsp_cache_scan_timestamp_seconds', dir=role, path=str(path))
+            if scanned and time.time() - scanned < max_age:
+                continue
+            if snapshot is None:
+                snapshot = DiskUsageSnapshot(self.get_cache_root() / "disk-usage.json")
+                snapshot.load()
+            start = time.monotonic()
+            size = sum(DiskUsageSnapshot.summarize(snapshot.scan(path), set()).values())
+            logging.debug("Measured %s in %.1fs: %.1f GiB", path, time.monotonic() - start, size / 2**30)
+            metrics.set('bsp_cache_size_bytes', size, dir=role, path=str(path))
+            metrics.set('bsp_cache_scan_timestamp_seconds', time.time(), dir=role, path=str(path))
+        if snapshot is not None:
+            snapshot.save()
+
+    def serve_metrics(self, host: str = "0.0.0.0", port: int = 9464, interval: float = 60.0) -> None:
+        """
+        Serve the metrics of all commands on this host over HTTP until interrupted.
+        
+        Cache sizes and free space are measured again every interval
+        seconds; build metrics come from the commands as they finish.
+        
+        Args:
+            host: Address to listen on
+            port: Port to listen on
+            interval: Seconds between cache measurements
             
         Raises:
-            SystemExit: If export fails
+            SystemExit: If no metrics directory is configured or the server cannot be started
         """
-        logging.info("Exporting KAS configuration...")
-        
-        if not self.validate_kas_files(check_includes=True):
-            logging.error("Cannot export due to missing files")
+        if not metrics.enabled:
+            logging.error("No metrics directory configured (set BSP_METRICS_DIR or use --metrics-dir)")
             sys.exit(1)
-
-        if not self.check_kas_available():
-            logging.error("KAS is not available")
+        try:
+            server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        except OSError as e:
+            logging.error(f"Cannot start metrics server on {host}:{port}: {e}")
             sys.exit(1)
-
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+        thread.start()
+        logging.info(f"Serving metrics at http://{host}:{server.server_address[1]}/metrics")
         try:
-            # Get the complete configuration dump
-            config_yaml = self.dump_config(show_output=False)
-            
-            if not config_yaml:
-                logging.error("Failed to get KAS configuration")
-                sys.exit(1)
-                
-            # Save to file if specified
-            if output_file:
-                output_path = Path(output_file)
-                output_path.parent.mkdir(parents=True, exist_ok=True)
-                
-                with open(output_path, 'w', encoding='utf-8') as f:
-                    f.write(config_yaml)
-                
-                logging.info(f"KAS configuration exported to: {output_path}")
-            else:
-                logging.info("KAS configuration exported successfully")
-                
-            return config_yaml
+            while True:
+                self.record_cache_metrics(max_age=interval)
+                metrics.flush()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            logging.info("Stopping metrics server")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def push_sstate(self, url: Optional[str] = None, jobs: Optional[int] = None) -> None:
+        """
+        Upload new local sstate objects to an sstate mirror server.
+        
+        Args:
+            url: Mirror URL (default: SSTATE_MIRROR_URL from the registry environment)
+            jobs: Number of parallel uploads
             
-        except SystemExit:
-            raise
-        except Exception as e:
-            logging.error(f"Failed to export KAS configuration: {e}")
+        Raises:
+            SystemExit: If no mirror is configured or an upload fails
+        """
+        url = url or (self.env_manager.get_value('SSTATE_MIRROR_URL') if self.env_manager else None)
+        if not url:
+            logging.error("No sstate mirror given (use --url or SSTATE_MIRROR_URL)")
+            sys.exit(1)
+        pusher = SstatePusher(str(self.get_sstate_dir()), url, self.get_sstate_upload_token())
+        start = time.monotonic()
+        try:
+            checked, uploaded, uploaded_bytes = pusher.push(jobs)
+        except (OSError, ScriptError, http.client.HTTPException) as e:
+            logging.error(f"Pushing sstate to {url} failed: {e}")
             sys.exit(1)
+        logging.info(f"Pushed {uploaded} of {checked} new sstate objects ({uploaded_bytes / 2**20:.1f} MiB) "
+                     f"to {url} in {time.monotonic() - start:.1f}s")
 
-# =============================================================================
-# Main BSP Management Class with Container Support
-# =============================================================================
+    def get_hashserv(self) -> HashEquivalenceServer:
+        """Get the hash equivalence server supervisor below the cache root."""
+        return HashEquivalenceServer(str(self.get_cache_root() / "hashserv"))
 
-class BspManager:
-    """
-    Main BSP management class for BSP registry management.
-    
-    This class coordinates the overall BSP management flow including
-    configuration loading, BSP discovery, build execution, shell access,
-    and configuration export operations with container support.
-    """
-    
-    def __init__(self, config_path: str = "bsp-registry.yml"):
+    def use_hashserv(self, kas_mgr: KasManager) -> Optional[Tuple[int, int]]:
         """
-        Initialize BSP manager.
+        Point a build at the host-wide hash equivalence server, starting it if needed.
+        
+        The server is not managed when the registry environment sets
+        BB_HASHSERVE (an external server) or BSP_HASHSERV=off.
         
         Args:
-            config_path: Path to BSP registry configuration file
+            kas_mgr: KAS manager configured for the BSP
+            
+        Returns:
+            Hash counts of the server database before the build, or None
+            if the build does not use the managed server
         """
-        self.config_path = Path(config_path)
-        self.logger = logging.getLogger(self.__class__.__name__)
-        self.model = None  # Will hold parsed registry configuration
-        self.env_manager = None  # Environment configuration manager
-        self.containers = {}  # Dictionary of container configurations
+        if self.env_manager and (self.env_manager.get_value('BB_HASHSERVE') or
+                                 self.env_manager.get_value('BSP_HASHSERV') in ('0', 'off', 'no', 'false')):
+            return None
+        executable = HashEquivalenceServer.find_executable([str(kas_mgr.build_dir)])
+        if not executable:
+            logging.warning("bitbake-hashserv not found, building without the shared hash equivalence server")
+            return None
+        if not kas_mgr.can_add_generated_config():
+            return None
+        server = self.get_hashserv()
+        try:
+            state = server.ensure_running(executable)
+        except (OSError, ScriptError) as e:
+            logging.warning(f"Building without the shared hash equivalence server: {e}")
+            return None
+        if kas_mgr.use_container and is_loopback_address(state['host']):
+            logging.warning("Hash equivalence server only listens on the loopback interface "
+                            "(no Docker bridge network), building without it")
+            return None
+        # Containers reach the bridge gateway address directly; so does the host
+        address = f"{state['host']}:{state['port']}"
+        kas_mgr.add_generated_config("hashserv.yml", {"local_conf_header": {
+            "bsp-hashserv": f'BB_SIGNATURE_HANDLER = "OEEquivHash"\nBB_HASHSERVE = "{address}"\n'
+        }}, "managed hash equivalence server")
+        logging.info(f"Using hash equivalence server {address} (pid {state['pid']}, database {state['database']})")
+        return server.hash_counts()
+
+    def report_hashserv(self, before: Tuple[int, int]) -> None:
+        """
+        Report unihash statistics of a build.
+        
+        Args:
+            before: Hash counts returned by use_hashserv() before the build
+        """
+        total, hits = self.get_hashserv().hash_counts()
+        new_hashes = total - before[0]
+        new_hits = hits - before[1]
+        logging.info(f"Hash equivalence: {new_hashes} new task hashes, {new_hits} mapped to an equivalent "
+                     f"unihash ({total} hashes, {hits} equivalences in total)")
 
-    def load_configuration(self) -> None:
+    def manage_hashserv(self, action: str) -> None:
         """
-        Load and parse BSP configuration from YAML file.
+        Start, stop or show the host-wide hash equivalence server.
         
+        Args:
+            action: 'start', 'stop' or 'status'
+            
         Raises:
-            SystemExit: If configuration file is missing or invalid
+            SystemExit: If the server cannot be started
         """
-        try:
-            if not self.config_path.exists():
-                logging.error(f"Config file not found: {self.config_path}")
+        server = self.get_hashserv()
+        if action == 'start':
+            executable = HashEquivalenceServer.find_executable(
+                [bsp.build.path for bsp in self.get_all_bsps()])
+            if not executable:
+                logging.error("bitbake-hashserv not found in PATH or in any BSP build directory")
                 sys.exit(1)
-
-            # Parse YAML configuration into structured model
-            self.model = get_registry_from_yaml_file(self.config_path)
-            logging.info(f"Configuration loaded successfully from {self.config_path}")
-
-            # Store containers from model
-            if self.model.containers:
-                self.containers = self.model.containers
-                logging.info(f"Loaded {len(self.containers)} container definitions")
-
-            # Initialize Environment manager if configuration exists
-            if self.model.environment:
-                self.env_manager = EnvironmentManager(self.model.environment)
-                logging.info(f"Environment configuration initialized with {len(self.model.environment)} variables")
-
-        except SystemExit:
-            raise
-        except Exception as e:
-            logging.error(f"Failed to load configuration: {e}")
-            sys.exit(1)
-
-    def initialize(self) -> None:
-        """Initialize BSP manager components and validate configuration."""
-        logging.info("Initializing BSP manager...")
-        self.load_configuration()
-        
-        # Validate environment configuration if present
-        if self.env_manager:
-            if not self.env_manager.validate_environment():
-                logging.error("Environment configuration validation failed")
+            try:
+                state = server.ensure_running(executable)
+            except (OSError, ScriptError) as e:
+                logging.error(f"Cannot start hash equivalence server: {e}")
                 sys.exit(1)
-                
-        logging.info("BSP manager initialized successfully")
+            logging.info(f"Hash equivalence server running on {state['host']}:{state['port']} (pid {state['pid']})")
+        elif action == 'stop':
+            if server.stop():
+                logging.info("Hash equivalence server stopped")
+            else:
+                logging.info("Hash equivalence server is not running")
+        else:
+            state = server.status()
+            if state:
+                print(f"Running: pid {state['pid']}, address {state.get('host', '0.0.0.0')}:{state['port']}, "
+                      f"started {state['started']}")
+            else:
+                print("Not running")
+            total, hits = server.hash_counts()
+            print(f"Database: {server.db_path}")
+            print(f"Task hashes: {total}, mapped to an equivalent unihash: {hits}")
 
-    def list_bsp(self) -> None:
+    def get_dispatcher(self) -> BuildDispatcher:
         """
-        List all available BSPs in the registry.
+        Get the dispatcher for the build hosts configured in the registry.
         
         Raises:
-            SystemExit: If no BSPs are found in registry
+            SystemExit: If no build hosts are configured
         """
-        if not self.model or not self.model.registry.bsp:
-            logging.error("No BSPs found in registry")
+        if not self.model.hosts:
+            logging.error("No build hosts configured in the registry (add a 'hosts' section)")
             sys.exit(1)
+        return BuildDispatcher(self.model.hosts, self.timeouts)
 
-        logging.info("Available BSPs:")
-        for bsp in self.model.registry.bsp:
-            print(f"- {bsp.name}: {bsp.description}")
+    def list_hosts(self) -> None:
+        """List the build hosts configured in the registry."""
+        if not self.model.hosts:
+            logging.info("No build hosts configured in the registry")
+            return
+        logging.info("Build hosts:")
+        for host in self.model.hosts:
+            location = f"ssh {host.ssh}" if host.ssh else "local"
+            print(f"- {host.name}: {location}, path {host.path}, {host.jobs} concurrent builds")
 
-    def list_containers(self) -> None:
+    def probe_host(self, bsp_names: List[str], as_json: bool = False) -> None:
         """
-        List all available containers in the registry.
+        Report the cache state of this host for placement by the build dispatcher.
         
-        Raises:
-            SystemExit: If no containers are found in registry
+        Args:
+            bsp_names: BSPs to report (default: all BSPs in the registry)
+            as_json: Print machine readable JSON instead of a summary
         """
-        if not self.containers:
-            logging.info("No container definitions found in registry")
+        bsps = [self.get_bsp_by_name(name) for name in bsp_names] if bsp_names else self.get_all_bsps()
+        sstate = self.env_manager.get_value('SSTATE_DIR') if self.env_manager else None
+        disk_path = resolver.resolve(sstate) if sstate and resolver.is_dir(sstate) else Path(".")
+        state = {
+            "hostname": socket.gethostname(),
+            "cpus": os.cpu_count(),
+            "load": os.getloadavg()[0],
+            "free_bytes": shutil.disk_usage(disk_path).free,
+            "images": {},
+            "bsps": {},
+        }
+        for tag in sorted({docker.image for docker in self.containers.values() if docker.image}):
+            info = docker_image_info(tag)
+            if info:
+                state["images"][tag] = info['labels'].get(DOCKER_FINGERPRINT_LABEL)
+
+        for bsp in bsps:
+            build_dir = Path(bsp.build.path).resolve()
+            deploy_dir = build_deploy_dir(build_dir)
+            fingerprint_path = deploy_dir / BuildFingerprint.FILE_NAME
+            record = {}
+            try:
+                with open(fingerprint_path, 'r', encoding='utf-8') as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                pass
+            failure = None
+            failure_path = build_dir / "failure-report.json"
+            try:
+                if not record or failure_path.stat().st_mtime > fingerprint_path.stat().st_mtime:
+                    with open(failure_path, 'r', encoding='utf-8') as f:
+                        failure = json.load(f)
+            except (OSError, ValueError):
+                pass
+            state["bsps"][bsp.name] = {
+                "release": bsp_release(bsp),
+                "built": bool(record),
+                "fingerprint": record.get('fingerprint'),
+                "built_at": record.get('created'),
+                "deploy_dir": str(deploy_dir),
+                "failure": failure,
+            }
+
+        if as_json:
+            print(json.dumps(state, indent=2, sort_keys=True))
             return
-
-        logging.info("Available Containers:")
-        for container_name, container_config in self.containers.items():
-            print(f"- {container_name}:")
-            print(f"    Image: {container_config.image}")
-            print(f"    File: {container_config.file}")
-            if container_config.args:
-                print(f"    Args: {', '.join([f'{arg.name}={arg.value}' for arg in container_config.args])}")
-
-    def get_bsp_by_name(self, bsp_name: str) -> BSP:
+        print(f"Host: {state['hostname']}, {state['cpus']} CPUs, load {state['load']:.1f}, "
+              f"{state['free_bytes'] / 2**30:.0f} GiB free")
+        for tag, label in state["images"].items():
+            print(f"Image: {tag} ({label[:12] if label else 'no fingerprint'})")
+        for name, info in state["bsps"].items():
+            status = f"built {info['built_at']}" if info['built'] else "not built"
+            if info['failure']:
+                status += f", last build failed ({', '.join(info['failure'].get('causes') or [])})"
+            print(f"- {name} [{info['release']}]: {status}")
+
+    def assign_hosts(self, bsp_names: List[str], output_file: Optional[str] = None
+                     ) -> Tuple[BuildDispatcher, Dict[str, Dict[str, Any]], List[HostAssignment]]:
         """
-        Retrieve BSP configuration by name.
+        Probe the build hosts and place BSP builds by cache affinity.
         
         Args:
-            bsp_name: Name of the BSP to retrieve
+            bsp_names: Names of the BSPs to place
+            output_file: Write the BSP to worker mapping as JSON (used by the Buildbot master)
             
         Returns:
-            BSP configuration object
+            Tuple of dispatcher, probe results and assignments
             
         Raises:
-            SystemExit: If BSP with given name is not found
+            SystemExit: If no build host is configured or reachable
         """
-        for bsp in self.model.registry.bsp:
-            if bsp.name == bsp_name:
-                return bsp
+        dispatcher = self.get_dispatcher()
+        bsps = [self.get_bsp_by_name(name) for name in bsp_names]
+        fingerprints = {}
+        image_fingerprints = {}
+        for bsp in bsps:
+            docker = self.get_container_config_for_bsp(bsp)
+            if docker.image not in fingerprints:
+                fingerprints[docker.image] = container_fingerprint(docker)
+            image_fingerprints[bsp.name] = fingerprints[docker.image]
+
+        probes = dispatcher.probe([])
+        assignments = dispatcher.assign(bsps, probes, image_fingerprints)
+        for assignment in assignments:
+            reasons = f" ({', '.join(assignment.reasons)})" if assignment.reasons else ""
+            logging.info(f"{assignment.bsp} -> {assignment.host}: score {assignment.score}{reasons}")
+
+        if output_file:
+            with open(output_file, 'w', encoding='utf-8') as f:
+                json.dump({a.bsp: a.host for a in assignments}, f, indent=2)
+            logging.info(f"Worker assignments written to {output_file}")
+        return dispatcher, probes, assignments
+
+    def dispatch_builds(self, bsp_names: List[str], force: bool = False, fetch_dir: Optional[str] = None,
+                        report_file: Optional[str] = None) -> None:
+        """
+        Build BSPs on the build hosts with cache-affinity placement.
         
-        # BSP not found - show error with available options
-        logging.error(f"BSP not found: {bsp_name}")
-        logging.info("Available BSPs:")
-        for bsp in self.model.registry.bsp:
-            logging.info(f"  - {bsp.name}")
-        sys.exit(1)
+        After the builds the hosts are probed again to collect the build
+        fingerprints and failure reports; deploy images of successful
+        builds are copied to fetch_dir/<bsp> when given.
+        
+        Args:
+            bsp_names: Names of the BSPs to build
+            force: Rebuild BSPs that are up to date on their host
+            fetch_dir: Local directory receiving the deploy images
+            report_file: Write a JSON dispatch report
+            
+        Raises:
+            SystemExit: If no host is reachable or any build fails
+        """
+        dispatcher, _, assignments = self.assign_hosts(bsp_names)
+        results = dispatcher.dispatch(assignments, force=force)
+        telemetry = dispatcher.probe(bsp_names)
+
+        report = []
+        for assignment in assignments:
+            result = results[assignment.bsp]
+            info = telemetry.get(assignment.host, {}).get('bsps', {}).get(assignment.bsp, {})
+            entry = {
+                "bsp": assignment.bsp,
+                "host": assignment.host,
+                "score": assignment.score,
+                "reasons": assignment.reasons,
+                "ok": result.ok,
+                "returncode": result.returncode,
+                "duration": round(result.duration, 1),
+                "fingerprint": info.get('fingerprint'),
+                "failure": info.get('failure') if not result.ok else None,
+                "artifacts": None,
+            }
+            if result.ok and fetch_dir and info.get('deploy_dir'):
+                target = resolver.resolve(fetch_dir) / assignment.bsp
+                if dispatcher.fetch_artifacts(dispatcher.hosts[assignment.host], info['deploy_dir'], target):
+                    entry["artifacts"] = str(target)
+                    logging.info(f"{assignment.bsp}: artifacts fetched to {target}")
+            if entry["failure"]:
+                logging.error(f"{assignment.bsp}: failure triage on {assignment.host}: "
+                              f"{', '.join(entry['failure'].get('causes') or [])}")
+            report.append(entry)
+
+        if report_file:
+            with open(report_file, 'w', encoding='utf-8') as f:
+                json.dump({"created": time.strftime('%Y-%m-%dT%H:%M:%S%z'), "builds": report}, f, indent=2)
+            logging.info(f"Dispatch report written to {report_file}")
+        failed = [entry["bsp"] for entry in report if not entry["ok"]]
+        if failed:
+            logging.error(f"Failed builds: {', '.join(failed)}")
+            sys.exit(1)
 
-    def get_container_config_for_bsp(self, bsp: BSP) -> Docker:
+    def _estimate(self, history: Dict[str, List[float]], release_history: Dict[str, List[float]],
+                  bsp: BSP, phase: str, default_key: str) -> Tuple[float, str]:
+        """Median of the recent durations of a phase, of its release, or the default estimate."""
+        for durations, source in ((history.get(bsp.name), 'history'),
+                                  (release_history.get(bsp_release(bsp)), 'release')):
+            if durations:
+                recent = sorted(durations[-5:])
+                return recent[len(recent) // 2], source
+        return BuildPlan.DEFAULT_DURATIONS[default_key], 'default'
+
+    def plan_builds(self, bsp_names: List[str], jobs: int = 1, shared_layers: bool = False,
+                    output_format: str = 'text', output_file: Optional[str] = None) -> BuildPlan:
         """
-        Get the Docker configuration for a BSP, resolving container references.
+        Build and print the execution plan of a set of BSP builds without running anything.
         
-        This method supports both direct Docker configuration and container references.
-        Priority: container reference > direct Docker configuration.
+        The plan holds one node per container image build, per layer mirror
+        update (with shared_layers), per checkout and per bitbake target.
+        Durations come from the archived build logs of the BSP, otherwise
+        from BSPs of the same release, otherwise from defaults. Images and
+        BSPs whose fingerprints are up to date take no time.
         
         Args:
-            bsp: BSP configuration object
+            bsp_names: Names of the BSPs to plan
+            jobs: Number of steps run in parallel
+            shared_layers: Plan builds using the shared layer store
+            output_format: 'text', 'json' or 'dot'
+            output_file: Write the plan to a file instead of stdout
             
         Returns:
-            Docker configuration for the BSP
+            The build plan
             
         Raises:
-            SystemExit: If container reference cannot be resolved or configuration is missing
+            SystemExit: If a BSP or container is unknown
         """
-        build_env = bsp.build.environment
-        
-        # First check for container reference
-        if build_env.container:
-            container_name = build_env.container
-            if container_name in self.containers:
-                logging.info(f"Using container reference: {container_name}")
-                return self.containers[container_name]
+        bsps = [self.get_bsp_by_name(name) for name in bsp_names]
+        history = {'checkout': {}, 'build': {}}
+        release_history = {'checkout': {}, 'build': {}}
+        for bsp in self.get_all_bsps():
+            archive = self.get_log_archive(bsp)
+            for phase in history:
+                durations = archive.phase_durations(phase)
+                if durations:
+                    history[phase][bsp.name] = durations
+                    release_history[phase].setdefault(bsp_release(bsp), []).extend(durations)
+
+        plan = BuildPlan()
+        store = self.get_layer_store() if shared_layers else None
+        for bsp in bsps:
+            docker = self.get_container_config_for_bsp(bsp)
+            kas_mgr = KasManager(bsp.build.configuration, bsp.build.path, use_container=True,
+                                 container_image=docker.image, env_manager=self.env_manager)
+            up_to_date = BuildFingerprint(kas_mgr, docker, bsp.name).is_up_to_date()
+
+            image_id = f"image:{docker.image}"
+            if image_id not in plan.nodes:
+                info = docker_image_info(docker.image) if docker.image else None
+                if not docker.file or (info and info['labels'].get(DOCKER_FINGERPRINT_LABEL)
+                                       == container_fingerprint(docker)):
+                    duration, source = 0.0, 'up to date'
+                else:
+                    duration, source = BuildPlan.DEFAULT_DURATIONS['image'], 'default'
+                plan.add(PlanNode(image_id, 'image', duration, source))
+            plan.add(PlanNode(image_id, 'image', 0.0, '', bsps=[bsp.name]))
+
+            # The checkout runs kas inside the container, so it waits for the image
+            checkout_deps = [image_id]
+            if store:
+                sources, _ = LayerStore.sources_for(kas_mgr)
+                for layer in sources:
+                    mirror_id = f"mirror:{LayerStore.qualified_name(layer.url)}"
+                    key = 'mirror_update' if store.mirror_path(layer.url).is_dir() else 'mirror'
+                    plan.add(PlanNode(mirror_id, 'mirror', BuildPlan.DEFAULT_DURATIONS[key], 'default',
+                                      bsps=[bsp.name]))
+                    if mirror_id not in checkout_deps:
+                        checkout_deps.append(mirror_id)
+
+            checkout_id = f"checkout:{bsp.name}"
+            if up_to_date:
+                duration, source = 0.0, 'up to date'
             else:
-                logging.error(f"Container '{container_name}' not found in registry containers")
-                logging.info("Available containers:")
-                for name in self.containers.keys():
-                    logging.info(f"  - {name}")
-                sys.exit(1)
+                duration, source = self._estimate(history['checkout'], release_history['checkout'], bsp,
+                                                  'checkout', 'checkout_shared' if store else 'checkout')
+            plan.add(PlanNode(checkout_id, 'checkout', duration, source, checkout_deps, [bsp.name]))
+
+            # Targets of one BSP share its build directory and run one after another
+            if up_to_date:
+                total, source = 0.0, 'up to date'
+            else:
+                total, source = self._estimate(history['build'], release_history['build'], bsp,
+                                               'build', 'build')
+            targets = kas_mgr.get_targets() or ['default']
+            previous = checkout_id
+            for target in targets:
+                build_id = f"build:{bsp.name}:{target}"
+                plan.add(PlanNode(build_id, 'build', total / len(targets), source,
+                                  [previous], [bsp.name]))
+                previous = build_id
+
+        if output_format == 'json':
+            output = json.dumps(plan.to_dict(jobs), indent=2) + "\n"
+        elif output_format == 'dot':
+            output = plan.to_dot(jobs)
+        else:
+            output = self._format_plan(plan, jobs)
+        if output_file:
+            with open(output_file, 'w', encoding='utf-8') as f:
+                f.write(output)
+            logging.info(f"Build plan written to {output_file}")
+        else:
+            sys.stdout.write(output)
+        return plan
+
+    @staticmethod
+    def _format_plan(plan: BuildPlan, jobs: int) -> str:
+        """Human readable summary of a build plan."""
+        lines = []
+        for node_id in plan.topological_order():
+            node = plan.nodes[node_id]
+            shared = f", shared by {len(node.bsps)} BSPs" if len(node.bsps) > 1 else ""
+            lines.append(f"{format_duration(node.duration):>8}  {node_id} ({node.source}{shared})")
+        length, path = plan.critical_path()
+        total, scheduled_path, _ = plan.schedule(jobs)
+        lines.append("")
+        lines.append(f"Critical path ({format_duration(length)}): {' -> '.join(path)}")
+        lines.append(f"Estimated duration with {jobs} job{'s' if jobs != 1 else ''}: {format_duration(total)}")
+        if scheduled_path != path:
+            lines.append(f"Critical path with {jobs} job{'s' if jobs != 1 else ''}: {' -> '.join(scheduled_path)}")
+        return "\n".join(lines) + "\n"
+
+    def watch_bsps(self, bsp_names: List[str], checkout: bool = False, debounce: float = 2.0) -> None:
+        """
+        Revalidate the KAS configuration of BSPs whenever one of their files changes.
         
-        # Fall back to direct Docker configuration
-        elif build_env.docker:
-            logging.info("Using direct Docker configuration")
-            return build_env.docker
+        Every file in the include closures of the BSPs is watched (through
+        inotify, or by polling where inotify is unavailable). A change
+        re-parses only the changed file and revalidates only the BSPs that
+        depend on it. Runs until interrupted.
         
-        # No container configuration found
-        else:
-            logging.error(f"No container configuration found for BSP {bsp.name}")
-            logging.info("Either specify 'container' to reference a registry container or provide 'docker' configuration")
-            sys.exit(1)
+        Args:
+            bsp_names: Names of the BSPs to watch
+            checkout: Run a checkout of affected BSPs once their configuration is valid again
+            debounce: Seconds without further changes before a checkout starts
+            
+        Raises:
+            SystemExit: If a BSP or container is unknown
+        """
+        graph = IncludeGraph()
+        start = time.perf_counter()
+        for name in bsp_names:
+            bsp = self.get_bsp_by_name(name)
+            docker = self.get_container_config_for_bsp(bsp)
+            kas_mgr = KasManager(bsp.build.configuration, bsp.build.path, use_container=True,
+                                 container_image=docker.image, env_manager=self.env_manager)
+            self._report_validation(name, graph.add_bsp(name, kas_mgr))
+        logging.info(f"Validated {len(bsp_names)} BSP(s) in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        try:
+            watcher = InotifyWatcher()
+        except OSError as e:
+            logging.warning(f"{e}; polling for changes every {PollingWatcher.INTERVAL:g}s")
+            watcher = PollingWatcher()
+        watcher.watch(graph.watched_files())
+        logging.info(f"Watching {len(graph.watched_files())} files (press Ctrl+C to stop)")
+
+        # BSP name -> time at which its checkout is due
+        pending: Dict[str, float] = {}
+        try:
+            while True:
+                timeout = max(0.0, min(pending.values()) - time.monotonic()) if pending else None
+                changed = watcher.wait(timeout)
+                if changed:
+                    start = time.perf_counter()
+                    affected = graph.update(changed)
+                    for name in affected:
+                        errors = graph.validate(name)
+                        self._report_validation(name, errors)
+                        if checkout and not errors:
+                            pending[name] = time.monotonic() + debounce
+                        else:
+                            pending.pop(name, None)
+                    if affected:
+                        watcher.watch(graph.watched_files())
+                        logging.info(f"Revalidated {len(affected)} BSP(s) in "
+                                     f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+                now = time.monotonic()
+                for name in [name for name, due in pending.items() if due <= now]:
+                    del pending[name]
+                    logging.info(f"Checking out {name}")
+                    try:
+                        self.build_bsp(name, checkout_only=True)
+                    except SystemExit:
+                        logging.error(f"Checkout of {name} failed")
+        except KeyboardInterrupt:
+            logging.info("Stopped watching")
+        finally:
+            watcher.close()
 
-    def prepare_build_directory(self, build_path: str) -> None:
+    @staticmethod
+    def _report_validation(bsp_name: str, errors: List[str]) -> None:
+        """Log the result of validating the KAS configuration of a BSP."""
+        if not errors:
+            logging.info(f"{bsp_name}: configuration valid")
+            return
+        for error in errors:
+            logging.error(f"{bsp_name}: {error}")
+
+    def get_log_archive(self, bsp: BSP) -> BuildLogArchive:
         """
-        Prepare build directory, creating it if necessary.
+        Get the build log archive for a BSP.
         
         Args:
-            build_path: Path to build directory
+            bsp: BSP configuration object
             
-        Raises:
-            SystemExit: If directory cannot be created
+        Returns:
+            Log archive located in the BSP build directory
         """
-        logging.info(f"Preparing build directory: {build_path}")
-        resolver.ensure_directory(build_path)
+        return BuildLogArchive(bsp.build.path, metadata={"bsp": bsp.name})
 
     def _get_kas_manager_for_bsp(self, bsp: BSP, use_container: bool = True) -> KasManager:
         """
@@ -1663,22 +9020,31 @@ class BspManager:
             sstate_dir=sstate, 
             use_container=use_container, 
             container_image=container_config.image if use_container else None,
-            env_manager=self.env_manager
+            env_manager=self.env_manager,
+            timeouts=self.timeouts,
+            log_archive=self.get_log_archive(bsp)
         )
+        kas_mgr.bsp_name = bsp.name
 
         return kas_mgr
 
-    def build_bsp(self, bsp_name: str, checkout_only: bool = False) -> None:
+    def build_bsp(self, bsp_name: str, checkout_only: bool = False, force: bool = False,
+                  shared_layers: bool = False, clean: Optional[str] = None) -> None:
         """
         Build a specific BSP including Docker image and Yocto build.
         
         This is the main build method that orchestrates the complete
         BSP build process from Docker image creation to Yocto build.
         When checkout_only is True, performs checkout and validation without the full build.
+        A build whose fingerprint matches the last successful build is skipped
+        unless force is True.
         
         Args:
             bsp_name: Name of the BSP to build
             checkout_only: If True, only checkout and validate configuration without building
+            force: Build even if the BSP fingerprint shows it is up to date
+            shared_layers: Use pinned layer repositories from the shared layer store
+            clean: Clean level applied before building (see clean_build)
             
         Raises:
             SystemExit: If any step of the build process fails
@@ -1687,53 +9053,215 @@ class BspManager:
             logging.info(f"Checking out BSP: {bsp_name}")
         else:
             logging.info(f"Building BSP: {bsp_name}")
+        start = time.monotonic()
+        with bsp_context(bsp_name):
+            # Retrieve BSP configuration
+            bsp = self.get_bsp_by_name(bsp_name)
         
-        # Retrieve BSP configuration
-        bsp = self.get_bsp_by_name(bsp_name)
+            if checkout_only:
+                logging.info(f"Checking out {bsp.name} - {bsp.description}")
+            else:
+                logging.info(f"Building {bsp.name} - {bsp.description}")
         
-        if checkout_only:
-            logging.info(f"Checking out {bsp.name} - {bsp.description}")
-        else:
-            logging.info(f"Building {bsp.name} - {bsp.description}")
+            # Get container configuration
+            container_config = self.get_container_config_for_bsp(bsp)
+
+            if clean in ('tmp', 'all'):
+                self.clean_build(bsp, clean)
         
-        # Get container configuration
-        container_config = self.get_container_config_for_bsp(bsp)
+            # Prepare build directory
+            self.prepare_build_directory(bsp.build.path)
         
-        # Build Docker image if configured (skip for checkout mode)
-        if not checkout_only:
-            if container_config.file and container_config.image:
-                build_docker(
-                    ".", 
-                    container_config.file, 
-                    container_config.image, 
-                    container_config.args
-                )
-        else:
-            logging.info("Skipping Docker build in checkout mode")
+            # Get KAS manager - use native KAS for checkout, container for builds
+            kas_mgr = self._get_kas_manager_for_bsp(bsp, use_container=not checkout_only)
+
+            # Skip the whole build when its inputs did not change since the last successful build
+            fingerprint = None
+            if not checkout_only:
+                fingerprint = BuildFingerprint(kas_mgr, container_config, bsp.name)
+                fingerprint.compute()
+                logging.info(f"BSP fingerprint: {fingerprint.digest}")
+                if not force and fingerprint.is_up_to_date():
+                    logging.info(f"BSP {bsp_name} is up to date, deploy artifacts in {fingerprint.path.parent}")
+                    logging.info("Use --force to rebuild")
+                    return
+
+            if shared_layers:
+                self.use_shared_layers(kas_mgr)
+            self.use_sstate_mirror(kas_mgr)
+            checkout_state = CheckoutState(kas_mgr)
+            checkout_current = not force and self.skip_current_checkout(checkout_state)
+            if not checkout_current:
+                checkout_state.invalidate()
+            heads_before = None
+            if clean == 'changed':
+                if checkout_only:
+                    logging.warning("--clean changed only applies to builds, ignored in checkout mode")
+                elif checkout_current:
+                    logging.info("No layer changed since the last checkout, nothing to clean")
+                else:
+                    heads_before = checkout_state.heads()
         
-        # Prepare build directory
-        self.prepare_build_directory(bsp.build.path)
+            # Build Docker image if configured (skip for checkout mode)
+            if not checkout_only:
+                if container_config.file and container_config.image:
+                    self.ensure_container_image(container_config)
+            else:
+                logging.info("Skipping Docker build in checkout mode")
         
-        # Get KAS manager - use native KAS for checkout, container for builds
-        kas_mgr = self._get_kas_manager_for_bsp(bsp, use_container=not checkout_only)
+            # Dump configuration for verification (debugging)
+            config_output = kas_mgr.dump_config(show_output=False)
+            if config_output:
+                logging.debug("Configuration dump:")
+                logging.debug(config_output)
+
+            if checkout_only:
+                if checkout_current:
+                    logging.info(f"BSP {bsp_name} is already checked out, configuration validated")
+                    return
+                # Execute checkout for validation only
+                logging.info("Performing checkout and validation (no build)...")
+                kas_mgr.checkout_project()
+                checkout_state.save()
+                logging.info(f"BSP {bsp_name} checked out and validated successfully!")
+            else:
+                # The dump checked out the layers, including the bitbake-hashserv of the build
+                hash_counts = self.use_hashserv(kas_mgr)
+                if heads_before is not None:
+                    self.clean_changed_recipes(kas_mgr, checkout_state, heads_before)
+
+                # Execute full build
+                try:
+                    kas_mgr.build_project()
+                except SystemExit:
+                    metrics.inc('bsp_builds_total', bsp=bsp_name, result='failure')
+                    raise
+                metrics.inc('bsp_builds_total', bsp=bsp_name, result='success')
+                metrics.set('bsp_build_duration_seconds', time.monotonic() - start, bsp=bsp_name)
+                metrics.set('bsp_build_last_success_timestamp_seconds', time.time(), bsp=bsp_name)
+                self.record_filesystem_metrics('build', kas_mgr.build_dir)
+                if not checkout_current:
+                    checkout_state.save()
+                if hash_counts is not None:
+                    self.report_hashserv(hash_counts)
+                fingerprint_path = fingerprint.save()
+                logging.debug("Fingerprint stored in %s", fingerprint_path)
+                logging.info(f"BSP {bsp_name} built successfully!",
+                             extra={"duration": round(time.monotonic() - start, 3)})
+                if self.env_manager and self.env_manager.get_value('SSTATE_MIRROR_PUSH') in ('1', 'yes', 'true'):
+                    self.push_sstate()
+
+    def clean_build(self, bsp: BSP, level: str) -> None:
+        """
+        Remove build output of a BSP, without waiting for the removal.
         
-        # Dump configuration for verification (debugging)
-        config_output = kas_mgr.dump_config(show_output=False)
-        if config_output:
-            logging.debug("Configuration dump:")
-            logging.debug(config_output)
-
-        if checkout_only:
-            # Execute checkout for validation only
-            logging.info("Performing checkout and validation (no build)...")
-            kas_mgr.checkout_project()
-            logging.info(f"BSP {bsp_name} checked out and validated successfully!")
+        Levels:
+            tmp: BitBake TMPDIR (build/tmp*), restored from the sstate cache
+                by the next build; layers and BitBake caches are kept
+            all: The whole build path, including the layer checkouts
+            
+        The directories are renamed aside and deleted by a background
+        process (see remove_in_background).
+        
+        Args:
+            bsp: BSP whose build path is cleaned
+            level: 'tmp' or 'all'
+            
+        Raises:
+            SystemExit: If the build path is unsafe to remove or cannot be renamed
+        """
+        build_path = resolver.resolve(bsp.build.path)
+        if level == 'all':
+            for kept, what in ((self.config_path, "the registry"), (Path(__file__), "bsp.py")):
+                kept = kept.resolve()
+                if kept == build_path or build_path in kept.parents:
+                    logging.error(f"Refusing to remove {build_path}: it contains {what} ({kept})")
+                    sys.exit(1)
+            paths = [build_path]
         else:
-            # Execute full build
-            kas_mgr.build_project()
-            logging.info(f"BSP {bsp_name} built successfully!")
+            bitbake_dir = build_path / "build"
+            paths = sorted(entry for entry in bitbake_dir.glob("tmp*")
+                           if entry.is_dir() and (entry.name == "tmp" or entry.name.startswith("tmp-"))) \
+                if bitbake_dir.is_dir() else []
+        paths = [path for path in paths if path.exists()]
+        if not paths:
+            logging.info(f"Nothing to clean in {build_path}")
+            return
+        try:
+            remove_in_background(paths)
+        except OSError as e:
+            logging.error(f"Failed to clean {build_path}: {e}")
+            sys.exit(1)
+        logging.info(f"Cleaned {', '.join(str(path) for path in paths)} (deleted in the background)")
+
+    def clean_changed_recipes(self, kas_mgr: KasManager, checkout_state: CheckoutState,
+                              heads_before: Dict[str, Optional[str]]) -> None:
+        """
+        Run cleansstate for the recipes of layers whose checkout changed.
+        
+        Compares the commits of the repositories before the KAS checkout
+        with those after it. Repositories checked out for the first time
+        have no build output to clean.
+        
+        Args:
+            kas_mgr: KAS manager of the BSP, after the checkout
+            checkout_state: Checkout state of the build directory
+            heads_before: Commits before the checkout (from CheckoutState.heads)
+            
+        Raises:
+            SystemExit: If the recipes cannot be listed or cleaned
+        """
+        heads_after = checkout_state.heads()
+        changed = [name for name, head in heads_after.items()
+                   if head and heads_before.get(name) and head != heads_before[name]]
+        if not changed:
+            logging.info("No layer changed since the last checkout, nothing to clean")
+            return
+        logging.info(f"Layers changed: {', '.join(changed)}")
+
+        # kas shell runs in <build dir>/build (KAS_BUILD_DIR below KAS_WORK_DIR)
+        (kas_mgr.build_dir / "bsp-changed-recipes.py").write_text(CHANGED_RECIPES_SCRIPT, encoding='utf-8')
+        layer_paths = []
+        for name in changed:
+            path = checkout_state.desired()[name]['path']
+            layer_paths.append(shlex.quote(path if os.path.isabs(path) else f"../{path}"))
+        output = CaptureLineHandler()
+        tail = CaptureLineHandler(max_lines=20)
+        spec = kas_mgr.get_shell_spec(f"python3 ../bsp-changed-recipes.py {' '.join(layer_paths)}",
+                                      [output, tail], [tail])
+        result = runner.run_sync(spec)
+        if not result.ok:
+            logging.error(f"Failed to list the recipes of the changed layers:\n{tail.text}")
+            sys.exit(1)
+        recipes = [line.split(' ', 1)[1].strip() for line in output.lines if line.startswith('BSP-RECIPE ')]
+        if not recipes:
+            logging.info("The changed layers define no recipes, nothing to clean")
+            return
+        logging.info(f"Cleaning the shared state of {len(recipes)} recipes")
+        kas_mgr.run_bitbake_command(" ".join(recipes), ["-c", "cleansstate"], show_output=False)
+
+    @staticmethod
+    def skip_current_checkout(checkout_state: CheckoutState) -> bool:
+        """
+        Skip the KAS checkout steps when the build directory already has the configured checkout.
+        
+        Args:
+            checkout_state: Checkout state of the build directory
+            
+        Returns:
+            True if the checkout steps are skipped
+        """
+        if not checkout_state.path.is_file():
+            return False
+        changed = checkout_state.changed_repos()
+        if changed:
+            logging.info(f"Repositories to check out: {', '.join(changed)}")
+            return False
+        logging.info("All repositories are checked out at their configured state, skipping KAS checkout")
+        checkout_state.kas_mgr.skip_steps.extend(CheckoutState.SKIP_STEPS)
+        return True
 
-    def shell_into_bsp(self, bsp_name: str, command: str = None) -> None:
+    def shell_into_bsp(self, bsp_name: str, command: str = None, shared_layers: bool = False) -> None:
         """
         Enter interactive shell session for the specified BSP.
         
@@ -1744,6 +9272,7 @@ class BspManager:
         Args:
             bsp_name: Name of the BSP to enter shell for
             command: Optional command to execute in the shell (if not provided, starts interactive shell)
+            shared_layers: Use pinned layer repositories from the shared layer store
             
         Raises:
             SystemExit: If shell session cannot be started
@@ -1761,18 +9290,18 @@ class BspManager:
         # Build Docker image if configured (same as build process)
         if container_config.file and container_config.image:
             logging.info("Building Docker image for shell environment...")
-            build_docker(
-                ".", 
-                container_config.file, 
-                container_config.image, 
-                container_config.args
-            )
+            self.ensure_container_image(container_config)
         
         # Prepare build directory
         self.prepare_build_directory(bsp.build.path)
         
         # Get KAS manager and start shell session
         kas_mgr = self._get_kas_manager_for_bsp(bsp)
+        if shared_layers:
+            self.use_shared_layers(kas_mgr)
+        self.use_sstate_mirror(kas_mgr)
+        self.use_hashserv(kas_mgr)
+        self.skip_current_checkout(CheckoutState(kas_mgr))
         
         # Start interactive shell session
         logging.info("Starting KAS shell session...")
@@ -1823,7 +9352,8 @@ class BspManager:
                 download_dir=downloads, 
                 sstate_dir=sstate, 
                 use_container=False,  # Don't need container for export
-                env_manager=self.env_manager
+                env_manager=self.env_manager,
+                timeouts=self.timeouts
             )
             
             # Export KAS configuration
@@ -1839,6 +9369,85 @@ class BspManager:
                     
         logging.info(f"BSP {bsp_name} configuration exported successfully!")
 
+    def show_logs(self, bsp_name: str, log_name: Optional[str] = None, kinds: Optional[List[str]] = None,
+                  context: int = 0, show_all: bool = False, prune_keep: Optional[int] = None) -> None:
+        """
+        List or inspect archived build logs of a BSP.
+        
+        Without options, lists the archived logs. With kinds, prints the
+        indexed lines of those kinds from the selected log (the newest one by
+        default) using only the side index; context lines are read by
+        decompressing just the frames that contain them.
+        
+        Args:
+            bsp_name: Name of the BSP
+            log_name: Log file name or prefix (default: newest log)
+            kinds: Marker kinds to print (error, warning, task_started, task_failed)
+            context: Number of context lines to print around each marker
+            show_all: Print the complete log
+            prune_keep: Apply retention keeping only this many logs
+            
+        Raises:
+            SystemExit: If the BSP or the requested log does not exist
+        """
+        bsp = self.get_bsp_by_name(bsp_name)
+        archive = self.get_log_archive(bsp)
+
+        if prune_keep is not None:
+            archive.keep = prune_keep
+            removed = archive.rotate()
+            logging.info(f"Removed {len(removed)} old build logs")
+            return
+
+        if not kinds and not show_all:
+            logs = archive.list_logs()
+            if not logs:
+                logging.info(f"No archived build logs in {archive.log_dir}")
+                return
+            logging.info(f"Build logs for {bsp.name}:")
+            for path in logs:
+                try:
+                    reader = BuildLogReader(path)
+                except (OSError, ConfigurationError) as e:
+                    print(f"- {path.name}: unreadable ({e})")
+                    continue
+                state = "" if reader.summary else " (incomplete)"
+                counts = {kind: sum(1 for mark in reader.marks if mark.kind == kind)
+                          for kind in ('error', 'warning', 'task_failed')}
+                print(f"- {path.name}: {reader.line_count} lines, {counts['error']} errors, "
+                      f"{counts['warning']} warnings, {counts['task_failed']} failed tasks, "
+                      f"{path.stat().st_size / (1024 * 1024):.1f} MiB{state}")
+            return
+
+        path = archive.find(log_name) if log_name else archive.latest()
+        if not path:
+            logging.error(f"No archived build log found in {archive.log_dir}")
+            sys.exit(1)
+
+        try:
+            reader = BuildLogReader(path)
+        except (OSError, ConfigurationError) as e:
+            logging.error(f"Failed to open build log {path}: {e}")
+            sys.exit(1)
+
+        logging.info(f"Build log: {path}")
+        if show_all:
+            for line in reader.iter_lines():
+                print(line)
+            return
+
+        marks = [mark for mark in reader.marks if mark.kind in kinds]
+        for mark in marks:
+            if context:
+                print("--")
+                first = mark.line - context
+                for number, line in enumerate(reader.get_lines(first, mark.line + context), max(first, 0)):
+                    separator = ":" if number == mark.line else "-"
+                    print(f"{number + 1}{separator} {line}")
+            else:
+                print(f"{mark.line + 1}: {mark.text}")
+        logging.info(f"{len(marks)} matching lines")
+
     def cleanup(self) -> None:
         """Cleanup resources and perform any necessary finalization."""
         logging.debug("Cleaning up resources...")
@@ -1848,6 +9457,31 @@ class BspManager:
 # Main Entry Point with Enhanced Commands
 # =============================================================================
 
+def parse_phase_timeouts(values: List[str]) -> Dict[str, float]:
+    """
+    Parse PHASE=SECONDS timeout options from the command line.
+    
+    Args:
+        values: List of PHASE=SECONDS strings
+        
+    Returns:
+        Dictionary mapping phase names to timeouts in seconds
+        
+    Raises:
+        SystemExit: If a value is malformed
+    """
+    timeouts = {}
+    for value in values:
+        phase, sep, seconds = value.partition('=')
+        try:
+            if not sep or not phase:
+                raise ValueError(value)
+            timeouts[phase.strip()] = float(seconds)
+        except ValueError:
+            logging.error(f"Invalid timeout '{value}', expected PHASE=SECONDS (e.g. build=14400)")
+            sys.exit(1)
+    return timeouts
+
 def main() -> int:
     """
     Main entry point for the BSP registry manager.
@@ -1858,12 +9492,47 @@ def main() -> int:
     Returns:
         Exit code (0 for success, non-zero for errors)
     """
+    args = None
+    bsp_mgr = None
+    profiler = None
+    succeeded = False
+    start = time.monotonic()
     try:
         # Parse command line arguments
         parser = argparse.ArgumentParser(description="Advantech Board Support Package Registry")
         parser.add_argument('--verbose', '-v', action='store_true', help='Verbose output')
         parser.add_argument('--registry', '-r', default='bsp-registry.yml', help='BSP Registry file')
         parser.add_argument('--no-color', action='store_true', help='Disable colored output')
+        parser.add_argument(
+            '--log-format',
+            choices=['text', 'json'],
+            default='text',
+            help='Log output format; json writes one event per line with bsp, phase, duration and exit_code fields'
+        )
+        parser.add_argument(
+            '--timeout',
+            action='append',
+            default=[],
+            metavar='PHASE=SECONDS',
+            help='Timeout for a build phase (docker, checkout, dump, build, shell); may be repeated'
+        )
+        parser.add_argument(
+            '--metrics-dir',
+            metavar='DIR',
+            help='Record metrics in DIR for the Prometheus textfile collector (default: BSP_METRICS_DIR)'
+        )
+        parser.add_argument(
+            '--profile',
+            nargs='?',
+            const='bsp.pstats',
+            metavar='FILE',
+            help='Profile the command with cProfile and write the statistics to FILE (default: bsp.pstats)'
+        )
+        parser.add_argument(
+            '--trace',
+            metavar='FILE',
+            help='Record the command, its phases and child processes as a Chrome trace (open in Perfetto)'
+        )
         
         # Create subparsers for different commands
         subparsers = parser.add_subparsers(dest='command', help='Command to execute', required=True)
@@ -1877,20 +9546,88 @@ def main() -> int:
         )
         build_parser.add_argument(
             '--clean',
-            action='store_true',
-            help='Clean before building'
+            nargs='?',
+            const='tmp',
+            choices=['tmp', 'changed', 'all'],
+            help='Clean before building: tmp removes BitBake TMPDIR (default), changed runs cleansstate '
+                 'for recipes of layers whose checkout changed, all removes the whole build path'
         )
         build_parser.add_argument(
             '--checkout',
             action='store_true',
             help='Checkout and validate build configuration without building (fast)'
         )
+        build_parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Build even if the BSP fingerprint shows it is up to date'
+        )
+        build_parser.add_argument(
+            '--shared-layers',
+            action='store_true',
+            help='Use pinned layer repositories from the shared layer store'
+        )
 
         # List command
         subparsers.add_parser('list', help='List available BSPs')
 
-        # List containers command
-        subparsers.add_parser('containers', help='List available containers')
+        # Containers command (lists containers without a subcommand)
+        containers_parser = subparsers.add_parser('containers', help='List or build available containers')
+        containers_subparsers = containers_parser.add_subparsers(dest='containers_command')
+        containers_subparsers.add_parser('list', help='List available containers')
+        containers_build_parser = containers_subparsers.add_parser(
+            'build', help='Build container images concurrently with a shared BuildKit cache')
+        containers_build_parser.add_argument(
+            'container_names',
+            nargs='*',
+            help='Names of the containers to build'
+        )
+        containers_build_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Build every image referenced by the registry'
+        )
+        containers_build_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='Number of images built in parallel (default: all)'
+        )
+        containers_build_parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Rebuild images whose fingerprint label is up to date'
+        )
+        containers_save_parser = containers_subparsers.add_parser(
+            'save', help='Export container images into compressed bundles for offline workers')
+        containers_save_parser.add_argument(
+            'container_names',
+            nargs='*',
+            help='Names of the containers to save'
+        )
+        containers_save_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Save every image referenced by the registry'
+        )
+        containers_load_parser = containers_subparsers.add_parser(
+            'load', help='Load container images missing locally from compressed bundles')
+        containers_load_parser.add_argument(
+            'container_names',
+            nargs='*',
+            help='Names of the containers to load (default: all bundled images)'
+        )
+        for bundle_parser in (containers_save_parser, containers_load_parser):
+            bundle_parser.add_argument(
+                '--dir',
+                type=str,
+                dest='bundle_dir',
+                help='Bundle directory (default: images below the cache root)'
+            )
+            bundle_parser.add_argument(
+                '--jobs', '-j',
+                type=int,
+                help='Number of images processed in parallel (default: all)'
+            )
 
         # Export command
         export_parser = subparsers.add_parser('export', help='Export BSP configuration')
@@ -1918,6 +9655,453 @@ def main() -> int:
             dest='shell_command',
             help='Command to execute in shell (optional, if not provided starts interactive shell)'
         )
+        shell_parser.add_argument(
+            '--shared-layers',
+            action='store_true',
+            help='Use pinned layer repositories from the shared layer store'
+        )
+
+        # Artifacts command
+        artifacts_parser = subparsers.add_parser('artifacts', help='Manage the deploy artifact store')
+        artifacts_subparsers = artifacts_parser.add_subparsers(dest='artifacts_command', required=True)
+        collect_parser = artifacts_subparsers.add_parser(
+            'collect', help='Store deploy artifacts of BSPs and deduplicate them with links')
+        collect_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs to collect'
+        )
+        collect_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Collect artifacts of all BSPs in the registry'
+        )
+        collect_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='Number of parallel hashing workers (default: CPU count)'
+        )
+        gc_parser = artifacts_subparsers.add_parser(
+            'gc', help='Remove old manifests and unreferenced objects')
+        gc_parser.add_argument(
+            '--keep',
+            type=int,
+            default=3,
+            help='Number of manifests to keep per BSP (default: 3)'
+        )
+
+        # Layers command
+        layers_parser = subparsers.add_parser('layers', help='Manage the shared layer store')
+        layers_subparsers = layers_parser.add_subparsers(dest='layers_command', required=True)
+        sync_parser = layers_subparsers.add_parser(
+            'sync', help='Fetch and check out the pinned layers of BSPs into the shared layer store')
+        sync_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs whose layers are prepared'
+        )
+        sync_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Prepare the layers of all BSPs in the registry'
+        )
+        sync_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='Number of repositories prepared in parallel (default: 8)'
+        )
+
+        # Patches command
+        patches_parser = subparsers.add_parser('patches', help='Verify patches referenced by BSPs')
+        patches_subparsers = patches_parser.add_subparsers(dest='patches_command', required=True)
+        check_parser = patches_subparsers.add_parser(
+            'check', help='Check that patches apply to their repositories at the configured refs')
+        check_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs whose patches are checked'
+        )
+        check_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Check the patches of all BSPs in the registry'
+        )
+        check_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='Number of patch series checked in parallel (default: CPU count)'
+        )
+
+        # Offline check command
+        offline_parser = subparsers.add_parser(
+            'offline-check', help='Verify that DL_DIR holds every download needed to build BSPs offline')
+        offline_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs to check'
+        )
+        offline_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Check all BSPs in the registry'
+        )
+        offline_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=2,
+            help='Number of BSPs whose sources are listed in parallel (default: 2)'
+        )
+        offline_parser.add_argument(
+            '--refresh',
+            action='store_true',
+            help='List the sources again even if the build inputs did not change'
+        )
+
+        # Metrics command
+        metrics_parser = subparsers.add_parser('metrics', help='Export build and cache metrics for Prometheus')
+        metrics_subparsers = metrics_parser.add_subparsers(dest='metrics_command', required=True)
+        metrics_subparsers.add_parser('write', help='Measure the caches and write the metrics file now')
+        metrics_serve_parser = metrics_subparsers.add_parser('serve', help='Serve the metrics over HTTP')
+        metrics_serve_parser.add_argument(
+            '--host',
+            default='0.0.0.0',
+            help='Address to listen on (default: 0.0.0.0)'
+        )
+        metrics_serve_parser.add_argument(
+            '--port',
+            type=int,
+            default=9464,
+            help='Port to listen on (default: 9464)'
+        )
+        metrics_serve_parser.add_argument(
+            '--interval',
+            type=float,
+            default=60.0,
+            help='Seconds between cache measurements (default: 60)'
+        )
+
+        # Disk usage command
+        du_parser = subparsers.add_parser('du', help='Show the disk usage of BSP build paths')
+        du_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs'
+        )
+        du_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Show all BSPs in the registry and build directories no BSP uses'
+        )
+        du_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=16,
+            help='Number of threads listing directories (default: 16)'
+        )
+        du_parser.add_argument(
+            '--refresh',
+            action='store_true',
+            help='List every directory again instead of reusing unchanged ones'
+        )
+        du_parser.add_argument(
+            '--idle-days',
+            type=int,
+            default=30,
+            help='Suggest cleaning build paths unchanged for this many days (default: 30)'
+        )
+
+        # Downloads command
+        downloads_parser = subparsers.add_parser('downloads', help='Inspect and clean up the download directory')
+        downloads_subparsers = downloads_parser.add_subparsers(dest='downloads_command', required=True)
+        downloads_check_parser = downloads_subparsers.add_parser(
+            'check', help='Find partial downloads, orphaned .done markers, stale locks and corrupt downloads')
+        downloads_check_parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Compare downloads with the checksums recorded in their .done markers'
+        )
+        downloads_check_parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Remove the reported entries'
+        )
+        downloads_check_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='Number of hashing processes (default: CPU count)'
+        )
+        dedup_parser = downloads_subparsers.add_parser(
+            'dedup', help='Find downloads stored several times under different names')
+        dedup_parser.add_argument(
+            '--link',
+            action='store_true',
+            help='Replace the copies by hardlinks'
+        )
+        dedup_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='Number of hashing processes (default: CPU count)'
+        )
+        usage_parser = downloads_subparsers.add_parser(
+            'usage', help='Show the download directory usage of BSPs')
+        usage_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs'
+        )
+        usage_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Show all BSPs in the registry'
+        )
+        usage_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=2,
+            help='Number of BSPs whose sources are listed in parallel (default: 2)'
+        )
+
+        # Lock command
+        lock_parser = subparsers.add_parser('lock', help='Pin floating repository refs of BSPs in KAS lock files')
+        lock_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs to lock'
+        )
+        lock_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Lock all BSPs in the registry'
+        )
+        lock_parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Report lock files that are missing or out of date without changing them'
+        )
+        lock_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='Number of repositories resolved in parallel (default: CPU count)'
+        )
+
+        # Sstate command
+        sstate_parser = subparsers.add_parser('sstate', help='Share the sstate cache between build workers')
+        sstate_subparsers = sstate_parser.add_subparsers(dest='sstate_command', required=True)
+        serve_parser = sstate_subparsers.add_parser('serve', help='Serve the local SSTATE_DIR over HTTP')
+        serve_parser.add_argument(
+            '--bind',
+            type=str,
+            default='127.0.0.1',
+            help='Address to listen on (default: 127.0.0.1; other workers need e.g. 0.0.0.0)'
+        )
+        serve_parser.add_argument(
+            '--port',
+            type=int,
+            default=8000,
+            help='Port to listen on (default: 8000)'
+        )
+        serve_parser.add_argument(
+            '--allow-upload',
+            action='store_true',
+            help='Accept sstate objects pushed by other workers (requires SSTATE_UPLOAD_TOKEN '
+                 'unless listening on a loopback address)'
+        )
+        serve_parser.add_argument(
+            '--dir',
+            type=str,
+            dest='sstate_dir',
+            help='Directory to serve (default: SSTATE_DIR)'
+        )
+        push_parser = sstate_subparsers.add_parser('push', help='Upload new local sstate objects to a mirror')
+        push_parser.add_argument(
+            '--url',
+            type=str,
+            help='Mirror URL (default: SSTATE_MIRROR_URL)'
+        )
+        push_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='Number of parallel uploads (default: 8)'
+        )
+
+        # Hash equivalence server command
+        hashserv_parser = subparsers.add_parser('hashserv', help='Manage the shared hash equivalence server')
+        hashserv_parser.add_argument(
+            'action',
+            choices=['start', 'stop', 'status'],
+            help='Start, stop or show the server and its unihash statistics'
+        )
+
+        # Plan command
+        plan_parser = subparsers.add_parser('plan', help='Show the execution plan and estimated duration of BSP builds')
+        plan_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs to plan'
+        )
+        plan_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Plan all BSPs in the registry'
+        )
+        plan_parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=1,
+            help='Number of steps run in parallel (default: 1)'
+        )
+        plan_parser.add_argument(
+            '--shared-layers',
+            action='store_true',
+            help='Plan builds using the shared layer store'
+        )
+        plan_parser.add_argument(
+            '--format',
+            choices=['text', 'json', 'dot'],
+            default='text',
+            help='Output format (default: text)'
+        )
+        plan_parser.add_argument(
+            '--output', '-o',
+            type=str,
+            help='Output file path (default: stdout)'
+        )
+
+        # Hosts command
+        hosts_parser = subparsers.add_parser('hosts', help='Inspect build hosts for distributed builds')
+        hosts_subparsers = hosts_parser.add_subparsers(dest='hosts_command', required=True)
+        hosts_subparsers.add_parser('list', help='List configured build hosts')
+        probe_parser = hosts_subparsers.add_parser(
+            'probe', help='Report the build and cache state of this host')
+        probe_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs to report (default: all)'
+        )
+        probe_parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Print machine readable JSON'
+        )
+        assign_parser = hosts_subparsers.add_parser(
+            'assign', help='Place BSP builds on build hosts by cache affinity')
+        assign_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs to place'
+        )
+        assign_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Place all BSPs in the registry'
+        )
+        assign_parser.add_argument(
+            '--output', '-o',
+            type=str,
+            help='Write the BSP to worker mapping as JSON (read by the Buildbot master)'
+        )
+
+        # Dispatch command
+        dispatch_parser = subparsers.add_parser('dispatch', help='Build BSPs on the configured build hosts')
+        dispatch_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs to build'
+        )
+        dispatch_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Build all BSPs in the registry'
+        )
+        dispatch_parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Rebuild BSPs that are up to date on their host'
+        )
+        dispatch_parser.add_argument(
+            '--fetch-artifacts',
+            type=str,
+            metavar='DIR',
+            help='Copy deploy images of successful builds to DIR/<bsp>'
+        )
+        dispatch_parser.add_argument(
+            '--report',
+            type=str,
+            metavar='FILE',
+            help='Write a JSON report with placement, duration and failure triage of each build'
+        )
+
+        # Watch command
+        watch_parser = subparsers.add_parser('watch', help='Revalidate the KAS configuration of BSPs on every change')
+        watch_parser.add_argument(
+            'bsp_names',
+            nargs='*',
+            help='Names of the BSPs to watch'
+        )
+        watch_parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Watch all BSPs in the registry'
+        )
+        watch_parser.add_argument(
+            '--checkout',
+            action='store_true',
+            help='Check out affected BSPs once their configuration is valid'
+        )
+        watch_parser.add_argument(
+            '--debounce',
+            type=float,
+            default=2.0,
+            metavar='SECONDS',
+            help='Quiet period before a checkout starts (default: 2)'
+        )
+
+        # Logs command
+        logs_parser = subparsers.add_parser('logs', help='Inspect archived build logs of a BSP')
+        logs_parser.add_argument(
+            'bsp_name',
+            type=str,
+            help='Name of the BSP'
+        )
+        logs_parser.add_argument(
+            '--log',
+            type=str,
+            dest='log_name',
+            help='Log file name or prefix (default: most recent log)'
+        )
+        logs_parser.add_argument(
+            '--errors',
+            action='store_true',
+            help='Show ERROR lines and failed tasks'
+        )
+        logs_parser.add_argument(
+            '--warnings',
+            action='store_true',
+            help='Show WARNING lines'
+        )
+        logs_parser.add_argument(
+            '--tasks',
+            action='store_true',
+            help='Show started and failed tasks'
+        )
+        logs_parser.add_argument(
+            '--context', '-C',
+            type=int,
+            default=0,
+            help='Number of context lines around each shown line'
+        )
+        logs_parser.add_argument(
+            '--all',
+            action='store_true',
+            dest='show_all',
+            help='Print the complete log'
+        )
+        logs_parser.add_argument(
+            '--prune',
+            type=int,
+            metavar='KEEP',
+            help='Remove old logs, keeping the KEEP most recent ones'
+        )
 
         args = parser.parse_args()
 
@@ -1925,7 +10109,11 @@ def main() -> int:
         log_level = logging.DEBUG if args.verbose else logging.INFO
 
         # Setup logging colors
-        if args.no_color or not COLORAMA_AVAILABLE:
+        if args.log_format == 'json':
+            handler = logging.StreamHandler()
+            handler.setFormatter(JsonFormatter())
+            logging.basicConfig(level=log_level, handlers=[handler])
+        elif args.no_color or not COLORAMA_AVAILABLE:
             logging.basicConfig(
                 level=log_level,
                 format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -1938,18 +10126,43 @@ def main() -> int:
                 '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
             ))
 
+        if args.trace:
+            tracer.start(origin=start)
+        if args.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        # Command completion events are shown in text output only when verbose
+        if args.log_format == 'text' and not args.verbose:
+            process_log.setLevel(logging.WARNING)
+
         # Initialize and run BSP manager
         bsp_mgr = BspManager(args.registry)
+        bsp_mgr.timeouts = parse_phase_timeouts(args.timeout)
         bsp_mgr.initialize()
+        metrics_dir = args.metrics_dir or (bsp_mgr.env_manager.get_value('BSP_METRICS_DIR')
+                                           if bsp_mgr.env_manager else None)
+        if metrics_dir:
+            metrics.start(metrics_dir)
 
         # Execute requested command
         if args.command == 'build':
             checkout_only = getattr(args, 'checkout', False)
-            bsp_mgr.build_bsp(args.bsp_name, checkout_only=checkout_only)
+            bsp_mgr.build_bsp(args.bsp_name, checkout_only=checkout_only, force=args.force,
+                              shared_layers=args.shared_layers, clean=args.clean)
         elif args.command == 'list':
             bsp_mgr.list_bsp()
         elif args.command == 'containers':
-            bsp_mgr.list_containers()
+            if args.containers_command == 'build':
+                bsp_mgr.build_containers(args.container_names, select_all=args.all,
+                                         jobs=args.jobs, force=args.force)
+            elif args.containers_command == 'save':
+                bsp_mgr.save_containers(args.container_names, select_all=args.all,
+                                        directory=args.bundle_dir, jobs=args.jobs)
+            elif args.containers_command == 'load':
+                bsp_mgr.load_containers(args.container_names, directory=args.bundle_dir, jobs=args.jobs)
+            else:
+                bsp_mgr.list_containers()
         elif args.command == 'export':
             bsp_mgr.export_bsp_config(
                 bsp_name=args.bsp_name,
@@ -1960,7 +10173,91 @@ def main() -> int:
             shell_command = getattr(args, 'shell_command', None)
             bsp_mgr.shell_into_bsp(
                 bsp_name=args.bsp_name,
-                command=shell_command
+                command=shell_command,
+                shared_layers=args.shared_layers
+            )
+        elif args.command == 'artifacts':
+            if args.artifacts_command == 'collect':
+                bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+                bsp_mgr.collect_artifacts(bsp_names, jobs=args.jobs)
+            elif args.artifacts_command == 'gc':
+                bsp_mgr.gc_artifacts(keep=args.keep)
+        elif args.command == 'layers':
+            if args.layers_command == 'sync':
+                bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+                bsp_mgr.sync_layers(bsp_names, jobs=args.jobs)
+        elif args.command == 'patches':
+            if args.patches_command == 'check':
+                bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+                bsp_mgr.check_patches(bsp_names, jobs=args.jobs)
+        elif args.command == 'offline-check':
+            bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+            bsp_mgr.offline_check(bsp_names, jobs=args.jobs, refresh=args.refresh)
+        elif args.command == 'metrics':
+            if args.metrics_command == 'write':
+                if not metrics.enabled:
+                    logging.error("No metrics directory configured (set BSP_METRICS_DIR or use --metrics-dir)")
+                    return 1
+                bsp_mgr.record_cache_metrics(max_age=0)
+            elif args.metrics_command == 'serve':
+                bsp_mgr.serve_metrics(host=args.host, port=args.port, interval=args.interval)
+        elif args.command == 'du':
+            bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+            bsp_mgr.disk_usage(bsp_names, jobs=args.jobs, refresh=args.refresh, unused=args.all,
+                               idle_days=args.idle_days)
+        elif args.command == 'downloads':
+            if args.downloads_command == 'check':
+                bsp_mgr.check_downloads(verify=args.verify, fix=args.fix, jobs=args.jobs)
+            elif args.downloads_command == 'dedup':
+                bsp_mgr.dedup_downloads(link=args.link, jobs=args.jobs)
+            elif args.downloads_command == 'usage':
+                bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+                bsp_mgr.downloads_usage(bsp_names, jobs=args.jobs)
+        elif args.command == 'lock':
+            bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+            bsp_mgr.lock_bsps(bsp_names, check=args.check, jobs=args.jobs)
+        elif args.command == 'sstate':
+            if args.sstate_command == 'serve':
+                bsp_mgr.serve_sstate(host=args.bind, port=args.port, allow_upload=args.allow_upload,
+                                     directory=args.sstate_dir)
+            elif args.sstate_command == 'push':
+                bsp_mgr.push_sstate(url=args.url, jobs=args.jobs)
+        elif args.command == 'hashserv':
+            bsp_mgr.manage_hashserv(args.action)
+        elif args.command == 'plan':
+            bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+            bsp_mgr.plan_builds(bsp_names, jobs=args.jobs, shared_layers=args.shared_layers,
+                                output_format=args.format, output_file=args.output)
+        elif args.command == 'hosts':
+            if args.hosts_command == 'list':
+                bsp_mgr.list_hosts()
+            elif args.hosts_command == 'probe':
+                bsp_mgr.probe_host(args.bsp_names, as_json=args.json)
+            elif args.hosts_command == 'assign':
+                bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+                bsp_mgr.assign_hosts(bsp_names, output_file=args.output)
+        elif args.command == 'dispatch':
+            bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+            bsp_mgr.dispatch_builds(bsp_names, force=args.force, fetch_dir=args.fetch_artifacts,
+                                    report_file=args.report)
+        elif args.command == 'watch':
+            bsp_names = bsp_mgr.get_bsp_names(args.bsp_names, args.all)
+            bsp_mgr.watch_bsps(bsp_names, checkout=args.checkout, debounce=args.debounce)
+        elif args.command == 'logs':
+            kinds = []
+            if args.errors:
+                kinds.extend(['error', 'task_failed'])
+            if args.warnings:
+                kinds.append('warning')
+            if args.tasks:
+                kinds.extend(['task_started', 'task_failed'])
+            bsp_mgr.show_logs(
+                bsp_name=args.bsp_name,
+                log_name=args.log_name,
+                kinds=kinds,
+                context=args.context,
+                show_all=args.show_all,
+                prune_keep=args.prune
             )
         else:
             # This should not happen since subparsers are required=True
@@ -1970,6 +10267,7 @@ def main() -> int:
 
         bsp_mgr.cleanup()
         logging.info("Command completed successfully")
+        succeeded = True
         return 0
 
     except KeyboardInterrupt:
@@ -1981,6 +10279,21 @@ def main() -> int:
     except Exception as e:
         logging.error(f"Fatal error: {e}")
         return 1
+    finally:
+        if metrics.enabled:
+            metrics.inc('bsp_command_runs_total', command=args.command, result='success' if succeeded else 'failure')
+            if bsp_mgr:
+                bsp_mgr.record_cache_metrics()
+            metrics.flush(final=True)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info(f"Profile written to {args.profile} (view with: python -m pstats {args.profile})")
+        if tracer.enabled:
+            tracer.complete(f"bsp.py {args.command}", "command", start, time.monotonic() - start,
+                            {"argv": sys.argv[1:]})
+            tracer.write(args.trace)
+            logging.info(f"Trace written to {args.trace} (open in https://ui.perfetto.dev)")
     
 if __name__ == "__main__":
     # Execute main function and exit with proper code
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# bsp.py is a single module in the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,25 @@
+import os
+import stat
+
+import bsp
+
+
+def test_collect_rehashes_files_rewritten_in_place(tmp_path):
+    deploy_dir = tmp_path / "deploy"
+    image = deploy_dir / "images" / "rsb3720" / "core-image.wic"
+    image.parent.mkdir(parents=True)
+    image.write_bytes(b"first")
+    store = bsp.ArtifactStore(str(tmp_path / "artifacts"))
+    store.collect("rsb3720", deploy_dir)
+    first = store.latest_manifest("rsb3720")["files"][0]["sha256"]
+    obj = store.object_path(first)
+    assert os.path.samefile(obj, image)
+    assert not obj.stat().st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+    # Same size and inode, new contents
+    os.chmod(image, 0o644)
+    image.write_bytes(b"other")
+    os.utime(image, ns=(0, obj.stat().st_mtime_ns + 10**9))
+    store.collect("rsb3720", deploy_dir)
+    second = store.latest_manifest("rsb3720")["files"][0]["sha256"]
+    assert second == bsp.file_sha256(image) != first
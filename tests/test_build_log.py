@@ -0,0 +1,31 @@
+import bsp
+
+LINES = [
+    "2024-05-01 10:00:00 - INFO     - kas 4.3 started",
+    "2024-05-01 10:00:01 - ERROR    - Command \"/usr/bin/git fetch\" failed with error 128",
+    "2024-05-01 10:00:01 - WARNING  - Repository meta-freescale has no commit",
+    "2024-05-01 10:00:02 - CRITICAL - Applying patch 0001-fix.patch failed",
+    "2026-10-19 03:16:38,590 - root - ERROR - Invalid registry configuration",
+    "NOTE: recipe busybox-1.36.1-r0: task do_compile: Started",
+    "ERROR: busybox-1.36.1-r0 do_compile: oe_runmake failed",
+    "NOTE: recipe busybox-1.36.1-r0: task do_compile: Failed",
+    "WARNING: busybox-1.36.1-r0 do_package_qa: QA Issue: ldflags",
+    "NOTE: Tasks Summary: Attempted 4120 tasks of which 4080 didn't need to be rerun and 1 failed.",
+    "2024-05-01 10:00:03 - INFO     - ERROR and WARNING in a message are not markers",
+]
+
+
+def test_marks_of_kas_and_bitbake_lines(tmp_path):
+    log_path = tmp_path / "build.log.gz"
+    writer = bsp.BuildLogWriter(log_path, bsp.FrameCodec("gzip"))
+    for line in LINES:
+        writer.handle(line)
+    writer.close()
+
+    reader = bsp.BuildLogReader(log_path)
+    assert [(mark.kind, mark.line) for mark in reader.marks] == [
+        ("error", 1), ("warning", 2), ("error", 3), ("error", 4),
+        ("task_started", 5), ("error", 6), ("task_failed", 7), ("warning", 8),
+    ]
+    assert reader.marks[0].text == LINES[1]
+    assert reader.get_lines(0, len(LINES) - 1) == LINES
@@ -0,0 +1,136 @@
+import json
+import sys
+import textwrap
+
+import pytest
+
+import bsp
+
+GiB = 2**30
+
+
+def make_bsp(name, container="debian-12"):
+    return bsp.BSP(name=name, description=name,
+                   build=bsp.BuildSetup(path=f"build/{name}", environment=bsp.BuildEnvironment(container=container),
+                                        docker=None, configuration=[f"{name}.yaml"]))
+
+
+def probe(built=(), release="scarthgap", images=None, free_bytes=500 * GiB):
+    return {"free_bytes": free_bytes, "images": images or {},
+            "bsps": {name: {"built": True, "release": release} for name in built}}
+
+
+@pytest.fixture
+def dispatcher():
+    return bsp.BuildDispatcher([bsp.BuildHost(name="a"), bsp.BuildHost(name="b")])
+
+
+def placement(assignments):
+    return {assignment.bsp: (assignment.host, assignment.reasons) for assignment in assignments}
+
+
+def test_assign_prefers_previous_build(dispatcher):
+    bsps = [make_bsp("adv-bsp-oenxp-scarthgap-rsb3720")]
+    probes = {"a": probe(), "b": probe(built=["adv-bsp-oenxp-scarthgap-rsb3720"])}
+    assert placement(dispatcher.assign(bsps, probes, {})) == {"adv-bsp-oenxp-scarthgap-rsb3720": ("b", ["built"])}
+
+
+def test_assign_release_and_image_affinity(dispatcher):
+    bsps = [make_bsp("adv-bsp-oenxp-scarthgap-rsb3720"), make_bsp("adv-bsp-oenxp-walnascar-rsb3720")]
+    probes = {
+        "a": probe(built=["adv-bsp-oenxp-scarthgap-aom5521a1", "adv-bsp-oenxp-scarthgap-rom2620"]),
+        "b": probe(images={"debian-12": "fp"}),
+    }
+    fingerprints = {"adv-bsp-oenxp-scarthgap-rsb3720": "other", "adv-bsp-oenxp-walnascar-rsb3720": "fp"}
+    assignments = dispatcher.assign(bsps, probes, fingerprints)
+    assert placement(assignments) == {
+        "adv-bsp-oenxp-scarthgap-rsb3720": ("a", ["release:2"]),
+        "adv-bsp-oenxp-walnascar-rsb3720": ("b", ["image"]),
+    }
+    assert [assignment.score for assignment in assignments] == [2 * bsp.BuildDispatcher.RELEASE_SCORE,
+                                                                bsp.BuildDispatcher.IMAGE_SCORE]
+
+
+def test_assign_balances_load_and_avoids_low_disk(dispatcher):
+    bsps = [make_bsp(f"adv-bsp-oenxp-scarthgap-board{number}") for number in range(3)]
+    probes = {"a": probe(), "b": probe()}
+    hosts = [assignment.host for assignment in dispatcher.assign(bsps, probes, {})]
+    # The first build is placed on a; the release affinity of a is then outweighed by its load
+    assert hosts == ["a", "b", "a"]
+
+    probes = {"a": probe(free_bytes=10 * GiB), "b": probe()}
+    assert placement(dispatcher.assign(bsps[:1], probes, {})) == {bsps[0].name: ("b", [])}
+    # Low disk cancels a previous build, so a cached image elsewhere wins
+    probes = {"a": probe(built=[bsps[0].name], free_bytes=10 * GiB), "b": probe(images={"debian-12": "fp"})}
+    assert placement(dispatcher.assign(bsps[:1], probes, {bsps[0].name: "fp"})) == {bsps[0].name: ("b", ["image"])}
+
+
+def test_assign_without_hosts(dispatcher):
+    with pytest.raises(SystemExit):
+        dispatcher.assign([make_bsp("adv-bsp-oenxp-scarthgap-rsb3720")], {}, {})
+
+
+STUB = '''\
+import json, sys
+
+# bsp.py --no-color --registry <file> <command...>
+assert sys.argv[1:3] == ["--no-color", "--registry"], sys.argv
+command = sys.argv[4:]
+if command[:2] == ["hosts", "probe"]:
+    print(json.dumps({"free_bytes": 500 * 2**30, "images": {}, "bsps": {
+        "adv-bsp-oenxp-scarthgap-good": {"built": True, "release": "scarthgap", "fingerprint": "f00d"},
+        "adv-bsp-oenxp-scarthgap-bad": {"built": False, "release": "scarthgap",
+                                        "failure": {"causes": ["do_compile failed"]}},
+    }}))
+elif command[0] == "build":
+    print(f"building {command[1]}")
+    if "bad" in command[1]:
+        print("ERROR: do_compile failed", file=sys.stderr)
+        sys.exit(3)
+'''
+
+
+def test_dispatch_to_local_host(tmp_path, monkeypatch):
+    host_dir = tmp_path / "host"
+    host_dir.mkdir()
+    (host_dir / "bsp.py").write_text(STUB)
+    registry = tmp_path / "bsp-registry.yml"
+    registry.write_text(textwrap.dedent(f"""\
+        specification:
+          version: "2.0"
+        containers:
+          - debian-12:
+              image: "test/debian-12"
+        hosts:
+          - name: local
+            path: {host_dir}
+            python: {sys.executable}
+            jobs: 2
+        registry:
+          bsp:
+        """) + "".join(textwrap.indent(textwrap.dedent(f"""\
+            - name: adv-bsp-oenxp-scarthgap-{name}
+              description: {name}
+              build:
+                path: build/{name}
+                environment:
+                  container: debian-12
+                configuration:
+                  - {name}.yaml
+            """), "    ") for name in ("good", "bad")))
+    monkeypatch.chdir(tmp_path)
+    manager = bsp.BspManager(str(registry))
+    manager.load_configuration()
+
+    report = tmp_path / "report.json"
+    with pytest.raises(SystemExit) as exit_info:
+        manager.dispatch_builds(["adv-bsp-oenxp-scarthgap-good", "adv-bsp-oenxp-scarthgap-bad"],
+                                report_file=str(report))
+    assert exit_info.value.code == 1
+
+    builds = {entry["bsp"]: entry for entry in json.loads(report.read_text())["builds"]}
+    good = builds["adv-bsp-oenxp-scarthgap-good"]
+    bad = builds["adv-bsp-oenxp-scarthgap-bad"]
+    assert (good["host"], good["ok"], good["returncode"], good["fingerprint"]) == ("local", True, 0, "f00d")
+    assert good["failure"] is None
+    assert (bad["ok"], bad["returncode"], bad["failure"]) == (False, 3, {"causes": ["do_compile failed"]})
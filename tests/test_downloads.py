@@ -0,0 +1,29 @@
+import hashlib
+import pickle
+
+import bsp
+
+
+def add_download(dl_dir, name, content, recorded=None):
+    """Write a download and the .done marker the BitBake fetcher leaves after verify_checksum."""
+    (dl_dir / name).write_bytes(content)
+    checksums = {
+        "md5": hashlib.md5(content).hexdigest(),
+        "sha256": recorded or hashlib.sha256(content).hexdigest(),
+    }
+    with open(dl_dir / f"{name}.done", "wb") as f:
+        pickle.dump(checksums, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def test_verify_compares_fetcher_checksums(tmp_path):
+    dl_dir = tmp_path / "downloads"
+    dl_dir.mkdir()
+    add_download(dl_dir, "good-1.0.tar.gz", b"good")
+    add_download(dl_dir, "bad-1.0.tar.gz", b"truncated", recorded=hashlib.sha256(b"original").hexdigest())
+
+    index = bsp.DownloadsIndex(dl_dir, tmp_path / "index.json")
+    index.refresh()
+    assert index.done_checksums("good-1.0.tar.gz")["sha256"] == hashlib.sha256(b"good").hexdigest()
+
+    problems = index.find_problems(verify=True, jobs=1)
+    assert [(kind, path) for kind, path, _ in problems] == [("corrupt", "bad-1.0.tar.gz")]
@@ -0,0 +1,109 @@
+import os
+import sys
+import textwrap
+
+import pytest
+
+import bsp
+
+# Minimal docker CLI: images are files named after their tag below $FAKE_DOCKER_DIR
+FAKE_DOCKER = '''\
+import hashlib, json, os, sys
+
+images = os.environ["FAKE_DOCKER_DIR"]
+args = sys.argv[1:]
+if args[:2] == ["image", "inspect"]:
+    path = os.path.join(images, args[-1].replace("/", "_"))
+    if not os.path.exists(path):
+        print(f"Error: No such image: {args[-1]}", file=sys.stderr)
+        sys.exit(1)
+    data = open(path, "rb").read()
+    print(json.dumps({"Id": "sha256:" + hashlib.sha256(data).hexdigest(), "Size": len(data), "Config": {}}))
+elif args[0] == "save":
+    sys.stdout.buffer.write(open(os.path.join(images, args[1].replace("/", "_")), "rb").read())
+elif args[0] == "load":
+    data = sys.stdin.buffer.read()
+    tag = data.split(b"\\n", 1)[0].decode()
+    open(os.path.join(images, tag.replace("/", "_")), "wb").write(data)
+    print(f"Loaded image: {tag}")
+else:
+    sys.exit(2)
+'''
+
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "docker"
+    script.write_text(f"#!{sys.executable}\n" + FAKE_DOCKER)
+    script.chmod(0o755)
+    images = tmp_path / "images"
+    images.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_DOCKER_DIR", str(images))
+    return images
+
+
+def test_save_and_load_roundtrip(tmp_path, docker):
+    tag = "test/debian-12"
+    # Several chunks of the runner and the compressor
+    content = b"test/debian-12\n" + os.urandom(3 * bsp.ProcessRunner.CHUNK_SIZE + 123)
+    (docker / "test_debian-12").write_bytes(content)
+    store = bsp.ImageBundleStore(str(tmp_path / "bundles"), timeout=60)
+    store.save({tag: bsp.Docker(image=tag, file=None, args=[])})
+
+    entry = store.load_manifest()[tag]
+    assert entry["file"].startswith(entry["id"].split(":")[-1] + ".tar.")
+    assert entry["sha256"] == bsp.file_sha256(store.root / entry["file"])
+
+    (docker / "test_debian-12").unlink()
+    store.load()
+    assert (docker / "test_debian-12").read_bytes() == content
+
+
+def test_load_reports_docker_failure(tmp_path, docker, caplog):
+    tag = "test/debian-12"
+    (docker / "test_debian-12").write_bytes(b"test/debian-12\ndata")
+    store = bsp.ImageBundleStore(str(tmp_path / "bundles"))
+    store.save({tag: bsp.Docker(image=tag, file=None, args=[])})
+    (docker / "test_debian-12").unlink()
+    (tmp_path / "bin" / "docker").write_text(textwrap.dedent(f"""\
+        #!{sys.executable}
+        import sys
+        if sys.argv[1] == "load":
+            sys.stdin.buffer.read(10)
+            print("unexpected EOF", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(1)
+        """))
+    with pytest.raises(SystemExit):
+        store.load()
+    assert "test/debian-12: docker load failed: unexpected EOF" in caplog.text
+
+
+def test_save_times_out(tmp_path, docker, caplog):
+    tag = "test/debian-12"
+    (docker / "test_debian-12").write_bytes(b"test/debian-12\ndata")
+    script = tmp_path / "bin" / "docker"
+    script.write_text(script.read_text().replace('elif args[0] == "save":',
+                                                 'elif args[0] == "save":\n    import time; time.sleep(60)'))
+    store = bsp.ImageBundleStore(str(tmp_path / "bundles"), timeout=0.5)
+    with pytest.raises(SystemExit):
+        store.save({tag: bsp.Docker(image=tag, file=None, args=[])})
+    assert "test/debian-12: docker save test/debian-12 timed out after 0.5s" in caplog.text
+    assert not list(store.root.glob("*.tar.*"))
+
+
+def test_save_keeps_exports_of_other_processes(tmp_path, docker):
+    tag = "test/debian-12"
+    (docker / "test_debian-12").write_bytes(b"test/debian-12\ndata")
+    store = bsp.ImageBundleStore(str(tmp_path / "bundles"))
+    store.root.mkdir()
+    running = store.root / "0123abcd.tar.zst.tmp"
+    running.write_bytes(b"partial")
+    stale = store.root / "0123abcd.tar.gz"
+    stale.write_bytes(b"old")
+    store.save({tag: bsp.Docker(image=tag, file=None, args=[])})
+    assert running.exists()
+    assert not stale.exists()
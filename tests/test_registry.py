@@ -0,0 +1,43 @@
+import textwrap
+
+import bsp
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(textwrap.dedent(content))
+    return path
+
+
+def test_root_with_only_includes(tmp_path):
+    root = write(tmp_path / "bsp-registry.yml", """\
+        specification:
+          version: "2.0"
+        includes:
+          - boards/*.yml
+        """)
+    write(tmp_path / "boards" / "rsb3720.yml", """\
+        registry:
+          bsp:
+            - name: rsb3720
+              description: RSB3720 BSP
+              build:
+                path: build/rsb3720
+                environment:
+                  container: debian-12
+                configuration:
+                  - rsb3720.yaml
+        """)
+    write(tmp_path / "boards" / "empty.yml", "{}\n")
+
+    model = bsp.get_registry_from_yaml_file(root)
+    assert not model.registry.bsp
+    assert model.includes == ["boards/*.yml"]
+
+    manager = bsp.BspManager(str(root))
+    manager.load_configuration()
+    assert manager.registry_index.entries == {
+        "rsb3720": {"file": "boards/rsb3720.yml", "description": "RSB3720 BSP"},
+    }
+    assert not bsp.get_registry_from_yaml_file(tmp_path / "boards" / "empty.yml",
+                                               bsp.RegistryFile).registry.bsp
@@ -0,0 +1,84 @@
+import http.client
+import threading
+
+import pytest
+
+import bsp
+
+OBJECT = "ab/sstate:zlib:core2-64-poky-linux:1.3:r0:core2-64:10:abcdef_populate_sysroot.tar.zst"
+
+
+@pytest.fixture
+def serve(tmp_path):
+    servers = []
+
+    def start(root, **kwargs):
+        server = bsp.SstateServer(str(root), "127.0.0.1", 0, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def request(server, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection(*server.server_address[:2], timeout=10)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        conn.close()
+
+
+def test_server_get_and_refused_requests(tmp_path, serve):
+    root = tmp_path / "sstate"
+    (root / "ab").mkdir(parents=True)
+    (root / OBJECT).write_bytes(b"0123456789")
+    server = serve(root)
+
+    status, headers, body = request(server, "GET", "/" + OBJECT, headers={"Range": "bytes=2-5"})
+    assert (status, body, headers["Content-Range"]) == (206, b"2345", "bytes 2-5/10")
+    assert request(server, "GET", "/ab/sstate:missing.tar.zst")[0] == 404
+    assert request(server, "PUT", "/ab/sstate:new.tar.zst", body=b"x")[0] == 405
+
+    uploads = serve(root, allow_upload=True, upload_token="secret")
+    auth = {"Authorization": "Bearer secret"}
+    assert request(uploads, "PUT", "/ab/other.tar.zst", body=b"x", headers=auth)[0] == 403
+    assert request(uploads, "PUT", "/ab/sstate:new.tar.zst", body=b"x")[0] == 401
+    assert not (root / "ab" / "sstate:new.tar.zst").exists()
+
+
+def test_push_uploads_new_objects(tmp_path, serve):
+    mirror = tmp_path / "mirror"
+    (mirror / "ab").mkdir(parents=True)
+    (mirror / OBJECT).write_bytes(b"already there")
+    server = serve(mirror, allow_upload=True, upload_token="secret")
+
+    local = tmp_path / "local"
+    new = "cd/sstate:busybox:core2-64-poky-linux:1.36:r0:core2-64:10:012345_package.tar.zst"
+    for relative, content in ((OBJECT, b"already there"), (new, b"new object"),
+                              ("cd/sstate:busybox.tar.zst.tmp", b"partial"), ("cd/index", b"other")):
+        (local / relative).parent.mkdir(parents=True, exist_ok=True)
+        (local / relative).write_bytes(content)
+
+    pusher = bsp.SstatePusher(str(local), server.url, token="secret")
+    assert pusher.push(jobs=2) == (2, 1, len(b"new object"))
+    assert (mirror / new).read_bytes() == b"new object"
+    assert not (mirror / "cd" / "sstate:busybox.tar.zst.tmp").exists()
+    # Pushed objects are remembered, a second push checks nothing
+    assert pusher.push() == (0, 0, 0)
+
+    assert bsp.SstatePusher(str(local), server.url).pending() == []
+    (local / "cd" / "sstate:late.tar.zst").write_bytes(b"late")
+    with pytest.raises(bsp.ScriptError, match="401"):
+        bsp.SstatePusher(str(local), server.url).push()
+
+
+def test_mirrors_config():
+    config = bsp.sstate_mirrors_config("http://build-server:8000/")
+    assert config == {"local_conf_header": {"bsp-sstate-mirror":
+                      'SSTATE_MIRRORS += "file://.* http://build-server:8000/PATH;downloadfilename=PATH"\n'}}